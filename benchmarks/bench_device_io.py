@@ -0,0 +1,176 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Benchmark of the device I/O and configuration codec paths, run against the virtual device backend.
+#
+#    PYTHONPATH=. python benchmarks/bench_device_io.py [--latency SECONDS]
+#
+# The default zero latency times only the host side of each operation, give a per-transfer latency to
+# include the time spent waiting on the emulated devices.
+#
+import argparse
+import json
+import logging
+import os
+import timeit
+from pathlib import Path
+
+from python_easy_json import JSONObject
+
+from ultimarc.devices import DeviceClassID, USBDevices
+from ultimarc.devices._device import USBDeviceHandle
+from ultimarc.devices._ultrastik_maps import UltraStikMapCache
+from ultimarc.devices._virtual import VirtualIpac2, VirtualIpac4, VirtualJpac, VirtualMiniPac, VirtualUltimateIO, \
+    VirtualUltraStik, VirtualUSB, VirtualUSBButton
+
+EXAMPLES = Path(__file__).resolve().parents[1] / 'ultimarc/examples'
+
+# Board class id -> virtual device class, example configuration file and a pin to edit.
+PAC_BOARDS = {
+    DeviceClassID.IPAC2: (VirtualIpac2, 'ipac2.json', '1up'),
+    DeviceClassID.IPAC4: (VirtualIpac4, 'ipac4.json', '1up'),
+    DeviceClassID.JPAC: (VirtualJpac, 'jpac.json', '1up'),
+    DeviceClassID.MiniPac: (VirtualMiniPac, 'mini-pac.json', '1up'),
+    DeviceClassID.UltimateIO: (VirtualUltimateIO, 'ultimateIO/ultimate-io-pin.json', '1up'),
+}
+
+
+def load_example(name):
+    with open(EXAMPLES / name) as h:
+        return json.load(h)
+
+
+def bench_enumerate(count, number):
+    """ Time finding 'count' attached devices """
+    devices = [PAC_BOARDS[DeviceClassID.IPAC2][0]() for x in range(count)]
+
+    def enumerate_devices():
+        USBDevices(['d209']).close_all()
+
+    with VirtualUSB(devices):
+        return min(timeit.repeat(enumerate_devices, number=number, repeat=5)) / number
+
+
+def bench_pac_board(dev_h, class_id, number):
+    """ Time the read, decode, encode and write paths of one PAC board """
+    virtual, config_name, pin = PAC_BOARDS[class_id]
+    config_file = str(EXAMPLES / config_name)
+    json_config = load_example(config_name)
+    name = class_id.value
+
+    def read_device():
+        dev_h.invalidate()
+        dev_h.read_device()
+
+    data = dev_h.read_device()
+    # Alternate between two actions so every edit is written to the device.
+    pins = iter([[pin, 'a', '', 'false'], [pin, 'b', '', 'false']] * number * 5)
+
+    tests = {
+        f'{name} read_device': read_device,
+        f'{name} to_json_str': lambda: dev_h.to_json_str(data),
+        f'{name} _create_device_struct_': lambda: dev_h._create_device_struct_(json_config),
+        f'{name} set_config': lambda: dev_h.set_config(config_file, False),
+        f'{name} set_pin': lambda: dev_h.set_pin(next(pins)),
+    }
+    return {key: min(timeit.repeat(func, number=number, repeat=5)) / number for key, func in tests.items()}
+
+
+def bench_ultrastik(dev_h, number):
+    config_file = str(EXAMPLES / 'ultrastik-joy8way.json')
+    maps = UltraStikMapCache(cache_file=False)
+    names = iter(['joy4way', 'joy8way'] * number * 5)
+    tests = {
+        'ultrastik set_config': lambda: dev_h.set_config(config_file),
+        # Alternate between two maps so every switch is sent.
+        'ultrastik switch_map': lambda: dev_h.switch_map(next(names), maps),
+    }
+    return {key: min(timeit.repeat(func, number=number, repeat=5)) / number for key, func in tests.items()}
+
+
+def bench_usb_button(dev_h, number):
+    config = JSONObject(load_example('usb-button-config.json'))
+    data = dev_h.create_message(config)
+    tests = {
+        'usb-button create_message': lambda: dev_h.create_message(config),
+        'usb-button create_json': lambda: dev_h.create_json(data),
+    }
+    return {key: min(timeit.repeat(func, number=number, repeat=5)) / number for key, func in tests.items()}
+
+
+def bench_ultimate_io_leds(dev_h, number):
+    """ Time lighting every LED one command at a time and as LED frames """
+    # Alternate between two frames so every LED changes each time.
+    frames = [bytes(range(96)), bytes(range(100, 196))]
+    panels = iter(frames * number * 5)
+    frame_panels = iter(frames * number * 5)
+    small = [bytearray(frames[0]), bytearray(frames[0])]
+    small[1][:3] = b'\xff\xff\xff'
+    small_panels = iter(small * number * 5)
+
+    def set_leds():
+        for led, value in enumerate(next(panels), 1):
+            dev_h.set_led_intensity(led, value)
+
+    tests = {
+        'ultimate-io 96 set_led_intensity': set_leds,
+        'ultimate-io set_led_frame 96 changed': lambda: dev_h.set_led_frame(next(frame_panels)),
+        'ultimate-io set_led_frame 3 changed': lambda: dev_h.set_led_frame(next(small_panels)),
+    }
+    return {key: min(timeit.repeat(func, number=number, repeat=5)) / number for key, func in tests.items()}
+
+
+def bench_validation(number):
+    """ Time schema validation of each example configuration """
+    results = dict()
+    for config_name, schema in (('ipac2.json', 'ipac2.schema'),
+                                ('ultrastik-joy8way.json', 'ultrastik-config.schema'),
+                                ('usb-button-config.json', 'usb-button-config.schema')):
+        config = load_example(config_name)
+        assert USBDeviceHandle.validate_config(config, schema), f'{config_name} did not validate'
+        results[f'validate {config_name}'] = \
+            min(timeit.repeat(lambda: USBDeviceHandle.validate_config(config, schema), number=number,
+                              repeat=5)) / number
+    return results
+
+
+def run(number=20, latency=0.0):
+    """
+    Time the device I/O and codec operations.
+    :param number: number of calls of each operation.
+    :param latency: per-transfer device latency in seconds.
+    :return: dict of name -> seconds per call.
+    """
+    results = dict()
+    for count in (1, 8, 32):
+        results[f'enumerate {count} devices'] = bench_enumerate(count, number)
+
+    boards = [virtual() for virtual, _name, _pin in PAC_BOARDS.values()]
+    with VirtualUSB(boards + [VirtualUltraStik(), VirtualUSBButton()], latency=latency):
+        devices = USBDevices(['d209'])
+        try:
+            for class_id in PAC_BOARDS:
+                with next(devices.filter(class_id=class_id)) as dev_h:
+                    results.update(bench_pac_board(dev_h, class_id, number))
+            with next(devices.filter(class_id=DeviceClassID.UltimateIO)) as dev_h:
+                results.update(bench_ultimate_io_leds(dev_h, number))
+            with next(devices.filter(class_id=DeviceClassID.UltraStik)) as dev_h:
+                results.update(bench_ultrastik(dev_h, number))
+            with next(devices.filter(class_id=DeviceClassID.USBButton)) as dev_h:
+                results.update(bench_usb_button(dev_h, number * 10))
+        finally:
+            devices.close_all()
+
+    results.update(bench_validation(number * 10))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=os.path.basename(__file__))
+    parser.add_argument('--latency', type=float, default=0.0, help='per-transfer device latency in seconds')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    for key, secs in run(latency=args.latency).items():
+        print(f'{key:>40}: {secs * 1e6:10.2f} us')
@@ -0,0 +1,61 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Micro-benchmark of the key mapping reverse lookups used when decoding device configurations.
+#
+#    PYTHONPATH=. python benchmarks/bench_mappings.py
+#
+import timeit
+
+from ultimarc.devices._mappings import IPACSeriesMapping, IPACSeriesDebounce, get_ipac_series_mapping_key, \
+    get_ipac_series_debounce_key
+
+# One full PAC configuration is 252 bytes, decode every byte value in a similar sized pass.
+_VALUES = [v & 0xff for v in range(252)]
+
+
+def linear_mapping_key(val):
+    """ The previous implementation, a scan over the mapping dict. """
+    for key, value in IPACSeriesMapping.items():
+        if val == value:
+            return key
+    return None
+
+
+def linear_debounce_key(val):
+    for key, value in IPACSeriesDebounce.items():
+        if val == value:
+            return key
+    return 'standard'
+
+
+def decode_linear():
+    for val in _VALUES:
+        linear_mapping_key(val)
+        linear_debounce_key(val & 0x3)
+
+
+def decode_table():
+    for val in _VALUES:
+        get_ipac_series_mapping_key(val)
+        get_ipac_series_debounce_key(val & 0x3)
+
+
+def run(number=2000):
+    """
+    Time both decoders.
+    :param number: number of passes over the values.
+    :return: dict of name -> seconds per pass.
+    """
+    results = dict()
+    for name, func in (('linear', decode_linear), ('table', decode_table)):
+        results[name] = min(timeit.repeat(func, number=number, repeat=5)) / number
+    return results
+
+
+if __name__ == '__main__':
+    res = run()
+    for name, secs in res.items():
+        print(f'{name:>8}: {secs * 1e6:8.2f} us per 252 byte decode')
+    print(f' speedup: {res["linear"] / res["table"]:.1f}x')
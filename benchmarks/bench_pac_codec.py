@@ -0,0 +1,198 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Benchmark of the shared PAC configuration codec against the previous per-board IPAC2 code.
+#
+#    PYTHONPATH=. python benchmarks/bench_pac_codec.py
+#
+import json
+import logging
+import timeit
+from pathlib import Path
+
+from python_easy_json import JSONObject
+
+from ultimarc.devices._macros import tokenize_macros
+from ultimarc.devices._mappings import IPACSeriesMapping, IPACSeriesDebounce, get_ipac_series_debounce_key, \
+    get_ipac_series_macro_mapping_index, get_ipac_series_mapping_key
+from ultimarc.devices._structures import PacConfigUnion, PacStruct
+from ultimarc.devices.ipac2 import Ipac2Device, PinMapping
+
+CONFIG_FILE = Path(__file__).resolve().parents[1] / 'ultimarc/examples/ipac2.json'
+
+MACRO_MAX_COUNT = 30
+MACRO_MAX_SIZE = 85
+MACRO_START_INDEX = 166
+
+
+def legacy_create_macro_array(pac_struct):
+    """ Ipac2Device._create_macro_array_() before the shared codec. """
+    macros = []
+    macro_start = 0xe0
+    macro_index = 1
+
+    y = 0
+    for x in range(MACRO_START_INDEX, len(pac_struct.bytes)):
+        if x >= y:
+            macro = {}
+            if pac_struct.bytes[x]:
+                if pac_struct.bytes[x] == macro_start:
+                    macro['name'] = f'#{macro_index}'
+                    macro_start += 1
+                    macro_index += 1
+
+                    action = []
+                    for y in range(x + 1, len(pac_struct.bytes)):
+                        if pac_struct.bytes[y] and pac_struct.bytes[y] != macro_start:
+                            action.append(get_ipac_series_mapping_key(pac_struct.bytes[y]))
+                        else:
+                            macro['action'] = action
+                            macros.append(macro)
+                            break
+            else:
+                break
+    return macros
+
+
+def legacy_decode(pac_struct):
+    """ Ipac2Device.to_json_str() before the shared codec, without schema validation. """
+    json_obj = {'schemaVersion': 2.0, 'resourceType': 'ipac2-pins', 'deviceClass': 'ipac2'}
+
+    header = PacConfigUnion()
+    header.asByte = pac_struct.header.byte_4
+    json_obj['debounce'] = get_ipac_series_debounce_key(header.config.debounce)
+    json_obj['paclink'] = True if header.config.paclink == 0x01 else False
+
+    macros = legacy_create_macro_array(pac_struct)
+    if len(macros):
+        json_obj['macros'] = macros
+
+    pins = []
+    for key in PinMapping:
+        action_index, alternate_action_index, shift_index = PinMapping[key]
+        pin = {}
+        if pac_struct.bytes[action_index]:
+            pin['name'] = key
+            pin['action'] = get_ipac_series_mapping_key(pac_struct.bytes[action_index])
+            if pin['action'] is None:
+                mi = get_ipac_series_macro_mapping_index(pac_struct.bytes[action_index])
+                if mi is not None:
+                    pin['action'] = macros[mi]['name']
+            if pac_struct.bytes[alternate_action_index]:
+                alt_action = get_ipac_series_mapping_key(pac_struct.bytes[alternate_action_index])
+                if alt_action is None:
+                    mi = get_ipac_series_macro_mapping_index(pac_struct.bytes[alternate_action_index])
+                    if mi is not None:
+                        pin['alternate_action'] = macros[mi]['name']
+                else:
+                    pin['alternate_action'] = alt_action
+            if pac_struct.bytes[shift_index] == 0x41:
+                pin['shift'] = True
+            pins.append(pin)
+    json_obj['pins'] = pins
+    return json_obj
+
+
+def legacy_encode(json_config):
+    """ Ipac2Device._create_device_struct_() before the shared codec, without schema validation. """
+    data = PacStruct()
+    config = JSONObject(json_config)
+
+    for x in range(1, 16):
+        data.bytes[x] = 0xff
+    data.bytes[48] = 0xff
+    data.bytes[49] = 0xff
+    data.bytes[100] = 0x01
+    for x in range(116, 148):
+        data.bytes[x] = 0x01 if x != 130 else 0
+    for x in range(155, 163):
+        data.bytes[x] = 0x7f
+
+    data.header.type = 0x50
+    data.header.byte_2 = 0xdd
+    data.header.byte_3 = 0x0f
+
+    header = PacConfigUnion()
+    header.config.debounce = IPACSeriesDebounce[config.debounce.lower()]
+    header.config.paclink = 0x1 if config.paclink is True else 0
+    data.header.byte_4 = header.asByte
+
+    macro_dict = {}
+    cur_macro = 0xe0
+    cur_position = MACRO_START_INDEX
+    for macro in config.macros:
+        if len(macro.action) > 0:
+            data.bytes[cur_position] = cur_macro
+            macro_dict[macro.name.upper()] = cur_macro
+            cur_position += 1
+            cur_macro += 1
+            for action in macro.action:
+                if action.upper() in IPACSeriesMapping:
+                    data.bytes[cur_position] = IPACSeriesMapping[action.upper()]
+                    cur_position += 1
+
+    for pin in config.pins:
+        action_index, alternate_action_index, shift_index = PinMapping[pin.name]
+        action = pin.action.upper()
+        if action in IPACSeriesMapping:
+            data.bytes[action_index] = IPACSeriesMapping[action]
+        elif action in macro_dict:
+            data.bytes[action_index] = macro_dict[action]
+        try:
+            alternate_action = pin.alternate_action.upper()
+            if alternate_action in IPACSeriesMapping:
+                data.bytes[alternate_action_index] = IPACSeriesMapping[alternate_action]
+            elif alternate_action in macro_dict:
+                data.bytes[alternate_action_index] = macro_dict[alternate_action]
+        except AttributeError:
+            pass
+        try:
+            if pin.shift:
+                data.bytes[shift_index] = 0x41
+        except AttributeError:
+            pass
+    return True, data
+
+
+def make_device():
+    """ Create an Ipac2Device object without a USB device, schema validation is skipped. """
+    dev = Ipac2Device.__new__(Ipac2Device)
+    dev.validate_config = lambda config, schema_file: True
+    return dev
+
+
+def run(number=500):
+    """
+    Time encode and decode of the example IPAC2 configuration.
+    :param number: number of encodes and decodes.
+    :return: dict of name -> seconds per call.
+    """
+    with open(CONFIG_FILE) as h:
+        json_config = json.load(h)
+    dev = make_device()
+
+    ok, legacy_data = legacy_encode(json_config)
+    ok, data = dev._create_device_struct_(json_config)
+    assert bytes(legacy_data) == bytes(data), 'encoders do not match'
+    assert legacy_decode(data) == dev.to_json_str(data), 'decoders do not match'
+
+    tests = {
+        'legacy encode': lambda: legacy_encode(json_config),
+        'codec encode': lambda: dev._create_device_struct_(json_config),
+        'legacy decode': lambda: legacy_decode(data),
+        'codec decode': lambda: dev.to_json_str(data),
+        'legacy macros': lambda: legacy_create_macro_array(data),
+        'codec macros': lambda: tokenize_macros(data.bytes, MACRO_START_INDEX),
+    }
+    return {name: min(timeit.repeat(func, number=number, repeat=5)) / number for name, func in tests.items()}
+
+
+if __name__ == '__main__':
+    logging.disable(logging.CRITICAL)
+    res = run()
+    for name, secs in res.items():
+        print(f'{name:>14}: {secs * 1e6:8.2f} us')
+    print(f'encode speedup: {res["legacy encode"] / res["codec encode"]:.1f}x')
+    print(f'decode speedup: {res["legacy decode"] / res["codec decode"]:.1f}x')
+    print(f'macros speedup: {res["legacy macros"] / res["codec macros"]:.1f}x')
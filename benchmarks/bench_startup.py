@@ -0,0 +1,83 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Benchmark of the command line startup time, each sample is a new interpreter.
+#
+#    PYTHONPATH=. python benchmarks/bench_startup.py [--importtime]
+#
+# --importtime prints the slowest imports of a tool launch, as reported by 'python -X importtime'.
+#
+import argparse
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# Benchmark name -> command line arguments given to the interpreter.
+COMMANDS = {
+    'startup ultimarc --help': ['-m', 'ultimarc.tools', '--help'],
+    'startup ultimarc ipac2 --help': ['-m', 'ultimarc.tools', 'ipac2', '--help'],
+    'import ultimarc.devices': ['-c', 'import ultimarc.devices'],
+}
+
+
+def _env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(ROOT), env.get('PYTHONPATH')]))
+    return env
+
+
+def time_command(args, repeat):
+    """
+    Return the fastest wall time of running the interpreter with the given arguments.
+    """
+    env = _env()
+    best = None
+    for x in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        secs = time.perf_counter() - start
+        best = secs if best is None else min(best, secs)
+    return best
+
+
+def import_times(args, count=20):
+    """
+    Return the slowest imports as a list of (cumulative microseconds, module name).
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=ROOT, env=_env(),
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    times = list()
+    for line in proc.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            times.append((int(parts[1]), parts[2].strip()))
+    return sorted(times, reverse=True)[:count]
+
+
+def run(repeat=10):
+    """
+    Time the command line startup.
+    :param repeat: number of interpreter launches of each command.
+    :return: dict of name -> seconds per launch.
+    """
+    return {name: time_command(args, repeat) for name, args in COMMANDS.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=os.path.basename(__file__))
+    parser.add_argument('--importtime', help='print the slowest imports of a tool launch', default=False,
+                        action='store_true')
+    args = parser.parse_args()
+
+    if args.importtime:
+        for micros, name in import_times(COMMANDS['startup ultimarc ipac2 --help']):
+            print(f'{name:>40}: {micros / 1000:10.2f} ms')
+    else:
+        for key, secs in run().items():
+            print(f'{key:>40}: {secs * 1000:10.2f} ms')
@@ -0,0 +1,111 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Run every benchmark module and store the results as JSON, so results can be compared between commits.
+#
+#    PYTHONPATH=. python benchmarks/run.py [-o results.json] [--only bench_device_io]
+#    PYTHONPATH=. python benchmarks/run.py --compare old.json new.json
+#
+# Each benchmarks/bench_*.py module provides a run() function returning a dict of name -> seconds per call.
+# Results are written to benchmarks/results/<commit>.json by default.
+#
+import argparse
+import importlib
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+
+
+def git_commit():
+    """ Return the short hash of the current commit, with a '-dirty' suffix if the tree has changes """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIR,
+                                         stderr=subprocess.DEVNULL, text=True).strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                        cwd=BENCHMARKS_DIR, stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return f'{commit}-dirty' if dirty else commit
+
+
+def run_benchmarks(only=None):
+    """
+    Run the benchmark modules.
+    :param only: list of module names to run, all modules if None.
+    :return: dict of module name -> dict of name -> seconds per call.
+    """
+    sys.path.insert(0, str(BENCHMARKS_DIR))
+    results = dict()
+    for path in sorted(BENCHMARKS_DIR.glob('bench_*.py')):
+        if only and path.stem not in only:
+            continue
+        print(f'running {path.stem}...', file=sys.stderr)
+        results[path.stem] = importlib.import_module(path.stem).run()
+    return results
+
+
+def compare(old_file, new_file, threshold=0.1):
+    """
+    Print the change of every benchmark found in both result files.
+    :param threshold: relative change reported as a regression or improvement.
+    :return: number of regressions.
+    """
+    with open(old_file) as h:
+        old = json.load(h)
+    with open(new_file) as h:
+        new = json.load(h)
+
+    print(f'{old["commit"]} -> {new["commit"]}')
+    regressions = 0
+    for module, benchmarks in new['results'].items():
+        for name, secs in benchmarks.items():
+            prev = old['results'].get(module, {}).get(name)
+            if not prev:
+                continue
+            change = (secs - prev) / prev
+            flag = ''
+            if change > threshold:
+                flag = 'REGRESSION'
+                regressions += 1
+            elif change < -threshold:
+                flag = 'improved'
+            print(f'{module + ": " + name:>58}: {prev * 1e6:10.2f} us -> {secs * 1e6:10.2f} us '
+                  f'{change * 100:+7.1f}% {flag}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=os.path.basename(__file__))
+    parser.add_argument('-o', '--output', help='result file, default benchmarks/results/<commit>.json')
+    parser.add_argument('--only', action='append', help='benchmark module to run, may be repeated')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change reported by --compare, default 0.1')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, threshold=args.threshold) else 0)
+
+    logging.disable(logging.CRITICAL)
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': run_benchmarks(args.only),
+    }
+
+    output = Path(args.output) if args.output else BENCHMARKS_DIR / 'results' / f'{commit}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as h:
+        json.dump(report, h, indent=2)
+    print(f'Wrote benchmark results to {output}')
@@ -0,0 +1,97 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import asyncio
+import queue
+from unittest import TestCase
+
+from ultimarc.devices import DeviceClassID, USBDevices
+from ultimarc.devices._virtual import VirtualUSB, VirtualUSBButton
+
+
+class ButtonStateTest(TestCase):
+
+    def setUp(self) -> None:
+        super(ButtonStateTest, self).setUp()
+        self.button = VirtualUSBButton()
+        self.bus = VirtualUSB([self.button])
+        self.bus.install()
+        self.devices = USBDevices(['d209'])
+
+    def tearDown(self) -> None:
+        self.devices.close_all()
+        self.bus.uninstall()
+        super(ButtonStateTest, self).tearDown()
+
+    def _open(self):
+        return next(self.devices.filter(class_id=DeviceClassID.USBButton))
+
+    def test_get_state(self):
+        """ Test reading the button state with the state report """
+        with self._open() as dev_h:
+            self.assertEqual(dev_h.get_state(), 0)
+            self.button.press()
+            self.assertEqual(dev_h.get_state(), 1)
+
+    def test_press_events(self):
+        """ Test that press and release events are published to a callback and a queue """
+        events = queue.Queue()
+        called = list()
+        with self._open() as dev_h:
+            watcher = dev_h.watch_state(callback=called.append, queue=events)
+            self.assertTrue(watcher.running)
+
+            self.button.press()
+            pressed = events.get(timeout=2)
+            self.button.press(False)
+            released = events.get(timeout=2)
+
+            self.assertTrue(pressed.pressed)
+            self.assertFalse(released.pressed)
+            self.assertLessEqual(pressed.timestamp, released.timestamp)
+            self.assertEqual(called, [pressed, released])
+            self.assertEqual(dev_h.get_state(), 0)
+
+            # A repeated state is not an event.
+            self.button.press(False)
+            self.button.press()
+            self.assertTrue(events.get(timeout=2).pressed)
+            self.assertTrue(events.empty())
+
+            watcher.stop()
+            self.assertFalse(watcher.running)
+
+    def test_no_config_read_while_watching(self):
+        """ Test that the configuration is not read from the endpoint the watcher is reading """
+        events = queue.Queue()
+        with self._open() as dev_h:
+            watcher = dev_h.watch_state(queue=events)
+            self.assertIsNone(dev_h.read_device())
+            self.assertIsNone(dev_h.get_device_config())
+
+            # The watcher still gets the state reports.
+            self.button.press()
+            self.assertTrue(events.get(timeout=2).pressed)
+
+            watcher.stop()
+            self.assertIsNotNone(dev_h.get_device_config())
+
+    def test_event_stream(self):
+        """ Test that events are published to an asyncio stream, which ends when the watcher stops """
+        with self._open() as dev_h:
+            watcher = dev_h.watch_state()
+
+            async def collect():
+                loop = asyncio.get_running_loop()
+                loop.call_later(0.05, self.button.press)
+                loop.call_later(0.1, self.button.press, False)
+                loop.call_later(0.3, watcher.stop)
+                return [event.pressed async for event in watcher.events()]
+
+            self.assertEqual(asyncio.run(asyncio.wait_for(collect(), 5)), [True, False])
+
+        # Closing the device stops watching.
+        watcher = dev_h.watch_state()
+        self.devices.close_all()
+        self.assertFalse(watcher.running)
@@ -0,0 +1,78 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import time
+from unittest import TestCase
+
+from ultimarc.devices import DeviceClassID, USBDevices
+from ultimarc.devices._color_stream import ColorStream
+from ultimarc.devices._virtual import VirtualUSB, VirtualUSBButton
+
+
+class ColorStreamTest(TestCase):
+
+    def setUp(self) -> None:
+        super(ColorStreamTest, self).setUp()
+        self.button = VirtualUSBButton()
+        self.bus = VirtualUSB([self.button])
+        self.bus.install()
+        self.devices = USBDevices(['d209'])
+
+    def tearDown(self) -> None:
+        self.devices.close_all()
+        self.bus.uninstall()
+        super(ColorStreamTest, self).tearDown()
+
+    def test_updates_are_coalesced(self):
+        """ Test that updates made faster than the rate cap are coalesced and the newest color is sent """
+        with next(self.devices.filter(class_id=DeviceClassID.USBButton)) as dev_h:
+            sent = list()
+            set_color = dev_h.set_color
+            dev_h.set_color = lambda *color: sent.append(color) or set_color(*color)
+
+            with dev_h.color_stream(max_rate=20) as stream:
+                for value in range(200):
+                    stream.set_color(value, 0, 255 - value)
+                with self.assertRaises(ValueError):
+                    stream.set_color(256, 0, 0)
+
+            self.assertTrue(stream.result)
+            self.assertEqual(stream.updates, 200)
+            self.assertLess(len(sent), 10)
+            self.assertEqual(sent[-1], (199, 0, 56))
+            self.assertEqual(self.button.color, (199, 0, 56))
+
+            # A color the button already shows is not sent again.
+            with dev_h.color_stream() as stream:
+                stream.set_color(199, 0, 56)
+            self.assertEqual(stream.sent, 1)
+
+    def test_fade_and_pulse(self):
+        """ Test the colors of fades and pulses over time """
+        now = [10.0]
+        stream = ColorStream(None, clock=lambda: now[0])
+        stream.set_color(0, 0, 100)
+        stream.fade((200, 100, 0), 2.0)
+        self.assertEqual(stream._effect(10.0), ((0, 0, 100), False))
+        self.assertEqual(stream._effect(11.0), ((100, 50, 50), False))
+        self.assertEqual(stream._effect(12.5), ((200, 100, 0), True))
+
+        stream.pulse((0, 255, 0), 1.0, low=(0, 0, 50))
+        self.assertEqual(stream._effect(10.0), ((0, 0, 50), False))
+        self.assertEqual(stream._effect(10.25), ((0, 128, 25), False))
+        self.assertEqual(stream._effect(10.5), ((0, 255, 0), False))
+        self.assertEqual(stream._effect(11.0), ((0, 0, 50), False))
+        with self.assertRaises(ValueError):
+            stream.pulse((0, 255, 0), 0)
+
+    def test_rate_cap(self):
+        """ Test that a pulse is sent no faster than the rate cap """
+        with next(self.devices.filter(class_id=DeviceClassID.USBButton)) as dev_h:
+            stream = dev_h.color_stream(max_rate=50)
+            stream.pulse((255, 255, 255), 0.1)
+            time.sleep(0.2)
+            stream.stop()
+            self.assertTrue(stream.result)
+            self.assertGreater(stream.sent, 2)
+            self.assertLessEqual(stream.sent, 12)
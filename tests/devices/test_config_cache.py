@@ -0,0 +1,111 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import json
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+from unittest import TestCase
+
+from ultimarc.devices import DeviceClassID, USBDevices
+from ultimarc.devices._config_cache import ConfigCache
+from ultimarc.devices._virtual import VirtualIpac2, VirtualUSB, VirtualUSBButton
+from ultimarc.profiles import ProfileStore
+from ultimarc.system_utils import git_project_root
+
+
+class ConfigCacheTest(TestCase):
+
+    def setUp(self) -> None:
+        super(ConfigCacheTest, self).setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = ConfigCache(os.path.join(self.tmp.name, 'configs'))
+        self.ipac2 = VirtualIpac2()
+        self.button = VirtualUSBButton()
+        self.bus = VirtualUSB([self.ipac2, self.button])
+        self.bus.install()
+
+    def tearDown(self) -> None:
+        self.bus.uninstall()
+        self.tmp.cleanup()
+        super(ConfigCacheTest, self).tearDown()
+
+    def _devices(self, cache):
+        """ Return a new USBDevices object, as a new process would find the devices """
+        return USBDevices(['d209'], config_cache=cache)
+
+    def test_entries(self):
+        """ Test that cached configurations are dropped when the device address changes or they expire """
+        dev_id = ConfigCache.device_id(SimpleNamespace(dev_key='d209:0420', bus=1, path='1.2', address=5))
+        digest = self.cache.put(dev_id, 'pac-config', b'\x01\x02')
+        self.assertEqual(self.cache.get(dev_id, 'pac-config'), b'\x01\x02')
+        self.assertEqual(self.cache.get_hash(dev_id, 'pac-config'), digest)
+
+        # Same content from another device shares the stored copy.
+        other = ConfigCache.device_id(SimpleNamespace(dev_key='d209:0420', bus=1, path='1.3', address=6))
+        self.assertEqual(self.cache.put(other, 'pac-config', b'\x01\x02'), digest)
+        self.assertEqual(len(os.listdir(os.path.join(self.cache.directory, 'objects', digest[:2]))), 1)
+
+        replugged = (dev_id[0], 7)
+        self.assertIsNone(self.cache.get(replugged, 'pac-config'))
+
+        expired = ConfigCache(self.cache.directory, ttl=0.05)
+        self.assertIsNotNone(expired.get(dev_id, 'pac-config'))
+        time.sleep(0.1)
+        self.assertIsNone(expired.get(dev_id, 'pac-config'))
+
+        self.cache.drop(dev_id, ['pac-config'])
+        self.assertEqual(self.cache.entries(dev_id), dict())
+
+    def test_get_config_without_reading(self):
+        """ Test that a configuration read once is shown again without reading the device """
+        devices = self._devices(self.cache)
+        with next(devices.filter(class_id=DeviceClassID.IPAC2)) as dev_h:
+            first = json.loads(dev_h.get_device_config())
+        devices.close_all()
+
+        # Change the device behind the cache's back, a cached copy does not see it.
+        self.ipac2.config[4] = 0x05
+        devices = self._devices(self.cache)
+        with next(devices.filter(class_id=DeviceClassID.IPAC2)) as dev_h:
+            self.assertEqual(json.loads(dev_h.get_device_config()), first)
+        devices.close_all()
+
+        devices = self._devices(ConfigCache(self.cache.directory, ttl=0))
+        with next(devices.filter(class_id=DeviceClassID.IPAC2)) as dev_h:
+            self.assertNotEqual(json.loads(dev_h.get_device_config()), first)
+        devices.close_all()
+
+    def test_edit_reads_device(self):
+        """ Test that an edit reads the device, so a change made by another program is not written back over """
+        devices = self._devices(self.cache)
+        with next(devices.filter(class_id=DeviceClassID.IPAC2)) as dev_h:
+            dev_h.get_device_config()
+        devices.close_all()
+
+        # Pin 1left is changed behind the cache's back, configuration byte 21 after the 4 byte header.
+        self.ipac2.config[4 + 21] = 0x1c
+        devices = self._devices(self.cache)
+        with next(devices.filter(class_id=DeviceClassID.IPAC2)) as dev_h:
+            self.assertTrue(dev_h.set_pin(['2up', 'C', '', 'false']))
+        devices.close_all()
+        self.assertEqual(self.ipac2.config[4 + 21], 0x1c)
+        self.assertEqual(self.ipac2.config[4 + 20], 0x06)
+
+    def test_profile_switch_between_processes(self):
+        """ Test that a new process applying the same profile sends nothing """
+        store = ProfileStore(os.path.join(self.tmp.name, 'profiles'), os.path.join(self.tmp.name, 'compiled'))
+        os.makedirs(store.profile_dir)
+        examples = os.path.join(git_project_root(), 'ultimarc/examples')
+        with open(store.path('game'), 'w') as h:
+            json.dump({'schemaVersion': 2.0, 'resourceType': 'profile',
+                       'devices': [{'config': os.path.join(examples, 'ipac2.json')},
+                                   {'config': os.path.join(examples, 'usb-button-config.json')}]}, h)
+
+        for expected in ('sent', 'unchanged'):
+            devices = self._devices(self.cache)
+            self.assertEqual([r['result'] for r in store.apply('game', devices)], [expected] * 2)
+            devices.close_all()
+        self.assertEqual((self.ipac2.writes, self.button.writes), (1, 1))
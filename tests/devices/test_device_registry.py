@@ -0,0 +1,142 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+from unittest import TestCase
+from unittest.mock import patch
+
+import libusb as usb
+
+from ultimarc.devices._base import USBDeviceInfo, USBDevices
+from ultimarc.devices._registry import DeviceEvent, HotplugEventSource, USBDeviceRegistry
+
+
+def make_device_info(bus=1, address=2, dev_key='d209:0420', class_id='ipac2'):
+    """ Create a USBDeviceInfo object without enumerating libusb devices. """
+    info = USBDeviceInfo.__new__(USBDeviceInfo)
+    info.bus = bus
+    info.address = address
+    info.dev_key = dev_key
+    info.class_id = class_id
+    return info
+
+
+class FakeEventSource:
+    """ Event source that replays a list of queued changes on each poll. """
+
+    def __init__(self):
+        self.pending = list()
+        self.started = 0
+        self.polls = 0
+
+    def start(self, registry):
+        self.started += 1
+        return True
+
+    def stop(self, registry):
+        self.started -= 1
+
+    def poll(self, registry):
+        self.polls += 1
+        for action, arg in self.pending:
+            if action == 'add':
+                registry.add(arg)
+            else:
+                registry.remove(*arg)
+        self.pending = list()
+        return True
+
+
+class USBDeviceRegistryTest(TestCase):
+
+    def test_events_emitted(self):
+        """ Test that subscribers see arrivals and departures """
+        source = FakeEventSource()
+        registry = USBDeviceRegistry(source, None)
+        events = list()
+        registry.subscribe(lambda event, dev: events.append((event, dev.address)))
+
+        source.pending = [('add', make_device_info(address=2)), ('add', make_device_info(address=3))]
+        self.assertTrue(registry.update())
+        self.assertEqual(len(registry), 2)
+        self.assertEqual(source.started, 1)
+
+        source.pending = [('remove', (1, 2))]
+        registry.update()
+        self.assertEqual(source.started, 1)
+        self.assertEqual(events, [(DeviceEvent.ARRIVED, 2), (DeviceEvent.ARRIVED, 3), (DeviceEvent.LEFT, 2)])
+        self.assertIsNone(registry.get(1, 2))
+        self.assertEqual(registry.get(1, 3).address, 3)
+
+    def test_readd_same_device_is_ignored(self):
+        """ Test that a device reported twice only emits one event, a new device at the same address replaces it """
+        registry = USBDeviceRegistry(FakeEventSource(), None)
+        events = list()
+        registry.subscribe(lambda event, dev: events.append((event, dev.dev_key)))
+
+        registry.add(make_device_info())
+        registry.add(make_device_info())
+        registry.add(make_device_info(dev_key='d209:0410'))
+        self.assertEqual(events, [(DeviceEvent.ARRIVED, 'd209:0420'), (DeviceEvent.LEFT, 'd209:0420'),
+                                  (DeviceEvent.ARRIVED, 'd209:0410')])
+
+    def test_bad_subscriber(self):
+        """ Test that a failing subscriber does not stop other subscribers """
+        registry = USBDeviceRegistry(FakeEventSource(), None)
+        events = list()
+
+        def bad_callback(event, dev):
+            raise RuntimeError('subscriber failure')
+
+        registry.subscribe(bad_callback)
+        registry.subscribe(lambda event, dev: events.append(event))
+        registry.add(make_device_info())
+        self.assertEqual(events, [DeviceEvent.ARRIVED])
+
+    @patch('libusb.handle_events_timeout_completed', return_value=0)
+    @patch('libusb.get_device_descriptor', return_value=0)
+    @patch('libusb.get_device_address', side_effect=lambda dev: dev)
+    @patch('libusb.get_bus_number', return_value=1)
+    def test_hotplug_events_applied_on_poll(self, *mocks):
+        """ Test that hotplug callbacks, which may run on the transfer event thread, only change the registry
+            when it is updated """
+        source = HotplugEventSource()
+        registry = USBDeviceRegistry(source, lambda dev, dev_desc: make_device_info(address=dev))
+        source._registry = registry
+        events = list()
+        registry.subscribe(lambda event, dev: events.append((event, dev.address)))
+
+        source._hotplug_callback(None, 2, usb.LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED, None)
+        source._hotplug_callback(None, 3, usb.LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED, None)
+        source._hotplug_callback(None, 2, usb.LIBUSB_HOTPLUG_EVENT_DEVICE_LEFT, None)
+        self.assertEqual((len(registry), events), (0, []))
+
+        self.assertTrue(source.poll(registry))
+        self.assertEqual(events, [(DeviceEvent.ARRIVED, 2), (DeviceEvent.ARRIVED, 3), (DeviceEvent.LEFT, 2)])
+        self.assertEqual([d.address for d in registry], [3])
+
+
+class USBDevicesRegistryTest(TestCase):
+
+    @patch('libusb.close')
+    def test_rescan_applies_changes(self, close_mock):
+        """ Test that USBDevices follows the registry and shares its handle pool with new devices """
+        source = FakeEventSource()
+        source.pending = [('add', make_device_info(address=2))]
+        devices = USBDevices(event_source=source)
+        self.assertEqual(devices.device_count, 1)
+
+        source.pending = [('add', make_device_info(address=4, class_id='ultrastik'))]
+        devices.rescan()
+        self.assertEqual(devices.device_count, 2)
+        self.assertEqual(source.polls, 2)
+        self.assertTrue(all(d._pool is devices._pool for d in devices))
+        self.assertEqual([d.address for d in devices.filter(bus=1, address=4)], [4])
+        self.assertEqual([d.address for d in devices.filter(class_id='ipac2')], [2])
+
+        source.pending = [('remove', (1, 2))]
+        devices.rescan()
+        self.assertEqual([d.address for d in devices], [4])
+
+        devices.close_all()
+        self.assertEqual(source.started, 0)
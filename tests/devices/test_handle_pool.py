@@ -0,0 +1,157 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+from ultimarc.devices._base import USBDeviceInfo, USBDeviceHandlePool
+from ultimarc.exceptions import USBDeviceNotFoundError
+
+
+class DummyHandle:
+    """ Stand in for a USBDeviceHandle class, does not touch libusb. """
+    released = 0
+
+    def __init__(self, dev_handle, dev_key):
+        self.dev_handle = dev_handle
+        self.dev_key = dev_key
+
+    def release_interface(self):
+        DummyHandle.released += 1
+
+
+def make_device_info(bus=1, address=2, dev_key='d209:0420'):
+    """ Create a USBDeviceInfo object without enumerating libusb devices. """
+    info = USBDeviceInfo.__new__(USBDeviceInfo)
+    info.bus = bus
+    info.address = address
+    info.dev_key = dev_key
+    info.__dev_class__ = DummyHandle
+    return info
+
+
+class USBDeviceHandlePoolTest(TestCase):
+
+    def setUp(self) -> None:
+        super(USBDeviceHandlePoolTest, self).setUp()
+        DummyHandle.released = 0
+
+    @patch('libusb.close')
+    @patch.object(USBDeviceInfo, '_get_device_handle', return_value='raw_handle')
+    def test_handle_reused_between_with_blocks(self, get_handle_mock, close_mock):
+        """ Test that the device is only opened once while the pool is alive """
+        pool = USBDeviceHandlePool()
+        info = make_device_info()
+        info._pool = pool
+
+        with info as dev_h_1:
+            self.assertIsInstance(dev_h_1, DummyHandle)
+        with info as dev_h_2:
+            self.assertIs(dev_h_1, dev_h_2)
+
+        self.assertEqual(get_handle_mock.call_count, 1)
+        self.assertEqual(len(pool), 1)
+        close_mock.assert_not_called()
+
+        pool.close_all()
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(DummyHandle.released, 1)
+        close_mock.assert_called_once_with('raw_handle')
+
+    @patch('libusb.close')
+    @patch.object(USBDeviceInfo, '_get_device_handle', return_value='raw_handle')
+    def test_rescanned_device_shares_handle(self, get_handle_mock, close_mock):
+        """ Test that a new device info object for the same bus/address reuses the open handle """
+        pool = USBDeviceHandlePool()
+        info_1 = make_device_info()
+        info_2 = make_device_info()
+        other = make_device_info(address=3)
+
+        self.assertIs(pool.acquire(info_1), pool.acquire(info_2))
+        self.assertIsNot(pool.acquire(info_1), pool.acquire(other))
+        self.assertEqual(get_handle_mock.call_count, 2)
+
+    @patch('libusb.close')
+    @patch.object(USBDeviceInfo, '_get_device_handle', return_value='raw_handle')
+    def test_discard_on_error(self, get_handle_mock, close_mock):
+        """ Test that a handle is closed when an exception is raised inside the with block """
+        pool = USBDeviceHandlePool()
+        info = make_device_info()
+        info._pool = pool
+
+        with self.assertRaises(RuntimeError):
+            with info:
+                raise RuntimeError('USB failure')
+
+        self.assertNotIn(info, pool)
+        close_mock.assert_called_once_with('raw_handle')
+
+    @patch('libusb.close')
+    @patch.object(USBDeviceInfo, '_get_device_handle', return_value='raw_handle')
+    def test_nested_discard_keeps_referenced_handle(self, get_handle_mock, close_mock):
+        """ Test that a referenced handle is not closed by an inner error """
+        pool = USBDeviceHandlePool()
+        info = make_device_info()
+
+        pool.acquire(info)
+        pool.acquire(info)
+        pool.release(info, discard=True)
+        self.assertIn(info, pool)
+        pool.release(info, discard=True)
+        self.assertNotIn(info, pool)
+
+    @patch('libusb.close')
+    @patch.object(USBDeviceInfo, '_get_device_handle', return_value='raw_handle')
+    def test_prune_removed_devices(self, get_handle_mock, close_mock):
+        """ Test that handles for detached devices are closed when pruned """
+        pool = USBDeviceHandlePool()
+        kept = make_device_info(address=2)
+        gone = make_device_info(address=5)
+
+        pool.acquire(kept)
+        pool.release(kept)
+        pool.acquire(gone)
+        pool.release(gone)
+
+        pool.prune({kept.pool_key})
+        self.assertIn(kept, pool)
+        self.assertNotIn(gone, pool)
+
+    @patch.object(USBDeviceInfo, '_get_device_handle', return_value=None)
+    def test_device_not_found(self, get_handle_mock):
+        """ Test that a missing device raises and is not added to the pool """
+        pool = USBDeviceHandlePool()
+        info = make_device_info()
+
+        with self.assertRaises(USBDeviceNotFoundError):
+            pool.acquire(info)
+        self.assertEqual(len(pool), 0)
+
+    @patch('libusb.close')
+    def test_devices_open_in_parallel(self, close_mock):
+        """ Test that a device being opened does not hold up opening another device """
+        pool = USBDeviceHandlePool()
+        slow = make_device_info(address=2)
+        fast = make_device_info(address=3)
+        opening = threading.Event()
+        resume = threading.Event()
+
+        def get_handle(info):
+            if info is slow:
+                opening.set()
+                resume.wait(5)
+            return f'raw_handle_{info.address}'
+
+        with patch.object(USBDeviceInfo, '_get_device_handle', autospec=True, side_effect=get_handle):
+            thread = threading.Thread(target=pool.acquire, args=(slow,))
+            thread.start()
+            self.assertTrue(opening.wait(5))
+            try:
+                self.assertEqual(pool.acquire(fast).dev_handle, 'raw_handle_3')
+                self.assertNotIn(slow, pool)
+            finally:
+                resume.set()
+                thread.join()
+        self.assertIn(slow, pool)
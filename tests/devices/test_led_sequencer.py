@@ -0,0 +1,86 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import os
+import time
+from unittest import TestCase
+
+from ultimarc.devices import DeviceClassID, USBDevices
+from ultimarc.devices._led_sequencer import LEDAnimation, LEDSequencer
+from ultimarc.devices._virtual import VirtualUltimateIO, VirtualUSB
+from ultimarc.system_utils import git_project_root
+
+
+class LEDSequencerTest(TestCase):
+
+    def setUp(self) -> None:
+        super(LEDSequencerTest, self).setUp()
+        self.uio = VirtualUltimateIO()
+        self.bus = VirtualUSB([self.uio])
+        self.bus.install()
+        self.devices = USBDevices(['d209'])
+
+    def tearDown(self) -> None:
+        self.devices.close_all()
+        self.bus.uninstall()
+        super(LEDSequencerTest, self).tearDown()
+
+    def test_render_keyframes(self):
+        """ Test that keyframes are rendered with fades and steps """
+        config_file = os.path.join(git_project_root(), 'ultimarc/examples/ultimateIO/ultimate-io-animation.json')
+        animation = LEDAnimation.load(config_file)
+        self.assertIsNotNone(animation)
+        self.assertEqual(len(animation.frames), 60)
+        self.assertEqual(animation.frames[0], bytes(96))
+        self.assertEqual(animation.frames[15][:4], bytes([255, 255, 255, 0]))
+        self.assertEqual(animation.frames[7][0], round(255 * 7 / 15))
+        # Frames before a step keyframe hold the previous keyframe.
+        self.assertEqual(animation.frames[29][:6], bytes([255, 255, 255, 0, 0, 0]))
+        self.assertEqual(animation.frames[30][:6], bytes([0, 0, 0, 255, 255, 255]))
+        self.assertEqual(animation.frames[45][3], 128)
+
+        self.assertEqual(len(LEDAnimation.load(config_file, fps=10).frames), 20)
+        bad_file = os.path.join(git_project_root(), 'tests/test-data/ultimateIO/ultimateio-animation-bad.json')
+        self.assertIsNone(LEDAnimation.load(bad_file))
+
+    def test_frame_scheduling(self):
+        """ Test that frames are scheduled from the start time and late frames are dropped """
+        animation = LEDAnimation([{'time': 0, 'allIntensities': 0}, {'time': 1, 'allIntensities': 250}], fps=10)
+        self.assertEqual(len(animation.frames), 11)
+
+        with next(self.devices.filter(class_id=DeviceClassID.UltimateIO)) as dev_h:
+            now = [100.0]
+            sequencer = LEDSequencer(dev_h, animation, clock=lambda: now[0])
+            self.assertAlmostEqual(sequencer._step_(now[0]), 0.1)
+            self.assertEqual(self.uio.leds, bytes([0]) * 96)
+
+            now[0] = 100.05
+            self.assertAlmostEqual(sequencer._step_(now[0]), 0.05)
+            self.assertEqual(sequencer.frames_sent, 1)
+
+            # The transfer ran late, frames 1 and 2 are dropped.
+            now[0] = 100.35
+            self.assertAlmostEqual(sequencer._step_(now[0]), 0.05)
+            self.assertEqual((sequencer.frames_sent, sequencer.frames_dropped), (2, 2))
+            self.assertEqual(self.uio.leds, bytes([75]) * 96)
+
+            # The last frame is always sent.
+            now[0] = 105.0
+            self.assertIsNone(sequencer._step_(now[0]))
+            self.assertEqual((sequencer.frames_sent, sequencer.frames_dropped), (3, 8))
+            self.assertEqual(self.uio.leds, bytes([250]) * 96)
+
+    def test_play_thread(self):
+        """ Test that a looping animation plays until stopped and unchanged frames are not sent """
+        animation = LEDAnimation([{'time': 0, 'intensities': [{'led': 2, 'value': 9}]}], fps=100, loop=True)
+        with next(self.devices.filter(class_id=DeviceClassID.UltimateIO)) as dev_h:
+            sequencer = dev_h.play_led_animation(animation)
+            time.sleep(0.1)
+            self.assertTrue(sequencer.is_alive())
+            sequencer.stop()
+            self.assertFalse(sequencer.is_alive())
+            self.assertTrue(sequencer.result)
+            self.assertEqual(sequencer.frames_sent, 1)
+            self.assertGreater(sequencer.frames_unchanged, 0)
+            self.assertEqual(self.uio.leds[:3], bytes([0, 9, 0]))
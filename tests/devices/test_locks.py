@@ -0,0 +1,127 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from ultimarc.devices import DeviceClassID, USBDevices
+from ultimarc.devices._locks import DeviceLocks
+from ultimarc.devices._virtual import VirtualIpac2, VirtualJpac, VirtualUSB
+from ultimarc.exceptions import USBDeviceBusyError
+from ultimarc.system_utils import FileLock, remove_pidfile, write_pidfile_or_die
+
+# Lock a file from another process until stdin is closed.
+_HOLD_LOCK = 'import sys; from ultimarc.system_utils import FileLock; lock = FileLock(sys.argv[1]); ' \
+             'lock.acquire(); print("locked", flush=True); sys.stdin.read()'
+
+
+class LockTest(TestCase):
+
+    def setUp(self) -> None:
+        super(LockTest, self).setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.locks = DeviceLocks(self.tmp.name, timeout=0.2)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+        super(LockTest, self).tearDown()
+
+    def test_file_lock(self):
+        """ Test that a held lock excludes other holders and a waiting holder gets it after release """
+        path = os.path.join(self.tmp.name, 'test.lock')
+        first = FileLock(path)
+        second = FileLock(path)
+        self.assertTrue(first.acquire(timeout=0))
+        self.assertFalse(second.acquire(timeout=0.1))
+        first.release()
+        self.assertTrue(second.acquire(timeout=0))
+        second.release()
+
+    def test_lock_other_process(self):
+        """ Test that a lock held by another process is released when the process exits """
+        path = self.locks.path(1, 2)
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        with subprocess.Popen([sys.executable, '-c', _HOLD_LOCK, path], stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE, text=True, cwd=root) as proc:
+            self.assertEqual(proc.stdout.readline().strip(), 'locked')
+            self.assertRaises(USBDeviceBusyError, self.locks.acquire, 1, 2, 'd209:0420')
+            # Another device is not blocked.
+            self.locks.acquire(1, 3).release()
+        self.locks.acquire(1, 2).release()
+
+    def test_pid_file(self):
+        """ Test that a second instance is refused while the pid file is locked """
+        pid_file = os.path.join(self.tmp.name, 'tool.pid')
+        write_pidfile_or_die('tool', pid_file)
+        with open(pid_file) as h:
+            self.assertEqual(int(h.read()), os.getpid())
+        self.assertFalse(FileLock(pid_file).acquire(timeout=0))
+        remove_pidfile('tool', pid_file)
+        self.assertFalse(os.path.exists(pid_file))
+
+    def test_pid_file_removed_while_waiting(self):
+        """ Test that an instance waiting on a removed pid file locks the new pid file, so only one instance runs """
+        pid_file = os.path.join(self.tmp.name, 'tool.pid')
+        write_pidfile_or_die('tool', pid_file)
+        waiter = FileLock(pid_file)
+        thread = threading.Thread(target=waiter.acquire, kwargs={'timeout': 5, 'poll': 0.01})
+        thread.start()
+        time.sleep(0.1)  # The waiter has opened the pid file.
+        remove_pidfile('tool', pid_file)
+        thread.join()
+
+        self.assertTrue(waiter.locked)
+        self.assertTrue(os.path.exists(pid_file))
+        self.assertFalse(FileLock(pid_file).acquire(timeout=0))
+        waiter.release()
+
+    def test_pool_locks_devices(self):
+        """ Test that a device is locked while it is used, other devices stay usable """
+        with VirtualUSB([VirtualIpac2(), VirtualJpac()]):
+            devices = USBDevices(['d209'], device_locks=self.locks)
+            other = USBDevices(['d209'], device_locks=self.locks)
+            try:
+                with next(devices.filter(class_id=DeviceClassID.IPAC2)):
+                    start = time.monotonic()
+                    with self.assertRaises(USBDeviceBusyError):
+                        with next(other.filter(class_id=DeviceClassID.IPAC2)):
+                            pass
+                    self.assertGreaterEqual(time.monotonic() - start, 0.15)
+                    with next(other.filter(class_id=DeviceClassID.JPAC)):
+                        pass
+            finally:
+                devices.close_all()
+                other.close_all()
+
+    def test_idle_device_unlocked(self):
+        """ Test that a device kept open in one pool can be used by another once it is no longer used """
+        with VirtualUSB([VirtualIpac2()]):
+            devices = USBDevices(['d209'], device_locks=self.locks)
+            other = USBDevices(['d209'], device_locks=self.locks)
+            try:
+                ipac2 = next(devices.filter(class_id=DeviceClassID.IPAC2))
+                with ipac2 as dev_h:
+                    handle = dev_h
+                    self.assertEqual(dev_h.read_config().bytes[19], 0x00)
+
+                # The handle stays open, but the device lock and interface are released.
+                with next(other.filter(class_id=DeviceClassID.IPAC2)) as dev_h:
+                    self.assertTrue(dev_h.set_pin(['1up', 'B', '', 'false']))
+                    with self.assertRaises(USBDeviceBusyError):
+                        with ipac2:
+                            pass
+
+                # The same handle is used again, it reads the change made while it was unlocked.
+                with ipac2 as dev_h:
+                    self.assertIs(dev_h, handle)
+                    self.assertEqual(dev_h.read_config().bytes[19], 0x05)
+                self.assertEqual(len(devices._pool), 1)
+            finally:
+                devices.close_all()
+                other.close_all()
@@ -0,0 +1,67 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+from unittest import TestCase
+
+from ultimarc.devices._macros import PacMacro, encode_macros, tokenize_macros
+from ultimarc.devices._structures import PacStruct
+
+MACRO_START_INDEX = 166
+MACRO_MAX_SIZE = 85
+
+
+def make_struct(region):
+    """ Return a PacStruct with the given bytes at the start of the macro region. """
+    data = PacStruct()
+    for x, value in enumerate(region):
+        data.bytes[MACRO_START_INDEX + x] = value
+    return data
+
+
+class MacroTokenizerTest(TestCase):
+
+    def test_tokenize(self):
+        """ Test that macros are split at control characters and stop at the first zero byte """
+        data = make_struct([0xe0, 0x16, 0x04, 0x05, 0xe1, 0x10, 0xe2, 0x1f, 0x00, 0xe3, 0x10])
+        macros = tokenize_macros(data.bytes, MACRO_START_INDEX)
+
+        self.assertEqual(macros, [PacMacro('#1', b'\x16\x04\x05', 166), PacMacro('#2', b'\x10', 170),
+                                  PacMacro('#3', b'\x1f', 172)])
+        self.assertEqual(macros[0].to_dict(), {'name': '#1', 'action': ['S', 'A', 'B']})
+        self.assertEqual(macros[0].size, 4)
+
+    def test_tokenize_unterminated(self):
+        """ Test that a macro running to the end of the data is dropped """
+        data = bytes(MACRO_START_INDEX) + bytes([0xe0, 0x04]) + bytes([0x05] * (252 - MACRO_START_INDEX - 2))
+        self.assertEqual(tokenize_macros(data, MACRO_START_INDEX), [])
+
+    def test_round_trip(self):
+        """ Test that encoding tokenized macros gives back the same bytes """
+        region = [0xe0, 0x16, 0x04, 0x05, 0xe1, 0x10, 0x1f, 0xe2, 0x10, 0x20, 0x10, 0x20, 0x1f, 0x1e, 0xe3, 0x10]
+        data = make_struct(region)
+        macros = tokenize_macros(data.bytes, MACRO_START_INDEX)
+
+        data_2 = PacStruct()
+        control = encode_macros(macros, data_2.bytes, MACRO_START_INDEX, MACRO_MAX_SIZE)
+        self.assertEqual(bytes(data.bytes), bytes(data_2.bytes))
+        self.assertEqual(control, {'#1': 0xe0, '#2': 0xe1, '#3': 0xe2, '#4': 0xe3})
+        self.assertEqual(tokenize_macros(data_2.bytes, MACRO_START_INDEX), macros)
+
+    def test_encode_from_dict(self):
+        """ Test encoding json config macros, skipping invalid keys and empty macros """
+        macros = [PacMacro.from_dict({'name': 'first', 'action': ['s', 'A', 'bad']}),
+                  PacMacro.from_dict({'name': 'empty', 'action': []}),
+                  PacMacro.from_dict({'name': 'second', 'action': ['M']})]
+        buf = bytearray(252)
+        control = encode_macros(macros, buf, MACRO_START_INDEX, MACRO_MAX_SIZE)
+
+        self.assertEqual(control, {'FIRST': 0xe0, 'SECOND': 0xe1})
+        self.assertEqual(buf[166:173], bytes([0xe0, 0x16, 0x04, 0xe1, 0x10, 0x00, 0x00]))
+        self.assertEqual((macros[0].offset, macros[1].offset, macros[2].offset), (166, None, 169))
+
+    def test_encode_overflow(self):
+        """ Test that macros larger than the macro region are not encoded """
+        macros = [PacMacro('#1', bytes([0x04] * 3))]
+        self.assertIsNone(encode_macros(macros, bytearray(252), 248, 3))
+        self.assertIsNotNone(encode_macros(macros, bytearray(252), 248, 4))
@@ -0,0 +1,47 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+from unittest import TestCase
+
+from ultimarc.devices._mappings import IPACSeriesMapping, IPACSeriesDebounce, LegacyIPACMapping, \
+    IPACSeriesMappingKeys, LegacyIPACMappingKeys, get_ipac_series_mapping_key, get_ipac_series_debounce_key, \
+    get_ipac_series_macro_mapping_index, get_legacy_ipac_mapping_key, get_mapping_key
+
+
+def _linear_lookup(mapping, val):
+    """ Reference lookup, the first key with a matching value. """
+    for key, value in mapping.items():
+        if val == value:
+            return key
+    return None
+
+
+class MappingsTest(TestCase):
+
+    def test_reverse_tables_match_linear_lookup(self):
+        """ Test that the reverse tables return the same key as a scan of the mapping for every byte """
+        for val in range(256):
+            self.assertEqual(get_ipac_series_mapping_key(val), _linear_lookup(IPACSeriesMapping, val))
+            self.assertEqual(get_legacy_ipac_mapping_key(val), _linear_lookup(LegacyIPACMapping, val))
+            self.assertEqual(get_ipac_series_debounce_key(val),
+                             _linear_lookup(IPACSeriesDebounce, val) or 'standard')
+
+    def test_shared_values(self):
+        """ Test that values shared by several keys return the first key """
+        self.assertEqual(get_ipac_series_mapping_key(0x64), '\\')
+        self.assertEqual(get_legacy_ipac_mapping_key(0x5A), 'ENTER')
+
+    def test_macro_index(self):
+        """ Test the macro index lookup """
+        self.assertEqual(get_ipac_series_macro_mapping_index(0xe0), 0)
+        self.assertEqual(get_ipac_series_macro_mapping_index(0xee), 14)
+        self.assertIsNone(get_ipac_series_macro_mapping_index(0xef))
+        self.assertIsNone(get_ipac_series_macro_mapping_index(0x04))
+
+    def test_out_of_range(self):
+        """ Test that values outside of a byte are not mapped """
+        self.assertEqual(len(IPACSeriesMappingKeys), 256)
+        self.assertEqual(len(LegacyIPACMappingKeys), 256)
+        self.assertIsNone(get_mapping_key(IPACSeriesMappingKeys, -1))
+        self.assertIsNone(get_mapping_key(IPACSeriesMappingKeys, 0x100))
@@ -0,0 +1,94 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+import libusb as usb
+
+from ultimarc.devices import DeviceClassID, USBDevices
+from ultimarc.devices._metrics import InMemoryMetrics, JSONMetricsSink, LatencyHistogram, MetricsSink, \
+    PrometheusTextfileSink, get_metrics_sink, set_metrics_sink
+from ultimarc.devices._virtual import VirtualIpac2, VirtualUSB
+
+
+class MetricsTest(TestCase):
+
+    def test_histogram_quantiles(self):
+        """ Test the quantile estimates of the latency histogram """
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.quantile(0.5), 0.0)
+        for x in range(99):
+            histogram.observe(0.0008)
+        histogram.observe(0.2)
+        self.assertTrue(0.0005 < histogram.quantile(0.5) <= 0.001)
+        self.assertTrue(0.0005 < histogram.quantile(0.99) <= 0.001)
+        self.assertEqual(histogram.quantile(1.0), 0.2)
+        self.assertEqual(histogram.count, 100)
+
+    def test_record_transfer(self):
+        """ Test counting transfers, bytes, errors and timeouts """
+        sink = InMemoryMetrics()
+        sink.record_transfer('d209:0420', 'control_out', 'SET_CONFIGURATION', 5, 5, 0.001)
+        sink.record_transfer('d209:0420', 'control_out', 'SET_CONFIGURATION', 5, usb.LIBUSB_ERROR_TIMEOUT, 2.0)
+        sink.record_transfer('d209:0420', 'control_out', 'SET_CONFIGURATION', 5, usb.LIBUSB_ERROR_PIPE, 0.001)
+        sink.record_operation('enumerate', 0.5)
+
+        snapshot = sink.snapshot()
+        stats = snapshot['transfers'][0]
+        self.assertEqual(stats['transfers'], 3)
+        self.assertEqual(stats['bytes'], 5)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['errors'], {'LIBUSB_ERROR_TIMEOUT': 1, 'LIBUSB_ERROR_PIPE': 1})
+        self.assertEqual(snapshot['operations'], {'enumerate': {'calls': 1, 'seconds': 0.5}})
+        self.assertIn('d209:0420 control_out SET_CONFIGURATION: 3 transfers', sink.summary())
+
+    def test_file_sinks(self):
+        """ Test the Prometheus text file and JSON sinks """
+        with tempfile.TemporaryDirectory() as tmp:
+            prom = PrometheusTextfileSink(os.path.join(tmp, 'ultimarc.prom'))
+            prom.record_transfer('d209:0420', 'interrupt_in', '0x84', 5, 5, 0.0003)
+            self.assertTrue(prom.flush())
+            with open(prom.path) as h:
+                text = h.read()
+            labels = 'device="d209:0420",type="interrupt_in",request="0x84"'
+            self.assertIn(f'ultimarc_usb_transfers_total{{{labels}}} 1', text)
+            self.assertIn(f'ultimarc_usb_transfer_seconds_bucket{{{labels},le="0.00025"}} 0', text)
+            self.assertIn(f'ultimarc_usb_transfer_seconds_bucket{{{labels},le="0.0005"}} 1', text)
+            self.assertIn(f'ultimarc_usb_transfer_seconds_count{{{labels}}} 1', text)
+
+            sink = JSONMetricsSink(os.path.join(tmp, 'ultimarc.json'))
+            sink.record_operation('schema_validation', 0.01)
+            self.assertTrue(sink.flush())
+            with open(sink.path) as h:
+                self.assertEqual(json.load(h)['operations']['schema_validation']['calls'], 1)
+            # No temporary files are left behind.
+            self.assertEqual(sorted(os.listdir(tmp)), ['ultimarc.json', 'ultimarc.prom'])
+
+    def test_default_sink(self):
+        """ Test that metrics are discarded unless a sink keeping them is installed """
+        self.assertIs(type(get_metrics_sink()), MetricsSink)
+
+    def test_device_transfers(self):
+        """ Test that synchronous and asynchronous device transfers are recorded """
+        sink = InMemoryMetrics()
+        previous = set_metrics_sink(sink)
+        try:
+            with VirtualUSB([VirtualIpac2()]):
+                devices = USBDevices(['d209'])
+                with next(devices.filter(class_id=DeviceClassID.IPAC2)) as dev_h:
+                    for async_transfers in (True, False):
+                        dev_h.async_transfers = async_transfers
+                        self.assertIsNotNone(dev_h.read_device())
+                devices.close_all()
+        finally:
+            set_metrics_sink(previous)
+
+        stats = {(s['type'], s['request']): s for s in sink.snapshot()['transfers']}
+        self.assertEqual(stats[('control_out', 'SET_CONFIGURATION')]['transfers'], 2)
+        self.assertEqual(stats[('interrupt_in', '0x84')]['transfers'], 128)
+        self.assertEqual(stats[('interrupt_in', '0x84')]['bytes'], 640)
+        self.assertIn('enumerate', sink.operations)
@@ -0,0 +1,104 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import json
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+from ultimarc.devices._device import USBDeviceHandle
+from ultimarc.devices._pac import PacLayout, fill
+from ultimarc.devices._structures import PacStruct
+from ultimarc.devices.ipac2 import Ipac2Device
+from ultimarc.devices.ipac4 import Ipac4Device
+from ultimarc.devices.jpac import JpacDevice
+from ultimarc.devices.mini_pac import MiniPacDevice
+from ultimarc.devices.ultimate_io import UltimateIODevice
+from ultimarc.system_utils import git_project_root
+
+EXAMPLES = (
+    (Ipac2Device, 'ultimarc/examples/ipac2.json'),
+    (Ipac4Device, 'ultimarc/examples/ipac4.json'),
+    (JpacDevice, 'ultimarc/examples/jpac.json'),
+    (MiniPacDevice, 'ultimarc/examples/mini-pac.json'),
+    (UltimateIODevice, 'ultimarc/examples/ultimateIO/ultimate-io-pin.json'),
+)
+
+
+class PacCodecTest(TestCase):
+
+    def test_layout_template(self):
+        """ Test that the layout defaults are applied to the template """
+        layout = PacLayout('test', 'test-pins', 'test.schema', {'1up': (0, 50, 100)}, macro_start=166,
+                           macro_max_size=85, defaults={**fill(1, 4, 0xff), **fill(10, 14, 0x01, skip=(12,))})
+        self.assertEqual(len(layout.template), 252)
+        self.assertEqual(layout.template[0:5], b'\x00\xff\xff\xff\x00')
+        self.assertEqual(layout.template[10:15], b'\x01\x01\x00\x01\x00')
+        self.assertEqual(layout.pin_table, (('1up', 0, 50, 100),))
+
+    @patch.object(USBDeviceHandle, '_get_descriptor_fields', return_value=None)
+    @patch('libusb.get_device', return_value='pointer')
+    def test_round_trip(self, dev_handle_mock, lib_usb_mock):
+        """ Test that decoding an encoded example config and encoding it again gives the same bytes """
+        for device_class, example in EXAMPLES:
+            dev = USBDeviceHandle('test_handle', '0000:0000')
+            dev.__class__ = device_class
+
+            config_file = Path(git_project_root()) / example
+            valid, data = dev._create_device_message_(config_file)
+            self.assertTrue(valid, example)
+
+            json_obj = dev.to_json_str(data)
+            self.assertIsNotNone(json_obj, example)
+            valid, data_2 = dev._create_device_struct_(json_obj)
+            self.assertTrue(valid, example)
+            self.assertEqual(bytes(data), bytes(data_2), example)
+
+    @patch.object(USBDeviceHandle, '_get_descriptor_fields', return_value=None)
+    @patch('libusb.get_device', return_value='pointer')
+    def test_current_config_macros_cleared(self, dev_handle_mock, lib_usb_mock):
+        """ Test that old macro bytes are cleared when updating the current device configuration """
+        dev = USBDeviceHandle('test_handle', '0000:0000')
+        dev.__class__ = Ipac2Device
+
+        cur_config = PacStruct.from_buffer_copy(bytes(4) + bytes([0x44] * 252))
+        config_file = Path(git_project_root()) / 'tests/test-data/ipac2/ipac2-pin-optional.json'
+        valid, data = dev._create_device_message_(config_file, cur_config)
+        self.assertTrue(valid)
+        self.assertIs(data, cur_config)
+        self.assertEqual(bytes(data.bytes[166:]), bytes(252 - 166))
+        # Bytes not set by the config or the defaults are kept.
+        self.assertEqual(data.bytes[99], 0x44)
+
+    @patch.object(USBDeviceHandle, '_get_descriptor_fields', return_value=None)
+    @patch('libusb.get_device', return_value='pointer')
+    def test_invalid_config_leaves_current_config(self, dev_handle_mock, lib_usb_mock):
+        """ Test that the current configuration is not changed when the new config is not valid """
+        dev = USBDeviceHandle('test_handle', '0000:0000')
+        dev.__class__ = Ipac2Device
+
+        cur_config = PacStruct.from_buffer_copy(bytes(4) + bytes([0x44] * 252))
+        config_file = Path(git_project_root()) / 'tests/test-data/ipac2/ipac2-macro-large-action-count.json'
+        valid, data = dev._create_device_message_(config_file, cur_config)
+        self.assertFalse(valid)
+        self.assertEqual(bytes(cur_config.bytes), bytes([0x44] * 252))
+
+    @patch.object(USBDeviceHandle, '_get_descriptor_fields', return_value=None)
+    @patch('libusb.get_device', return_value='pointer')
+    def test_jpac_disabled_pins(self, dev_handle_mock, lib_usb_mock):
+        """ Test that disabled jpac pins are encoded and decoded """
+        dev = USBDeviceHandle('test_handle', '0000:0000')
+        dev.__class__ = JpacDevice
+
+        config_file = Path(git_project_root()) / 'ultimarc/examples/jpac.json'
+        with open(config_file) as h:
+            config = json.load(h)
+        name = config['pins'][0]['name']
+        config['pins'][0] = {'name': name, 'action': '', 'disabled': True}
+
+        valid, data = dev._create_device_struct_(config)
+        self.assertTrue(valid)
+        pins = dev.to_json_str(data)['pins']
+        self.assertTrue([p for p in pins if p['name'] == name][0]['disabled'])
+        self.assertEqual(len(pins), len(JpacDevice.layout.pins))
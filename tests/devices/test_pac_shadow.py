@@ -0,0 +1,100 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+from unittest import TestCase
+from unittest.mock import patch
+
+from ultimarc.devices._device import USBDeviceHandle
+from ultimarc.devices._structures import PacStruct
+from ultimarc.devices.ipac2 import Ipac2Device
+
+
+def device_config():
+    """ Return a configuration as read from a device, pin 1up set to 'A'. """
+    data = PacStruct()
+    data.header.type = 0x59
+    data.bytes[19] = 0x04
+    return data
+
+
+def device_state(write_mock):
+    """ Return a read side effect giving the configuration last written with write_mock, as the device would. """
+    def read(*args):
+        if write_mock.called:
+            return PacStruct.from_buffer_copy(write_mock.call_args[0][3])
+        return device_config()
+    return read
+
+
+class PacShadowConfigTest(TestCase):
+
+    def setUp(self) -> None:
+        super(PacShadowConfigTest, self).setUp()
+        with patch.object(USBDeviceHandle, '_get_descriptor_fields', return_value=None), \
+                patch('libusb.get_device', return_value='pointer'):
+            self.dev = USBDeviceHandle('test_handle', '0000:0000')
+        self.dev.__class__ = Ipac2Device
+
+        self.read_patch = patch.object(Ipac2Device, 'read_interrupt', side_effect=lambda *a: device_config())
+        self.write_patch = patch.object(Ipac2Device, 'write', return_value=True)
+        self.write_alt_patch = patch.object(Ipac2Device, 'write_alt', return_value=True)
+        self.read_mock = self.read_patch.start()
+        self.write_patch.start()
+        self.write_alt_mock = self.write_alt_patch.start()
+
+    def tearDown(self) -> None:
+        patch.stopall()
+        super(PacShadowConfigTest, self).tearDown()
+
+    def test_edits_read_device(self):
+        """ Test that every edit reads the device before it is written """
+        self.read_mock.side_effect = device_state(self.write_alt_mock)
+        self.assertTrue(self.dev.set_pin(['1up', 'B', '', 'false']))
+        self.assertTrue(self.dev.set_pin(['1down', 'C', '', 'false']))
+        self.assertTrue(self.dev.set_debounce('short'))
+        self.assertEqual(self.read_mock.call_count, 3)
+        self.assertEqual(self.write_alt_mock.call_count, 3)
+
+        data = self.write_alt_mock.call_args[0][3]
+        self.assertEqual(data.header.type, 0x50)
+        self.assertEqual(data.bytes[19], 0x05)
+        self.assertEqual(data.bytes[17], 0x06)
+
+    def test_unchanged_edit_not_written(self):
+        """ Test that an edit that changes nothing does not write to the device """
+        self.read_mock.side_effect = device_state(self.write_alt_mock)
+        self.dev.set_pin(['1up', 'A', '', 'false'])
+        self.assertEqual(self.write_alt_mock.call_count, 1)  # shift byte changed from 0 to 0x01
+        self.dev.set_pin(['1up', 'A', '', 'false'])
+        self.assertEqual(self.write_alt_mock.call_count, 1)
+
+    def test_deferred_commit(self):
+        """ Test that edits are coalesced into one write when auto commit is off """
+        self.dev.auto_commit = False
+        for pin in ['1up', '1down', '1left', '1right', '2up']:
+            self.assertTrue(self.dev.set_pin([pin, 'Z', '', 'false']))
+        self.write_alt_mock.assert_not_called()
+
+        ranges = self.dev.dirty_ranges()
+        # Pin action bytes 17, 19 - 21 and 23, after the 4 byte header.
+        self.assertEqual(ranges[:3], [(21, 22), (23, 26), (27, 28)])
+        self.assertTrue(self.dev.commit())
+        self.assertEqual(self.read_mock.call_count, 1)
+        self.assertEqual(self.write_alt_mock.call_count, 1)
+        self.assertEqual(self.dev.dirty_ranges(), [])
+
+    def test_failed_write_invalidates(self):
+        """ Test that a failed write makes the next edit read the device again """
+        self.write_alt_mock.return_value = False
+        self.assertFalse(self.dev.set_pin(['1up', 'B', '', 'false']))
+
+        self.write_alt_mock.return_value = True
+        self.assertTrue(self.dev.set_pin(['1up', 'B', '', 'false']))
+        self.assertEqual(self.read_mock.call_count, 2)
+
+    def test_read_failure(self):
+        """ Test that edits fail when the device can not be read """
+        self.read_mock.side_effect = lambda *a: None
+        self.assertFalse(self.dev.set_paclink(True))
+        self.write_alt_mock.assert_not_called()
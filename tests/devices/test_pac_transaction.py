@@ -0,0 +1,156 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+from unittest import TestCase
+from unittest.mock import patch
+
+from ultimarc.devices._device import USBDeviceHandle
+from ultimarc.devices._pac import PacDevice
+from ultimarc.devices._mappings import IPACSeriesMapping
+from ultimarc.devices._structures import PacStruct
+from ultimarc.devices.ipac2 import Ipac2Device
+from ultimarc.devices.jpac import JpacDevice
+
+
+def device_config():
+    """ Return a configuration as read from a device, pin 1up set to 'A' with alternate action 'B'. """
+    data = PacStruct()
+    data.header.type = 0x59
+    data.bytes[19] = 0x04
+    data.bytes[69] = 0x05
+    return data
+
+
+def device_state(write_mock):
+    """ Return a read side effect giving the configuration last written with write_mock, as the device would. """
+    def read(*args):
+        if write_mock.called:
+            return PacStruct.from_buffer_copy(write_mock.call_args[0][3])
+        return device_config()
+    return read
+
+
+class PacTransactionTest(TestCase):
+
+    def setUp(self) -> None:
+        super(PacTransactionTest, self).setUp()
+        with patch.object(USBDeviceHandle, '_get_descriptor_fields', return_value=None), \
+                patch('libusb.get_device', return_value='pointer'):
+            self.dev = USBDeviceHandle('test_handle', '0000:0000')
+        self.dev.__class__ = Ipac2Device
+
+        self.read_mock = patch.object(PacDevice, 'read_interrupt', side_effect=lambda *a: device_config()).start()
+        patch.object(PacDevice, 'write', return_value=True).start()
+        self.write_alt_mock = patch.object(PacDevice, 'write_alt', return_value=True).start()
+
+    def tearDown(self) -> None:
+        patch.stopall()
+        super(PacTransactionTest, self).tearDown()
+
+    def test_single_write(self):
+        """ Test that several staged changes are written once """
+        with self.dev.transaction() as tx:
+            self.assertTrue(tx.set_pin('1down', 'c'))
+            self.assertTrue(tx.set_pin('1left', '#1', 'd', shift=True))
+            self.assertTrue(tx.set_macro('#1', ['x', 'y']))
+            self.assertTrue(tx.set_debounce('short'))
+            self.assertTrue(tx.set_paclink(True))
+        self.assertTrue(tx.result)
+        self.assertEqual(self.read_mock.call_count, 1)
+        self.assertEqual(self.write_alt_mock.call_count, 1)
+
+        data = self.write_alt_mock.call_args[0][3]
+        config = self.dev.to_json_str(data)
+        pins = {p['name']: p for p in config['pins']}
+        self.assertEqual(pins['1up']['action'], 'A')
+        self.assertEqual(pins['1up']['alternate_action'], 'B')
+        self.assertEqual(pins['1down']['action'], 'C')
+        self.assertEqual(pins['1left'], {'name': '1left', 'action': '#1', 'alternate_action': 'D', 'shift': True})
+        self.assertEqual(config['macros'], [{'name': '#1', 'action': ['X', 'Y']}])
+        self.assertEqual(config['debounce'], 'short')
+        self.assertTrue(config['paclink'])
+
+    def test_replace_pin(self):
+        """ Test that a staged pin replaces every value of the pin """
+        with self.dev.transaction() as tx:
+            tx.set_pin('1up', 'c')
+        self.assertTrue(tx.result)
+        data = self.write_alt_mock.call_args[0][3]
+        self.assertEqual(data.bytes[19], IPACSeriesMapping['C'])
+        self.assertEqual(data.bytes[69], 0)
+
+    def test_unknown_values_kept(self):
+        """ Test that pins can be set when the configuration holds a value the decoder does not know """
+        def config():
+            data = device_config()
+            data.bytes[17] = 0xff  # 1down action is not a key or macro.
+            return data
+        self.read_mock.side_effect = lambda *a: config()
+
+        with self.dev.transaction() as tx:
+            tx.set_pin('1up', 'c', shift=True)
+            tx.set_debounce('short')
+        self.assertTrue(tx.result)
+        data = self.write_alt_mock.call_args[0][3]
+        self.assertEqual((data.bytes[19], data.bytes[69], data.bytes[17]), (IPACSeriesMapping['C'], 0, 0xff))
+        self.assertEqual(data.bytes[119], Ipac2Device.layout.shift_value)
+        # The whole configuration does not validate.
+        self.assertIsNone(self.dev.to_json_str(data))
+
+    def test_exception_rolls_back(self):
+        """ Test that nothing is written when the block raises an exception """
+        with self.assertRaises(RuntimeError):
+            with self.dev.transaction() as tx:
+                tx.set_pin('1up', 'c')
+                raise RuntimeError('abort')
+        self.assertIsNone(tx.result)
+        self.read_mock.assert_not_called()
+        self.write_alt_mock.assert_not_called()
+
+    def test_invalid_change_rolls_back(self):
+        """ Test that one invalid change stops every staged change from being written """
+        with self.dev.transaction() as tx:
+            tx.set_pin('1up', 'c')
+            self.assertFalse(tx.set_pin('99up', 'c'))
+        self.assertFalse(tx.result)
+        self.write_alt_mock.assert_not_called()
+
+        with self.dev.transaction() as tx:
+            tx.set_pin('1up', 'not-a-key')
+        self.assertFalse(tx.result)
+        self.write_alt_mock.assert_not_called()
+
+        with self.dev.transaction() as tx:
+            self.assertFalse(tx.set_debounce('slow'))
+            self.assertFalse(tx.set_macro('#1', ['a', 'not-a-key']))
+        self.assertFalse(tx.result)
+        self.write_alt_mock.assert_not_called()
+
+    def test_no_changes(self):
+        """ Test that an empty transaction or one that changes nothing does not write to the device """
+        with self.dev.transaction() as tx:
+            pass
+        self.assertTrue(tx.result)
+        self.read_mock.assert_not_called()
+
+        self.read_mock.side_effect = device_state(self.write_alt_mock)
+        for x in range(2):
+            with self.dev.transaction() as tx:
+                tx.set_pin('1up', 'a', 'b')
+            self.assertTrue(tx.result)
+        # Both transactions read the device, only the first changes it, it sets the layout default values.
+        self.assertEqual(self.read_mock.call_count, 2)
+        self.assertEqual(self.write_alt_mock.call_count, 1)
+
+    def test_disabled_pin(self):
+        """ Test that disabled pins can only be staged on boards that support them """
+        with self.dev.transaction() as tx:
+            self.assertFalse(tx.set_pin('1up', '', disabled=True))
+        self.assertFalse(tx.result)
+
+        self.dev.__class__ = JpacDevice
+        self.dev.invalidate()
+        with self.dev.transaction() as tx:
+            self.assertTrue(tx.set_pin('1up', '', disabled=True))
+        self.assertTrue(tx.result)
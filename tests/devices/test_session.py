@@ -0,0 +1,85 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import os
+import tempfile
+from unittest import TestCase
+
+from ultimarc.devices import DeviceClassID, USBDevices
+from ultimarc.devices._session import ReplayUSB, Session, SessionFormatError, start_recording, stop_recording
+from ultimarc.devices._virtual import VirtualIpac2, VirtualUSB, VirtualUSBButton
+from ultimarc.system_utils import git_project_root
+
+
+def run_session(async_transfers=True, debounce='short'):
+    """ Read an IPAC2 and change its debounce, then set the USB button color """
+    devices = USBDevices(['d209'])
+    try:
+        with next(devices.filter(class_id=DeviceClassID.IPAC2)) as dev_h:
+            dev_h.async_transfers = async_transfers
+            config = dev_h.read_device()
+            result = dev_h.set_debounce(debounce)
+        with next(devices.filter(class_id=DeviceClassID.USBButton)) as dev_h:
+            result = dev_h.set_color(1, 2, 3) and result
+            color = dev_h.get_color()
+    finally:
+        devices.close_all()
+    return bytes(config) if config else None, result, color
+
+
+class SessionTest(TestCase):
+
+    def setUp(self) -> None:
+        super(SessionTest, self).setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'session.bin')
+
+        with VirtualUSB([VirtualIpac2(), VirtualUSBButton()]):
+            start_recording()
+            self.expected = run_session()
+            self.session = stop_recording()
+        self.session.save(self.path)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+        super(SessionTest, self).tearDown()
+
+    def test_save_load(self):
+        """ Test that a session file reads back the same devices and transfers """
+        self.assertEqual(len(self.session.devices), 2)
+        # Two reads of a request and 64 reports, 64 configuration packets, color write and read.
+        self.assertEqual(len(self.session.transfers), 2 * (1 + 64) + 64 + 2)
+
+        loaded = Session.load(self.path)
+        self.assertEqual(loaded.devices, self.session.devices)
+        for old, new in zip(self.session.transfers, loaded.transfers):
+            self.assertEqual((new.bus, new.address, new.transfer_type, new.endpoint, new.setup, new.code, new.data),
+                             (old.bus, old.address, old.transfer_type, old.endpoint, old.setup, old.code, old.data))
+            self.assertAlmostEqual(new.timestamp, old.timestamp, places=5)
+
+    def test_replay(self):
+        """ Test that a replayed session gives the recorded results without the devices """
+        for async_transfers in (True, False):
+            with ReplayUSB(self.path) as replay:
+                self.assertEqual(run_session(async_transfers), self.expected)
+                for device in replay.devices:
+                    self.assertEqual((device.remaining, device.mismatches), (0, 0))
+
+    def test_replay_mismatch(self):
+        """ Test that a transfer not in the recording fails in strict mode """
+        with ReplayUSB(self.path), self.assertLogs('ultimarc', level='ERROR'):
+            config, result, color = run_session(debounce='long')
+        self.assertEqual(config, self.expected[0])
+        self.assertFalse(result)
+
+    def test_bad_file(self):
+        """ Test loading files that are not session files """
+        with self.assertRaises(SessionFormatError):
+            Session.load(os.path.join(git_project_root(), 'ultimarc/examples/ipac2.json'))
+        with open(self.path, 'rb') as h:
+            data = h.read()
+        with open(self.path, 'wb') as h:
+            h.write(data[:-3])
+        with self.assertRaises(SessionFormatError):
+            Session.load(self.path)
@@ -0,0 +1,84 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import os
+import struct
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from ultimarc.devices import DeviceClassID, USBDevices
+from ultimarc.devices import _device, _trace
+from ultimarc.devices._virtual import VirtualIpac2, VirtualUSB
+
+
+class TransferTraceTest(TestCase):
+
+    def setUp(self) -> None:
+        super(TransferTraceTest, self).setUp()
+        self.bus = VirtualUSB([VirtualIpac2()])
+        self.bus.install()
+        self.devices = USBDevices(['d209'])
+
+    def tearDown(self) -> None:
+        _trace.disable_trace()
+        self.devices.close_all()
+        self.bus.uninstall()
+        super(TransferTraceTest, self).tearDown()
+
+    def _read_device(self, async_transfers=True):
+        with next(self.devices.filter(class_id=DeviceClassID.IPAC2)) as dev_h:
+            dev_h.async_transfers = async_transfers
+            dev_h.invalidate()
+            self.assertIsNotNone(dev_h.read_device())
+
+    def test_disabled(self):
+        """ Test that nothing is recorded or formatted for debug output while disabled """
+        with next(self.devices.filter(class_id=DeviceClassID.IPAC2)) as dev_h, \
+                patch.object(_device._logger, 'isEnabledFor', return_value=False), \
+                patch.object(_device._logger, 'debug') as debug:
+            for async_transfers in (True, False):
+                dev_h.async_transfers = async_transfers
+                dev_h.invalidate()
+                self.assertIsNotNone(dev_h.read_device())
+                self.assertTrue(dev_h.commit())
+                dev_h.set_debounce('short')
+        debug.assert_not_called()
+        self.assertIsNone(_trace.active)
+
+    def test_ring_buffer(self):
+        """ Test that the trace keeps the most recent transfers with their payloads """
+        trace = _trace.enable_trace(size=10)
+        self._read_device()
+        self.assertEqual(len(trace), 10)
+        record = trace.records[-1]
+        self.assertEqual((record.transfer_type, record.endpoint, record.bus, record.address), ('interrupt', 0x84, 1, 1))
+        self.assertEqual(len(record.data), 5)
+
+        trace.clear()
+        self._read_device(async_transfers=False)
+        self.assertEqual([r.id for r in trace.records], list(range(121, 131)))
+
+    def test_dump(self):
+        """ Test writing the trace in the pcap usbmon format """
+        trace = _trace.enable_trace()
+        self._read_device(async_transfers=False)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trace.pcap')
+            trace.dump(path)
+            with open(path, 'rb') as h:
+                data = h.read()
+
+        magic, major, minor, _zone, _sigfigs, _snaplen, linktype = struct.unpack_from('<IHHiIII', data)
+        self.assertEqual((magic, linktype), (0xa1b2c3d4, _trace.LINKTYPE_USB_LINUX_MMAPPED))
+
+        # The first transfer is the configuration request, a control transfer with a 5 byte payload.
+        _ts, _us, incl_len, orig_len = struct.unpack_from('<IIII', data, 24)
+        self.assertEqual(incl_len, 64 + 5)
+        header = _trace._usbmon_header.unpack_from(data, 40)
+        self.assertEqual(chr(header[1]), 'S')
+        self.assertEqual(header[2], 2)  # control
+        self.assertEqual(header[13][:2], bytes([0x21, 0x09]))  # class interface OUT, SET_CONFIGURATION
+        self.assertEqual(data[104:109], bytes([0x03, 0x59, 0xdd, 0x0f, 0x00]))
+        self.assertEqual(len(data), 24 + 65 * 2 * 80 + 65 * 5)
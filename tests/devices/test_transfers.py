@@ -0,0 +1,133 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import asyncio
+import ctypes as ct
+from unittest import TestCase
+from unittest.mock import patch
+
+import libusb as usb
+
+from ultimarc.devices import _transfers
+from ultimarc.devices._device import USBDeviceHandle, USBRequestCode
+from ultimarc.devices._structures import PacStruct
+from ultimarc.devices.ipac2 import Ipac2Device
+
+
+class FakeLibusb:
+    """
+    Records control transfers and answers interrupt reads. Transfers complete as they are submitted, unless
+    auto_complete is False, then they wait in 'pending' until complete() is called.
+    """
+
+    def __init__(self, reports=None, fail_at=None, auto_complete=True):
+        self.auto_complete = auto_complete
+        self.pending = list()
+        self.control = list()
+        self.reports = list(reports or [])
+        self.fail_at = fail_at
+        self.submitted = 0
+        self.max_in_flight = 0
+        self._in_flight = 0
+
+    def submit_transfer(self, transfer_p):
+        transfer = transfer_p.contents
+        self.submitted += 1
+        self._in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self._in_flight)
+        transfer.status = usb.LIBUSB_TRANSFER_COMPLETED
+        if transfer.type == usb.LIBUSB_TRANSFER_TYPE_CONTROL:
+            self.control.append(ct.string_at(transfer.buffer, transfer.length))
+            transfer.actual_length = transfer.length - usb.LIBUSB_CONTROL_SETUP_SIZE
+        else:
+            report = self.reports.pop(0)
+            ct.memmove(transfer.buffer, report, len(report))
+            transfer.actual_length = len(report)
+        if self.submitted == self.fail_at:
+            transfer.status = usb.LIBUSB_TRANSFER_TIMED_OUT
+
+        if self.auto_complete:
+            self.complete(transfer_p)
+        else:
+            self.pending.append(transfer_p)
+        return 0
+
+    def complete(self, transfer_p):
+        self._in_flight -= 1
+        _transfers._transfer_done(transfer_p)
+
+
+class USBTransferTest(TestCase):
+
+    def setUp(self) -> None:
+        super(USBTransferTest, self).setUp()
+        with patch.object(USBDeviceHandle, '_get_descriptor_fields', return_value=None), \
+                patch('libusb.get_device', return_value='pointer'):
+            self.dev = USBDeviceHandle('test_handle', '0000:0000')
+        self.dev.__class__ = Ipac2Device
+        self.dev.__libusb_dev_handle__ = None
+        patch.object(_transfers, 'start_event_thread').start()
+
+    def tearDown(self) -> None:
+        patch.stopall()
+        super(USBTransferTest, self).tearDown()
+
+    @staticmethod
+    def _fake(fake):
+        """ Patch libusb to submit transfers to a FakeLibusb object """
+        patch('libusb.submit_transfer', side_effect=fake.submit_transfer).start()
+        return fake
+
+    def test_write_alt_queues_all_packets(self):
+        """ Test that write_alt submits one control transfer per 4 byte packet """
+        fake = self._fake(FakeLibusb())
+        data = PacStruct()
+        data.header.type = 0x50
+        data.bytes[0] = 0x7f
+        self.assertTrue(self.dev.write_alt(USBRequestCode.SET_CONFIGURATION, 0x03, self.dev.PAC_INDEX,
+                                           data, ct.sizeof(data)))
+        self.assertEqual(len(fake.control), 64)
+
+        setup = usb.control_setup.from_buffer_copy(fake.control[0][:8])
+        self.assertEqual(setup.bRequest, USBRequestCode.SET_CONFIGURATION)
+        self.assertEqual(setup.wValue, 0x203)
+        self.assertEqual(setup.wIndex, 0x02)
+        self.assertEqual(setup.wLength, 5)
+        self.assertEqual(fake.control[0][8:], b'\x03\x50\x00\x00\x00')
+        self.assertEqual(fake.control[1][8:], b'\x03\x7f\x00\x00\x00')
+
+    def test_write_alt_failure(self):
+        """ Test that write_alt fails if any packet fails """
+        self._fake(FakeLibusb(fail_at=3))
+        data = PacStruct()
+        with self.assertLogs('ultimarc', level='ERROR'):
+            self.assertFalse(self.dev.write_alt(USBRequestCode.SET_CONFIGURATION, 0x03, self.dev.PAC_INDEX,
+                                                data, ct.sizeof(data)))
+
+    def test_read_interrupt_in_flight(self):
+        """ Test that read_interrupt keeps several transfers submitted and assembles the reports in order """
+        reports = [bytes([0x03, x, x, x, x]) for x in range(64)]
+        fake = self._fake(FakeLibusb(reports, auto_complete=False))
+
+        future = self.dev._queue_read_interrupt_(0x84, PacStruct())
+        while fake.pending:
+            fake.complete(fake.pending.pop(0))
+        config = future.result(timeout=1)
+
+        self.assertEqual(fake.max_in_flight, self.dev.in_flight)
+        self.assertEqual(fake.submitted, 64)
+        self.assertEqual(config.header.type, 0)
+        self.assertEqual(config.bytes[0], 1)
+        self.assertEqual(config.bytes[251], 63)
+
+    def test_read_device_async(self):
+        """ Test the awaitable read of a PAC device configuration """
+        reports = [bytes([0x03, 0x59, 0xdd, 0x0f, 0x00])] + [bytes([0x03, 0x04, 0, 0, 0])] * 63
+        fake = self._fake(FakeLibusb(reports))
+
+        config = asyncio.run(self.dev.read_device_async())
+        self.assertEqual(config.header.type, 0x59)
+        self.assertEqual(config.bytes[0], 0x04)
+        self.assertEqual(fake.control[0][8:], b'\x03\x59\xdd\x0f\x00')
+        self.assertEqual(self.dev.dirty_ranges(), [])
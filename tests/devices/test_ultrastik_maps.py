@@ -0,0 +1,79 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from ultimarc.devices import USBDevices
+from ultimarc.devices._ultrastik_maps import EXAMPLES_DIR, UltraStikMapCache
+from ultimarc.devices._virtual import VirtualUltraStik, VirtualUSB
+from ultimarc.devices.ultrastik import UltraStikDevice, UltraStikPre2015Device
+
+
+class UltraStikMapCacheTest(TestCase):
+
+    def setUp(self) -> None:
+        super(UltraStikMapCacheTest, self).setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.tmp.name, 'cache', 'ultrastik-maps.json')
+        self.maps = UltraStikMapCache([os.path.join(self.tmp.name, 'maps'), str(EXAMPLES_DIR)], self.cache_file)
+        self.ustik = VirtualUltraStik(controller_id=1)
+        self.ustik_pre = VirtualUltraStik(controller_id=2, pre_2015=True)
+        self.bus = VirtualUSB([self.ustik, self.ustik_pre])
+        self.bus.install()
+        self.devices = USBDevices(['d209'])
+
+    def tearDown(self) -> None:
+        self.devices.close_all()
+        self.bus.uninstall()
+        self.tmp.cleanup()
+        super(UltraStikMapCacheTest, self).tearDown()
+
+    def _open(self, pre_2015=False):
+        cls = UltraStikPre2015Device if pre_2015 else UltraStikDevice
+        return next(dev for dev in self.devices.filter(class_id='ultrastik') if dev.__dev_class__ is cls)
+
+    def test_names(self):
+        """ Test that the example maps are found and files that are not maps are left out """
+        names = self.maps.names()
+        for name in ('analog', 'joy4way', 'joy8way', 'mouse', 'pre-2015-map2way'):
+            self.assertIn(name, names)
+        self.assertNotIn('controller-id', names)
+
+    def test_switch_map(self):
+        """ Test that a map is only sent when the joystick does not already hold it """
+        with self._open() as dev_h:
+            self.assertTrue(dev_h.switch_map('joy4way', self.maps))
+            self.assertEqual(self.ustik.writes, 1)
+            expected = UltraStikDevice.compile_config(str(EXAMPLES_DIR / 'ultrastik-joy4way.json'))[1]
+            self.assertEqual(bytes(self.ustik.config), expected)
+
+            self.assertTrue(dev_h.switch_map('joy4way', self.maps))
+            self.assertEqual(self.ustik.writes, 1)
+            self.assertTrue(dev_h.switch_map('joy8way', self.maps))
+            self.assertEqual(self.ustik.writes, 2)
+            self.assertFalse(dev_h.switch_map('missing', self.maps))
+
+        with self._open(pre_2015=True) as dev_h:
+            self.assertTrue(dev_h.switch_map('pre-2015-map2way', self.maps))
+            self.assertEqual(self.ustik_pre.writes, 1)
+
+    def test_compiled_maps_are_stored(self):
+        """ Test that stored payloads are used without compiling until the map file changes """
+        payload = self.maps.payload(UltraStikDevice, 'joy8way')
+        self.assertTrue(os.path.exists(self.cache_file))
+
+        maps = UltraStikMapCache(self.maps.map_dirs, self.cache_file)
+        with patch.object(UltraStikDevice, 'compile_config', return_value=None) as compile_config:
+            self.assertEqual(maps.payload(UltraStikDevice, 'joy8way'), payload)
+            compile_config.assert_not_called()
+
+            # A user map replaces the example map.
+            os.makedirs(maps.map_dirs[0])
+            shutil.copy(EXAMPLES_DIR / 'ultrastik-joy8way.json', maps.map_dirs[0])
+            self.assertIsNone(maps.payload(UltraStikDevice, 'joy8way'))
+            compile_config.assert_called_once()
@@ -0,0 +1,161 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import asyncio
+import ctypes as ct
+import os
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+import libusb as usb
+
+from ultimarc.devices import DeviceClassID, USBDevices
+from ultimarc.devices._virtual import VirtualIpac2, VirtualJpac, VirtualUltimateIO, VirtualUltraStik, \
+    VirtualUSB, VirtualUSBButton
+from ultimarc.system_utils import git_project_root
+
+
+class VirtualDeviceTest(TestCase):
+
+    def setUp(self) -> None:
+        super(VirtualDeviceTest, self).setUp()
+        self.ipac2 = VirtualIpac2()
+        self.jpac = VirtualJpac()
+        self.uio = VirtualUltimateIO()
+        self.button = VirtualUSBButton()
+        self.ustik = VirtualUltraStik(controller_id=1)
+        self.ustik_pre = VirtualUltraStik(controller_id=3, pre_2015=True)
+        self.bus = VirtualUSB([self.ipac2, self.jpac, self.uio, self.button, self.ustik, self.ustik_pre])
+        self.bus.install()
+        self.devices = USBDevices(['d209'])
+
+    def tearDown(self) -> None:
+        self.devices.close_all()
+        self.bus.uninstall()
+        super(VirtualDeviceTest, self).tearDown()
+
+    def _open(self, class_id):
+        return next(self.devices.filter(class_id=class_id))
+
+    def test_enumerate(self):
+        """ Test that the virtual devices are found with their descriptor values """
+        keys = sorted(dev.dev_key for dev in self.devices)
+        self.assertEqual(keys, ['d209:0410', 'd209:0420', 'd209:0450', 'd209:0503', 'd209:0511', 'd209:1200'])
+        with self._open(DeviceClassID.IPAC2) as dev_h:
+            self.assertEqual(dev_h.get_descriptor_string(dev_h.get_descriptor_value('iManufacturer')), 'Ultimarc')
+
+    def test_pac_config_round_trip(self):
+        """ Test that a configuration written to a PAC board is read back, with and without async transfers """
+        config_file = os.path.join(git_project_root(), 'tests/test-data/ipac2/ipac2-good.json')
+        with self._open(DeviceClassID.IPAC2) as dev_h:
+            self.assertTrue(dev_h.set_config(config_file, False))
+            written = bytes(self.ipac2.config)
+        self.assertEqual(self.ipac2.writes, 1)
+
+        for async_transfers in (True, False):
+            with self._open(DeviceClassID.IPAC2) as dev_h:
+                dev_h.async_transfers = async_transfers
+                dev_h.invalidate()
+                self.assertEqual(bytes(dev_h.read_device())[4:], written[4:])
+
+        with self._open(DeviceClassID.JPAC) as dev_h:
+            config = asyncio.run(dev_h.read_device_async())
+            self.assertEqual(bytes(config)[4:], bytes(VirtualJpac.layout.template))
+
+    def test_ultimate_io_leds(self):
+        """ Test the Ultimate IO LED commands """
+        with self._open(DeviceClassID.UltimateIO) as dev_h:
+            self.assertTrue(dev_h.set_all_led_intensities(100))
+            self.assertTrue(dev_h.set_led_intensity(3, 255))
+            self.assertTrue(dev_h.set_led_fade_rate(20))
+        self.assertEqual(self.uio.leds[:4], bytearray([100, 100, 255, 100]))
+        self.assertEqual(self.uio.fade_rate, 20)
+        self.assertEqual(self.uio.writes, 0)
+
+    def test_ultimate_io_led_frame(self):
+        """ Test that LED frames only send the LEDs that changed, using the all intensities command when shorter """
+        with self._open(DeviceClassID.UltimateIO) as dev_h, \
+                patch.object(self.uio, 'command', wraps=self.uio.command) as command:
+            frame = bytearray([10]) * 96
+            self.assertTrue(dev_h.set_led_frame(frame))
+            self.assertEqual(command.call_count, 1)
+            self.assertTrue(dev_h.set_led_frame(frame))
+            self.assertEqual(command.call_count, 1)
+
+            frame[0], frame[50], frame[95] = 1, 2, 3
+            self.assertTrue(dev_h.set_led_frame(frame))
+            self.assertEqual(command.call_count, 4)
+            self.assertEqual(self.uio.leds, frame)
+
+            frame = bytearray([200]) * 96
+            frame[10:15] = bytes(5)
+            self.assertTrue(dev_h.set_led_frame(list(frame)))
+            self.assertEqual(command.call_count, 10)
+            self.assertEqual(self.uio.leds, frame)
+
+            # A single LED command already sent is skipped, random states make the LEDs unknown.
+            self.assertTrue(dev_h.set_led_intensity(11, 0))
+            self.assertEqual(command.call_count, 10)
+            self.assertTrue(dev_h.set_led_random_state())
+            self.assertTrue(dev_h.set_led_frame(frame))
+            self.assertEqual(command.call_count, 17)
+
+            self.assertRaises(ValueError, dev_h.set_led_frame, bytes(95))
+
+    def test_usb_button_color(self):
+        """ Test setting and reading the USB button color """
+        with self._open(DeviceClassID.USBButton) as dev_h:
+            self.assertTrue(dev_h.set_color(10, 20, 30))
+            self.assertEqual(dev_h.get_color(), (10, 20, 30))
+        self.assertEqual(self.button.color, (10, 20, 30))
+
+    def test_ultrastik_controller_id(self):
+        """ Test that changing the controller id changes the product id of both UltraStik models """
+        for dev_info in list(self.devices.filter(class_id=DeviceClassID.UltraStik)):
+            with dev_info as dev_h:
+                self.assertTrue(dev_h.set_controller_id(4))
+        self.assertEqual(self.ustik.product_id, 0x0514)
+        self.assertEqual(self.ustik_pre.product_id, 0x0504)
+        self.devices.rescan()
+        self.assertIn('d209:0514', [dev.dev_key for dev in self.devices])
+
+    def test_claim_busy(self):
+        """ Test that an interface claimed by one handle can't be claimed by another """
+        dev_list = ct.POINTER(ct.POINTER(usb.device))()
+        self.assertEqual(usb.get_device_list(None, ct.byref(dev_list)), 6)
+        handles = [ct.POINTER(usb.device_handle)(), ct.POINTER(usb.device_handle)()]
+        for handle in handles:
+            self.assertEqual(usb.open(dev_list[0], ct.byref(handle)), usb.LIBUSB_SUCCESS)
+        usb.free_device_list(dev_list, 1)
+
+        self.assertEqual(usb.claim_interface(handles[0], 2), usb.LIBUSB_SUCCESS)
+        self.assertEqual(usb.claim_interface(handles[1], 2), usb.LIBUSB_ERROR_BUSY)
+        self.assertEqual(usb.claim_interface(handles[1], 3), usb.LIBUSB_ERROR_NOT_FOUND)
+        usb.close(handles[0])
+        self.assertEqual(usb.claim_interface(handles[1], 2), usb.LIBUSB_SUCCESS)
+        usb.close(handles[1])
+
+    def test_detach(self):
+        """ Test that a detached device is removed on rescan """
+        self.bus.detach(self.button)
+        self.devices.rescan()
+        self.assertNotIn('d209:1200', [dev.dev_key for dev in self.devices])
+
+    def test_round_trip_overlaps(self):
+        """ Test that queued asynchronous transfers overlap their round trip time """
+        self.bus.round_trip = 0.002
+        for async_transfers in (False, True):
+            with self._open(DeviceClassID.IPAC2) as dev_h:
+                dev_h.async_transfers = async_transfers
+                dev_h.invalidate()
+                start = time.monotonic()
+                self.assertIsNotNone(dev_h.read_device())
+                elapsed = time.monotonic() - start
+            if async_transfers:
+                # 65 transfers with 4 in flight, the synchronous read takes at least 65 round trips.
+                self.assertLess(elapsed, sync_elapsed)
+            else:
+                sync_elapsed = elapsed
+                self.assertGreaterEqual(elapsed, 0.002 * 65)
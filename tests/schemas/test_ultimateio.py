@@ -122,3 +122,24 @@ class UltimateIOSchemaTest(TestCase):
 
         with self.assertRaises(fastjsonschema.JsonSchemaValueException):
             self.config_led_validation(bad_config)
+
+    def test_ultimateio_animation_json(self):
+        """ Test the ultimate-io animation example and a bad animation against the animation schema """
+        schema_file = Path(git_project_root()) / 'ultimarc/schemas/ultimate-io-animation.schema'
+        self.assertTrue(schema_file.is_file())
+        with open(schema_file) as h:
+            config_animation_validation = fastjsonschema.compile(json.loads(h.read()))
+
+        config_file = Path(git_project_root()) / 'ultimarc/examples/ultimateIO/ultimate-io-animation.json'
+        self.assertTrue(config_file.is_file())
+        with open(config_file) as h:
+            good_config = json.loads(h.read())
+        self.assertIsNotNone(config_animation_validation(good_config))
+
+        bad_config_file = Path(git_project_root()) / 'tests/test-data/ultimateIO/ultimateio-animation-bad.json'
+        self.assertTrue(bad_config_file.is_file())
+        with open(bad_config_file) as h:
+            bad_config = json.loads(h.read())
+
+        with self.assertRaises(fastjsonschema.JsonSchemaValueException):
+            config_animation_validation(bad_config)
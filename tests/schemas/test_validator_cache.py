@@ -0,0 +1,81 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+import fastjsonschema
+
+from ultimarc.devices import _validators
+from ultimarc.devices._device import USBDeviceHandle
+from ultimarc.system_utils import git_project_root
+
+
+class ValidatorCacheTest(TestCase):
+
+    def setUp(self) -> None:
+        super(ValidatorCacheTest, self).setUp()
+        self._tmp_dir = tempfile.mkdtemp()
+        _validators.clear_cache()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self._tmp_dir)
+        _validators.clear_cache()
+        super(ValidatorCacheTest, self).tearDown()
+
+    def test_validator_compiled_once(self):
+        """ Test that the schema is only compiled once while the file is unchanged """
+        with patch.object(_validators, 'COMPILED_DIR', Path(self._tmp_dir)), \
+                patch('fastjsonschema.compile', wraps=fastjsonschema.compile) as compile_mock:
+            config = {'schemaVersion': 2.0, 'resourceType': 'ultrastik-controller-id', 'deviceClass': 'ultrastik',
+                      'currentControllerId': 1, 'newControllerId': 2}
+            self.assertTrue(USBDeviceHandle.validate_config(config, 'ultrastik-controller-id.schema'))
+            self.assertTrue(USBDeviceHandle.validate_config(config, 'ultrastik-controller-id.schema'))
+            config['newControllerId'] = 9
+            self.assertFalse(USBDeviceHandle.validate_config(config, 'ultrastik-controller-id.schema'))
+            self.assertEqual(compile_mock.call_count, 1)
+
+    def test_schema_change_recompiles(self):
+        """ Test that a change to the schema file mtime drops the cached validator """
+        schema_dir = Path(self._tmp_dir)
+        schema_path = schema_dir / 'test.schema'
+        schema_path.write_text('{"type": "object", "required": ["a"]}')
+        os.utime(schema_path, ns=(1, 1))
+
+        with patch.object(_validators, 'SCHEMA_DIR', schema_dir), \
+                patch.object(_validators, 'COMPILED_DIR', schema_dir / 'compiled'):
+            _schema, validator = _validators.get_schema_validator('test.schema')
+            self.assertRaises(fastjsonschema.JsonSchemaException, validator, {})
+
+            schema_path.write_text('{"type": "object"}')
+            os.utime(schema_path, ns=(2, 2))
+            _schema, validator = _validators.get_schema_validator('test.schema')
+            self.assertEqual(validator({}), {})
+
+    def test_generated_validators(self):
+        """ Test that generated validator modules are used and stale modules are ignored """
+        compiled_dir = Path(self._tmp_dir) / 'compiled'
+        with patch.object(_validators, 'COMPILED_DIR', compiled_dir):
+            generated = _validators.build_validators(compiled_dir)
+            self.assertEqual(len(generated), len(list(_validators.SCHEMA_DIR.glob('*.schema'))))
+
+            with patch('fastjsonschema.compile') as compile_mock:
+                config_file = Path(git_project_root()) / 'tests/test-data/usb-button/usb-button-color-good.json'
+                self.assertTrue(USBDeviceHandle.validate_config_base(config_file, ['usb-button-color']))
+                compile_mock.assert_not_called()
+
+            # A generated module that no longer matches the schema file must not be used.
+            module_path = compiled_dir / 'base_schema.py'
+            module_path.write_text(module_path.read_text().replace('SCHEMA_HASH = ', 'SCHEMA_HASH = "x" + '))
+            for schema_file in ['base.schema', 'ipac2.schema']:
+                schema_hash = _validators._schema_hash((_validators.SCHEMA_DIR / schema_file).read_bytes())
+                validator = _validators._load_generated(schema_file, schema_hash)
+                if schema_file == 'base.schema':
+                    self.assertIsNone(validator)
+                else:
+                    self.assertIsNotNone(validator)
@@ -0,0 +1,36 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+from ultimarc.devices import _USB_PRODUCT_CLASSES, product_class
+from ultimarc.tools._commands import COMMANDS, scan_tools
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class CommandIndexTest(TestCase):
+    """ Test the command index and lazy imports used by the command line entry point """
+
+    def test_index_current(self):
+        """ The generated index must match the tool modules, run 'python -m ultimarc.tools._commands' """
+        self.assertEqual(COMMANDS, scan_tools())
+
+    def test_help_skips_devices(self):
+        """ Showing the command list must not import libusb or the device modules """
+        code = 'import sys; sys.argv = ["ultimarc", "--help"]; ' \
+               'from ultimarc.tools.__main__ import run; run(); ' \
+               'print("modules:" + ",".join(m for m in sys.modules if m == "libusb" or m.startswith("ultimarc.devices")))'
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=_ROOT, text=True)
+        self.assertEqual(output.strip().splitlines()[-1], 'modules:')
+
+    def test_product_class(self):
+        """ Device classes resolve from the product key """
+        for key, path in _USB_PRODUCT_CLASSES.items():
+            cls = product_class(key + '1')
+            self.assertEqual(f'{cls.__module__}:{cls.__name__}', path)
+        self.assertIsNone(product_class('d209:999'))
@@ -0,0 +1,134 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import contextlib
+import io
+import os
+import tempfile
+from unittest import TestCase
+
+from ultimarc.daemon import DaemonClient, DaemonError, DaemonServer, _absolute_paths
+from ultimarc.devices import DeviceClassID, USBDevices
+from ultimarc.devices._locks import DeviceLocks
+from ultimarc.devices._metrics import MetricsSink, get_metrics_sink
+from ultimarc.devices._virtual import VirtualIpac2, VirtualUltimateIO, VirtualUSB, VirtualUSBButton
+from ultimarc.system_utils import git_project_root
+
+
+class DaemonTest(TestCase):
+
+    def setUp(self) -> None:
+        super(DaemonTest, self).setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.ipac2 = VirtualIpac2()
+        self.uio = VirtualUltimateIO()
+        self.button = VirtualUSBButton()
+        self.bus = VirtualUSB([self.ipac2, self.uio, self.button])
+        self.bus.install()
+        self.locks = DeviceLocks(os.path.join(self.tmp.name, 'locks'), timeout=0.1)
+        self.devices = USBDevices(['d209'], device_locks=self.locks)
+        self.path = os.path.join(self.tmp.name, 'daemon.sock')
+        self.server = DaemonServer(self.devices, self.path)
+        self.server.start()
+        self.client = DaemonClient(self.path, timeout=10)
+
+    def tearDown(self) -> None:
+        self.client.close()
+        self.server.stop()
+        self.devices.close_all()
+        self.bus.uninstall()
+        self.tmp.cleanup()
+        super(DaemonTest, self).tearDown()
+
+    def test_requests(self):
+        """ Test device requests over one connection, the device handles stay open between requests """
+        self.assertEqual(self.client.call('ping')['devices'], 3)
+        self.assertEqual(sorted(d['class_id'] for d in self.client.call('list')),
+                         ['ipac2', 'ultimate-io', 'usb-button'])
+
+        result = self.client.call('set-color', class_id='usb-button', color=[10, 20, 30])
+        self.assertTrue(result[0]['result'])
+        self.assertEqual(tuple(self.button.color), (10, 20, 30))
+
+        result = self.client.call('set-pin', class_id='ipac2', pins=[['1up', 'a', '', 'false']])
+        self.assertTrue(result[0]['result'])
+        config = self.client.call('get-config', class_id='ipac2')[0]['result']
+        self.assertEqual([p for p in config['pins'] if p['name'] == '1up'][0]['action'], 'A')
+
+        self.assertTrue(self.client.call('set-leds', all_intensity=100)[0]['result'])
+        self.assertEqual(set(self.uio.leds), {100})
+        self.assertEqual(len(self.devices._pool), 3)
+
+    def test_errors(self):
+        """ Test that request errors are returned without closing the connection """
+        self.assertRaises(DaemonError, self.client.call, 'no-such-method')
+        self.assertRaises(DaemonError, self.client.call, 'set-color', class_id='usb-button', color=[300, 0, 0])
+        self.assertRaises(DaemonError, self.client.call, 'set-config', config='relative.json')
+        self.assertEqual(self.client.call('rescan'), 3)
+
+    def test_run_tool(self):
+        """ Test running a command line tool in the daemon """
+        config_file = os.path.join(git_project_root(), 'tests/test-data/ipac2/ipac2-good.json')
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(self.client.run_tool(['ipac2', '--set-config', config_file, '-q']), 0)
+        self.assertEqual(output.getvalue().strip(), '')
+        self.assertEqual(self.ipac2.writes, 1)
+
+        result = self.client.call('run', argv=['ipac2', '--get-config'])
+        self.assertEqual(result['exit_code'], 0)
+        self.assertIn('"pins"', result['stdout'])
+        self.assertEqual(self.client.call('run', argv=['ipac2', '--bad-arg'])['exit_code'], 2)
+        # Tools that capture or replay transfers run in the calling process.
+        self.assertIsNone(self.client.run_tool(['ipac2', '--get-config', '--no-daemon']))
+
+    def test_run_tool_output(self):
+        """ Test that a tool writes to the streams it is given, not the output of the daemon """
+        with contextlib.redirect_stdout(io.StringIO()) as output, contextlib.redirect_stderr(io.StringIO()) as errors:
+            result = self.client.call('run', argv=['ipac2', '--help'])
+            self.assertTrue(result['system_exit'])
+            self.assertIn('usage: ipac2', result['stdout'])
+            result = self.client.call('run', argv=['ipac2', '--bad-arg'])
+            self.assertIn('unrecognized arguments: --bad-arg', result['stderr'])
+            self.assertIn('"pins"', self.client.call('run', argv=['ipac2', '--get-config'])['stdout'])
+        self.assertEqual((output.getvalue(), errors.getvalue()), ('', ''))
+
+    def test_absolute_paths(self):
+        """ Test that the client makes the path arguments of a tool absolute """
+        self.assertEqual(_absolute_paths(['ipac2', '--get-config', '--file', 'out.json', '--stats-file=stats.json',
+                                          '--set-config', 'ipac2.json']),
+                         ['ipac2', '--get-config', '--file', os.path.abspath('out.json'),
+                          '--stats-file=' + os.path.abspath('stats.json'), '--set-config', 'ipac2.json'])
+        self.assertEqual(_absolute_paths(['ultrastik', '--set-config', 'joy4way.json']),
+                         ['ultrastik', '--set-config', os.path.abspath('joy4way.json')])
+
+    def test_run_tool_stats(self):
+        """ Test that each tool run reports only its own transfers and the daemon keeps discarding metrics """
+        stats_file = os.path.join(self.tmp.name, 'stats.json')
+        result = self.client.call('run', argv=['ipac2', '--get-config', '--stats-file', stats_file])
+        self.assertEqual(result['exit_code'], 0)
+        self.assertTrue(os.path.exists(stats_file))
+        self.assertIs(type(get_metrics_sink()), MetricsSink)
+
+        config_file = os.path.join(git_project_root(), 'tests/test-data/ipac2/ipac2-good.json')
+        for x in range(2):
+            result = self.client.call('run', argv=['ipac2', '--set-config', config_file, '--stats'])
+            self.assertIn('control_out SET_CONFIGURATION: 64 transfers', result['stderr'])
+        self.assertIs(type(get_metrics_sink()), MetricsSink)
+
+    def test_release_for_local_tool(self):
+        """ Test that a tool running in its own process can open a device the daemon holds open """
+        self.assertTrue(self.client.call('set-color', class_id='usb-button', color=[1, 2, 3])[0]['result'])
+        self.assertEqual(len(self.devices._pool), 1)
+
+        local = USBDevices(['d209'], device_locks=self.locks)
+        try:
+            self.assertIsNone(self.client.run_tool(['usb-button', '--get-config', '--no-daemon']))
+            self.assertEqual(len(self.devices._pool), 0)
+            with next(local.filter(class_id=DeviceClassID.USBButton)) as dev_h:
+                self.assertTrue(dev_h.set_color(4, 5, 6))
+        finally:
+            local.close_all()
+        # The daemon opens the device again for the next request.
+        self.assertTrue(self.client.call('set-color', class_id='usb-button', color=[7, 8, 9])[0]['result'])
+        self.assertEqual(tuple(self.button.color), (7, 8, 9))
@@ -0,0 +1,72 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import threading
+import time
+from unittest import TestCase
+
+from ultimarc.tools import ToolEnvironmentObject, run_device_jobs
+
+
+class FakeDeviceInfo:
+    """ Stands in for a USBDeviceInfo object, counts how many devices are open at the same time. """
+    lock = threading.Lock()
+    open_count = 0
+    max_open = 0
+
+    def __init__(self, address):
+        self.dev_key = 'd209:0410'
+        self.bus = 1
+        self.address = address
+
+    def __enter__(self):
+        with self.lock:
+            FakeDeviceInfo.open_count += 1
+            FakeDeviceInfo.max_open = max(FakeDeviceInfo.max_open, FakeDeviceInfo.open_count)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self.lock:
+            FakeDeviceInfo.open_count -= 1
+
+
+class DeviceJobsTest(TestCase):
+
+    def setUp(self) -> None:
+        super(DeviceJobsTest, self).setUp()
+        FakeDeviceInfo.open_count = FakeDeviceInfo.max_open = 0
+        self.devices = [FakeDeviceInfo(x) for x in range(1, 7)]
+
+    @staticmethod
+    def job(dev, dev_h):
+        time.sleep(0.02)
+        if dev.address == 3:
+            raise IOError('device went away')
+        return dev.address != 5
+
+    def test_sequential(self):
+        """ Test that one job at a time opens one device at a time """
+        with self.assertLogs('ultimarc', level='ERROR'):
+            results = run_device_jobs(self.devices, self.job)
+        self.assertEqual(FakeDeviceInfo.max_open, 1)
+        self.assertEqual([r.device for r in results], self.devices)
+
+    def test_bounded_parallel(self):
+        """ Test that devices are processed concurrently, up to the number of jobs """
+        with self.assertLogs('ultimarc', level='ERROR'):
+            results = run_device_jobs(self.devices, self.job, jobs=4)
+        self.assertEqual(FakeDeviceInfo.max_open, 4)
+        self.assertEqual([r.device for r in results], self.devices)
+
+        self.assertEqual([r.result for r in results], [True, True, False, True, False, True])
+        self.assertIsInstance(results[2].error, IOError)
+        self.assertIsNone(results[4].error)
+
+    def test_aggregate_result(self):
+        """ Test that the tool environment reports failure if any device failed """
+        env = ToolEnvironmentObject({'jobs': 3})
+        with self.assertLogs('ultimarc', level='ERROR') as logs:
+            self.assertFalse(env.run_jobs(self.devices, self.job))
+        self.assertIn('Failed on 2 of 6 devices', logs.output[-1])
+        self.assertTrue(env.run_jobs(self.devices[:2], self.job))
@@ -0,0 +1,102 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+import json
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from ultimarc.devices import USBDevices
+from ultimarc.devices._virtual import VirtualIpac2, VirtualUltimateIO, VirtualUltraStik, VirtualUSB, \
+    VirtualUSBButton
+from ultimarc.profiles import ProfileStore
+from ultimarc.system_utils import git_project_root
+
+_EXAMPLES = os.path.join(git_project_root(), 'ultimarc/examples')
+
+
+class ProfileStoreTest(TestCase):
+
+    def setUp(self) -> None:
+        super(ProfileStoreTest, self).setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.ipac2 = VirtualIpac2()
+        self.uio = VirtualUltimateIO()
+        self.button = VirtualUSBButton()
+        self.ustik = VirtualUltraStik(controller_id=1)
+        self.bus = VirtualUSB([self.ipac2, self.uio, self.button, self.ustik])
+        self.bus.install()
+        self.devices = USBDevices(['d209'])
+        self.store = ProfileStore(os.path.join(self.tmp.name, 'profiles'), os.path.join(self.tmp.name, 'cache'))
+        os.makedirs(self.store.profile_dir)
+
+    def tearDown(self) -> None:
+        self.devices.close_all()
+        self.bus.uninstall()
+        self.tmp.cleanup()
+        super(ProfileStoreTest, self).tearDown()
+
+    def _write_profile(self, name, configs):
+        with open(self.store.path(name), 'w') as h:
+            json.dump({'schemaVersion': 2.0, 'resourceType': 'profile',
+                       'devices': [{'config': config} for config in configs]}, h)
+
+    def test_apply_only_sends_changes(self):
+        """ Test that applying a profile again sends nothing and switching profiles only sends what differs """
+        self._write_profile('game-a', [os.path.join(_EXAMPLES, f) for f in
+                                       ('ipac2.json', 'ultrastik-joy4way.json', 'usb-button-config.json',
+                                        'ultimateIO/ultimate-io-led.json')])
+        self._write_profile('game-b', [os.path.join(_EXAMPLES, f) for f in
+                                       ('ipac2.json', 'ultrastik-joy8way.json')])
+        self.assertEqual(self.store.names(), ['game-a', 'game-b'])
+
+        results = self.store.apply('game-a', self.devices)
+        self.assertEqual([r['result'] for r in results], ['sent'] * 4)
+        self.assertEqual((self.ipac2.writes, self.ustik.writes, self.button.writes), (1, 1, 1))
+
+        results = self.store.apply('game-a', self.devices)
+        self.assertEqual([r['result'] for r in results], ['unchanged'] * 4)
+        self.assertEqual((self.ipac2.writes, self.ustik.writes, self.button.writes), (1, 1, 1))
+
+        results = self.store.apply('game-b', self.devices)
+        self.assertEqual([r['result'] for r in results], ['unchanged', 'sent'])
+        self.assertEqual((self.ipac2.writes, self.ustik.writes), (1, 2))
+
+        # The device changed outside of the profile, the configuration is sent again.
+        with next(self.devices.filter(class_id='usb-button')) as dev_h:
+            dev_h.set_color(1, 2, 3)
+        results = self.store.apply('game-a', self.devices)
+        self.assertEqual([r['result'] for r in results], ['unchanged', 'sent', 'sent', 'unchanged'])
+        self.assertEqual(self.button.writes, 2)
+
+    def test_compiled_profile_is_refreshed(self):
+        """ Test that the compiled profile is reused until a source file changes """
+        config = os.path.join(self.tmp.name, 'button.json')
+        with open(os.path.join(_EXAMPLES, 'usb-button-color.json')) as h:
+            data = json.load(h)
+        with open(config, 'w') as h:
+            json.dump(data, h)
+        self._write_profile('button', [config])
+
+        compiled = self.store.compile('button')
+        self.assertEqual(self.store.load('button'), compiled)
+        self.assertEqual(compiled['devices'][0]['class_id'], 'usb-button')
+
+        data['colorRGB'] = {'red': 1, 'green': 2, 'blue': 3}
+        with open(config, 'w') as h:
+            json.dump(data, h)
+        reloaded = self.store.load('button')
+        self.assertNotEqual(reloaded['hash'], compiled['hash'])
+
+        self.store.apply('button', self.devices)
+        self.assertEqual(tuple(self.button.color), (1, 2, 3))
+
+    def test_invalid_profiles(self):
+        """ Test that profiles with missing or invalid configurations are not compiled """
+        self.assertIsNone(self.store.apply('missing', self.devices))
+        self._write_profile('bad', [os.path.join(git_project_root(), 'tests/test-data/ipac2/ipac2-pin-bad.json')])
+        self.assertIsNone(self.store.compile('bad'))
+        self._write_profile('no-device', [os.path.join(_EXAMPLES, 'jpac.json')])
+        self.assertEqual([r['result'] for r in self.store.apply('no-device', self.devices)], ['not found'])
@@ -4,10 +4,29 @@
 #
 # Enable i18n internationalization support for python
 #
-import gettext
+# The translation catalog is loaded when the first string is translated, not at import.
+#
 import os
 
 base_path = os.path.dirname(os.path.abspath(__name__))
 
-translate = gettext.translation(base_path, './locale', fallback=True)
-translate_gettext = translate.gettext
+_translate = None
+
+
+def _translation():
+    """ Return the gettext translation object, loading the catalog on first use """
+    global _translate
+    if _translate is None:
+        import gettext
+        _translate = gettext.translation(base_path, './locale', fallback=True)
+    return _translate
+
+
+def translate_gettext(message):
+    return _translation().gettext(message)
+
+
+def __getattr__(name):
+    if name == 'translate':
+        return _translation()
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
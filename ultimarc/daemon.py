@@ -0,0 +1,443 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Long running device server and its client.
+#
+# The daemon keeps the USBDevices registry and the opened device handles resident and serves requests on a
+# Unix domain socket, so a request costs a socket round trip instead of a process launch, libusb
+# initialization, device enumeration and interface claim. Start it with 'ultimarc daemon'.
+#
+# Requests and responses are JSON objects, one per line:
+#
+#    -> {"id": 1, "method": "set-color", "params": {"class_id": "usb-button", "color": [255, 0, 0]}}
+#    <- {"id": 1, "result": [{"device": "d209:1200", "bus": 1, "address": 4, "result": true}]}
+#    <- {"id": 1, "error": "No matching devices found."}
+#
+# Device requests take optional 'class_id', 'bus' and 'address' filters and return one result per matched
+# device. The 'run' request runs a command line tool inside the daemon, the tools use it transparently when
+# the daemon is running, see DaemonClient.run_tool(). Tools running in their own process send a 'release' request
+# first, so the daemon closes the devices it holds open and their device locks are free.
+#
+import importlib
+import io
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+
+from ultimarc import translate_gettext as _
+from ultimarc.system_utils import runtime_dir
+
+_logger = logging.getLogger('ultimarc')
+
+PROTOCOL_VERSION = 1
+
+# Tool arguments that only make sense in the calling process, these tools never use the daemon. Tools running until
+# ctrl-c is pressed are also run locally.
+_LOCAL_ARGS = ('--no-daemon', '--no-cache', '--log-file', '--trace', '--record', '--replay', '--watch',
+               '--play-led-animation')
+
+# Tool arguments naming a file or directory relative to the working directory. The daemon has its own working
+# directory, so the client makes these paths absolute.
+_PATH_ARGS = ('--file', '--stats-file', '--profile-dir', '--map-dir')
+_COMMAND_PATH_ARGS = {'ultrastik': ('--set-config',)}
+
+# Device class ids by the requests they support.
+_PAC_CLASSES = ('ipac2', 'ipac4', 'jpac', 'mini-pac', 'ultimate-io')
+_CONFIG_CLASSES = _PAC_CLASSES + ('usb-button',)
+
+
+def _absolute_paths(argv):
+    """
+    Make the path arguments of a tool command line absolute, see _PATH_ARGS.
+    :param argv: command name followed by the tool arguments.
+    :return: list of arguments.
+    """
+    names = _PATH_ARGS + _COMMAND_PATH_ARGS.get(argv[0], ())
+    result = list(argv[:1])
+    path_next = False
+    for arg in argv[1:]:
+        if path_next:
+            arg = os.path.abspath(arg)
+            path_next = False
+        elif arg in names:
+            path_next = True
+        elif '=' in arg and arg.split('=', 1)[0] in names:
+            name, value = arg.split('=', 1)
+            arg = f'{name}={os.path.abspath(value)}'
+        result.append(arg)
+    return result
+
+
+def default_socket_path():
+    """ Return the path of the daemon socket """
+    return os.environ.get('ULTIMARC_SOCKET') or os.path.join(runtime_dir(), 'daemon.sock')
+
+
+class DaemonError(Exception):
+    """ The daemon returned an error for a request. """
+
+
+class DaemonClient(object):
+    """ Sends requests to the daemon over one connection. """
+
+    def __init__(self, path=None, timeout=60.0):
+        """
+        :param path: socket path, see default_socket_path().
+        :param timeout: seconds to wait for a response.
+        """
+        self.path = path or default_socket_path()
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._next_id = 1
+
+    @staticmethod
+    def available(path=None):
+        """ Return True if a daemon socket exists, without connecting to it """
+        return hasattr(socket, 'AF_UNIX') and os.path.exists(path or default_socket_path())
+
+    def connect(self):
+        """
+        Connect to the daemon.
+        :return: True if connected otherwise False.
+        """
+        if self._sock is not None:
+            return True
+        if not hasattr(socket, 'AF_UNIX'):
+            return False
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            return False
+        self._sock = sock
+        self._file = sock.makefile('rb')
+        return True
+
+    def close(self):
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+            self._sock = self._file = None
+
+    def __enter__(self):
+        if not self.connect():
+            raise ConnectionError(_('Unable to connect to the ultimarc daemon') + f' ({self.path}).')
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def call(self, method, **params):
+        """
+        Send a request and wait for the response.
+        :param method: request method name, IE: 'set-color'.
+        :param params: request parameters.
+        :return: request result.
+        """
+        if not self.connect():
+            raise ConnectionError(_('Unable to connect to the ultimarc daemon') + f' ({self.path}).')
+        request_id = self._next_id
+        self._next_id += 1
+        self._sock.sendall(json.dumps({'id': request_id, 'method': method, 'params': params}).encode('utf-8') +
+                           b'\n')
+        line = self._file.readline()
+        if not line:
+            self.close()
+            raise ConnectionError(_('The ultimarc daemon closed the connection.'))
+        response = json.loads(line)
+        if 'error' in response:
+            raise DaemonError(response['error'])
+        return response.get('result')
+
+    def release(self):
+        """
+        Ask the daemon to close the devices it is not using, before a tool opens them in this process.
+        :return: number of devices closed, None if the daemon could not be reached.
+        """
+        if not self.connect():
+            return None
+        try:
+            return self.call('release')
+        except (OSError, ValueError, DaemonError):
+            return None
+        finally:
+            self.close()
+
+    def run_tool(self, argv):
+        """
+        Run a command line tool in the daemon, printing its output. Raises SystemExit if the tool exited,
+        IE: on a command line argument error.
+        :param argv: command name followed by the tool arguments.
+        :return: tool exit code, None if the daemon can't be used for this command.
+        """
+        if argv[0] == 'daemon':
+            return None
+        if any(a in _LOCAL_ARGS for a in argv):
+            self.release()
+            return None
+        if not self.connect():
+            return None
+        try:
+            result = self.call('run', argv=_absolute_paths(argv))
+        except (OSError, ValueError, DaemonError):
+            return None
+        finally:
+            self.close()
+        sys.stdout.write(result['stdout'])
+        sys.stderr.write(result['stderr'])
+        if result.get('system_exit'):
+            raise SystemExit(result['exit_code'])
+        return result['exit_code']
+
+
+class DaemonServer(object):
+    """
+    Serves requests on a Unix domain socket, one thread per connection. Requests are handled one at a time,
+    so device handles and tools are never used from two requests at once.
+    """
+
+    def __init__(self, devices, path=None):
+        """
+        :param devices: USBDevices object kept for the life of the daemon.
+        :param path: socket path, see default_socket_path().
+        """
+        self.devices = devices
+        self.path = path or default_socket_path()
+        self._sock = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._methods = {
+            'ping': self.ping,
+            'list': self.list_devices,
+            'rescan': self.rescan,
+            'get-config': self.get_config,
+            'set-config': self.set_config,
+            'set-pin': self.set_pin,
+            'set-color': self.set_color,
+            'set-leds': self.set_leds,
+            'switch-map': self.switch_map,
+            'apply-profile': self.apply_profile,
+            'release': self.release,
+            'run': self.run_tool,
+        }
+
+    def start(self):
+        """ Bind the socket and accept connections in a background thread """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.path):
+            # Only one daemon runs at a time, see write_pidfile_or_die(), so the socket is left over.
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self._sock.listen(16)
+        threading.Thread(target=self._accept, name='ultimarc-daemon', daemon=True).start()
+        _logger.info(_('ultimarc daemon listening on') + f' {self.path}')
+
+    def stop(self):
+        """ Stop accepting connections and remove the socket """
+        self._stopped.set()
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def serve_forever(self):
+        """ Start the server and wait until stop() is called """
+        self.start()
+        try:
+            self._stopped.wait()
+        finally:
+            self.stop()
+
+    def _accept(self):
+        while not self._stopped.is_set():
+            try:
+                conn, _addr = self._sock.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._serve, args=(conn,), name='ultimarc-daemon-conn', daemon=True).start()
+
+    def _serve(self, conn):
+        """ Handle the requests of one connection until it is closed """
+        with conn, conn.makefile('rb') as reader:
+            for line in reader:
+                if not line.strip():
+                    continue
+                response = self.handle(line)
+                try:
+                    conn.sendall(json.dumps(response).encode('utf-8') + b'\n')
+                except OSError:
+                    break
+
+    def handle(self, line):
+        """
+        Handle one request.
+        :param line: JSON request bytes.
+        :return: response dict.
+        """
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            method = self._methods.get(request.get('method'))
+        except (ValueError, AttributeError):
+            return {'id': None, 'error': _('Invalid request.')}
+        if method is None:
+            return {'id': request_id, 'error': _('Unknown method') + f' {request.get("method")}.'}
+
+        params = request.get('params') or dict()
+        with self._lock:
+            try:
+                return {'id': request_id, 'result': method(**params)}
+            except (TypeError, ValueError, KeyError, OSError) as e:
+                return {'id': request_id, 'error': str(e)}
+            except Exception as e:
+                _logger.exception(_('ultimarc daemon request failed.'))
+                return {'id': request_id, 'error': str(e)}
+
+    def _each_device(self, func, class_id=None, bus=None, address=None, classes=None):
+        """
+        Call func(dev_h) for every matching device.
+        :param classes: class ids the request supports, None for any.
+        :return: list of result dicts.
+        """
+        devices = [dev for dev in self.devices.filter(class_id=class_id, bus=bus, address=address)
+                   if classes is None or dev.class_id in classes]
+        if not devices:
+            raise ValueError(_('No matching devices found.'))
+        results = list()
+        for dev in devices:
+            with dev as dev_h:
+                results.append({'device': dev.dev_key, 'bus': dev.bus, 'address': dev.address,
+                                'result': func(dev_h)})
+        return results
+
+    def ping(self):
+        return {'version': PROTOCOL_VERSION, 'pid': os.getpid(), 'devices': len(list(self.devices))}
+
+    def list_devices(self, class_id=None):
+        return [{'device': dev.dev_key, 'bus': dev.bus, 'address': dev.address, 'path': dev.path,
+                 'class_id': dev.class_id, 'product_name': dev.product_name}
+                for dev in self.devices.filter(class_id=class_id)]
+
+    def rescan(self):
+        self.devices.rescan()
+        return len(list(self.devices))
+
+    def release(self):
+        """ Close the opened devices so a tool in another process can use them, they are opened again when used """
+        return self.devices.close_idle()
+
+    def get_config(self, **filters):
+        def get(dev_h):
+            config = dev_h.get_device_config()
+            return json.loads(config) if config else None
+        return self._each_device(get, classes=_CONFIG_CLASSES, **filters)
+
+    def set_config(self, config, use_current=False, **filters):
+        """ Write a configuration file, 'config' is an absolute path readable by the daemon """
+        if not os.path.isabs(config) or not os.path.exists(config):
+            raise ValueError(_('Unable to find configuration file') + f' {config}.')
+
+        def apply(dev_h):
+            if dev_h.class_id in _PAC_CLASSES:
+                return dev_h.set_config(config, use_current)
+            return dev_h.set_config(config)
+        return self._each_device(apply, **filters)
+
+    def set_pin(self, pins, **filters):
+        """ Set pins, 'pins' is a list of [pin, action, alternate action, shift] lists """
+        def apply(dev_h):
+            with dev_h.transaction() as tx:
+                for pin in pins:
+                    shift = len(pin) > 3 and str(pin[3]).lower() in ('true', '1', 't', 'y')
+                    tx.set_pin(pin[0], pin[1], pin[2] if len(pin) > 2 else '', shift)
+            return tx.result
+        return self._each_device(apply, classes=_PAC_CLASSES, **filters)
+
+    def set_color(self, color, **filters):
+        """ Set the color of USB buttons, 'color' is a [red, green, blue] list """
+        red, green, blue = color
+        return self._each_device(lambda dev_h: dev_h.set_color(red, green, blue), classes=('usb-button',),
+                                 **filters)
+
+    def set_leds(self, intensities=None, all_intensity=None, fade_rate=None, random=False, frame=None, **filters):
+        """
+        Update Ultimate IO LEDs.
+        :param intensities: dict of LED index -> intensity.
+        :param all_intensity: intensity set on every LED.
+        :param fade_rate: LED fade rate.
+        :param random: set the LEDs to random states.
+        :param frame: list of 96 intensities, only the LEDs that changed are sent.
+        """
+        def apply(dev_h):
+            ret = True
+            if frame is not None:
+                ret = dev_h.set_led_frame(frame) and ret
+            if all_intensity is not None:
+                ret = dev_h.set_all_led_intensities(int(all_intensity)) and ret
+            for led, value in (intensities or dict()).items():
+                ret = dev_h.set_led_intensity(int(led), int(value)) and ret
+            if fade_rate is not None:
+                ret = dev_h.set_led_fade_rate(int(fade_rate)) and ret
+            if random:
+                ret = dev_h.set_led_random_state() and ret
+            return bool(ret)
+        return self._each_device(apply, classes=('ultimate-io',), **filters)
+
+    def switch_map(self, name, **filters):
+        """ Switch UltraStik joysticks to a compiled map, see UltraStikMapCache """
+        return self._each_device(lambda dev_h: dev_h.switch_map(name), classes=('ultrastik',), **filters)
+
+    def apply_profile(self, name, profile_dir=None):
+        """ Apply a profile, only the payloads the devices do not already hold are sent """
+        from ultimarc.profiles import ProfileStore
+        results = ProfileStore(profile_dir).apply(name, self.devices)
+        if results is None:
+            raise ValueError(_('Failed to compile profile') + f' {name}.')
+        return results
+
+    def run_tool(self, argv):
+        """
+        Run a command line tool with the resident devices, capturing its output. The tool is given its arguments
+        and output streams, path arguments must be absolute, see DaemonClient.run_tool().
+        :param argv: command name followed by the tool arguments.
+        :return: dict with 'exit_code', 'stdout' and 'stderr', 'system_exit' is set if the tool called exit().
+        """
+        from ultimarc.tools import ToolContextManager
+        from ultimarc.tools._commands import COMMANDS
+
+        if not argv or argv[0] not in COMMANDS or argv[0] == 'daemon':
+            raise ValueError(_('Error: Invalid command argument'))
+        mod = importlib.import_module(f'ultimarc.tools.{COMMANDS[argv[0]][0]}')
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+        saved_handlers, saved_level = list(_logger.handlers), logging.getLogger().level
+        ToolContextManager.shared_devices = self.devices
+        exit_code, system_exit = 0, False
+        try:
+            # The tool adds its own output handler.
+            _logger.handlers[:] = []
+            # The tools configure logging on every run, the root level is only set by the first run.
+            logging.getLogger().setLevel(logging.DEBUG if '--debug' in argv else
+                                         logging.WARNING if '-q' in argv or '--quiet' in argv else logging.INFO)
+            try:
+                exit_code = mod.run(list(argv[1:]), stdout, stderr)
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+                system_exit = True
+        finally:
+            ToolContextManager.shared_devices = None
+            _logger.handlers[:] = saved_handlers
+            logging.getLogger().setLevel(saved_level)
+        return {'exit_code': exit_code or 0, 'system_exit': system_exit, 'stdout': stdout.getvalue(),
+                'stderr': stderr.getvalue()}
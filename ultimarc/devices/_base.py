@@ -4,41 +4,103 @@
 #
 # http://libusb.sourceforge.net/api-1.0/libusb_api.html
 #
+import atexit
 import ctypes as ct
 from enum import Enum
+import importlib
 import logging
+import sys
+import threading
 import traceback
 
 import libusb as usb
 
 from ultimarc import translate_gettext as _
 from ultimarc.devices._device import usb_error
-from ultimarc.devices.ipac2 import Ipac2Device
-from ultimarc.devices.ipac4 import Ipac4Device
-from ultimarc.devices.jpac import JpacDevice
-from ultimarc.devices.usb_button import USBButtonDevice
-from ultimarc.devices.aimtrak import AimTrakDevice
-from ultimarc.devices.mini_pac import MiniPacDevice
-from ultimarc.devices.ultrastik import UltraStikPre2015Device, UltraStikDevice
-from ultimarc.devices.ultimate_io import UltimateIODevice
+from ultimarc.devices._metrics import timed_operation
+from ultimarc.devices._registry import DeviceEvent, USBDeviceRegistry, default_event_source
+from ultimarc.devices._transfers import stop_event_thread
 from ultimarc.exceptions import USBDeviceNotFoundError
 
 _logger = logging.getLogger('ultimarc')
 
 
-# Device Class lookups are based on first 3 digits of product id.
+# Device Class lookups are based on first 3 digits of product id. Classes are given as 'module:class' and
+# only imported when a matching device is found, see product_class().
 _USB_PRODUCT_CLASSES = {
-    'd209:120': USBButtonDevice,
-    'd209:160': AimTrakDevice,
-    'd209:044': MiniPacDevice,
-    'd209:042': Ipac2Device,
-    'd209:043': Ipac4Device,
-    'd209:045': JpacDevice,
-    'd209:050': UltraStikPre2015Device,
-    'd209:051': UltraStikDevice,
-    'd209:041': UltimateIODevice
+    'd209:120': 'ultimarc.devices.usb_button:USBButtonDevice',
+    'd209:160': 'ultimarc.devices.aimtrak:AimTrakDevice',
+    'd209:044': 'ultimarc.devices.mini_pac:MiniPacDevice',
+    'd209:042': 'ultimarc.devices.ipac2:Ipac2Device',
+    'd209:043': 'ultimarc.devices.ipac4:Ipac4Device',
+    'd209:045': 'ultimarc.devices.jpac:JpacDevice',
+    'd209:050': 'ultimarc.devices.ultrastik:UltraStikPre2015Device',
+    'd209:051': 'ultimarc.devices.ultrastik:UltraStikDevice',
+    'd209:041': 'ultimarc.devices.ultimate_io:UltimateIODevice'
 }
 
+_product_classes = dict()  # Product class key -> imported device class.
+
+
+def product_class(key):
+    """
+    Return the device class for a product, importing the device module on first use.
+    :param key: product class key, IE: 'd209:042' or a full 'd209:0420' device key.
+    :return: USBDeviceHandle subclass or None if the product is unknown.
+    """
+    key = key[:8]
+    cls = _product_classes.get(key)
+    if cls is None and key in _USB_PRODUCT_CLASSES:
+        module_name, class_name = _USB_PRODUCT_CLASSES[key].split(':')
+        cls = _product_classes[key] = getattr(importlib.import_module(module_name), class_name)
+    return cls
+
+
+def class_id_classes(class_id):
+    """
+    Return the device classes of a device class id, importing their modules.
+    :param class_id: DeviceClassID value or string.
+    :return: list of USBDeviceHandle subclasses, some class ids have more than one product class.
+    """
+    class_id = class_id.value if isinstance(class_id, DeviceClassID) else class_id
+    classes = [product_class(key) for key in _USB_PRODUCT_CLASSES]
+    return [cls for cls in dict.fromkeys(classes) if cls.class_id == class_id]
+
+
+_libusb_ready = False
+_libusb_lock = threading.Lock()
+
+
+def init_libusb():
+    """
+    Initialize the default libusb context, called by USBDevices before the first device scan. Initialization
+    is deferred until then so importing the package stays cheap for tools that never touch a device.
+    """
+    global _libusb_ready
+    if _libusb_ready:
+        return
+    with _libusb_lock:
+        if _libusb_ready:
+            return
+        ret = usb.init(None)
+        if ret < 0:
+            raise IOError(f'{_("LibUSB.init() failed with error")} {usb.error_name(ret).decode("utf-8")} ({ret}).')
+        # Enable additional logging from LibUSB.
+        usb.set_option(None, usb.LIBUSB_OPTION_LOG_LEVEL, 1 if '--debug' in sys.argv else 0)
+        # Register the _exit_libusb() function to be called when program quits.
+        atexit.register(_exit_libusb)
+        _libusb_ready = True
+
+
+def _exit_libusb():
+    """ Clean up libusb on exit """
+    global _libusb_ready
+    stop_event_thread()
+    usb.exit(None)
+    _libusb_ready = False
+    _logger.debug(_('LibUSB.exit() function called successfully.'))
+
+
 # USB key values for every USB device.
 USB_PRODUCT_DESCRIPTIONS = {
     'd209:1200': 'USB button',
@@ -84,10 +146,12 @@ class USBDeviceInfo:
     __dev_handle_obj__ = None  # USBDeviceHandle object.
     __dev_class__ = None  # Device class, based on USB_PRODUCT_CATEGORY lookup.
 
+    _pool = None  # USBDeviceHandlePool object, set by the USBDevices object that found this device.
+
     dev_key = None
     class_id = ''  # Used to match config/schemas to devices.
     class_descr = ''
-    
+
     vendor_id = None
     product_id = None
     bus = None
@@ -120,18 +184,26 @@ class USBDeviceInfo:
         self.dev_key = f'{self.vendor_id:04x}:{self.product_id:04x}'
 
         # Find USB product group, based on first 3 digits of product id.
-        if self.dev_key[:8] in _USB_PRODUCT_CLASSES:
-            product_class = _USB_PRODUCT_CLASSES[self.dev_key[:8]]
-            self.class_id = product_class.class_id
-            self.class_descr = product_class.class_descr
-            self.__dev_class__ = product_class
+        dev_class = product_class(self.dev_key)
+        if dev_class is not None:
+            self.class_id = dev_class.class_id
+            self.class_descr = dev_class.class_descr
+            self.__dev_class__ = dev_class
 
         # Find USB product description.
         if self.dev_key in USB_PRODUCT_DESCRIPTIONS:
             self.product_name = USB_PRODUCT_DESCRIPTIONS[self.dev_key]
 
+    @property
+    def pool_key(self):
+        """ Key used to find this device in a USBDeviceHandlePool. """
+        return self.bus, self.address, self.dev_key
+
     def __enter__(self):
         """ Return object with properties set to config values """
+        if self._pool is not None:
+            return self._pool.acquire(self)
+
         _logger.debug(_('Opening USB device') + f' {self.dev_key}')
 
         dev_handle = self._get_device_handle()
@@ -160,7 +232,10 @@ class USBDeviceInfo:
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """ Clean up or close everything we need to """
-        if self.__dev_handle__:
+        if self._pool is not None:
+            # Pooled handles stay open, unless something went wrong while using them.
+            self._pool.release(self, discard=exc_type is not None)
+        elif self.__dev_handle__:
             _logger.debug(_('Closing USB device') + f' {self.dev_key}.')
             usb.close(self.__dev_handle__)
             self.__dev_handle__ = None
@@ -218,17 +293,209 @@ class USBDeviceInfo:
         return f'{self.dev_key} {self.bus, self.address}: {self.product_name}'
 
 
+class _PoolEntry:
+    """ An opened USB device handle held by a USBDeviceHandlePool. """
+    __slots__ = ('dev_handle', 'handle_obj', 'ref_count', 'lock')
+
+    def __init__(self, dev_handle, handle_obj, lock=None):
+        self.dev_handle = dev_handle  # Raw handle set by usb.open().
+        self.handle_obj = handle_obj  # USBDeviceHandle object, interface already claimed.
+        self.ref_count = 0
+        self.lock = lock  # FileLock object held while the handle is referenced, see DeviceLocks.
+
+
+class USBDeviceHandlePool:
+    """
+    Keeps opened USB device handles, and their claimed interfaces, open between 'with' blocks.
+    Handles are keyed by (bus, address, dev_key) and reference counted. A handle is only closed
+    by discarding it after an error, pruning it after the device has gone or calling close_all().
+    If a DeviceLocks object is given, each device is locked against other processes while it is referenced. When
+    the last reference is released the lock and the interface are released, the handle stays open and the
+    interface is claimed again by the next acquire().
+    If a ConfigCache object is given, it is attached to each handle opened.
+    """
+
+    def __init__(self, locks=None, config_cache=None):
+        """
+        :param locks: optional DeviceLocks object.
+        :param config_cache: optional ConfigCache object.
+        """
+        self._entries = dict()
+        self._lock = threading.RLock()
+        self._locks = locks
+        self._config_cache = config_cache
+        self._opening = dict()  # pool key -> threading.Lock, serializes opening one device.
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, dev_info):
+        return dev_info.pool_key in self._entries
+
+    def acquire(self, dev_info):
+        """
+        Return the opened USBDeviceHandle object for the device, opening it if needed.
+        :param dev_info: USBDeviceInfo object.
+        :return: USBDeviceHandle object.
+        """
+        with self._lock:
+            entry = self._entries.get(dev_info.pool_key)
+            if entry is not None and self._is_claimed(entry):
+                entry.ref_count += 1
+                return entry.handle_obj
+            opening = self._opening.setdefault(dev_info.pool_key, threading.Lock())
+
+        # Waiting for another process to release the device must not hold up opening other devices.
+        with opening:
+            with self._lock:
+                entry = self._entries.get(dev_info.pool_key)
+                if entry is not None and self._is_claimed(entry):
+                    entry.ref_count += 1
+                    return entry.handle_obj
+
+            lock = self._locks.acquire(dev_info.bus, dev_info.address, dev_info.dev_key) \
+                if self._locks is not None else None
+            idle = None
+            try:
+                # Opening and claiming the interface only holds the lock for this device, the pool lock is
+                # taken again to publish the entry. An idle handle whose device lock was released leaves the
+                # pool until its interface is claimed again.
+                with self._lock:
+                    idle = self._entries.pop(dev_info.pool_key, None)
+                if idle is not None:
+                    dev_handle, handle_obj = self._reclaim(idle)
+                    idle = None
+                else:
+                    dev_handle, handle_obj = self._open(dev_info)
+                entry = _PoolEntry(dev_handle, handle_obj, lock)
+                lock = None
+                with self._lock:
+                    self._entries[dev_info.pool_key] = entry
+                    self._opening.pop(dev_info.pool_key, None)
+                    entry.ref_count += 1
+                return entry.handle_obj
+            finally:
+                if idle is not None:
+                    usb.close(idle.dev_handle)
+                if lock is not None:
+                    lock.release()
+
+    def _open(self, dev_info):
+        """
+        Open the device and claim its interface.
+        :return: (raw handle, USBDeviceHandle object) tuple.
+        """
+        _logger.debug(_('Opening USB device') + f' {dev_info.dev_key}')
+        dev_handle = dev_info._get_device_handle()
+        dev_info._close_device_list_handle()
+        if not dev_handle:
+            raise USBDeviceNotFoundError(dev_info.dev_key)
+        try:
+            handle_obj = dev_info.__dev_class__(dev_handle, dev_info.dev_key)
+        except Exception:
+            usb.close(dev_handle)
+            raise
+        if self._config_cache is not None:
+            handle_obj.attach_cache(self._config_cache, dev_info)
+        return dev_handle, handle_obj
+
+    @staticmethod
+    def _reclaim(entry):
+        """
+        Claim the interface of an idle handle again, another process may have changed the device meanwhile.
+        :return: (raw handle, USBDeviceHandle object) tuple.
+        """
+        if entry.handle_obj.interface is not None:
+            entry.handle_obj.claim_interface(entry.handle_obj.interface)
+        entry.handle_obj._forget_state_()
+        return entry.dev_handle, entry.handle_obj
+
+    def _is_claimed(self, entry):
+        """ Return True if the entry holds its device lock and interface, or devices are not locked """
+        return self._locks is None or entry.lock is not None
+
+    def release(self, dev_info, discard=False):
+        """
+        Release a reference to a device handle obtained with acquire().
+        :param dev_info: USBDeviceInfo object.
+        :param discard: If True, close the handle once it is no longer referenced.
+        """
+        with self._lock:
+            entry = self._entries.get(dev_info.pool_key)
+            if entry is None:
+                return
+            entry.ref_count = max(entry.ref_count - 1, 0)
+            if entry.ref_count:
+                return
+            if discard:
+                self._close_entry(dev_info.pool_key)
+            elif entry.lock is not None:
+                # Let other processes use the device until it is acquired again.
+                try:
+                    entry.handle_obj.release_interface()
+                finally:
+                    entry.lock.release()
+                    entry.lock = None
+
+    def prune(self, keys):
+        """
+        Close any unreferenced handles whose keys are not in the given collection.
+        :param keys: collection of (bus, address, dev_key) tuples for devices still attached.
+        """
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if k not in keys and e.ref_count == 0]:
+                self._close_entry(key)
+
+    def close_idle(self):
+        """
+        Close every handle that is not referenced, releasing its device lock.
+        :return: number of handles closed.
+        """
+        with self._lock:
+            keys = [k for k, e in self._entries.items() if e.ref_count == 0]
+            for key in keys:
+                self._close_entry(key)
+        return len(keys)
+
+    def close_all(self):
+        """ Release interfaces and close every handle in the pool. """
+        with self._lock:
+            for key in list(self._entries):
+                self._close_entry(key)
+
+    def _close_entry(self, key):
+        """ Remove an entry from the pool and close the device handle. """
+        entry = self._entries.pop(key)
+        _logger.debug(_('Closing USB device') + f' {key[2]}.')
+        try:
+            if self._is_claimed(entry):
+                entry.handle_obj.release_interface()
+        finally:
+            usb.close(entry.dev_handle)
+            if entry.lock is not None:
+                entry.lock.release()
+
+
 class USBDevices:
     """ Class that represents all USB devices found on local system. """
 
     _filters = None
     _usb_devices = None  # List of USB devices found.
+    _pool = None  # USBDeviceHandlePool object shared by all devices found.
+    _registry = None  # USBDeviceRegistry object, tracks attached devices.
+    config_cache = None  # ConfigCache object attached to the opened devices.
     device_count = 0
     error = False
 
-    def __init__(self, vendor_filter: list = None):
+    def __init__(self, vendor_filter: list = None, event_source=None, device_locks=None, config_cache=None):
         """
         :param vendor_filter: list of vendor/manufacturer IDs to capture.
+        :param event_source: optional device event source for the registry, defaults to libusb hotplug
+                             events when supported, otherwise polling.
+        :param device_locks: optional DeviceLocks object, locks each device while it is open so other
+                             programs using the same device wait for it.
+        :param config_cache: optional ConfigCache object, keeps the configurations read from and written to
+                             the devices so they are not read again.
         """
         if vendor_filter:
             if not isinstance(vendor_filter, list):
@@ -238,6 +505,12 @@ class USBDevices:
                     raise ValueError(_("Invalid USB vendor/manufacturer id") + f' ({vendor_id}).')
             self._filters = vendor_filter
 
+        init_libusb()
+        self.config_cache = config_cache
+        self._pool = USBDeviceHandlePool(device_locks, config_cache)
+        self._registry = USBDeviceRegistry(event_source or default_event_source(self._filters), USBDeviceInfo)
+        self._registry.subscribe(self._device_event)
+        self._usb_devices = list()
         self._find_devices()
 
     def __iter__(self):
@@ -254,8 +527,15 @@ class USBDevices:
         if (class_id and not isinstance(class_id, (str, DeviceClassID))) or (bus and not isinstance(bus, int)) or \
                 (address and not isinstance(address, int)):
             raise ValueError(_('Invalid filter method argument'))
+
+        # A bus and address pair identifies a single device, look it up directly.
+        candidates = self._usb_devices
+        if bus and address:
+            dev = self._registry.get(bus, address)
+            candidates = [dev] if dev else list()
+
         devices = list()
-        for dev in self._usb_devices:
+        for dev in candidates:
             if class_id and dev.class_id != (class_id if isinstance(class_id, str) else class_id.value):
                 continue
             if bus and dev.bus != bus:
@@ -267,44 +547,52 @@ class USBDevices:
         return iter(devices)
 
     def rescan(self):
-        """ Reload connected USB devices from local host. """
+        """ Apply any USB device changes on the local host since the last scan. """
         self._find_devices()
 
+    def subscribe(self, callback):
+        """
+        Register a callable to be called as callback(event, dev_info) when a device arrives or leaves.
+        Events are delivered from inside rescan().
+        :param callback: callable
+        """
+        self._registry.subscribe(callback)
+
+    def unsubscribe(self, callback):
+        """ Remove a callable registered with subscribe(). """
+        self._registry.unsubscribe(callback)
+
+    def close_all(self):
+        """ Stop tracking device changes and close every device handle kept open by this object. """
+        self._registry.stop()
+        self._pool.close_all()
+
+    def close_idle(self):
+        """
+        Close the device handles not in use, so other programs can open the devices. A device is opened again
+        the next time it is used.
+        :return: number of handles closed.
+        """
+        return self._pool.close_idle()
+
     def get_device_classes(self):
         """ Return a list of device class descriptions for the devices we have. """
         return list(set([d.class_descr for d in self._usb_devices]))
 
     def _find_devices(self):
-        """ Find all attached USB devices that match the filter. """
-        self.error = False
-        self.device_count = 0
-        self._usb_devices = list()
-
-        # Get device list from libusb.
-        dev_list = ct.POINTER(ct.POINTER(usb.device))()
-        cnt = usb.get_device_list(None, ct.byref(dev_list))
-        if cnt < 0:
-            usb_error(cnt, _('Failed to find attached USB devices.'))
-            self.error = True
-            return
-
-        _logger.debug(_('Vendor filters: ') + ', '.join(self._filters))
+        """ Update the attached USB devices that match the filter. """
         _logger.debug(_('Searching for Ultimarc USB devices...'))
-        for dev in dev_list:
-            if not dev:  # We must always look for the Null device and quit the loop.
-                break
-
-            dev_desc = usb.device_descriptor()
-            ret = usb.get_device_descriptor(dev, ct.byref(dev_desc))
-            if ret != usb.LIBUSB_SUCCESS:
-                usb_error(ret, _('failed to get USB device descriptor.'))
-                continue
-
-            if not self._filters or f'{dev_desc.idVendor:04x}' in self._filters:
-                ud = USBDeviceInfo(dev, dev_desc)
-                self._usb_devices.append(ud)
-                self.device_count += 1
-
+        with timed_operation('enumerate'):
+            self.error = not self._registry.update()
         _logger.debug(_('Device search complete.'))
 
-        usb.free_device_list(dev_list, 1)
+    def _device_event(self, event, dev_info):
+        """ Keep the device list and handle pool in step with the registry. """
+        if event == DeviceEvent.ARRIVED:
+            dev_info._pool = self._pool
+            self._usb_devices.append(dev_info)
+        else:
+            self._usb_devices = [d for d in self._usb_devices if d is not dev_info]
+            # Close the handle for a device that is no longer attached.
+            self._pool.prune(set(d.pool_key for d in self._usb_devices))
+        self.device_count = len(self._usb_devices)
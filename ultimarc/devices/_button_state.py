@@ -0,0 +1,176 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# USB button press and release events.
+#
+# A ButtonWatcher keeps one interrupt IN transfer pending on the button endpoint, the transfer has no timeout and
+# is submitted again from its completion callback, so no thread polls the device. State reports use report id 0x02
+# with the state in the first data byte, the same report get_state() requests. Events are published to a callback,
+# a queue.Queue and to every asyncio stream returned by events(), from the USB event thread.
+#
+import asyncio
+import logging
+import threading
+import time
+from collections import namedtuple
+
+import libusb as usb
+
+from ultimarc import translate_gettext as _
+from ultimarc.devices._transfers import USBTransfer
+
+_logger = logging.getLogger('ultimarc')
+
+STATE_ENDPOINT = 0x81
+STATE_REPORT_ID = 0x02
+REPORT_SIZE = 5
+
+# 'pressed' is True when the button was pressed and False when released, 'timestamp' is the time.monotonic()
+# value when the report was received.
+ButtonEvent = namedtuple('ButtonEvent', ['pressed', 'timestamp'])
+
+
+class ButtonWatcher(object):
+    """ Publishes USB button press and release events. """
+
+    def __init__(self, dev_h, callback=None, queue=None, endpoint=STATE_ENDPOINT):
+        """
+        :param dev_h: opened USBButtonDevice handle, configurations can't be read from the device while watching
+                      as they are sent on the same endpoint, see USBButtonDevice.read_device().
+        :param callback: optional callable taking a ButtonEvent, called from the USB event thread.
+        :param queue: optional queue.Queue object events are put on.
+        :param endpoint: interrupt IN endpoint address.
+        """
+        self.dev_h = dev_h
+        self.callback = callback
+        self.queue = queue
+        self.endpoint = endpoint
+        self.pressed = None  # Last known state, None until the first state report.
+
+        self._lock = threading.Lock()
+        self._transfer = None
+        self._running = False
+        self._stopped = threading.Event()
+        self._callback_thread = None  # Thread id running _done_().
+        self._streams = list()  # (event loop, asyncio.Queue) tuples, see events().
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        """
+        Start watching the button.
+        :return: True if the transfer was submitted otherwise False.
+        """
+        with self._lock:
+            if self._running:
+                return True
+            self._running = True
+            self._stopped.clear()
+        return self._submit_()
+
+    def stop(self, timeout=2.0):
+        """
+        Stop watching the button, ends the asyncio event streams.
+        :param timeout: seconds to wait for the pending transfer to be cancelled.
+        """
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            transfer = self._transfer
+        if transfer is not None:
+            transfer.cancel()
+        # Wait until no transfer is pending and no completion callback is running, unless called from one.
+        if self._callback_thread != threading.get_ident():
+            self._stopped.wait(timeout)
+        self._publish_(None)
+
+    def _submit_(self):
+        transfer = USBTransfer.interrupt(self.dev_h.__libusb_dev_handle__, self.endpoint, REPORT_SIZE, timeout=0)
+        with self._lock:
+            self._transfer = transfer
+        future = transfer.submit()
+        future.add_done_callback(lambda f: self._done_(transfer, f))
+        with self._lock:
+            running = self._running
+        if not running:
+            transfer.cancel()  # stop() was called while the transfer was submitted.
+        return not (future.done() and future.result().code < 0)
+
+    def _done_(self, transfer, future):
+        """ Transfer completion callback, called from the USB event thread """
+        self._callback_thread = threading.get_ident()
+        try:
+            self._handle_result_(transfer, future.result())
+        finally:
+            self._callback_thread = None
+
+    def _handle_result_(self, transfer, result):
+        with self._lock:
+            if self._transfer is transfer:
+                self._transfer = None
+        if result.code == usb.LIBUSB_SUCCESS:
+            data = result.data
+            if len(data) >= 2 and data[0] == STATE_REPORT_ID:
+                pressed = bool(data[1] & 0x01)
+                if pressed != self.pressed:
+                    self.pressed = pressed
+                    self._publish_(ButtonEvent(pressed, time.monotonic()))
+        elif result.code != usb.LIBUSB_ERROR_INTERRUPTED:
+            _logger.error(f'{usb.error_name(result.code).decode("utf-8")} ({result.code}): ' +
+                          _('Failed to read usb button state, stopping.'))
+            with self._lock:
+                self._running = False
+
+        with self._lock:
+            running = self._running
+            pending = self._transfer is not None  # The watcher was started again while this transfer ended.
+        if running:
+            if not pending:
+                self._submit_()
+            return
+        self._stopped.set()
+        if result.code != usb.LIBUSB_ERROR_INTERRUPTED:
+            self._publish_(None)
+
+    def _publish_(self, event):
+        """ Send an event to the callback, queue and event streams, None ends the event streams """
+        if event is not None:
+            if self.callback is not None:
+                try:
+                    self.callback(event)
+                except Exception:
+                    _logger.exception(_('USB button event callback failed.'))
+            if self.queue is not None:
+                self.queue.put(event)
+        with self._lock:
+            streams = list(self._streams)
+        for loop, queue in streams:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+            except RuntimeError:
+                pass  # The event loop is closed.
+
+    async def events(self):
+        """
+        Asynchronous iterator of ButtonEvent objects, ends when the watcher is stopped.
+        Example:
+            async for event in watcher.events():
+                ...
+        """
+        queue = asyncio.Queue()
+        entry = (asyncio.get_running_loop(), queue)
+        with self._lock:
+            self._streams.append(entry)
+        try:
+            while self._running or not queue.empty():
+                event = await queue.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            with self._lock:
+                self._streams.remove(entry)
@@ -0,0 +1,170 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Streaming color updates to a USB button.
+#
+# A ColorStream keeps the device handle open and sends colors from its own thread. Any thread may set a color,
+# fade to a color or pulse between two colors. Updates made faster than 'max_rate' are coalesced, only the newest
+# color is sent, and a color the button already shows is not sent again. Fades and pulses are computed on the host,
+# the button only supports setting one color.
+#
+import logging
+import threading
+import time
+
+from ultimarc import translate_gettext as _
+
+_logger = logging.getLogger('ultimarc')
+
+DEFAULT_RATE = 60.0  # Maximum colors sent per second.
+
+
+def _check_color(color):
+    """ Return a color as a tuple of three integers, raise ValueError if it is not valid """
+    color = tuple(color)
+    if len(color) != 3 or not all(isinstance(value, int) and 0 <= value <= 255 for value in color):
+        raise ValueError(_('Color argument value is invalid'))
+    return color
+
+
+def blend(start, end, fraction):
+    """
+    Return the color a fraction of the way between two colors.
+    :param start: (red, green, blue) tuple.
+    :param end: (red, green, blue) tuple.
+    :param fraction: value between 0.0 (start) and 1.0 (end).
+    :return: (red, green, blue) tuple.
+    """
+    fraction = min(1.0, max(0.0, fraction))
+    return tuple(round(a + (b - a) * fraction) for a, b in zip(start, end))
+
+
+class ColorStream(threading.Thread):
+    """ Sends color updates to an opened USB button handle at a capped rate. """
+
+    def __init__(self, dev_h, max_rate=DEFAULT_RATE, clock=time.monotonic):
+        """
+        :param dev_h: opened USBButtonDevice handle, it must not be used by other threads while streaming.
+        :param max_rate: maximum colors sent per second.
+        :param clock: function returning seconds, used to compute fades and pulses.
+        """
+        super(ColorStream, self).__init__(name='ultimarc-color-stream', daemon=True)
+        self.dev_h = dev_h
+        self.interval = 1.0 / max_rate
+        self.clock = clock
+        self.result = None  # True when the stream was stopped, False if sending a color failed.
+        self.updates = 0
+        self.sent = 0
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._color = None  # Newest color requested.
+        self._effect = None  # function(now) -> ((red, green, blue), finished), see fade() and pulse().
+        self._last = None  # Color last sent.
+
+    def __enter__(self):
+        if self.ident is None:
+            self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _update_(self, color, effect=None):
+        with self._lock:
+            self._color = color
+            self._effect = effect
+            self.updates += 1
+        self._wake.set()
+
+    def set_color(self, red, green, blue):
+        """
+        Set the button color, replaces a running fade or pulse.
+        :param red: integer between 0 and 255
+        :param green: integer between 0 and 255
+        :param blue: integer between 0 and 255
+        """
+        self._update_(_check_color((red, green, blue)))
+
+    def fade(self, color, seconds, start=None):
+        """
+        Fade to a color.
+        :param color: (red, green, blue) tuple.
+        :param seconds: length of the fade.
+        :param start: (red, green, blue) tuple to fade from, defaults to the current color.
+        """
+        color = _check_color(color)
+        with self._lock:
+            current = self._last if self._effect else self._color or self._last
+            begin = _check_color(start) if start else current or (0, 0, 0)
+        began = self.clock()
+
+        def effect(now):
+            elapsed = now - began
+            return blend(begin, color, elapsed / seconds if seconds > 0 else 1.0), elapsed >= seconds
+        self._update_(color, effect)
+
+    def pulse(self, color, period, low=(0, 0, 0)):
+        """
+        Fade between two colors until another color is set.
+        :param color: (red, green, blue) tuple reached half way through each period.
+        :param period: seconds of one pulse.
+        :param low: (red, green, blue) tuple each pulse starts and ends with.
+        """
+        high = _check_color(color)
+        low = _check_color(low)
+        if period <= 0:
+            raise ValueError(_('Pulse period must be greater than zero'))
+        began = self.clock()
+
+        def effect(now):
+            phase = ((now - began) / period) % 1.0
+            return blend(low, high, 1.0 - abs(2.0 * phase - 1.0)), False
+        self._update_(low, effect)
+
+    def stop(self, timeout=None):
+        """
+        Send the newest color and stop the stream.
+        :param timeout: seconds to wait for the stream thread, None to wait until it ends.
+        """
+        with self._lock:
+            self._stopping = True
+        self._wake.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while True:
+            with self._lock:
+                self._wake.clear()
+                stopping = self._stopping
+                if self._effect:
+                    color, finished = self._effect(self.clock())
+                    if finished:
+                        self._effect = None
+                else:
+                    color = self._color
+                active = self._effect is not None
+
+            if color is not None and color != self._last:
+                started = self.clock()
+                if not self.dev_h.set_color(*color):
+                    _logger.error(_('Failed to send usb button color, stopping color stream.'))
+                    self.result = False
+                    return
+                self._last = color
+                self.sent += 1
+                if stopping:
+                    break
+                # Updates made while waiting for the next send are coalesced.
+                remaining = started + self.interval - self.clock()
+                if remaining > 0:
+                    time.sleep(remaining)
+                continue
+
+            if stopping:
+                break
+            self._wake.wait(self.interval if active else None)
+        self.result = True
@@ -0,0 +1,160 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Persistent cache of the configurations devices hold, so they can be shown and compared without reading them
+# over USB. Reading a PAC configuration takes a request and 64 interrupt reads.
+#
+# Configurations are stored by content hash in $XDG_CACHE_HOME/ultimarc/configs/objects, and each device has
+# an index of the configuration hash it holds for each kind of payload, see USBDeviceHandle.compile_config().
+# Devices are keyed by product, bus and port path, these are known without the USB transfer reading a serial
+# number string would take. A cached copy is only used while the device has the same address, a device gets a
+# new address when it is plugged in again, and for 'ttl' seconds after it was stored, in case another program
+# changed the device. Configurations read from or written to a device by a handle with a cache are stored as
+# they happen.
+#
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+from ultimarc import translate_gettext as _
+from ultimarc.system_utils import cache_dir
+
+_logger = logging.getLogger('ultimarc')
+
+DEFAULT_TTL = 3600.0
+
+
+class ConfigCache(object):
+    """ Content addressed cache of device configurations. """
+
+    def __init__(self, directory=None, ttl=DEFAULT_TTL):
+        """
+        :param directory: cache directory, defaults to system_utils.cache_dir()/configs.
+        :param ttl: seconds a cached configuration is used for, None to use it until the device is plugged in
+                    again, 0 to only store configurations.
+        """
+        self.directory = directory or os.path.join(cache_dir(), 'configs')
+        self.ttl = ttl
+
+    @staticmethod
+    def device_id(dev_info):
+        """
+        Return the cache identity of a device, no USB transfer is needed.
+        :param dev_info: USBDeviceInfo object.
+        :return: (key, probe) tuple, the cached copies of a device are dropped when its probe value changes.
+        """
+        key = re.sub(r'[^0-9A-Za-z.-]', '-', f'{dev_info.dev_key}-{dev_info.bus}-{dev_info.path or "0"}')
+        return key, dev_info.address
+
+    def _index_path_(self, key):
+        return os.path.join(self.directory, 'devices', f'{key}.json')
+
+    def _object_path_(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest)
+
+    def _read_index_(self, dev_id):
+        """ Return the index entries of a device, an empty dict if there are none or the device has changed """
+        key, probe = dev_id
+        try:
+            with open(self._index_path_(key)) as h:
+                index = json.loads(h.read())
+        except (OSError, ValueError):
+            return dict()
+        if not isinstance(index, dict) or index.get('probe') != probe:
+            return dict()
+        return index.get('entries') or dict()
+
+    def _write_index_(self, dev_id, entries):
+        key, probe = dev_id
+        self._write_file_(self._index_path_(key), json.dumps({'probe': probe, 'entries': entries}).encode('utf-8'))
+
+    @staticmethod
+    def _write_file_(path, data):
+        """ Replace a file, readers never see a partial file """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as h:
+            h.write(data)
+        os.replace(tmp_path, path)
+
+    def _valid_(self, entry):
+        return self.ttl is None or 0 <= time.time() - entry.get('time', 0) < self.ttl
+
+    def entries(self, dev_id):
+        """
+        Return the valid cached configurations of a device.
+        :param dev_id: identity returned by device_id().
+        :return: dict of payload kind -> {'hash': sha256, 'time': seconds since the epoch}.
+        """
+        return {kind: entry for kind, entry in self._read_index_(dev_id).items() if self._valid_(entry)}
+
+    def get_hash(self, dev_id, kind):
+        """
+        Return the content hash of the configuration a device holds.
+        :param dev_id: identity returned by device_id().
+        :param kind: payload kind.
+        :return: sha256 hex string or None if there is no valid cached copy.
+        """
+        entry = self.entries(dev_id).get(kind)
+        return entry['hash'] if entry else None
+
+    def get(self, dev_id, kind):
+        """
+        Return the configuration a device holds.
+        :param dev_id: identity returned by device_id().
+        :param kind: payload kind.
+        :return: bytes or None if there is no valid cached copy.
+        """
+        digest = self.get_hash(dev_id, kind)
+        if digest is None:
+            return None
+        try:
+            with open(self._object_path_(digest), 'rb') as h:
+                data = h.read()
+        except OSError:
+            return None
+        if hashlib.sha256(data).hexdigest() != digest:
+            _logger.debug(_('Dropping corrupt cached configuration') + f' {digest}.')
+            return None
+        return data
+
+    def put(self, dev_id, kind, data):
+        """
+        Store the configuration a device holds.
+        :param dev_id: identity returned by device_id().
+        :param kind: payload kind.
+        :param data: configuration bytes.
+        :return: sha256 hex string of the configuration.
+        """
+        data = bytes(data)
+        digest = hashlib.sha256(data).hexdigest()
+        try:
+            if not os.path.exists(self._object_path_(digest)):
+                self._write_file_(self._object_path_(digest), data)
+            entries = self._read_index_(dev_id)
+            entries[kind] = {'hash': digest, 'time': time.time()}
+            self._write_index_(dev_id, entries)
+        except OSError as e:
+            _logger.debug(_('Unable to store cached configuration') + f': {e}')
+        return digest
+
+    def drop(self, dev_id, kinds=None):
+        """
+        Forget the configurations a device holds.
+        :param dev_id: identity returned by device_id().
+        :param kinds: payload kinds to forget, None forgets them all.
+        """
+        entries = self._read_index_(dev_id)
+        kinds = list(entries) if kinds is None else [kind for kind in kinds if kind in entries]
+        if not kinds:
+            return
+        for kind in kinds:
+            del entries[kind]
+        try:
+            self._write_index_(dev_id, entries)
+        except OSError as e:
+            _logger.debug(_('Unable to update configuration cache') + f': {e}')
@@ -5,18 +5,25 @@
 # Base class for all USB device classes.
 #
 
+import asyncio
 import ctypes as ct
+import hashlib
 import json
 import logging
+import struct
+import time
 
 from enum import IntEnum
 from json import JSONDecodeError
-from pathlib import Path
 
 import fastjsonschema
 import libusb as usb
 
 from ultimarc import translate_gettext as _
+from ultimarc.devices import _trace
+from ultimarc.devices._metrics import get_metrics_sink, timed_operation
+from ultimarc.devices._transfers import USBTransfer, _value, gather, read_interrupt_stream, then
+from ultimarc.devices._validators import get_schema_validator
 from ultimarc.exceptions import USBDeviceClaimInterfaceError, USBDeviceInterfaceNotClaimedError
 
 _logger = logging.getLogger('ultimarc')
@@ -102,8 +109,15 @@ class USBDeviceHandle:
     class_id = 'unset'  # Used to match/filter devices. Override in child classes.
     class_descr = 'unset'  # Override in child classes.
     interface = None  # Interface to write and read from.
+    async_transfers = True  # Queue the packets of multi packet writes and reads with the libusb asynchronous API.
+    in_flight = 4  # Interrupt IN transfers kept submitted while reading a response.
 
     descriptor_fields = None  # List of available device property fields.
+    _trace_address_ = None  # (bus, address) tuple, looked up when the first transfer is traced.
+    _applied_ = None  # Payload kind -> sha256 of the last payload sent with apply_payload().
+    config_cache = None  # ConfigCache object, see attach_cache().
+    _cache_id_ = None  # Identity of the device in the config cache.
+    _forgotten_ = None  # Payload kinds dropped from the config cache since the last payload, True for all kinds.
 
     def __init__(self, dev_handle, dev_key):
         self.__libusb_dev__ = usb.get_device(dev_handle)
@@ -163,6 +177,14 @@ class USBDeviceHandle:
             # usb.close(self.__libusb_dev_handle__)
             raise USBDeviceClaimInterfaceError(self.dev_key)
 
+    def release_interface(self):
+        """ Release the claimed USB device interface, if one has been claimed. """
+        if self.interface is None:
+            return
+        status = usb.release_interface(self.__libusb_dev_handle__, self.interface)
+        if status != usb.LIBUSB_SUCCESS:
+            usb_error(status, _('Failed to release USB device interface') + f' {self.dev_key}.', debug=True)
+
     def _make_interrupt_transfer(self, endpoint, data, size, actual_length, timeout=2000):
         """
         Read message from USB device
@@ -174,16 +196,24 @@ class USBDeviceHandle:
         if self.interface is None:
             raise USBDeviceInterfaceNotClaimedError(self.dev_key)
 
+        actual_length = ct.cast(actual_length, ct.POINTER(ct.c_int))
+        start = time.perf_counter()
         ret = usb.interrupt_transfer(
             self.__libusb_dev_handle__,  # ct.c_char_p
             endpoint,  # ct.ubyte
             ct.cast(data, ct.POINTER(ct.c_ubyte)),  # ct.POINTER(ct.c_ubyte)
             size,
-            ct.cast(actual_length, ct.POINTER(ct.c_int)),  # ct.POINTER(ct.c_int)
+            actual_length,  # ct.POINTER(ct.c_int)
             timeout)  # ct.c_uint32
+        self._record_transfer_(self._interrupt_type_(endpoint), f'0x{endpoint:02x}', ret, actual_length[0],
+                               time.perf_counter() - start)
+        if _trace.active is not None:
+            self._trace_transfer_('interrupt', endpoint, None, ret,
+                                  ct.string_at(ct.cast(data, ct.c_void_p), max(actual_length[0], 0)))
 
         if ret >= 0:
-            _logger.debug(f'Read {size} ' + _('bytes from device').format(size) + f' {self.dev_key}.')
+            if _logger.isEnabledFor(logging.DEBUG):
+                _logger.debug(f'Read {size} ' + _('bytes from device').format(size) + f' {self.dev_key}.')
             return True
 
         usb_error(ret, _('Failed to communicate with device') + f' {self.dev_key}.')
@@ -213,6 +243,7 @@ class USBDeviceHandle:
         if not isinstance(b_request, (USBRequestCode, IntEnum)):
             raise ValueError('b_request argument must be USBRequestCode enum value.')
 
+        start = time.perf_counter()
         ret = usb.control_transfer(
             self.__libusb_dev_handle__,  # ct.c_char_p
             request_type,  # ct.c_uint8
@@ -222,17 +253,55 @@ class USBDeviceHandle:
             ct.cast(data, ct.POINTER(ct.c_ubyte)),  # ct.POINTER(ct.c_ubyte)
             ct.c_uint16(size),  # ct.c_uint16
             timeout)  # ct.c_uint32
+        self._record_transfer_(self._control_type_(request_type), b_request.name, ret, ret,
+                               time.perf_counter() - start)
+        if _trace.active is not None:
+            length = size if not request_type & USBRequestDirection.ENDPOINT_IN else max(ret, 0)
+            self._trace_transfer_('control', request_type & usb.LIBUSB_ENDPOINT_IN,
+                                  self._setup_packet_(request_type, b_request, w_value, w_index, size), ret,
+                                  ct.string_at(ct.cast(data, ct.c_void_p), length) if length else b'')
 
         if ret >= 0:
-            if request_type & USBRequestDirection.ENDPOINT_IN:
-                _logger.debug('Read {} bytes from'.format(size) + f' {self.dev_key}.')
-            else:
-                _logger.debug('Wrote {} bytes to'.format(size) + f' {self.dev_key}.')
+            if _logger.isEnabledFor(logging.DEBUG):
+                if request_type & USBRequestDirection.ENDPOINT_IN:
+                    _logger.debug('Read {} bytes from'.format(size) + f' {self.dev_key}.')
+                else:
+                    _logger.debug('Wrote {} bytes to'.format(size) + f' {self.dev_key}.')
             return True
 
         usb_error(ret, _('Failed to communicate with device') + f' {self.dev_key}.')
         return False
 
+    def _record_transfer_(self, transfer_type, request, code, size, seconds):
+        """ Record a transfer in the metrics sink, see ultimarc.devices._metrics """
+        get_metrics_sink().record_transfer(self.dev_key, transfer_type, request, size, code, seconds)
+
+    def _trace_transfer_(self, transfer_type, endpoint, setup, code, data):
+        """ Add a transfer to the active trace, see ultimarc.devices._trace """
+        trace = _trace.active
+        if trace is None:
+            return
+        if self._trace_address_ is None:
+            self._trace_address_ = (usb.get_bus_number(self.__libusb_dev__),
+                                    usb.get_device_address(self.__libusb_dev__))
+        if self._trace_address_ not in trace.devices:
+            trace.add_device(*self._trace_address_, bytes(self.__libusb_dev_desc__))
+        trace.record(self.dev_key, *self._trace_address_, transfer_type, endpoint, setup, code, data)
+
+    @staticmethod
+    def _setup_packet_(request_type, b_request, w_value, w_index, length):
+        """ Return the 8 byte setup packet of a control transfer """
+        return struct.pack('<BBHHH', _value(request_type), _value(b_request), _value(w_value), _value(w_index),
+                           length)
+
+    @staticmethod
+    def _control_type_(request_type):
+        return 'control_in' if request_type & USBRequestDirection.ENDPOINT_IN else 'control_out'
+
+    @staticmethod
+    def _interrupt_type_(endpoint):
+        return 'interrupt_in' if endpoint & usb.LIBUSB_ENDPOINT_IN else 'interrupt_out'
+
     def write(self, b_request, report_id, w_index, data=None, size=None, request_type=USBRequestType.REQUEST_TYPE_CLASS,
               recipient=USBRequestRecipient.RECIPIENT_INTERFACE):
         """
@@ -269,7 +338,8 @@ class USBDeviceHandle:
         ret = self._make_control_transfer(request_type, b_request, w_value,
                                           w_index, payload_ptr,
                                           ct.sizeof(payload) if report_id else size)
-        _logger.debug(_(' '.join(hex(x) for x in payload)))
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug(' '.join(hex(x) for x in payload))
         return ret
 
     def write_alt(self, b_request, report_id, w_index, data=None, size=None,
@@ -285,6 +355,53 @@ class USBDeviceHandle:
         :param recipient: USBRequestRecipient enum value.
         :return: True if successful otherwise False.
         """
+        request_type, w_value, report_id = self._out_request_(report_id, request_type, recipient)
+        payloads = self._split_payload_(report_id, data, size)
+        if self.async_transfers:
+            return self._queue_control_transfers_(request_type, b_request, w_value, w_index, payloads).result()
+
+        ret = -1
+        for payload in payloads:
+            buf = (ct.c_ubyte * len(payload)).from_buffer_copy(payload)
+            ret = self._make_control_transfer(request_type, b_request, w_value, w_index, ct.byref(buf), len(payload))
+            if _logger.isEnabledFor(logging.DEBUG):
+                _logger.debug(' '.join(hex(x) for x in payload))
+
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug(_('Write operation complete, wrote {} bytes.').format(size))
+        return ret
+
+    async def write_alt_async(self, b_request, report_id, w_index, data=None, size=None,
+                              request_type=USBRequestType.REQUEST_TYPE_CLASS,
+                              recipient=USBRequestRecipient.RECIPIENT_INTERFACE):
+        """
+        Write message to USB device without blocking the event loop, see write_alt().
+        :return: True if successful otherwise False.
+        """
+        request_type, w_value, report_id = self._out_request_(report_id, request_type, recipient)
+        payloads = self._split_payload_(report_id, data, size)
+        return await asyncio.wrap_future(
+            self._queue_control_transfers_(request_type, b_request, w_value, w_index, payloads))
+
+    async def write_async(self, b_request, report_id, w_index, data=None, size=None,
+                          request_type=USBRequestType.REQUEST_TYPE_CLASS,
+                          recipient=USBRequestRecipient.RECIPIENT_INTERFACE):
+        """
+        Write a single packet message to USB device without blocking the event loop, see write().
+        :return: True if successful otherwise False.
+        """
+        request_type, w_value, report_id = self._out_request_(report_id, request_type, recipient)
+        payload = self._split_payload_(report_id, data, min(size, 4))[0]
+        if report_id:
+            payload = payload.ljust(5, b'\x00')
+        return await asyncio.wrap_future(
+            self._queue_control_transfers_(request_type, b_request, w_value, w_index, [payload]))
+
+    def _out_request_(self, report_id, request_type, recipient):
+        """
+        Check the arguments of a write request.
+        :return: (request type, w_value, report_id) tuple.
+        """
         if self.interface is None:
             raise USBDeviceInterfaceNotClaimedError(self.dev_key)
         if not isinstance(request_type, USBRequestType):
@@ -298,26 +415,62 @@ class USBDeviceHandle:
         # Combine direction, request type and recipient together.
         request_type = USBRequestDirection.ENDPOINT_OUT | request_type | recipient
         w_value = ct.c_uint16(USB_REPORT_TYPE_OUT.value | report_id.value)
+        return request_type, w_value, report_id
 
-        payload = (ct.c_ubyte * 5)(0)
-        offset = 1 if report_id else 0
-        pos = 0
-        ret = -1
-
-        if report_id:
-            payload[0] = report_id
-
-        while pos < size:
-            payload_size = 4 if size - pos > 4 else size - pos
-            ct.memmove(ct.addressof(payload) + offset, ct.byref(data, pos), payload_size)
+    @staticmethod
+    def _split_payload_(report_id, data, size):
+        """
+        Split a message into 4 byte packets, prefixed with the report id if there is one.
+        :param report_id: ctypes.c_uint8 report id.
+        :param data: ctypes structure class.
+        :param size: size of message.
+        :return: list of bytes objects.
+        """
+        prefix = bytes([report_id.value]) if report_id else b''
+        message = ct.string_at(ct.addressof(data), size)
+        return [prefix + message[pos:pos + 4] for pos in range(0, size, 4)]
 
-            ret = self._make_control_transfer(request_type, b_request, w_value,
-                                              w_index, ct.byref(payload), payload_size + offset)
-            pos += payload_size
-            _logger.debug(_(' '.join(hex(x) for x in payload)))
+    def _queue_control_transfers_(self, request_type, b_request, w_value, w_index, payloads, timeout=2000):
+        """
+        Submit one control transfer per payload, libusb sends them back to back.
+        :return: Future, the result is True if every transfer was successful otherwise False.
+        """
+        if self.interface is None:
+            raise USBDeviceInterfaceNotClaimedError(self.dev_key)
+        if not isinstance(b_request, (USBRequestCode, IntEnum)):
+            raise ValueError('b_request argument must be USBRequestCode enum value.')
 
-        _logger.debug(_('Write operation complete, wrote {} bytes.').format(pos))
-        return ret
+        start = time.perf_counter()
+        futures = [USBTransfer.control(self.__libusb_dev_handle__, request_type, b_request, w_value, w_index,
+                                       payload, timeout).submit() for payload in payloads]
+        transfer_type = self._control_type_(request_type)
+
+        def record(future):
+            result = future.result()
+            self._record_transfer_(transfer_type, b_request.name, result.code, len(result.data),
+                                   time.perf_counter() - start)
+            if _trace.active is not None:
+                self._trace_transfer_('control', request_type & usb.LIBUSB_ENDPOINT_IN,
+                                      self._setup_packet_(request_type, b_request, w_value, w_index,
+                                                          len(result.data)), result.code, result.data)
+
+        for future in futures:
+            future.add_done_callback(record)
+
+        def done(results):
+            ok = True
+            debug = _logger.isEnabledFor(logging.DEBUG)
+            for payload, result in zip(payloads, results):
+                if result.code < 0:
+                    usb_error(result.code, _('Failed to communicate with device') + f' {self.dev_key}.')
+                    ok = False
+                elif debug:
+                    _logger.debug(' '.join(hex(x) for x in payload))
+            if debug:
+                _logger.debug(_('Write operation complete, wrote {} bytes.').format(sum(len(p) for p in payloads)))
+            return ok
+
+        return then(gather(futures), done)
 
     def write_raw(self, b_request, w_value, w_index, data=None, size=None,
                   request_type=USBRequestType.REQUEST_TYPE_CLASS, recipient=USBRequestRecipient.RECIPIENT_INTERFACE):
@@ -377,6 +530,9 @@ class USBDeviceHandle:
         if self.interface is None:
             raise USBDeviceInterfaceNotClaimedError(self.dev_key)
 
+        if self.async_transfers:
+            return self._queue_read_interrupt_(endpoint, response, uses_report_id).result()
+
         actual_length = ct.c_int(0)
         length = 5 if uses_report_id else 4
         payload = (ct.c_ubyte * length)(0)
@@ -386,7 +542,8 @@ class USBDeviceHandle:
         # response structures plan on 4 bytes of data each read
         for pos in range(0, ct.sizeof(response), 4):
             self._make_interrupt_transfer(endpoint, payload_ptr, length, ct.byref(actual_length))
-            _logger.debug(_(' '.join(hex(x) for x in payload)))
+            if _logger.isEnabledFor(logging.DEBUG):
+                _logger.debug(' '.join(hex(x) for x in payload))
 
             # Remove report_id (byte 0) from copy length if it is used
             copy_length = actual_length.value - (1 if uses_report_id else 0)
@@ -399,6 +556,48 @@ class USBDeviceHandle:
         # _logger.debug(response)
         return response
 
+    async def read_interrupt_async(self, endpoint, response, uses_report_id=True):
+        """
+        Read response from USB device on the interrupt endpoint without blocking the event loop,
+        see read_interrupt().
+        """
+        return await asyncio.wrap_future(self._queue_read_interrupt_(endpoint, response, uses_report_id))
+
+    def _queue_read_interrupt_(self, endpoint, response, uses_report_id=True, timeout=2000):
+        """
+        Read the response packets keeping several interrupt IN transfers submitted.
+        :return: Future, the result is the response.
+        """
+        if self.interface is None:
+            raise USBDeviceInterfaceNotClaimedError(self.dev_key)
+
+        size = ct.sizeof(response)
+        length = 5 if uses_report_id else 4
+        # response structures plan on 4 bytes of data each read
+        count = (size + 3) // 4
+
+        def done(results):
+            debug = _logger.isEnabledFor(logging.DEBUG)
+            for pos, result in zip(range(0, size, 4), results):
+                if result.code < 0:
+                    usb_error(result.code, _('Failed to communicate with device') + f' {self.dev_key}.')
+                    continue
+                if debug:
+                    _logger.debug(' '.join(hex(x) for x in result.data))
+                # Remove report_id (byte 0) if it is used
+                data = result.data[1:] if uses_report_id else result.data
+                ct.memmove(ct.addressof(response) + pos, data, min(len(data), size - pos))
+            return response
+
+        def record(result, seconds):
+            self._record_transfer_(self._interrupt_type_(endpoint), f'0x{endpoint:02x}', result.code,
+                                   len(result.data), seconds)
+            if _trace.active is not None:
+                self._trace_transfer_('interrupt', endpoint, None, result.code, result.data)
+
+        return then(read_interrupt_stream(self.__libusb_dev_handle__, endpoint, length, count, self.in_flight,
+                                          timeout, record), done)
+
     @classmethod
     def load_config_schema(cls, schema_file):
         """
@@ -406,18 +605,8 @@ class USBDeviceHandle:
         :param schema_file: Schema file name only, no path included.
         :return: schema dict.
         """
-        file_path = Path.resolve(Path(__file__))
-        proj_path = file_path.parents[2]
-        import_base = proj_path / 'ultimarc'
-        schema_base = import_base / 'schemas'
-        schema_path = schema_base / schema_file
-
-        if not schema_path.is_file():
-            _logger.error(_('Unable to locate schema directory.'))
-            return None
-
-        with open(schema_path) as h:
-            return json.loads(h.read())
+        schema, _validator = get_schema_validator(schema_file)
+        return schema
 
     @classmethod
     def validate_config(cls, config, schema_file):
@@ -427,17 +616,17 @@ class USBDeviceHandle:
         :param schema_file: relative or abspath of schema.
         :return: True if valid otherwise False.
         """
-        schema = cls.load_config_schema(schema_file)
-        if not schema:
-            return False
-
-        try:
-            config_validator = fastjsonschema.compile(schema)
-            config_validator(config)
-        except fastjsonschema.JsonSchemaException as e:
-            _logger.error(_('Configuration file did not validate against config schema.'))
-            _logger.error(e)
-            return False
+        with timed_operation('schema_validation'):
+            schema, config_validator = get_schema_validator(schema_file)
+            if not schema:
+                return False
+
+            try:
+                config_validator(config)
+            except fastjsonschema.JsonSchemaException as e:
+                _logger.error(_('Configuration file did not validate against config schema.'))
+                _logger.error(e)
+                return False
 
         return True
 
@@ -450,7 +639,7 @@ class USBDeviceHandle:
         :return: config dict.
         """
         # Read the base schema, all json configs must validate against this schema.
-        base_schema = cls.load_config_schema('base.schema')
+        base_schema, config_validator = get_schema_validator('base.schema')
         if not base_schema:
             return None
 
@@ -462,8 +651,8 @@ class USBDeviceHandle:
             return None
 
         try:
-            config_validator = fastjsonschema.compile(base_schema)
-            config_validator(config)
+            with timed_operation('schema_validation'):
+                config_validator(config)
         except fastjsonschema.JsonSchemaException as e:
             _logger.error(_('Configuration file did not validate against the base schema.') + f'\n{e}')
             return None
@@ -474,3 +663,115 @@ class USBDeviceHandle:
             return None
 
         return config
+
+    @classmethod
+    def compile_config(cls, config_file):
+        """
+        Validate a configuration file and encode it as the bytes sent to the device, see apply_payload().
+        No device is needed, the payload can be stored and sent later.
+        :param config_file: Absolute path to configuration json file.
+        :return: (kind, bytes) tuple or None if the configuration is not valid for this device class.
+        """
+        return cls.__new__(cls)._compile_config_(config_file)
+
+    def _compile_config_(self, config_file):
+        """
+        Encode a configuration file, override in child classes. Called on an instance without a device handle,
+        only helpers which do not transfer data may be used.
+        :return: (kind, bytes) tuple or None.
+        """
+        _logger.error(_('Device class does not support compiled configurations') + f' ({self.class_id}).')
+        return None
+
+    def attach_cache(self, cache, dev_info):
+        """
+        Keep the configurations this handle reads from and writes to the device in a cache.
+        :param cache: ConfigCache object.
+        :param dev_info: USBDeviceInfo object of this device.
+        """
+        self.config_cache = cache
+        self._cache_id_ = cache.device_id(dev_info)
+
+    def _cache_get_(self, kind):
+        """ Return the cached configuration bytes of a payload kind or None """
+        return self.config_cache.get(self._cache_id_, kind) if self.config_cache is not None else None
+
+    def _cache_put_(self, kind, data):
+        """ Store the configuration bytes the device now holds """
+        if self.config_cache is not None:
+            self.config_cache.put(self._cache_id_, kind, data)
+            self._forgotten_ = None
+
+    def _cache_drop_(self, kinds=None):
+        """ Forget cached configurations, None forgets them all """
+        if self.config_cache is not None:
+            self.config_cache.drop(self._cache_id_, kinds)
+
+    def payload_applied(self, kind, payload):
+        """
+        Check if the device holds a payload, as far as this handle or the config cache knows.
+        :param kind: payload kind returned by compile_config().
+        :param payload: payload bytes.
+        :return: True if the payload does not need to be sent.
+        """
+        digest = hashlib.sha256(payload).hexdigest()
+        if self._applied_ is not None and kind in self._applied_:
+            return self._applied_[kind] == digest
+        return self.config_cache is not None and self.config_cache.get_hash(self._cache_id_, kind) == digest
+
+    def apply_payload(self, kind, payload):
+        """
+        Send a payload created by compile_config().
+        :param kind: payload kind returned by compile_config().
+        :param payload: payload bytes.
+        :return: True if successful otherwise False.
+        """
+        ok = self._send_payload_(kind, bytes(payload))
+        if self._applied_ is None:
+            self._applied_ = dict()
+        if ok:
+            self._applied_[kind] = hashlib.sha256(payload).hexdigest()
+            self._cache_put_(kind, payload)
+        else:
+            self._applied_.pop(kind, None)
+            self._cache_drop_([kind])
+        return ok
+
+    def _send_payload_(self, kind, payload):
+        """
+        Send payload bytes to the device, override in child classes.
+        :return: True if successful otherwise False.
+        """
+        _logger.error(_('Unknown payload kind') + f' {kind}.')
+        return False
+
+    def _forget_state_(self):
+        """
+        Forget what this handle knows about the device, call when another process may have changed the device.
+        The config cache is kept, other processes update it. Override in child classes that keep more state.
+        """
+        self._applied_ = None
+
+    def _forget_payloads_(self, *kinds):
+        """
+        Forget the payloads sent, call when the device state is changed by other requests. The config cache is
+        only updated the first time, so requests sent in a loop don't touch the cache each time.
+        :param kinds: payload kinds, no kinds forgets all.
+        """
+        if not kinds:
+            self._applied_ = None
+            if self._forgotten_ is not True:
+                self._cache_drop_()
+                self._forgotten_ = True
+            return
+
+        if self._applied_ is None:
+            self._applied_ = dict()
+        for kind in kinds:
+            self._applied_[kind] = None
+        if self._forgotten_ is True:
+            return
+        kinds = [kind for kind in kinds if kind not in (self._forgotten_ or ())]
+        if kinds:
+            self._cache_drop_(kinds)
+            self._forgotten_ = (self._forgotten_ or set()) | set(kinds)
@@ -0,0 +1,180 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Keyframed LED animations for ultimate-io devices.
+#
+# An animation is a json file of keyframes, see 'ultimate-io-animation.schema'. Each keyframe starts from the LED
+# intensities of the keyframe before it, 'allIntensities' sets every LED and 'intensities' sets single LEDs.
+# A keyframe either fades from the previous keyframe or steps to its intensities at its time.
+#
+# Frames are rendered once when an animation is loaded. LEDSequencer plays them on its own thread, frames are
+# scheduled from the start time so sleep overruns don't add up, and frames that are already late when the previous
+# transfer finished are dropped. Only the LEDs that changed since the last frame are sent, see
+# UltimateIODevice.set_led_frame().
+#
+import bisect
+import logging
+import threading
+import time
+
+from ultimarc import translate_gettext as _
+from ultimarc.devices._device import USBDeviceHandle
+
+_logger = logging.getLogger('ultimarc')
+
+LED_COUNT = 96
+DEFAULT_FPS = 30.0
+
+
+class LEDAnimation(object):
+    """ Rendered frames of a keyframed LED animation. """
+
+    def __init__(self, keyframes, fps=DEFAULT_FPS, loop=False, duration=None):
+        """
+        :param keyframes: list of keyframe dicts, see 'ultimate-io-animation.schema'.
+        :param fps: frames per second.
+        :param loop: play the animation again from the start when it ends.
+        :param duration: length of the animation in seconds, defaults to the time of the last keyframe.
+        """
+        keyframes = sorted(keyframes, key=lambda k: k['time'])
+        self.fps = float(fps)
+        self.loop = loop
+        self.duration = max(keyframes[-1]['time'], duration or 0.0)
+
+        self._times = [k['time'] for k in keyframes]
+        self._fades = [k.get('transition', 'fade') == 'fade' for k in keyframes]
+        self._states = list()
+        state = bytearray(LED_COUNT)
+        for keyframe in keyframes:
+            if 'allIntensities' in keyframe:
+                state = bytearray([keyframe['allIntensities']]) * LED_COUNT
+            for intensity in keyframe.get('intensities', []):
+                state[intensity['led'] - 1] = intensity['value']
+            self._states.append(bytes(state))
+
+        # A looping animation ends where it starts, so its last frame is the first frame of the next pass.
+        count = max(1, int(round(self.duration * self.fps)) + (0 if self.loop else 1))
+        self.frames = [self.frame_at(x / self.fps) for x in range(count)]
+
+    @classmethod
+    def load(cls, config_file, fps=None):
+        """
+        Load an animation from a configuration file.
+        :param config_file: Absolute path to animation json file.
+        :param fps: frames per second, overrides the 'fps' value of the file.
+        :return: LEDAnimation object or None if the file is not valid.
+        """
+        config = USBDeviceHandle.validate_config_base(config_file, ['ultimate-io-animation'])
+        if not config:
+            return None
+        if config['deviceClass'] != 'ultimate-io':
+            _logger.error(_('Configuration device class is not "ultimate-io".'))
+            return None
+        if not USBDeviceHandle.validate_config(config, 'ultimate-io-animation.schema'):
+            return None
+        return cls(config['keyframes'], fps=fps or config.get('fps', DEFAULT_FPS), loop=config.get('loop', False),
+                   duration=config.get('duration'))
+
+    def frame_at(self, seconds):
+        """
+        Return the LED intensities at a time.
+        :param seconds: time from the start of the animation.
+        :return: bytes of 96 intensities, LED 1 first.
+        """
+        index = bisect.bisect_right(self._times, seconds)
+        if index == 0:
+            return self._states[0]
+        if index == len(self._times) or not self._fades[index]:
+            return self._states[index - 1]
+
+        start, end = self._times[index - 1], self._times[index]
+        fraction = (seconds - start) / (end - start)
+        return bytes(round(a + (b - a) * fraction) for a, b in zip(self._states[index - 1], self._states[index]))
+
+
+class LEDSequencer(threading.Thread):
+    """ Plays an LEDAnimation on an ultimate-io device from a scheduler thread. """
+
+    def __init__(self, dev_h, animation: LEDAnimation, clock=time.monotonic):
+        """
+        :param dev_h: opened UltimateIODevice handle, it must not be used by other threads while playing.
+        :param animation: LEDAnimation object.
+        :param clock: function returning seconds, used to schedule frames.
+        """
+        super(LEDSequencer, self).__init__(name='ultimarc-led-sequencer', daemon=True)
+        self.dev_h = dev_h
+        self.animation = animation
+        self.clock = clock
+        self.result = None  # True when the animation finished or was stopped, False if a frame failed.
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.frames_unchanged = 0
+
+        self._stop_event = threading.Event()
+        self._start_time = None
+        self._frame = 0
+        self._last = None
+
+    def stop(self, timeout=None):
+        """
+        Stop playing and wait for the scheduler thread to end.
+        :param timeout: seconds to wait, None to wait until the thread ends.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            wait = self._step_(self.clock())
+            if wait is None:
+                break
+            if wait > 0:
+                self._stop_event.wait(wait)
+        if self.result is None:
+            self.result = True
+
+    def _step_(self, now):
+        """
+        Send the frame due at a time.
+        :param now: clock time.
+        :return: seconds until the next frame is due, None when the animation has ended.
+        """
+        fps = self.animation.fps
+        frames = self.animation.frames
+        if self._start_time is None:
+            self._start_time = now
+
+        due = self._start_time + self._frame / fps
+        if now < due:
+            return due - now
+
+        # Skip to the newest frame due, the frames in between are dropped.
+        current = int((now - self._start_time) * fps)
+        if current > self._frame:
+            self.frames_dropped += current - self._frame
+            self._frame = current
+
+        if self.animation.loop:
+            frame = frames[self._frame % len(frames)]
+        else:
+            if self._frame >= len(frames):
+                self.frames_dropped -= self._frame - (len(frames) - 1)
+                self._frame = len(frames) - 1
+            frame = frames[self._frame]
+
+        if frame == self._last:
+            self.frames_unchanged += 1
+        elif self.dev_h.set_led_frame(frame):
+            self.frames_sent += 1
+            self._last = frame
+        else:
+            _logger.error(_('Failed to send LED animation frame, stopping animation.'))
+            self.result = False
+            return None
+
+        self._frame += 1
+        if not self.animation.loop and self._frame >= len(frames):
+            return None
+        return max(0.0, self._start_time + self._frame / fps - self.clock())
@@ -0,0 +1,53 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Per-device locks shared between processes.
+#
+# A device is locked by (bus, address) while its handle is open, so two tools working on the same board are
+# serialized while tools working on different boards run at the same time. The locks are fcntl file locks,
+# the operating system drops them when a process exits. Lock files are kept in $XDG_RUNTIME_DIR/ultimarc or
+# ~/.local/run/ultimarc and never removed, removing a lock file another process is waiting on would let two
+# processes hold the "same" lock.
+#
+import logging
+import os
+
+from ultimarc import translate_gettext as _
+from ultimarc.exceptions import USBDeviceBusyError
+from ultimarc.system_utils import FileLock, runtime_dir
+
+_logger = logging.getLogger('ultimarc')
+
+
+class DeviceLocks:
+    """ Creates the lock of each device, see USBDeviceHandlePool. """
+
+    def __init__(self, lock_dir=None, timeout=30.0):
+        """
+        :param lock_dir: directory holding the lock files, defaults to system_utils.runtime_dir().
+        :param timeout: seconds to wait for another process to release a device, None waits forever.
+        """
+        self.lock_dir = lock_dir or runtime_dir()
+        self.timeout = timeout
+
+    def path(self, bus, address):
+        """ Return the lock file of a device """
+        return os.path.join(self.lock_dir, f'usb-{bus:03d}-{address:03d}.lock')
+
+    def acquire(self, bus, address, dev_key=''):
+        """
+        Lock a device, waiting up to 'timeout' seconds for another process to release it.
+        :param bus: bus number.
+        :param address: device address.
+        :param dev_key: device key used in messages.
+        :return: FileLock object, release it when the device is closed.
+        """
+        lock = FileLock(self.path(bus, address))
+        if lock.acquire(timeout=0):
+            return lock
+
+        _logger.info(_('Waiting for another program to release device') + f' {dev_key} ({bus},{address}).')
+        if not lock.acquire(timeout=self.timeout):
+            raise USBDeviceBusyError(dev_key)
+        return lock
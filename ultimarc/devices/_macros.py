@@ -0,0 +1,121 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Macro region tokenizer and encoder for the PAC series boards.
+#
+# The macro region is a run of macros, each starting with a control character. The first macro uses 0xe0,
+# the next 0xe1 and so on. The key codes of a macro follow its control character. The region ends at the
+# first zero byte.
+#
+from ultimarc.devices._mappings import IPACSeriesMapping, IPACSeriesMappingKeys
+
+# Control character of the first macro.
+MACRO_START = 0xe0
+
+
+class PacMacro:
+    """ A macro read from, or to be written to, the macro region of a PacStruct. """
+    __slots__ = ('name', 'codes', 'offset')
+
+    def __init__(self, name, codes, offset=None):
+        """
+        :param name: macro name, IE: '#1'.
+        :param codes: bytes object of key codes, without the control character.
+        :param offset: index of the control character in the PacStruct 'bytes' field, None if not placed yet.
+        """
+        self.name = name
+        self.codes = bytes(codes)
+        self.offset = offset
+
+    def __repr__(self):
+        return f'PacMacro({self.name!r}, {self.codes!r}, offset={self.offset})'
+
+    def __eq__(self, other):
+        return isinstance(other, PacMacro) and \
+            (self.name, self.codes, self.offset) == (other.name, other.codes, other.offset)
+
+    @property
+    def size(self):
+        """ Number of bytes used in the macro region, including the control character. """
+        return 1 + len(self.codes)
+
+    @property
+    def actions(self):
+        """ Return the key names of the macro. """
+        return [IPACSeriesMappingKeys[code] for code in self.codes]
+
+    def to_dict(self):
+        """ Return the macro as a json config macro dict. """
+        return {'name': self.name, 'action': self.actions}
+
+    @classmethod
+    def from_dict(cls, macro):
+        """
+        Create a macro from a json config macro dict, key names that are not valid are dropped.
+        :param macro: dict with 'name' and 'action' values.
+        :return: PacMacro object.
+        """
+        codes = [IPACSeriesMapping[a.upper()] for a in macro.get('action', []) if a.upper() in IPACSeriesMapping]
+        return cls(macro['name'], codes)
+
+
+def tokenize_macros(data, start):
+    """
+    Split the macro region into macros in a single pass.
+    :param data: PacStruct 'bytes' field, or any object supporting the buffer protocol.
+    :param start: index of the macro region.
+    :return: list of PacMacro objects.
+    """
+    view = memoryview(data).cast('B')
+    macros = []
+    next_macro = MACRO_START
+    begin = None
+
+    for x in range(start, len(view)):
+        value = view[x]
+        if begin is not None:
+            # check that the value isn't zero and not the start of the next macro
+            if value and value != next_macro:
+                continue
+            macros.append(PacMacro(f'#{len(macros) + 1}', view[begin + 1:x], begin))
+            begin = None
+
+        if not value:
+            # No more macros defined
+            break
+        if value == next_macro:
+            begin = x
+            next_macro += 1
+
+    return macros
+
+
+def encode_macros(macros, data, start, max_size):
+    """
+    Write macros into the macro region, setting the offset of each macro. Macros without key codes are skipped.
+    :param macros: list of PacMacro objects.
+    :param data: writable buffer, IE: bytearray or PacStruct 'bytes' field.
+    :param start: index of the macro region.
+    :param max_size: size of the macro region.
+    :return: dict of upper case macro name -> control character, or None if the macros do not fit.
+    """
+    view = memoryview(data).cast('B')
+    control = dict()
+    position = start
+    end = start + max_size
+    cur_macro = MACRO_START
+
+    for macro in macros:
+        if not macro.codes:
+            continue
+        if position + macro.size > end:
+            return None
+        view[position] = cur_macro
+        view[position + 1:position + macro.size] = macro.codes
+        macro.offset = position
+        control[macro.name.upper()] = cur_macro
+        position += macro.size
+        cur_macro += 1
+
+    return control
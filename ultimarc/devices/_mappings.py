@@ -22,11 +22,11 @@ IPACSeriesDebounce = {
 
 
 def get_ipac_series_debounce_key(val):
-    for key, value in IPACSeriesDebounce.items():
-        if val == value:
-            return key
-    _logger.info(_(f'"{val}" debounce value is not a valid value'))
-    return 'standard'
+    key = get_mapping_key(IPACSeriesDebounceKeys, val)
+    if key is None:
+        _logger.info(_(f'"{val}" debounce value is not a valid value'))
+        return 'standard'
+    return key
 
 
 #
@@ -221,17 +221,13 @@ IPACSeriesMapping = {
 
 
 def get_ipac_series_mapping_key(val):
-    for key, value in IPACSeriesMapping.items():
-        if val == value:
-            return key
-    return None
+    return get_mapping_key(IPACSeriesMappingKeys, val)
 
 
 def get_ipac_series_macro_mapping_index(val):
     # Check if it is a Macro entry
     # Will return None on Macro entries
-    r = range(0xe0, 0xef)
-    return r.index(val) if val in r else None
+    return get_mapping_key(IPACSeriesMacroIndexes, val)
 
 
 #
@@ -453,6 +449,11 @@ MacroLookupTable = (
     (63, 67, 71, 75)
 )
 
+
+def get_legacy_ipac_mapping_key(val):
+    return get_mapping_key(LegacyIPACMappingKeys, val)
+
+
 DecipherLookupKey = {
     "1up": 0,
     "1down": 1,
@@ -525,3 +526,36 @@ DecipherLookupMacroKey = {
     "m3": 2,
     "m4": 3,
 }
+
+
+def _reverse_table(mapping):
+    """
+    Build a reverse lookup table for a mapping of names to byte values.
+    When several names share a value, the first name in the mapping is used.
+    :param mapping: dict of name -> byte value.
+    :return: tuple of 256 names, None for unmapped values.
+    """
+    table = [None] * 256
+    for key, value in mapping.items():
+        if table[value] is None:
+            table[value] = key
+    return tuple(table)
+
+
+def get_mapping_key(table, val):
+    """
+    Return the name for a byte value from a reverse lookup table.
+    :param table: reverse lookup table, IE: IPACSeriesMappingKeys.
+    :param val: byte value.
+    :return: name or None if the value is not mapped.
+    """
+    return table[val] if 0 <= val <= 0xff else None
+
+
+#
+# Reverse lookup tables, indexed by byte value.
+#
+IPACSeriesDebounceKeys = _reverse_table(IPACSeriesDebounce)
+IPACSeriesMappingKeys = _reverse_table(IPACSeriesMapping)
+IPACSeriesMacroIndexes = tuple(val - 0xe0 if 0xe0 <= val < 0xef else None for val in range(256))
+LegacyIPACMappingKeys = _reverse_table(LegacyIPACMapping)
@@ -0,0 +1,311 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# USB transfer and operation metrics.
+#
+# Every transfer made by a USBDeviceHandle is recorded in the current metrics sink, keyed by device, transfer
+# type and request: transfer count, bytes, errors by libusb error code, timeouts and a latency histogram.
+# Slow operations that are not USB transfers, such as device enumeration and schema validation, are recorded
+# as operation timings. The latency of queued asynchronous transfers includes the time spent waiting behind
+# the transfers submitted before them.
+#
+# The default sink discards the metrics so transfers don't pay for them, the tools install an InMemoryMetrics
+# sink for --stats. Replace it with set_metrics_sink():
+#
+#    set_metrics_sink(PrometheusTextfileSink('/var/lib/node_exporter/ultimarc.prom'))
+#    ...
+#    get_metrics_sink().flush()
+#
+import bisect
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import libusb as usb
+
+from ultimarc import translate_gettext as _
+
+_logger = logging.getLogger('ultimarc')
+
+# Upper bounds of the latency histogram buckets in seconds, the last bucket holds everything slower.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def error_name(code):
+    """ Return the libusb name of an error code """
+    name = usb.error_name(code)
+    return name.decode('utf-8') if isinstance(name, bytes) else str(name)
+
+
+class LatencyHistogram:
+    """ Fixed bucket latency histogram, quantiles are interpolated inside the bucket they fall in. """
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """
+        Return an estimate of a quantile.
+        :param q: float between 0 and 1.
+        :return: seconds, zero if nothing was observed.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for x, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = LATENCY_BUCKETS[x - 1] if x else 0.0
+                upper = LATENCY_BUCKETS[x] if x < len(LATENCY_BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+
+class TransferStats:
+    """ Counters for one device, transfer type and request """
+    __slots__ = ('transfers', 'bytes', 'errors', 'timeouts', 'latency')
+
+    def __init__(self):
+        self.transfers = 0
+        self.bytes = 0
+        self.errors = dict()  # libusb error name -> count
+        self.timeouts = 0
+        self.latency = LatencyHistogram()
+
+    def to_dict(self):
+        return {
+            'transfers': self.transfers,
+            'bytes': self.bytes,
+            'errors': dict(self.errors),
+            'timeouts': self.timeouts,
+            'latency': {
+                'count': self.latency.count,
+                'sum': self.latency.sum,
+                'max': self.latency.max,
+                'p50': self.latency.quantile(0.5),
+                'p99': self.latency.quantile(0.99),
+                'buckets': dict(zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], self.latency.counts)),
+            },
+        }
+
+
+class MetricsSink:
+    """ Receives transfer and operation metrics, the base class discards them. """
+
+    def record_transfer(self, device, transfer_type, request, size, code, seconds):
+        """
+        Record a completed USB transfer.
+        :param device: device key string, IE: 'd209:0420'.
+        :param transfer_type: 'control_in', 'control_out', 'interrupt_in' or 'interrupt_out'.
+        :param request: request name for control transfers, endpoint address for interrupt transfers.
+        :param size: bytes transferred.
+        :param code: libusb error code, zero or positive if successful.
+        :param seconds: time taken by the transfer.
+        """
+
+    def record_operation(self, operation, seconds):
+        """
+        Record the time taken by an operation, IE: 'enumerate' or 'schema_validation'.
+        """
+
+    def flush(self):
+        """ Write the metrics to their destination, called when the tool exits. """
+
+
+class InMemoryMetrics(MetricsSink):
+    """ Keeps every metric in memory, see snapshot() and summary(). """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.transfers = dict()  # (device, transfer type, request) -> TransferStats
+        self.operations = dict()  # operation -> [calls, seconds]
+
+    def record_transfer(self, device, transfer_type, request, size, code, seconds):
+        key = (device, transfer_type, str(request))
+        with self._lock:
+            stats = self.transfers.get(key)
+            if stats is None:
+                stats = self.transfers[key] = TransferStats()
+            stats.transfers += 1
+            stats.latency.observe(seconds)
+            if code < 0:
+                name = error_name(code)
+                stats.errors[name] = stats.errors.get(name, 0) + 1
+                if code == usb.LIBUSB_ERROR_TIMEOUT:
+                    stats.timeouts += 1
+            else:
+                stats.bytes += size
+
+    def record_operation(self, operation, seconds):
+        with self._lock:
+            totals = self.operations.setdefault(operation, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    def reset(self):
+        with self._lock:
+            self.transfers.clear()
+            self.operations.clear()
+
+    def snapshot(self):
+        """ Return the metrics as a dict that can be serialized to JSON """
+        with self._lock:
+            return {
+                'transfers': [dict(device=device, type=transfer_type, request=request, **stats.to_dict())
+                              for (device, transfer_type, request), stats in sorted(self.transfers.items())],
+                'operations': {name: {'calls': calls, 'seconds': seconds}
+                               for name, (calls, seconds) in sorted(self.operations.items())},
+            }
+
+    def summary(self):
+        """ Return a human readable summary of the metrics """
+        snapshot = self.snapshot()
+        lines = [_('USB transfer statistics') + ':']
+        if not snapshot['transfers']:
+            lines.append('  ' + _('no transfers'))
+        for stats in snapshot['transfers']:
+            errors = sum(stats['errors'].values())
+            lines.append(
+                f'  {stats["device"]} {stats["type"]} {stats["request"]}: {stats["transfers"]} ' + _('transfers') +
+                f', {stats["bytes"]} ' + _('bytes') + f', {errors} ' + _('errors') +
+                f', {stats["timeouts"]} ' + _('timeouts') +
+                f', p50 {stats["latency"]["p50"] * 1000:.2f} ms, p99 {stats["latency"]["p99"] * 1000:.2f} ms')
+        if snapshot['operations']:
+            lines.append(_('Operation timings') + ':')
+            for name, totals in snapshot['operations'].items():
+                lines.append(f'  {name}: {totals["calls"]} ' + _('calls') + f', {totals["seconds"] * 1000:.2f} ms')
+        return '\n'.join(lines)
+
+
+def _write_atomic(path, text):
+    """ Replace a file so readers never see a partly written file """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.ultimarc-metrics-')
+    try:
+        with os.fdopen(fd, 'w') as h:
+            h.write(text)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        _logger.error(_('Failed to write metrics file') + f' {path}: {e}')
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        return False
+    return True
+
+
+class JSONMetricsSink(InMemoryMetrics):
+    """ Writes the metrics snapshot to a JSON file when flushed. """
+
+    def __init__(self, path, indent=2):
+        super().__init__()
+        self.path = path
+        self.indent = indent
+
+    def flush(self):
+        return _write_atomic(self.path, json.dumps(self.snapshot(), indent=self.indent))
+
+
+class PrometheusTextfileSink(InMemoryMetrics):
+    """ Writes the metrics in the Prometheus text format when flushed, for the node exporter textfile collector. """
+
+    def __init__(self, path, prefix='ultimarc'):
+        super().__init__()
+        self.path = path
+        self.prefix = prefix
+
+    @staticmethod
+    def _labels(**labels):
+        values = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels.items())
+        return '{' + values + '}'
+
+    def to_text(self):
+        """ Return the metrics in the Prometheus text exposition format """
+        prefix = self.prefix
+        with self._lock:
+            transfers = sorted(self.transfers.items())
+            operations = sorted(self.operations.items())
+
+        lines = list()
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f'# HELP {prefix}_{name} {help_text}')
+            lines.append(f'# TYPE {prefix}_{name} {metric_type}')
+            lines.extend(f'{prefix}_{name}{suffix}{self._labels(**labels)} {value}'
+                         for suffix, labels, value in samples)
+
+        keys = [(dict(device=d, type=t, request=r), stats) for (d, t, r), stats in transfers]
+        metric('usb_transfers_total', 'counter', 'USB transfers made.',
+               [('', labels, stats.transfers) for labels, stats in keys])
+        metric('usb_transfer_bytes_total', 'counter', 'Bytes transferred by successful USB transfers.',
+               [('', labels, stats.bytes) for labels, stats in keys])
+        metric('usb_transfer_errors_total', 'counter', 'Failed USB transfers by libusb error.',
+               [('', dict(labels, code=code), count) for labels, stats in keys for code, count in
+                sorted(stats.errors.items())])
+        metric('usb_transfer_timeouts_total', 'counter', 'USB transfers that timed out.',
+               [('', labels, stats.timeouts) for labels, stats in keys])
+
+        samples = list()
+        for labels, stats in keys:
+            cumulative = 0
+            for bound, count in zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], stats.latency.counts):
+                cumulative += count
+                samples.append(('_bucket', dict(labels, le=bound), cumulative))
+            samples.append(('_sum', labels, stats.latency.sum))
+            samples.append(('_count', labels, stats.latency.count))
+        metric('usb_transfer_seconds', 'histogram', 'USB transfer latency.', samples)
+
+        metric('operation_seconds_total', 'counter', 'Time spent in operations.',
+               [('', dict(operation=name), seconds) for name, (calls, seconds) in operations])
+        metric('operation_calls_total', 'counter', 'Operation calls.',
+               [('', dict(operation=name), calls) for name, (calls, seconds) in operations])
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        return _write_atomic(self.path, self.to_text())
+
+
+_sink = MetricsSink()
+
+
+def get_metrics_sink():
+    """ Return the current metrics sink """
+    return _sink
+
+
+def set_metrics_sink(sink):
+    """
+    Replace the metrics sink.
+    :param sink: MetricsSink object, None to discard all metrics.
+    :return: the previous sink.
+    """
+    global _sink
+    previous = _sink
+    _sink = sink if sink is not None else MetricsSink()
+    return previous
+
+
+@contextmanager
+def timed_operation(operation):
+    """ Record the time taken by the block as an operation timing """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _sink.record_operation(operation, time.perf_counter() - start)
@@ -0,0 +1,814 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Shared configuration codec for the PAC series boards (IPAC2, IPAC4, JPAC, Mini-PAC and Ultimate IO).
+#
+# Each board describes its configuration with a PacLayout object, the codec below encodes a json config into
+# a PacStruct and decodes a PacStruct into a json config using only the layout.
+#
+import ctypes as ct
+import json
+import logging
+from contextlib import contextmanager
+
+from ultimarc import translate_gettext as _
+from ultimarc.devices._device import USBDeviceHandle, USBRequestCode
+from ultimarc.devices._macros import MACRO_START, PacMacro, encode_macros, tokenize_macros
+from ultimarc.devices._mappings import IPACSeriesMapping, IPACSeriesDebounce, IPACSeriesMappingKeys, \
+    IPACSeriesMacroIndexes, get_ipac_series_debounce_key
+from ultimarc.devices._structures import PacHeaderStruct, PacStruct, PacConfigUnion
+
+_logger = logging.getLogger('ultimarc')
+
+# Size of the PacStruct 'bytes' field.
+PAC_DATA_SIZE = 252
+
+
+def fill(start, stop, value, skip=()):
+    """
+    Return a default byte dict for a range of indexes.
+    :param start: first index.
+    :param stop: last index + 1.
+    :param value: byte value.
+    :param skip: indexes in the range to set to zero instead.
+    :return: dict of index -> byte value.
+    """
+    return {x: 0 if x in skip else value for x in range(start, stop)}
+
+
+class PacLayout:
+    """ Describes how a PAC series board stores its configuration in a PacStruct. """
+
+    def __init__(self, device_class, resource_type, schema_file, pins, macro_start, macro_max_size,
+                 defaults=None, macro_max_count=30, shift_value=0x41, pin_shift=(0x41, 0x01),
+                 shift_detect=(0x41,), paclink=True, disabled=None, name=None):
+        """
+        :param device_class: 'deviceClass' value in the json config.
+        :param resource_type: 'resourceType' value in the json config.
+        :param schema_file: Schema file name only, no path included.
+        :param pins: dict of pin name -> (action_index, alternate_action_index, shift_index).
+        :param macro_start: Index of the first macro byte.
+        :param macro_max_size: Total macro bytes available, including control characters.
+        :param defaults: dict of index -> byte value, set on every encode before the pins and macros.
+        :param macro_max_count: Maximum number of macros.
+        :param shift_value: Shift byte value written for shift pins in a json config.
+        :param pin_shift: (shift, no shift) byte values written when setting a single pin.
+        :param shift_detect: Shift byte values that mark a pin as a shift pin when decoding.
+        :param paclink: True if the board supports the paclink header option.
+        :param disabled: Action byte value of a disabled pin, None if pins can not be disabled.
+        :param name: Board name used in messages, defaults to device_class.
+        """
+        self.device_class = device_class
+        self.resource_type = resource_type
+        self.schema_file = schema_file
+        self.pins = pins
+        self.macro_start = macro_start
+        self.macro_max_size = macro_max_size
+        self.macro_max_count = macro_max_count
+        self.shift_value = shift_value
+        self.pin_shift = pin_shift
+        self.shift_detect = frozenset(shift_detect)
+        self.paclink = paclink
+        self.disabled = disabled
+        self.name = name or device_class
+
+        self.defaults = tuple(sorted((defaults or dict()).items()))
+        # Data bytes of a new configuration with the defaults already set.
+        template = bytearray(PAC_DATA_SIZE)
+        for index, value in self.defaults:
+            template[index] = value
+        self.template = bytes(template)
+        # Pin names and indexes in decode order.
+        self.pin_table = tuple((name,) + indexes for name, indexes in pins.items())
+
+
+class PacDevice(USBDeviceHandle):
+    """
+    Base class for PAC series boards, subclasses set 'layout' to a PacLayout object.
+
+    The handle keeps a shadow copy of the last configuration read from or written to the device. The set_*
+    methods edit the shadow copy instead of reading the device each time, and commit() writes it back when it
+    has changed. When 'auto_commit' is False, edits are kept until commit() is called.
+    """
+    interface = 2
+    layout = None
+    PAC_INDEX = ct.c_uint16(0x02)
+
+    auto_commit = True
+    _shadow = None  # PacStruct, configuration with any edits not yet written to the device.
+    _synced = None  # bytes object, the configuration as last read from or written to the device.
+
+    def get_device_config(self, indent=None, file=None):
+        """ Return a json string of the device configuration """
+        config = self.read_config()
+        json_obj = self.to_json_str(config)
+        if file:
+            if self.write_to_file(json_obj, file, indent):
+                return _(f'Wrote {self.layout.name} configuration to ' + file)
+            else:
+                return _(f'Failed to write {self.layout.name} configuration to file.')
+        else:
+            return json.dumps(json_obj, indent=indent) if config else None
+
+    def read_device(self):
+        """ Return the configuration of the connected device """
+        request = PacHeaderStruct(0x59, 0xdd, 0x0f, 0)
+        ret = self.write(USBRequestCode.SET_CONFIGURATION, int(0x03), self.PAC_INDEX,
+                         request, ct.sizeof(request))
+        config = self.read_interrupt(0x84, PacStruct()) if ret else None
+        if config is not None:
+            self._set_shadow_(config)
+        return config
+
+    async def read_device_async(self):
+        """ Return the configuration of the connected device without blocking the event loop """
+        request = PacHeaderStruct(0x59, 0xdd, 0x0f, 0)
+        ret = await self.write_async(USBRequestCode.SET_CONFIGURATION, int(0x03), self.PAC_INDEX,
+                                     request, ct.sizeof(request))
+        config = await self.read_interrupt_async(0x84, PacStruct()) if ret else None
+        if config is not None:
+            self._set_shadow_(config)
+        return config
+
+    def read_config(self):
+        """ Return the configuration of the connected device, only reading it if the config cache does not have it """
+        if self._load_cached_():
+            return PacStruct.from_buffer_copy(self._synced)
+        return self.read_device()
+
+    def _set_shadow_(self, config):
+        """ Replace the shadow configuration with a copy of a configuration the device now holds """
+        self._shadow = PacStruct.from_buffer_copy(config)
+        self._set_write_header_(self._shadow)
+        self._synced = bytes(self._shadow)
+        self._cache_put_('pac-config', self._synced)
+
+    def _load_cached_(self):
+        """ Make sure there is a shadow configuration without reading the device, return False if there isn't one """
+        if self._synced is None:
+            cached = self._cache_get_('pac-config')
+            if cached is None or len(cached) != ct.sizeof(PacStruct):
+                return False
+            self._shadow = PacStruct.from_buffer_copy(cached)
+            self._synced = cached
+        return True
+
+    def _is_dirty_(self):
+        """ Return True if the shadow configuration holds edits not yet written to the device """
+        return self._shadow is not None and bytes(self._shadow) != self._synced
+
+    def _get_shadow_(self):
+        """ Return the shadow configuration to edit. The device is read again unless the shadow holds edits not yet
+            written, the config cache is never used here so changes made by other programs are not written back. """
+        if not self._is_dirty_() and self.read_device() is None:
+            return None
+        return self._shadow
+
+    def invalidate(self):
+        """ Drop the shadow configuration and any edits not yet written, the next edit reads the device. """
+        self._shadow = None
+        self._synced = None
+        self._cache_drop_(['pac-config'])
+
+    def _forget_state_(self):
+        """ Edits not yet written are kept, the shadow configuration is otherwise read again """
+        super()._forget_state_()
+        if not self._is_dirty_():
+            self._shadow = None
+            self._synced = None
+
+    def dirty_ranges(self):
+        """
+        Return the parts of the shadow configuration that differ from the device.
+        :return: list of (start, stop) byte offsets into the PacStruct.
+        """
+        if self._shadow is None:
+            return []
+        data = bytes(self._shadow)
+        if data == self._synced:
+            return []
+
+        ranges = []
+        start = None
+        for x, (new, old) in enumerate(zip(data, self._synced)):
+            if new != old:
+                if start is None:
+                    start = x
+            elif start is not None:
+                ranges.append((start, x))
+                start = None
+        if start is not None:
+            ranges.append((start, len(data)))
+        return ranges
+
+    def commit(self):
+        """
+        Write the shadow configuration to the device if it has changed.
+        The firmware only accepts a complete configuration starting from the header, so any change is sent
+        as a single full write.
+        :return: True if successful otherwise False.
+        """
+        ranges = self.dirty_ranges()
+        if not ranges:
+            return True
+
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug(_('Writing configuration changes') + f' {ranges} ' + _('to') + f' {self.dev_key}.')
+        if self._write_config_(self._shadow):
+            self._synced = bytes(self._shadow)
+            self._cache_put_('pac-config', self._synced)
+            return True
+
+        # We don't know what the device holds after a failed write.
+        self.invalidate()
+        return False
+
+    @contextmanager
+    def transaction(self):
+        """
+        Stage several configuration changes and write them to the device at once.
+
+            with dev_h.transaction() as tx:
+                tx.set_pin('1up', 'a')
+                tx.set_macro('#1', ['a', 'b'])
+                tx.set_debounce('short')
+
+        The staged changes are validated once against the device schema and sent as a single write when the
+        block exits. Nothing is written if a change is not valid or the block raises an exception, the result
+        is stored in 'tx.result'.
+        """
+        tx = PacTransaction(self)
+        yield tx
+        tx.result = tx.apply()
+
+    def _edited_(self):
+        """ Called after the shadow configuration has been edited """
+        return self.commit() if self.auto_commit else True
+
+    def to_json_str(self, pac_struct):
+        """ Converts a PacStruct to a json object """
+        json_obj = self._decode_config_(pac_struct)
+        return json_obj if self.validate_config(json_obj, self.layout.schema_file) else None
+
+    def _decode_config_(self, pac_struct):
+        """ Converts a PacStruct to a json config dict without validating it """
+        layout = self.layout
+        data = memoryview(pac_struct.bytes).cast('B')
+        keys = IPACSeriesMappingKeys
+        macro_indexes = IPACSeriesMacroIndexes
+
+        json_obj = {'schemaVersion': 2.0, 'resourceType': layout.resource_type, 'deviceClass': self.class_id}
+
+        # header configuration
+        header = PacConfigUnion()
+        header.asByte = pac_struct.header.byte_4
+        json_obj['debounce'] = get_ipac_series_debounce_key(header.config.debounce)
+        if layout.paclink:
+            json_obj['paclink'] = True if header.config.paclink == 0x01 else False
+
+        # macros
+        macros = tokenize_macros(data, layout.macro_start)
+        if len(macros):
+            json_obj['macros'] = [m.to_dict() for m in macros]
+        macro_names = [m.name for m in macros]
+
+        # pins
+        pins = []
+        shift_detect = layout.shift_detect
+        disabled = layout.disabled
+        for key, action_index, alternate_action_index, shift_index in layout.pin_table:
+            value = data[action_index]
+            if disabled is not None:
+                # Boards with disabled pins report every pin.
+                if value == disabled:
+                    pins.append({'name': key, 'disabled': True, 'action': ''})
+                    continue
+            elif not value:
+                continue
+
+            pin = {'name': key, 'action': keys[value]}
+            if pin['action'] is None:
+                mi = macro_indexes[value]
+                if mi is not None and mi < len(macro_names):
+                    pin['action'] = macro_names[mi]
+                else:
+                    _logger.debug(_(f'{key} action is not a valid value'))
+
+            value = data[alternate_action_index]
+            if value:
+                alt_action = keys[value]
+                if alt_action is None:
+                    mi = macro_indexes[value]
+                    if mi is not None and mi < len(macro_names):
+                        pin['alternate_action'] = macro_names[mi]
+                else:
+                    pin['alternate_action'] = alt_action
+
+            if data[shift_index] in shift_detect:
+                pin['shift'] = True
+            pins.append(pin)
+        json_obj['pins'] = pins
+
+        return json_obj
+
+    @classmethod
+    def _create_macro_array_(cls, pac_struct):
+        """ Return the list of macro dicts stored in a PacStruct """
+        return [m.to_dict() for m in cls.get_macros(pac_struct)]
+
+    @classmethod
+    def get_macros(cls, pac_struct):
+        """
+        Return the macros stored in a PacStruct.
+        :param pac_struct: PacStruct object.
+        :return: list of PacMacro objects.
+        """
+        return tokenize_macros(pac_struct.bytes, cls.layout.macro_start)
+
+    @classmethod
+    def write_to_file(cls, data: dict, file_path, indent=None):
+        try:
+            with open(file_path, 'w') as h:
+                json.dump(data, h, indent=indent)
+                return True
+        except FileNotFoundError as err:
+            _logger.debug(err)
+            return False
+
+    def _write_config_(self, data):
+        """ Send a PacStruct configuration to the device """
+        return self.write_alt(USBRequestCode.SET_CONFIGURATION, int(0x03), self.PAC_INDEX, data, ct.sizeof(data))
+
+    @staticmethod
+    def _set_write_header_(data):
+        """ Header - Setup to send back to device """
+        data.header.type = 0x50
+        data.header.byte_2 = 0xdd
+        data.header.byte_3 = 0x0f
+
+    def set_config(self, config_file, use_current):
+        """ Write a new configuration to the current device """
+
+        # Get the current configuration from the device
+        cur_config = None
+        if use_current and self._get_shadow_() is not None:
+            cur_config = PacStruct.from_buffer_copy(self._shadow)
+
+        # Insert the new configuration into the PacStruct data object
+        res, data = self._create_device_message_(config_file, cur_config)
+        return self._write_full_config_(data) if res else False
+
+    async def set_config_async(self, config_file, use_current):
+        """ Write a new configuration to the current device without blocking the event loop """
+        cur_config = None
+        if use_current:
+            if not self._is_dirty_():
+                await self.read_device_async()
+            if self._shadow is not None:
+                cur_config = PacStruct.from_buffer_copy(self._shadow)
+
+        res, data = self._create_device_message_(config_file, cur_config)
+        if not res:
+            return False
+
+        if await self.write_alt_async(USBRequestCode.SET_CONFIGURATION, int(0x03), self.PAC_INDEX,
+                                      data, ct.sizeof(data)):
+            self._set_shadow_(data)
+            return True
+        self.invalidate()
+        return False
+
+    def set_config_ui(self, config_dict: dict):
+        """ Write a new configuration from UI to the current device """
+
+        # Insert the new configuration into the PacStruct data object
+        res, data = self._create_device_struct_(config_dict)
+        return self._write_full_config_(data) if res else False
+
+    def _compile_config_(self, config_file):
+        """ Encode a configuration file as PacStruct bytes """
+        res, data = self._create_device_message_(config_file)
+        return ('pac-config', bytes(data)) if res else None
+
+    def payload_applied(self, kind, payload):
+        """ A PAC configuration is compared with the configuration last read from or written to the device """
+        if kind == 'pac-config':
+            return self._load_cached_() and self._synced == bytes(payload)
+        return super().payload_applied(kind, payload)
+
+    def _send_payload_(self, kind, payload):
+        if kind == 'pac-config':
+            return self._write_full_config_(PacStruct.from_buffer_copy(payload))
+        return super()._send_payload_(kind, payload)
+
+    def _write_full_config_(self, data):
+        """ Write a complete new configuration and keep it as the shadow configuration """
+        if self._write_config_(data):
+            self._set_shadow_(data)
+            return True
+        self.invalidate()
+        return False
+
+    def _lookup_action_(self, action, macros):
+        """
+        Return the byte value of a key or macro name.
+        :param action: Upper case key or macro name.
+        :param macros: list of PacMacro objects from the device.
+        :return: byte value, zero if not found.
+        """
+        if action in IPACSeriesMapping:
+            return IPACSeriesMapping[action]
+        for x, macro in enumerate(macros):
+            if macro.name.upper() == action:
+                return MACRO_START + x
+        return 0
+
+    def set_pin(self, pin_config):
+        """ Write a pin to the current device """
+        pin = pin_config[0]
+        # Get the current configuration
+        cur_config = self._get_shadow_()
+        if cur_config is None:
+            return False
+        macros = self.get_macros(cur_config)
+
+        action_index, alternate_action_index, shift_index = self.layout.pins[pin]
+        action = pin_config[1].upper()
+        cur_config.bytes[action_index] = self._lookup_action_(action, macros)
+        if cur_config.bytes[action_index] == 0:
+            _logger.info(_(f'{pin} action "{action}" is not a valid value'))
+
+        # Pin alternate action
+        alternate_action = pin_config[2].upper()
+        # Empty string means no value
+        if len(alternate_action) > 0:
+            cur_config.bytes[alternate_action_index] = self._lookup_action_(alternate_action, macros)
+            if cur_config.bytes[alternate_action_index] == 0:
+                _logger.info(_(f'{pin} alternate action "{alternate_action}" is not a valid value'))
+        else:
+            # No Alternate Value
+            cur_config.bytes[alternate_action_index] = 0
+
+        # Pin designated as shift
+        shift, no_shift = self.layout.pin_shift
+        cur_config.bytes[shift_index] = shift if pin_config[3].lower() in ['true', '1', 't', 'y'] else no_shift
+
+        return self._edited_()
+
+    def set_debounce(self, debounce):
+        """ Set debounce value to the current device """
+        val = debounce.lower()
+        if val not in IPACSeriesDebounce:
+            _logger.info(_(f'"{debounce}" is not a valid debounce value.'))
+            _logger.info(_(f'Valid values are: {list(IPACSeriesDebounce.keys())}'))
+            return None
+
+        # Get the current configuration
+        cur_config = self._get_shadow_()
+        if cur_config is None:
+            return False
+
+        header = PacConfigUnion()
+        header.asByte = cur_config.header.byte_4
+        header.config.debounce = IPACSeriesDebounce[val]
+        cur_config.header.byte_4 = header.asByte
+
+        return self._edited_()
+
+    def set_paclink(self, paclink):
+        """ Set paclink value to the current device """
+        if not self.layout.paclink:
+            _logger.error(_(f'The {self.layout.name} device does not support paclink.'))
+            return False
+
+        # Get the current configuration
+        cur_config = self._get_shadow_()
+        if cur_config is None:
+            return False
+
+        header = PacConfigUnion()
+        header.asByte = cur_config.header.byte_4
+        header.config.paclink = 0x01 if paclink is True else 0
+        cur_config.header.byte_4 = header.asByte
+
+        return self._edited_()
+
+    def _create_device_message_(self, config_file: str, cur_device_config=None):
+        """ Create the message to be sent to the device """
+
+        # Validate against the base schema.
+        valid_config = self.validate_config_base(config_file, [self.layout.resource_type])
+        if not valid_config:
+            return False, None
+
+        return self._create_device_struct_(valid_config, cur_device_config)
+
+    def _create_device_struct_(self, json_config: dict, cur_device_config=None):
+        """
+        Encode a json config into a PacStruct.
+        :param json_config: config dict.
+        :param cur_device_config: PacStruct read from the device, updated in place if given.
+        :return: (True, PacStruct) or (False, None) if the config is not valid.
+        """
+        layout = self.layout
+
+        if json_config.get('deviceClass') != layout.device_class:
+            _logger.error(_(f'Configuration device class is not "{layout.device_class}".'))
+            return False, None
+
+        # Determine which config resource type we have.
+        if json_config.get('resourceType') != layout.resource_type:
+            return False, None
+
+        if not self.validate_config(json_config, layout.schema_file):
+            return False, None
+
+        # Header configuration options
+        header = PacConfigUnion()
+        val = json_config['debounce'].lower()
+        if val in IPACSeriesDebounce:
+            header.config.debounce = IPACSeriesDebounce[val]
+        else:
+            _logger.info(_(f'"{json_config["debounce"]}" is not a valid debounce value'))
+            return False, None
+        if layout.paclink:
+            header.config.paclink = 0x1 if json_config.get('paclink') is True else 0
+
+        # Work on a copy of the data bytes, the struct is only updated once the whole config is valid.
+        if cur_device_config is not None:
+            buf = bytearray(bytes(cur_device_config.bytes))
+            for index, value in layout.defaults:
+                buf[index] = value
+            # Macros are not kept between configurations, clear the macro region to prevent lingering values.
+            buf[layout.macro_start:] = bytes(PAC_DATA_SIZE - layout.macro_start)
+        else:
+            buf = bytearray(layout.template)
+
+        # Macros
+        macros = [PacMacro.from_dict(m) for m in json_config.get('macros') or []]
+        if len(macros) > layout.macro_max_count:
+            _logger.debug(_(f'There are more than {layout.macro_max_count} '
+                            f'macros defined for the {layout.name} device'))
+            return False, None
+
+        # key: Macro name value: macro value (e0 - fe)
+        macro_dict = encode_macros(macros, buf, layout.macro_start, layout.macro_max_size)
+        if macro_dict is None:
+            _logger.debug(_(f'There are more than {layout.macro_max_size} '
+                            f'macro values defined for the {layout.name} device'))
+            return False, None
+
+        # Pins
+        # Places the action value, alternate action value and the shift value in the shift position
+        # for all pins designated as shift pins in json config
+        for pin in json_config['pins']:
+            name = pin['name']
+            if name not in layout.pins:
+                _logger.debug(_(f'Pin {name} does not exists in {layout.name} device'))
+                continue
+            action_index, alternate_action_index, shift_index = layout.pins[name]
+
+            # The pin is disabled if disabled is present, don't update any other bytes for this pin.
+            if layout.disabled is not None and pin.get('disabled'):
+                buf[action_index] = layout.disabled
+                continue
+
+            action = pin.get('action', '').upper()
+            if action in IPACSeriesMapping:
+                buf[action_index] = IPACSeriesMapping[action]
+            elif action in macro_dict:
+                buf[action_index] = macro_dict[action]
+            else:
+                _logger.info(_(f'{name} action "{action}" is not a valid value'))
+
+            alternate_action = pin.get('alternate_action', '').upper()
+            if alternate_action in IPACSeriesMapping:
+                buf[alternate_action_index] = IPACSeriesMapping[alternate_action]
+            elif alternate_action in macro_dict:
+                buf[alternate_action_index] = macro_dict[alternate_action]
+            elif alternate_action:
+                _logger.info(_(f'{name} alternate action "{alternate_action}" is not a valid value'))
+
+            # Pin designated as shift
+            if pin.get('shift'):
+                buf[shift_index] = layout.shift_value
+
+        data = cur_device_config if cur_device_config is not None else PacStruct()
+        ct.memmove(data.bytes, bytes(buf), PAC_DATA_SIZE)
+        self._set_write_header_(data)
+        data.header.byte_4 = header.asByte
+
+        return True, data
+
+
+class PacTransaction:
+    """ Configuration changes staged by PacDevice.transaction(). """
+
+    def __init__(self, device):
+        """
+        :param device: PacDevice object.
+        """
+        self.device = device
+        self.pins = dict()  # pin name -> json config pin dict
+        self.macros = dict()  # macro name -> list of key names
+        self.debounce = None
+        self.paclink = None
+        self.valid = True
+        self.result = None
+
+    def __len__(self):
+        return len(self.pins) + len(self.macros) + (self.debounce is not None) + (self.paclink is not None)
+
+    def _reject_(self, message):
+        """ Log a staging error, the transaction will not be written """
+        _logger.error(message)
+        self.valid = False
+        return False
+
+    def set_pin(self, name, action, alternate_action='', shift=False, disabled=False):
+        """
+        Stage a pin change.
+        :param name: pin name, IE: '1up'.
+        :param action: key or macro name.
+        :param alternate_action: key or macro name, empty string for no alternate action.
+        :param shift: True if the pin is a shift pin.
+        :param disabled: True to disable the pin, only for boards supporting disabled pins.
+        :return: True if staged otherwise False.
+        """
+        layout = self.device.layout
+        if name not in layout.pins:
+            return self._reject_(_(f'Pin {name} does not exists in {layout.name} device'))
+        if disabled and layout.disabled is None:
+            return self._reject_(_(f'The {layout.name} device does not support disabled pins.'))
+
+        pin = {'name': name, 'action': action}
+        if disabled:
+            pin['disabled'] = True
+        if alternate_action:
+            pin['alternate_action'] = alternate_action
+        if shift:
+            pin['shift'] = True
+        self.pins[name] = pin
+        return True
+
+    def set_macro(self, name, actions):
+        """
+        Stage a macro, replacing any macro with the same name. Macros are added after the existing macros.
+        :param name: macro name, IE: '#1'.
+        :param actions: list of key names.
+        :return: True if staged otherwise False.
+        """
+        for action in actions:
+            if action.upper() not in IPACSeriesMapping:
+                return self._reject_(_(f'Macro {name} action "{action}" is not a valid value'))
+        self.macros[name] = list(actions)
+        return True
+
+    def set_debounce(self, debounce):
+        """
+        Stage a debounce value.
+        :param debounce: debounce name, IE: 'short'.
+        :return: True if staged otherwise False.
+        """
+        if debounce.lower() not in IPACSeriesDebounce:
+            return self._reject_(_(f'"{debounce}" is not a valid debounce value.'))
+        self.debounce = debounce.lower()
+        return True
+
+    def set_paclink(self, paclink):
+        """
+        Stage a paclink value.
+        :param paclink: boolean
+        :return: True if staged otherwise False.
+        """
+        if not self.device.layout.paclink:
+            return self._reject_(_(f'The {self.device.layout.name} device does not support paclink.'))
+        self.paclink = paclink is True
+        return True
+
+    def apply(self):
+        """
+        Validate the staged changes against the device configuration and write them in a single transfer.
+        :return: True if successful otherwise False.
+        """
+        device = self.device
+        if not self.valid:
+            _logger.error(_('Configuration changes are not valid, nothing was written to') + f' {device.dev_key}.')
+            return False
+        if not len(self):
+            return True
+
+        cur_config = device._get_shadow_()
+        if cur_config is None:
+            return False
+
+        # Macros change the macro values pins refer to, so the configuration is decoded and encoded again.
+        # Otherwise the staged values are patched into the configuration bytes and the rest is left as it is.
+        data = self._encode_(cur_config) if self.macros else self._patch_(cur_config)
+        if data is None:
+            _logger.error(_('Configuration changes are not valid, nothing was written to') + f' {device.dev_key}.')
+            return False
+
+        if bytes(data) == device._synced:
+            return True
+        return device._write_full_config_(data)
+
+    def _check_pin_actions_(self, macro_names):
+        """ Return True if the staged pin actions are key or macro names """
+        for pin in self.pins.values():
+            if pin.get('disabled'):
+                continue
+            for key in ('action', 'alternate_action'):
+                value = pin.get(key)
+                if value is None and key == 'alternate_action':
+                    continue
+                if value.upper() not in IPACSeriesMapping and value.upper() not in macro_names:
+                    _logger.error(_(f'{pin["name"]} {key} "{value}" is not a valid value'))
+                    return False
+        return True
+
+    def _encode_(self, cur_config):
+        """
+        Apply the staged changes to the decoded configuration and encode it.
+        :param cur_config: PacStruct shadow configuration.
+        :return: PacStruct or None if the changes are not valid.
+        """
+        device = self.device
+        json_config = device._decode_config_(cur_config)
+        if self.debounce is not None:
+            json_config['debounce'] = self.debounce
+        if self.paclink is not None:
+            json_config['paclink'] = self.paclink
+
+        macros = json_config.get('macros') or []
+        names = {m['name']: x for x, m in enumerate(macros)}
+        for name, actions in self.macros.items():
+            if name in names:
+                macros[names[name]] = {'name': name, 'action': actions}
+            else:
+                macros.append({'name': name, 'action': actions})
+        json_config['macros'] = macros
+
+        if self.pins:
+            if not self._check_pin_actions_({m['name'].upper() for m in macros}):
+                return None
+            pins = [p for p in json_config['pins'] if p['name'] not in self.pins]
+            json_config['pins'] = pins + list(self.pins.values())
+
+        # Clear the bytes of the staged pins, the encoder only sets the values present in the pin dict.
+        data = PacStruct.from_buffer_copy(cur_config)
+        no_shift = device.layout.pin_shift[1]
+        for name in self.pins:
+            action_index, alternate_action_index, shift_index = device.layout.pins[name]
+            data.bytes[action_index] = 0
+            data.bytes[alternate_action_index] = 0
+            data.bytes[shift_index] = no_shift
+
+        res, data = device._create_device_struct_(json_config, data)
+        return data if res else None
+
+    def _patch_(self, cur_config):
+        """
+        Write the staged pins, debounce and paclink values into a copy of the configuration bytes. Only the staged
+        values are validated, so values in the configuration the decoder does not know are kept as they are.
+        :param cur_config: PacStruct shadow configuration.
+        :return: PacStruct or None if the changes are not valid.
+        """
+        device = self.device
+        layout = device.layout
+        data = PacStruct.from_buffer_copy(cur_config)
+        header = PacConfigUnion()
+        header.asByte = data.header.byte_4
+
+        if self.pins:
+            config = {'schemaVersion': 2.0, 'resourceType': layout.resource_type, 'deviceClass': device.class_id,
+                      'debounce': self.debounce or get_ipac_series_debounce_key(header.config.debounce),
+                      'pins': [dict(pin) for pin in self.pins.values()]}  # Validating sets default values.
+            if layout.paclink:
+                config['paclink'] = self.paclink if self.paclink is not None else header.config.paclink == 0x01
+            if not device.validate_config(config, layout.schema_file):
+                return None
+
+            macros = device.get_macros(data)
+            if not self._check_pin_actions_({m.name.upper() for m in macros}):
+                return None
+
+            shift, no_shift = layout.shift_value, layout.pin_shift[1]
+            for pin in self.pins.values():
+                action_index, alternate_action_index, shift_index = layout.pins[pin['name']]
+                if pin.get('disabled'):
+                    data.bytes[action_index] = layout.disabled
+                    continue
+                data.bytes[action_index] = device._lookup_action_(pin['action'].upper(), macros)
+                data.bytes[alternate_action_index] = \
+                    device._lookup_action_(pin['alternate_action'].upper(), macros) if 'alternate_action' in pin else 0
+                data.bytes[shift_index] = shift if pin.get('shift') else no_shift
+
+        if self.debounce is not None:
+            header.config.debounce = IPACSeriesDebounce[self.debounce]
+        if self.paclink is not None:
+            header.config.paclink = 0x01 if self.paclink else 0
+        device._set_write_header_(data)
+        data.header.byte_4 = header.asByte
+        return data
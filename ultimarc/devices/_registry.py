@@ -0,0 +1,284 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Incremental registry of attached USB devices, updated by hotplug events or by polling.
+#
+# http://libusb.sourceforge.net/api-1.0/group__libusb__hotplug.html
+#
+import ctypes as ct
+import logging
+import threading
+from collections import deque
+from enum import Enum
+
+import libusb as usb
+
+from ultimarc import translate_gettext as _
+from ultimarc.devices._device import usb_error
+
+_logger = logging.getLogger('ultimarc')
+
+
+class DeviceEvent(Enum):
+    """ Change events emitted by a USBDeviceRegistry. """
+    ARRIVED = 'arrived'
+    LEFT = 'left'
+
+
+class USBDeviceRegistry:
+    """
+    Holds the attached USB devices keyed by (bus, address). The registry is kept up to date by an event
+    source and notifies subscribers with a DeviceEvent and the USBDeviceInfo object for every change.
+    """
+
+    def __init__(self, event_source, device_factory):
+        """
+        :param event_source: object implementing start(registry), poll(registry) and stop(registry).
+        :param device_factory: callable taking (libusb device, device descriptor), returns a USBDeviceInfo object.
+        """
+        self._source = event_source
+        self._device_factory = device_factory
+        self._devices = dict()  # (bus, address) -> USBDeviceInfo
+        self._subscribers = list()
+        self._lock = threading.RLock()
+        self._started = False
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._devices.values()))
+
+    def __len__(self):
+        return len(self._devices)
+
+    def get(self, bus, address):
+        """
+        Return the device at the given bus and address.
+        :param bus: integer
+        :param address: integer
+        :return: USBDeviceInfo or None
+        """
+        return self._devices.get((bus, address))
+
+    def subscribe(self, callback):
+        """
+        Register a callable to be called as callback(event, dev_info) for every device change.
+        :param callback: callable
+        """
+        if callback not in self._subscribers:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """ Remove a callable registered with subscribe(). """
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def update(self):
+        """
+        Start the event source if needed, then process any pending device changes.
+        :return: True if successful otherwise False.
+        """
+        if not self._started:
+            self._started = True
+            if not self._source.start(self):
+                return False
+        return self._source.poll(self)
+
+    def stop(self):
+        """ Stop receiving device changes from the event source. """
+        if self._started:
+            self._source.stop(self)
+            self._started = False
+
+    def device_arrived(self, dev, dev_desc):
+        """
+        Called by event sources when a libusb device has been attached.
+        :param dev: libusb device pointer.
+        :param dev_desc: libusb device descriptor.
+        """
+        self.add(self.device_info(dev, dev_desc))
+
+    def device_info(self, dev, dev_desc):
+        """
+        Return a new USBDeviceInfo object for a libusb device, without adding it to the registry.
+        :param dev: libusb device pointer.
+        :param dev_desc: libusb device descriptor.
+        """
+        return self._device_factory(dev, dev_desc)
+
+    def add(self, dev_info):
+        """ Add a device to the registry, replacing any stale device found at the same bus and address. """
+        key = (dev_info.bus, dev_info.address)
+        with self._lock:
+            old = self._devices.get(key)
+            if old is not None:
+                if old.dev_key == dev_info.dev_key:
+                    return
+                self.remove(*key)
+            self._devices[key] = dev_info
+        _logger.debug(_('USB device arrived') + f' {dev_info}')
+        self._emit(DeviceEvent.ARRIVED, dev_info)
+
+    def remove(self, bus, address):
+        """ Remove the device at the given bus and address from the registry. """
+        with self._lock:
+            dev_info = self._devices.pop((bus, address), None)
+        if dev_info is not None:
+            _logger.debug(_('USB device left') + f' {dev_info}')
+            self._emit(DeviceEvent.LEFT, dev_info)
+
+    def _emit(self, event, dev_info):
+        for callback in list(self._subscribers):
+            try:
+                callback(event, dev_info)
+            except Exception as e:  # A bad subscriber must not stop the registry from updating.
+                _logger.error(_('USB device event subscriber failed') + f': {e}')
+
+
+def _vendor_match(dev_desc, vendor_ids):
+    """ Return True if the device descriptor vendor id is in the list of vendor ids, or the list is empty. """
+    return not vendor_ids or dev_desc.idVendor in vendor_ids
+
+
+class PollingEventSource:
+    """
+    Event source for hosts without hotplug support. Each poll walks the libusb device list, but only fetches
+    descriptors for bus/address pairs it has not seen before, then reports the differences.
+    """
+
+    def __init__(self, vendor_ids=None):
+        """
+        :param vendor_ids: list of integer vendor ids to capture, empty or None captures every device.
+        """
+        self._vendor_ids = vendor_ids or list()
+        self._ignored = set()  # (bus, address) pairs of devices that do not match the vendor filter.
+
+    def start(self, registry):
+        return True
+
+    def stop(self, registry):
+        self._ignored.clear()
+
+    def poll(self, registry):
+        dev_list = ct.POINTER(ct.POINTER(usb.device))()
+        cnt = usb.get_device_list(None, ct.byref(dev_list))
+        if cnt < 0:
+            usb_error(cnt, _('Failed to find attached USB devices.'))
+            return False
+
+        attached = set()
+        for dev in dev_list:
+            if not dev:  # We must always look for the Null device and quit the loop.
+                break
+
+            key = (usb.get_bus_number(dev), usb.get_device_address(dev))
+            attached.add(key)
+            if key in self._ignored or registry.get(*key) is not None:
+                continue
+
+            dev_desc = usb.device_descriptor()
+            ret = usb.get_device_descriptor(dev, ct.byref(dev_desc))
+            if ret != usb.LIBUSB_SUCCESS:
+                usb_error(ret, _('failed to get USB device descriptor.'))
+                continue
+
+            if _vendor_match(dev_desc, self._vendor_ids):
+                registry.device_arrived(dev, dev_desc)
+            else:
+                self._ignored.add(key)
+
+        usb.free_device_list(dev_list, 1)
+
+        self._ignored &= attached
+        for dev_info in registry:
+            if (dev_info.bus, dev_info.address) not in attached:
+                registry.remove(dev_info.bus, dev_info.address)
+        return True
+
+
+class HotplugEventSource:
+    """
+    Event source using libusb hotplug callbacks, one callback is registered per vendor id. Pending events are
+    dispatched without blocking each time the registry is updated. Any thread handling libusb events may run the
+    hotplug callbacks, IE: the transfer event thread, so they only queue the changes and poll() applies them.
+    """
+
+    def __init__(self, vendor_ids=None):
+        """
+        :param vendor_ids: list of integer vendor ids to capture, empty or None captures every device.
+        """
+        self._vendor_ids = vendor_ids or list()
+        self._handles = list()
+        self._registry = None
+        self._pending = deque()  # (DeviceEvent, USBDeviceInfo or (bus, address)) tuples, see poll().
+        # Keep a reference to the ctypes callback, libusb holds a raw pointer to it.
+        self._callback = usb.hotplug_callback_fn(self._hotplug_callback)
+
+    @staticmethod
+    def is_supported():
+        """ Return True if the libusb library on this host supports hotplug events. """
+        return bool(usb.has_capability(usb.LIBUSB_CAP_HAS_HOTPLUG))
+
+    def start(self, registry):
+        self._registry = registry
+        events = usb.LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED | usb.LIBUSB_HOTPLUG_EVENT_DEVICE_LEFT
+        for vendor_id in (self._vendor_ids or [usb.LIBUSB_HOTPLUG_MATCH_ANY]):
+            handle = usb.hotplug_callback_handle()
+            # LIBUSB_HOTPLUG_ENUMERATE reports devices that are already attached before returning.
+            ret = usb.hotplug_register_callback(None, events, usb.LIBUSB_HOTPLUG_ENUMERATE, vendor_id,
+                                                usb.LIBUSB_HOTPLUG_MATCH_ANY, usb.LIBUSB_HOTPLUG_MATCH_ANY,
+                                                self._callback, None, ct.byref(handle))
+            if ret != usb.LIBUSB_SUCCESS:
+                usb_error(ret, _('Failed to register USB hotplug callback.'))
+                self.stop(registry)
+                return False
+            self._handles.append(handle)
+        return True
+
+    def stop(self, registry):
+        for handle in self._handles:
+            usb.hotplug_deregister_callback(None, handle)
+        self._handles = list()
+        self._pending.clear()
+
+    def poll(self, registry):
+        # Zero timeout, only dispatch events libusb has already received.
+        tv = usb.timeval(0, 0)
+        ret = usb.handle_events_timeout_completed(None, ct.byref(tv), None)
+        if ret < 0:
+            usb_error(ret, _('Failed to handle USB events.'))
+            return False
+        while self._pending:
+            event, arg = self._pending.popleft()
+            if event == DeviceEvent.ARRIVED:
+                registry.add(arg)
+            else:
+                registry.remove(*arg)
+        return True
+
+    def _hotplug_callback(self, ctx, dev, event, user_data):
+        """ Called by libusb from inside handle_events(). Must return 0 to stay registered. """
+        if event == usb.LIBUSB_HOTPLUG_EVENT_DEVICE_LEFT:
+            self._pending.append((DeviceEvent.LEFT, (usb.get_bus_number(dev), usb.get_device_address(dev))))
+            return 0
+
+        dev_desc = usb.device_descriptor()
+        ret = usb.get_device_descriptor(dev, ct.byref(dev_desc))
+        if ret != usb.LIBUSB_SUCCESS:
+            usb_error(ret, _('failed to get USB device descriptor.'))
+            return 0
+        # The libusb device is only valid during the callback, the device information is read now.
+        self._pending.append((DeviceEvent.ARRIVED, self._registry.device_info(dev, dev_desc)))
+        return 0
+
+
+def default_event_source(vendor_filter=None):
+    """
+    Return the best event source for this host.
+    :param vendor_filter: list of vendor id hex strings, IE: ['d209'].
+    :return: HotplugEventSource or PollingEventSource object.
+    """
+    vendor_ids = [int(v, 16) for v in vendor_filter] if vendor_filter else list()
+    if HotplugEventSource.is_supported():
+        return HotplugEventSource(vendor_ids)
+    return PollingEventSource(vendor_ids)
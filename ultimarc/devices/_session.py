@@ -0,0 +1,290 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Capture and replay of USB device sessions.
+#
+# A session file holds the device descriptor of every device used and every control and interrupt transfer
+# made, with timing, setup packet and payload. Record a session with start_recording() or the tools
+# '--record FILE' argument, then serve it back in place of libusb with ReplayUSB:
+#
+#    with ReplayUSB(Session.load('ipac2-session.bin')):
+#        devices = USBDevices(['d209'])
+#        ...
+#
+# File format, all values little endian:
+#
+#    header:   b'UMSESS', version (u8), reserved (u8), start time in seconds (f64)
+#    device:   0x01, bus (u8), address (u8), device descriptor (18 bytes)
+#    transfer: 0x02, microseconds since the previous transfer (u32), bus (u8), address (u8),
+#              type (u8, 0 control, 1 interrupt), endpoint (u8), libusb result (i32), data length (u16),
+#              setup packet (8 bytes, control transfers only), data
+#
+import ctypes as ct
+import logging
+import struct
+from collections import defaultdict
+
+import libusb as usb
+
+from ultimarc import translate_gettext as _
+from ultimarc.devices import _trace
+from ultimarc.devices._base import USB_PRODUCT_DESCRIPTIONS
+from ultimarc.devices._trace import TraceRecord, TransferTrace
+from ultimarc.devices._virtual import VirtualDevice, VirtualUSB
+
+_logger = logging.getLogger('ultimarc')
+
+MAGIC = b'UMSESS'
+VERSION = 1
+
+_HEADER = struct.Struct('<6sBxd')
+_DEVICE = struct.Struct('<BBB18s')
+_TRANSFER = struct.Struct('<BIBBBBiH')
+_SETUP = struct.Struct('<BBHHH')
+
+_RECORD_DEVICE = 0x01
+_RECORD_TRANSFER = 0x02
+
+_TRANSFER_TYPES = ('control', 'interrupt')
+
+
+class SessionFormatError(ValueError):
+    """ The session file is not valid """
+
+
+class Session:
+    """ Devices and transfers of a recorded session. """
+
+    def __init__(self, devices=None, transfers=None, start=0.0):
+        """
+        :param devices: dict of (bus, address) -> device descriptor bytes.
+        :param transfers: list of TraceRecord objects in the order made.
+        :param start: time the session started, seconds since the epoch.
+        """
+        self.devices = dict(devices or {})
+        self.transfers = list(transfers or [])
+        self.start = start or (self.transfers[0].timestamp if self.transfers else 0.0)
+
+    @classmethod
+    def from_trace(cls, trace):
+        """ Create a session from the records of a TransferTrace object """
+        return cls(trace.devices, trace.records)
+
+    def save(self, path):
+        """
+        Write the session file.
+        :param path: file path.
+        """
+        with open(path, 'wb') as h:
+            h.write(_HEADER.pack(MAGIC, VERSION, self.start))
+            for (bus, address), descriptor in sorted(self.devices.items()):
+                h.write(_DEVICE.pack(_RECORD_DEVICE, bus, address, descriptor))
+
+            previous = self.start
+            for record in self.transfers:
+                delta = min(max(round((record.timestamp - previous) * 1000000), 0), 0xffffffff)
+                # Keep the time as it will be read back, so rounding errors don't add up.
+                previous += delta / 1000000
+                h.write(_TRANSFER.pack(_RECORD_TRANSFER, delta, record.bus, record.address,
+                                       _TRANSFER_TYPES.index(record.transfer_type), record.endpoint, record.code,
+                                       len(record.data)))
+                if record.transfer_type == 'control':
+                    h.write(record.setup)
+                h.write(record.data)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a session file.
+        :param path: file path.
+        :return: Session object.
+        """
+        with open(path, 'rb') as h:
+            data = h.read()
+
+        if len(data) < _HEADER.size:
+            raise SessionFormatError(_('Session file is too short') + f' ({path}).')
+        magic, version, start = _HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise SessionFormatError(_('Not a session file or unsupported version') + f' ({path}).')
+
+        session = cls(start=start)
+        timestamp = start
+        pos = _HEADER.size
+        try:
+            while pos < len(data):
+                if data[pos] == _RECORD_DEVICE:
+                    _type, bus, address, descriptor = _DEVICE.unpack_from(data, pos)
+                    session.devices[(bus, address)] = descriptor
+                    pos += _DEVICE.size
+                elif data[pos] == _RECORD_TRANSFER:
+                    _type, delta, bus, address, kind, endpoint, code, length = _TRANSFER.unpack_from(data, pos)
+                    pos += _TRANSFER.size
+                    setup = None
+                    if _TRANSFER_TYPES[kind] == 'control':
+                        setup = data[pos:pos + _SETUP.size]
+                        pos += _SETUP.size
+                    payload = data[pos:pos + length]
+                    if len(payload) != length:
+                        raise SessionFormatError(_('Session file is truncated') + f' ({path}).')
+                    pos += length
+                    timestamp += delta / 1000000
+                    session.transfers.append(TraceRecord(len(session.transfers) + 1, timestamp, None, bus,
+                                                         address, _TRANSFER_TYPES[kind], endpoint, setup, code,
+                                                         payload))
+                else:
+                    raise SessionFormatError(_('Unknown session record type') + f' {data[pos]} ({path}).')
+        except (struct.error, IndexError):
+            raise SessionFormatError(_('Session file is truncated') + f' ({path}).')
+        return session
+
+    def transfers_for(self, bus, address):
+        """ Return the transfers made to one device """
+        return [t for t in self.transfers if (t.bus, t.address) == (bus, address)]
+
+
+class SessionRecorder(TransferTrace):
+    """ Transfer trace keeping every transfer, see start_recording(). """
+
+    def __init__(self):
+        super().__init__(size=None)
+
+    def to_session(self):
+        with self._lock:
+            return Session(self.devices, self.records)
+
+    def save(self, path):
+        """ Write the recorded transfers as a session file """
+        self.to_session().save(path)
+
+
+def start_recording():
+    """
+    Record every transfer until stop_recording() is called, replaces an active transfer trace.
+    :return: SessionRecorder object.
+    """
+    return _trace.enable_trace(trace=SessionRecorder())
+
+
+def stop_recording():
+    """
+    Stop recording.
+    :return: Session object or None if no recording was active.
+    """
+    trace = _trace.disable_trace()
+    return trace.to_session() if isinstance(trace, SessionRecorder) else None
+
+
+class ReplayDevice(VirtualDevice):
+    """
+    Serves the recorded transfers of one device in order. Interrupt IN reports recorded after an OUT transfer
+    are queued when the OUT transfer is replayed. If 'strict' is set, a transfer that does not match the next
+    recorded transfer fails with LIBUSB_ERROR_IO, otherwise the recording is searched for the next match.
+    """
+    interfaces = 3
+
+    def __init__(self, descriptor, transfers, strict=True):
+        """
+        :param descriptor: device descriptor bytes.
+        :param transfers: list of TraceRecord objects of this device.
+        :param strict: fail transfers that don't match the recording.
+        """
+        super().__init__()
+        self._descriptor = usb.device_descriptor.from_buffer_copy(descriptor)
+        self.product_id = self._descriptor.idProduct
+        self.product_name = USB_PRODUCT_DESCRIPTIONS.get(
+            f'{self._descriptor.idVendor:04x}:{self.product_id:04x}', '')
+        self.strict = strict
+        self.mismatches = 0
+        self._transfers = list(transfers)
+        self._pos = 0
+        self._queue_reports()
+
+    @property
+    def remaining(self):
+        """ Number of recorded transfers not replayed yet """
+        return len(self._transfers) - self._pos
+
+    def descriptor(self, desc):
+        ct.memmove(ct.addressof(desc), ct.addressof(self._descriptor), ct.sizeof(desc))
+
+    def _queue_reports(self):
+        """ Queue the interrupt IN reports that follow the current position """
+        while self._pos < len(self._transfers):
+            record = self._transfers[self._pos]
+            if record.transfer_type != 'interrupt' or not record.endpoint & usb.LIBUSB_ENDPOINT_IN:
+                break
+            if record.code >= 0:
+                self.queue_report(record.endpoint, record.data)
+            self._pos += 1
+
+    def _next(self, match):
+        """ Return the next recorded transfer accepted by 'match', None if there isn't one """
+        for pos in range(self._pos, len(self._transfers)):
+            record = self._transfers[pos]
+            if match(record):
+                if pos != self._pos:
+                    self.mismatches += 1
+                self._pos = pos + 1
+                return record
+            if self.strict:
+                break
+        self.mismatches += 1
+        _logger.error(_('Transfer does not match the recorded session') + f' ({self.bus}, {self.address}).')
+        return None
+
+    def _replay(self, match, result):
+        record = self._next(match)
+        if record is None:
+            return result(None)
+        ret = result(record)
+        self._queue_reports()
+        return ret
+
+    def control(self, request_type, b_request, w_value, w_index, data):
+        with self._lock:
+            self.transfers += 1
+            is_in = request_type & usb.LIBUSB_ENDPOINT_IN
+            length = data if is_in else len(data)
+            setup = _SETUP.pack(request_type, b_request, w_value & 0xffff, w_index & 0xffff, length)
+
+            def match(record):
+                return record.transfer_type == 'control' and record.setup[:6] == setup[:6] and \
+                    (is_in or record.data == bytes(data))
+
+            def result(record):
+                if record is None:
+                    return usb.LIBUSB_ERROR_IO, b''
+                if record.code < 0:
+                    return record.code, b''
+                return usb.LIBUSB_SUCCESS, record.data[:length] if is_in else b''
+
+            return self._replay(match, result)
+
+    def interrupt_out(self, endpoint, data):
+        with self._lock:
+            def match(record):
+                return record.transfer_type == 'interrupt' and record.endpoint == endpoint and \
+                    record.data == bytes(data)
+
+            return self._replay(match, lambda record: usb.LIBUSB_ERROR_IO if record is None else min(record.code, 0))
+
+
+class ReplayUSB(VirtualUSB):
+    """ Serves a recorded session in place of libusb, see VirtualUSB. """
+
+    def __init__(self, session, strict=True, latency=0.0, round_trip=0.0):
+        """
+        :param session: Session object or session file path.
+        :param strict: fail transfers that don't match the recording.
+        :param latency: seconds per transfer, the default replays at full speed.
+        :param round_trip: seconds added to every transfer seen by the host.
+        """
+        super().__init__(latency=latency, round_trip=round_trip)
+        self.session = session if isinstance(session, Session) else Session.load(session)
+        transfers = defaultdict(list)
+        for record in self.session.transfers:
+            transfers[(record.bus, record.address)].append(record)
+        for (bus, address), descriptor in sorted(self.session.devices.items()):
+            self.attach(ReplayDevice(descriptor, transfers[(bus, address)], strict), address, bus)
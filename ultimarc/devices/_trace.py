@@ -0,0 +1,134 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Ring buffer trace of raw USB transfers.
+#
+# Tracing is off unless enable_trace() is called, the transfer code only checks 'active' for None. While
+# enabled, every transfer is kept with its setup packet and payload, the oldest records are dropped when the
+# buffer is full. The buffer can be written as a pcap file in the Linux usbmon format, which Wireshark reads:
+#
+#    trace = enable_trace()
+#    ...
+#    trace.dump('ultimarc.pcap')
+#
+import struct
+import threading
+import time
+from collections import deque, namedtuple
+
+import libusb as usb
+
+# pcap link type of the Linux usbmon memory mapped header.
+LINKTYPE_USB_LINUX_MMAPPED = 220
+
+# usbmon transfer type values.
+_XFER_TYPES = {'control': 2, 'interrupt': 1}
+
+# A transfer, 'setup' is the 8 byte setup packet of control transfers otherwise None.
+TraceRecord = namedtuple('TraceRecord', ['id', 'timestamp', 'device', 'bus', 'address', 'transfer_type',
+                                         'endpoint', 'setup', 'code', 'data'])
+
+_usbmon_header = struct.Struct('<QBBBBHBBqiiII8siiII')
+
+active = None  # TransferTrace object while tracing is enabled.
+
+
+class TransferTrace:
+    """ Keeps the last 'size' transfers. """
+
+    def __init__(self, size=4096):
+        """
+        :param size: maximum number of transfers kept, None to keep every transfer.
+        """
+        self.records = deque(maxlen=size)
+        self.devices = dict()  # (bus, address) -> device descriptor bytes
+        self._lock = threading.Lock()
+        self._next_id = 1
+
+    def __len__(self):
+        return len(self.records)
+
+    def clear(self):
+        self.records.clear()
+
+    def add_device(self, bus, address, descriptor):
+        """
+        Keep the descriptor of a device seen in the trace.
+        :param bus: bus number.
+        :param address: device address.
+        :param descriptor: device descriptor bytes.
+        """
+        self.devices[(bus, address)] = bytes(descriptor)
+
+    def record(self, device, bus, address, transfer_type, endpoint, setup, code, data):
+        """
+        Add a transfer to the trace.
+        :param device: device key string.
+        :param bus: bus number.
+        :param address: device address.
+        :param transfer_type: 'control' or 'interrupt'.
+        :param endpoint: endpoint address, the direction bit is set for IN transfers.
+        :param setup: 8 byte setup packet for control transfers, otherwise None.
+        :param code: libusb error code, zero or positive if successful.
+        :param data: bytes sent or received.
+        """
+        with self._lock:
+            self.records.append(TraceRecord(self._next_id, time.time(), device, bus, address, transfer_type,
+                                            endpoint, setup, code, bytes(data)))
+            self._next_id += 1
+
+    @staticmethod
+    def _packet(record, event, data):
+        """ Return one usbmon event as a pcap packet """
+        seconds = int(record.timestamp)
+        micros = int((record.timestamp - seconds) * 1000000)
+        setup = record.setup if event == b'S' and record.setup is not None else bytes(8)
+        status = record.code if event == b'C' and record.code < 0 else 0
+        header = _usbmon_header.pack(
+            record.id, event[0], _XFER_TYPES[record.transfer_type], record.endpoint, record.address, record.bus,
+            0 if event == b'S' and record.setup is not None else ord('-'),
+            0 if data else ord('<' if record.endpoint & usb.LIBUSB_ENDPOINT_IN else '>'),
+            seconds, micros, status, len(data), len(data), setup, 0, 0, 0, 0)
+        packet = header + data
+        return struct.pack('<IIII', seconds, micros, len(packet), len(packet)) + packet
+
+    def dump(self, path):
+        """
+        Write the trace as a pcap file, each transfer is written as a submit and a completion event.
+        :param path: file path.
+        """
+        with self._lock:
+            records = list(self.records)
+
+        with open(path, 'wb') as h:
+            h.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, LINKTYPE_USB_LINUX_MMAPPED))
+            for record in records:
+                is_in = record.endpoint & usb.LIBUSB_ENDPOINT_IN
+                h.write(self._packet(record, b'S', b'' if is_in else record.data))
+                h.write(self._packet(record, b'C', record.data if is_in else b''))
+
+
+def enable_trace(size=4096, trace=None):
+    """
+    Start tracing transfers.
+    :param size: maximum number of transfers kept.
+    :param trace: TransferTrace object to record into, replaces the active trace if given.
+    :return: the active TransferTrace object.
+    """
+    global active
+    if trace is not None:
+        active = trace
+    elif active is None:
+        active = TransferTrace(size)
+    return active
+
+
+def disable_trace():
+    """
+    Stop tracing transfers.
+    :return: the TransferTrace object that was active or None.
+    """
+    global active
+    trace, active = active, None
+    return trace
@@ -0,0 +1,297 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Asynchronous libusb transfers.
+#
+# Transfers are submitted with libusb_submit_transfer() and completed by a background thread handling libusb
+# events, so several transfers can be queued on an endpoint back to back. Submitting a transfer returns a
+# concurrent.futures.Future, use asyncio.wrap_future() to await it from a coroutine.
+#
+# http://libusb.sourceforge.net/api-1.0/group__libusb__asyncio.html
+#
+import ctypes as ct
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+
+import libusb as usb
+
+from ultimarc import translate_gettext as _
+
+_logger = logging.getLogger('ultimarc')
+
+# Result of a completed transfer, 'code' is a libusb error code, zero if successful.
+TransferResult = namedtuple('TransferResult', ['code', 'data'])
+
+# Transfer status -> libusb error code.
+_TRANSFER_ERRORS = {
+    usb.LIBUSB_TRANSFER_COMPLETED: usb.LIBUSB_SUCCESS,
+    usb.LIBUSB_TRANSFER_ERROR: usb.LIBUSB_ERROR_IO,
+    usb.LIBUSB_TRANSFER_TIMED_OUT: usb.LIBUSB_ERROR_TIMEOUT,
+    usb.LIBUSB_TRANSFER_CANCELLED: usb.LIBUSB_ERROR_INTERRUPTED,
+    usb.LIBUSB_TRANSFER_STALL: usb.LIBUSB_ERROR_PIPE,
+    usb.LIBUSB_TRANSFER_NO_DEVICE: usb.LIBUSB_ERROR_NO_DEVICE,
+    usb.LIBUSB_TRANSFER_OVERFLOW: usb.LIBUSB_ERROR_OVERFLOW,
+}
+
+_active = dict()  # libusb transfer address -> USBTransfer, keeps the buffers alive until the transfer completes.
+_active_lock = threading.Lock()  # Held while a transfer completes, so a pending transfer is not cancelled once freed.
+_event_thread = None
+_event_lock = threading.Lock()
+
+
+class USBEventThread(threading.Thread):
+    """ Handles libusb events until stopped, calling the completion callback of submitted transfers. """
+
+    def __init__(self):
+        super().__init__(name='ultimarc-usb-events', daemon=True)
+        self._running = True
+
+    def run(self):
+        while self._running:
+            tv = usb.timeval(0, 100000)
+            ret = usb.handle_events_timeout_completed(None, ct.byref(tv), None)
+            if ret < 0 and ret != usb.LIBUSB_ERROR_INTERRUPTED:
+                _logger.error(f'{usb.error_name(ret).decode("utf-8")} ({ret}): ' + _('Failed to handle USB events.'))
+
+    def stop(self):
+        """ Stop handling events and wait for the thread to finish. """
+        self._running = False
+        usb.interrupt_event_handler(None)
+        self.join()
+
+
+def start_event_thread():
+    """ Start the event handling thread if it is not running. """
+    global _event_thread
+    if _event_thread is not None:
+        return
+    with _event_lock:
+        if _event_thread is None:
+            thread = USBEventThread()
+            thread.start()
+            _event_thread = thread
+
+
+def stop_event_thread():
+    """ Stop the event handling thread, transfers still pending complete when the thread is started again. """
+    global _event_thread
+    with _event_lock:
+        if _event_thread is not None:
+            _event_thread.stop()
+            _event_thread = None
+
+
+def _value(value):
+    """ Return the integer value of an integer or ctypes integer """
+    return getattr(value, 'value', value)
+
+
+class USBTransfer:
+    """ A single libusb transfer and the buffer it reads from or writes to. """
+    __slots__ = ('buffer', 'future', '_transfer', '_offset')
+
+    def __init__(self, dev_handle, endpoint, transfer_type, length, timeout, offset=0):
+        """
+        :param dev_handle: libusb device handle.
+        :param endpoint: endpoint address, zero for control transfers.
+        :param transfer_type: libusb transfer type value.
+        :param length: size of the transfer buffer.
+        :param timeout: timeout in milliseconds.
+        :param offset: index of the data in the transfer buffer.
+        """
+        self._transfer = usb.alloc_transfer(0)
+        if not self._transfer:
+            raise MemoryError(_('Failed to allocate USB transfer.'))
+        self._offset = offset
+        self.buffer = (ct.c_ubyte * length)()
+        self.future = Future()
+
+        transfer = self._transfer.contents
+        transfer.dev_handle = dev_handle
+        transfer.endpoint = endpoint
+        transfer.type = transfer_type
+        transfer.timeout = timeout
+        transfer.buffer = ct.cast(self.buffer, ct.POINTER(ct.c_ubyte))
+        transfer.length = length
+        transfer.callback = _transfer_callback
+
+    @classmethod
+    def control(cls, dev_handle, request_type, b_request, w_value, w_index, payload, timeout=2000):
+        """
+        Create a control transfer, the setup packet is placed in front of the payload.
+        :param dev_handle: libusb device handle.
+        :param request_type: Request type value. Combines direction, type and recipient enum values.
+        :param b_request: Request field for the setup packet.
+        :param w_value: Value field for the setup packet.
+        :param w_index: Index field for the setup packet.
+        :param payload: bytes object to send, or a zeroed bytes object of the size to read.
+        :param timeout: timeout in milliseconds.
+        :return: USBTransfer object.
+        """
+        setup_size = usb.LIBUSB_CONTROL_SETUP_SIZE
+        transfer = cls(dev_handle, 0, usb.LIBUSB_TRANSFER_TYPE_CONTROL, setup_size + len(payload), timeout,
+                       setup_size)
+        setup = usb.control_setup.from_buffer(transfer.buffer)
+        setup.bmRequestType = _value(request_type)
+        setup.bRequest = _value(b_request)
+        setup.wValue = usb.cpu_to_le16(_value(w_value))
+        setup.wIndex = usb.cpu_to_le16(_value(w_index))
+        setup.wLength = usb.cpu_to_le16(len(payload))
+        ct.memmove(ct.byref(transfer.buffer, setup_size), bytes(payload), len(payload))
+        return transfer
+
+    @classmethod
+    def interrupt(cls, dev_handle, endpoint, length, timeout=2000):
+        """
+        Create an interrupt transfer.
+        :param dev_handle: libusb device handle.
+        :param endpoint: endpoint address.
+        :param length: bytes to send or receive.
+        :param timeout: timeout in milliseconds.
+        :return: USBTransfer object.
+        """
+        return cls(dev_handle, endpoint, usb.LIBUSB_TRANSFER_TYPE_INTERRUPT, length, timeout)
+
+    def submit(self):
+        """
+        Submit the transfer to libusb, the transfer can only be submitted once.
+        :return: Future, the result is a TransferResult.
+        """
+        start_event_thread()
+        key = ct.addressof(self._transfer.contents)
+        _active[key] = self
+        ret = usb.submit_transfer(self._transfer)
+        if ret < 0:
+            _active.pop(key, None)
+            usb.free_transfer(self._transfer)
+            self.future.set_result(TransferResult(ret, b''))
+        return self.future
+
+    def cancel(self):
+        """ Cancel the transfer if it is still pending, the result code is then LIBUSB_ERROR_INTERRUPTED. """
+        with _active_lock:
+            if _active.get(ct.addressof(self._transfer.contents)) is not self:
+                return
+            ret = usb.cancel_transfer(self._transfer)
+        if ret < 0 and ret != usb.LIBUSB_ERROR_NOT_FOUND:
+            _logger.debug(f'{usb.error_name(ret).decode("utf-8")} ({ret}): ' + _('Failed to cancel USB transfer.'))
+
+    def _result_(self, transfer):
+        """ Called from the completion callback, the libusb transfer is freed afterwards """
+        code = _TRANSFER_ERRORS.get(transfer.status, usb.LIBUSB_ERROR_OTHER)
+        data = bytes(self.buffer[self._offset:self._offset + transfer.actual_length])
+        return TransferResult(code, data)
+
+
+def _transfer_done(transfer_p):
+    """ libusb transfer completion callback, called from inside handle_events(). """
+    result = None
+    with _active_lock:
+        transfer = _active.pop(ct.addressof(transfer_p.contents), None)
+        try:
+            if transfer is not None:
+                result = transfer._result_(transfer_p.contents)
+        finally:
+            usb.free_transfer(transfer_p)
+    # Completion callbacks may submit or cancel transfers, they run without the lock held.
+    if transfer is not None:
+        transfer.future.set_result(result)
+
+
+# Keep a reference to the ctypes callback, libusb holds a raw pointer to it.
+_transfer_callback = usb.transfer_cb_fn(_transfer_done)
+
+
+def gather(futures):
+    """
+    Combine futures into one future.
+    :param futures: list of Future objects.
+    :return: Future, the result is the list of results in the same order.
+    """
+    combined = Future()
+    results = [None] * len(futures)
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    if not futures:
+        combined.set_result(results)
+        return combined
+
+    def done(index, future):
+        results[index] = future.result()
+        with lock:
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished:
+            combined.set_result(results)
+
+    for x, future in enumerate(futures):
+        future.add_done_callback(lambda f, x=x: done(x, f))
+    return combined
+
+
+def then(future, func):
+    """
+    Chain a function onto a future.
+    :param future: Future object.
+    :param func: callable taking the result of the future.
+    :return: Future, the result is the value returned by func.
+    """
+    chained = Future()
+
+    def done(f):
+        try:
+            chained.set_result(func(f.result()))
+        except Exception as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(done)
+    return chained
+
+
+def read_interrupt_stream(dev_handle, endpoint, length, count, depth=4, timeout=2000, observer=None):
+    """
+    Read several reports from an interrupt endpoint, keeping up to 'depth' transfers submitted at once.
+    :param dev_handle: libusb device handle.
+    :param endpoint: endpoint address.
+    :param length: size of each report.
+    :param count: number of reports to read.
+    :param depth: maximum number of transfers in flight.
+    :param timeout: timeout in milliseconds of each transfer.
+    :param observer: optional callable taking (TransferResult, seconds), called as each transfer completes.
+    :return: Future, the result is a list of TransferResult objects in the order received.
+    """
+    stream = Future()
+    results = list()
+    lock = threading.Lock()
+    submitted = [0]
+
+    def submit_next():
+        with lock:
+            if submitted[0] >= count:
+                return
+            submitted[0] += 1
+        start = time.perf_counter()
+        USBTransfer.interrupt(dev_handle, endpoint, length, timeout).submit().add_done_callback(
+            lambda f: done(f, start))
+
+    def done(future, start):
+        if observer is not None:
+            observer(future.result(), time.perf_counter() - start)
+        with lock:
+            results.append(future.result())
+            finished = len(results) == count
+        if finished:
+            stream.set_result(results)
+        else:
+            submit_next()
+
+    if not count:
+        stream.set_result(results)
+    for x in range(min(depth, count)):
+        submit_next()
+    return stream
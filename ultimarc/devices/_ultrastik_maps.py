@@ -0,0 +1,155 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Compiled UltraStik maps, so a joystick map can be switched without JSON or schema work.
+#
+# Maps are the 'ultrastik-config' files in $XDG_CONFIG_HOME/ultimarc/ultrastik and the examples directory, named by
+# file name without the 'ultrastik-' prefix, IE: 'ultrastik-joy4way.json' is 'joy4way'. A map in the config
+# directory replaces an example map with the same name. Each map is validated and packed into the payload of each
+# UltraStik device class once, see USBDeviceHandle.compile_config(). Payloads are kept in memory and in
+# $XDG_CACHE_HOME/ultimarc/ultrastik-maps.json, a payload is compiled again when the size or modification time of
+# its map file changes.
+#
+import json
+import logging
+import os
+from pathlib import Path
+
+from ultimarc import translate_gettext as _
+from ultimarc.system_utils import cache_dir, config_dir
+
+_logger = logging.getLogger('ultimarc')
+
+EXAMPLES_DIR = Path(__file__).resolve().parents[1] / 'examples'
+MAP_PREFIX = 'ultrastik-'
+COMPILED_VERSION = 1  # Increase when the cache file format or the UltraStik payload encoding changes.
+
+
+def default_map_dirs():
+    """ Return the map directories, user maps first """
+    return [os.path.join(config_dir(), 'ultrastik'), str(EXAMPLES_DIR)]
+
+
+def default_cache_file():
+    """ Return the compiled map cache file """
+    return os.path.join(cache_dir(), 'ultrastik-maps.json')
+
+
+def _class_path(cls):
+    """ Return the 'module:class' name of a device class """
+    return f'{cls.__module__}:{cls.__name__}'
+
+
+class UltraStikMapCache(object):
+    """ Compiles UltraStik maps and keeps the payloads. """
+
+    def __init__(self, map_dirs=None, cache_file=None):
+        """
+        :param map_dirs: list of directories holding map files, see default_map_dirs().
+        :param cache_file: compiled map cache file, see default_cache_file(). False to only keep payloads in memory.
+        """
+        self.map_dirs = map_dirs or default_map_dirs()
+        self.cache_file = default_cache_file() if cache_file is None else cache_file
+        self._compiled = None  # class path -> map name -> {'path', 'stat', 'data'}
+
+    def _map_files_(self):
+        """ Return a dict of map name -> map file path """
+        files = dict()
+        for directory in reversed(self.map_dirs):
+            try:
+                names = sorted(os.listdir(directory))
+            except OSError:
+                continue
+            for file in names:
+                if file.startswith(MAP_PREFIX) and file.endswith('.json'):
+                    files[file[len(MAP_PREFIX):-5]] = os.path.join(directory, file)
+        return files
+
+    def names(self):
+        """ Return a sorted list of map names, files that are not 'ultrastik-config' files are left out """
+        names = list()
+        for name, path in sorted(self._map_files_().items()):
+            try:
+                with open(path) as h:
+                    if json.loads(h.read()).get('resourceType') == 'ultrastik-config':
+                        names.append(name)
+            except (OSError, ValueError, AttributeError):
+                continue
+        return names
+
+    def _load_(self):
+        if self._compiled is not None:
+            return self._compiled
+        self._compiled = dict()
+        if self.cache_file:
+            try:
+                with open(self.cache_file) as h:
+                    data = json.loads(h.read())
+                if data.get('version') == COMPILED_VERSION:
+                    self._compiled = data['classes']
+            except (OSError, ValueError, KeyError, AttributeError):
+                pass
+        return self._compiled
+
+    def _store_(self):
+        if not self.cache_file:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            tmp_file = f'{self.cache_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as h:
+                json.dump({'version': COMPILED_VERSION, 'classes': self._compiled}, h)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            _logger.debug(_('Unable to store compiled UltraStik maps') + f': {e}')
+
+    def payload(self, cls, name):
+        """
+        Return the compiled payload of a map for a device class.
+        :param cls: UltraStik device class.
+        :param name: map name.
+        :return: bytes or None if the map was not found or is not valid.
+        """
+        path = self._map_files_().get(name)
+        if path is None:
+            _logger.error(_('Unable to find UltraStik map') + f' {name}.')
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            _logger.error(_('Unable to find UltraStik map') + f' {name}.')
+            return None
+
+        stat = [st.st_mtime_ns, st.st_size]
+        maps = self._load_().setdefault(_class_path(cls), dict())
+        entry = maps.get(name)
+        if entry and entry['path'] == path and entry['stat'] == stat:
+            return bytes.fromhex(entry['data'])
+
+        compiled = cls.compile_config(path)
+        if compiled is None:
+            _logger.error(_('Unable to compile UltraStik map') + f' {name} ({path}).')
+            return None
+        maps[name] = {'path': path, 'stat': stat, 'data': compiled[1].hex()}
+        self._store_()
+        return compiled[1]
+
+    def compile(self, classes):
+        """
+        Compile every map for the device classes.
+        :param classes: list of UltraStik device classes.
+        :return: list of map names that failed to compile.
+        """
+        return [name for name in self.names() for cls in classes if self.payload(cls, name) is None]
+
+
+_default_cache = None
+
+
+def default_map_cache():
+    """ Return the process wide UltraStikMapCache object """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = UltraStikMapCache()
+    return _default_cache
@@ -0,0 +1,129 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Process wide cache of compiled JSON schema validators.
+#
+# Validators are keyed by schema file name and file modification time, so a schema is only read and
+# compiled again when the file changes. Validators can also be generated ahead of time as Python modules,
+# see build_validators() or run:
+#
+#    python -m ultimarc.devices._validators
+#
+import hashlib
+import importlib.util
+import json
+import logging
+import threading
+from pathlib import Path
+
+import fastjsonschema
+
+from ultimarc import translate_gettext as _
+
+_logger = logging.getLogger('ultimarc')
+
+SCHEMA_DIR = Path(__file__).resolve().parents[1] / 'schemas'
+COMPILED_DIR = SCHEMA_DIR / 'compiled'
+
+_cache = dict()  # schema file name -> (mtime, schema dict, validator)
+_lock = threading.Lock()
+
+
+def _module_name(schema_file):
+    """ Return the generated module name for a schema file name, IE: 'ipac2.schema' -> 'ipac2_schema'. """
+    return schema_file.replace('-', '_').replace('.', '_')
+
+
+def _schema_hash(data):
+    """ Return the hash of the schema file contents, used to detect stale generated validators. """
+    return hashlib.sha256(data).hexdigest()
+
+
+def _load_generated(schema_file, schema_hash):
+    """
+    Import a validator generated by build_validators().
+    :param schema_file: Schema file name only, no path included.
+    :param schema_hash: Hash of the current schema file contents.
+    :return: validate function or None if missing or out of date.
+    """
+    module_path = COMPILED_DIR / f'{_module_name(schema_file)}.py'
+    if not module_path.is_file():
+        return None
+
+    spec = importlib.util.spec_from_file_location(f'ultimarc_compiled_{_module_name(schema_file)}', module_path)
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    except Exception as e:
+        _logger.debug(_('Failed to import generated schema validator') + f' {module_path}: {e}')
+        return None
+
+    if getattr(module, 'SCHEMA_HASH', None) != schema_hash:
+        _logger.debug(_('Generated schema validator is out of date') + f' ({schema_file}).')
+        return None
+    return module.validate
+
+
+def get_schema_validator(schema_file):
+    """
+    Return the schema dict and compiled validator for a schema file.
+    :param schema_file: Schema file name only, no path included.
+    :return: (schema dict, validator function) tuple or (None, None) if the schema file was not found.
+    """
+    schema_path = SCHEMA_DIR / schema_file
+    try:
+        mtime = schema_path.stat().st_mtime_ns
+    except OSError:
+        _logger.error(_('Unable to locate schema directory.'))
+        return None, None
+
+    entry = _cache.get(schema_file)
+    if entry and entry[0] == mtime:
+        return entry[1], entry[2]
+
+    with _lock:
+        entry = _cache.get(schema_file)
+        if entry and entry[0] == mtime:
+            return entry[1], entry[2]
+
+        data = schema_path.read_bytes()
+        schema = json.loads(data)
+        validator = _load_generated(schema_file, _schema_hash(data)) or fastjsonschema.compile(schema)
+        _cache[schema_file] = (mtime, schema, validator)
+
+    return schema, validator
+
+
+def clear_cache():
+    """ Drop all cached validators. """
+    with _lock:
+        _cache.clear()
+
+
+def build_validators(output_dir=COMPILED_DIR):
+    """
+    Generate a Python validator module for every schema file.
+    :param output_dir: Path object, directory to write the generated modules to.
+    :return: list of generated module paths.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    generated = list()
+    for schema_path in sorted(SCHEMA_DIR.glob('*.schema')):
+        data = schema_path.read_bytes()
+        code = fastjsonschema.compile_to_code(json.loads(data))
+        module_path = output_dir / f'{_module_name(schema_path.name)}.py'
+        with open(module_path, 'w') as h:
+            h.write(f'# Generated from {schema_path.name}, do not edit.\n')
+            h.write(f'SCHEMA_HASH = {_schema_hash(data)!r}\n')
+            h.write(code)
+        generated.append(module_path)
+
+    return generated
+
+
+if __name__ == '__main__':
+    for path in build_validators():
+        print(path)
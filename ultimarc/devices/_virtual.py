@@ -0,0 +1,740 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# In-process emulator of Ultimarc devices, standing in for the libusb entry points this package calls.
+#
+# A VirtualUSB object replaces the libusb functions used for enumeration, opening devices and transfers,
+# both synchronous and asynchronous, with versions talking to virtual devices. Each virtual device models
+# the firmware state of a board, so configurations written with write_alt() can be read back with
+# read_interrupt(). Example:
+#
+#    with VirtualUSB([VirtualIpac2(), VirtualUltraStik(controller_id=2)], latency=0.001):
+#        devices = USBDevices(['d209'])
+#        ...
+#
+import ctypes as ct
+import threading
+import time
+from collections import deque
+
+import libusb as usb
+
+from ultimarc.devices import ipac2, ipac4, jpac, mini_pac, ultimate_io
+
+VENDOR_ID = 0xd209
+
+# libusb functions replaced by VirtualUSB.
+_ENTRY_POINTS = (
+    'get_device_list', 'free_device_list', 'get_bus_number', 'get_device_address', 'get_port_numbers',
+    'get_device_descriptor', 'open', 'close', 'get_device', 'set_auto_detach_kernel_driver', 'claim_interface',
+    'release_interface', 'get_string_descriptor_ascii', 'control_transfer', 'interrupt_transfer', 'has_capability',
+    'submit_transfer', 'cancel_transfer', 'handle_events_timeout_completed', 'interrupt_event_handler',
+)
+
+# Setup packet bRequest values used by the firmware models.
+_SET_CONFIGURATION = 0x09
+_CLEAR_FEATURE = 0x01
+
+
+def _address(ptr):
+    """ Return the address a ctypes pointer points to """
+    return ct.cast(ptr, ct.c_void_p).value
+
+
+def _set_pointer(ref, address):
+    """ Make the pointer behind a byref() argument point to an address """
+    ct.cast(ref, ct.POINTER(ct.c_void_p))[0] = address
+
+
+def _value(value):
+    """ Return the integer value of an integer or ctypes integer """
+    return getattr(value, 'value', value)
+
+
+class VirtualDevice:
+    """
+    Base class for a virtual device. Subclasses model the firmware by overriding control_out() and control_in(),
+    and queue interrupt IN reports with queue_report().
+    """
+    product_id = 0
+    product_name = ''
+    interfaces = 1  # Number of interfaces the device has.
+    bcd_device = 0x0001
+
+    def __init__(self, serial=None):
+        """
+        :param serial: serial number string.
+        """
+        self.serial = serial or ''
+        self.bus = None
+        self.address = None
+        self.port_numbers = ()
+        self.transfers = 0  # Number of transfers handled.
+        self._reports = dict()  # endpoint -> deque of reports
+        self._lock = threading.RLock()
+        self._report_ready = threading.Condition(self._lock)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.bus}, {self.address})'
+
+    @property
+    def strings(self):
+        """ String descriptors by index """
+        return {1: 'Ultimarc', 2: self.product_name, 3: self.serial}
+
+    def descriptor(self, desc):
+        """ Fill a libusb device descriptor """
+        desc.bLength = 18
+        desc.bDescriptorType = 1
+        desc.bcdUSB = 0x0200
+        desc.bDeviceClass = 0
+        desc.bDeviceSubClass = 0
+        desc.bDeviceProtocol = 0
+        desc.bMaxPacketSize0 = 8
+        desc.idVendor = VENDOR_ID
+        desc.idProduct = self.product_id
+        desc.bcdDevice = self.bcd_device
+        desc.iManufacturer = 1
+        desc.iProduct = 2
+        desc.iSerialNumber = 3
+        desc.bNumConfigurations = 1
+
+    def queue_report(self, endpoint, data):
+        """ Queue an interrupt IN report for the host to read """
+        with self._lock:
+            self._reports.setdefault(endpoint, deque()).append(bytes(data))
+            self._report_ready.notify_all()
+
+    def pending_reports(self, endpoint):
+        """ Return the number of reports waiting on an endpoint """
+        return len(self._reports.get(endpoint, ()))
+
+    def interrupt_in(self, endpoint, timeout=None):
+        """
+        Return the next report on an endpoint.
+        :param endpoint: endpoint address.
+        :param timeout: seconds to wait for a report, None to not wait.
+        :return: bytes object or None if there is no report.
+        """
+        with self._lock:
+            reports = self._reports.setdefault(endpoint, deque())
+            if not reports and timeout:
+                self._report_ready.wait_for(lambda: reports, timeout)
+            return reports.popleft() if reports else None
+
+    def interrupt_out(self, endpoint, data):
+        """ Handle an interrupt OUT transfer, return a libusb error code """
+        return usb.LIBUSB_ERROR_PIPE
+
+    def control_out(self, request_type, b_request, w_value, w_index, data):
+        """ Handle a host to device control transfer, return a libusb error code """
+        return usb.LIBUSB_SUCCESS
+
+    def control_in(self, request_type, b_request, w_value, w_index, length):
+        """ Handle a device to host control transfer, return (libusb error code, bytes) """
+        return usb.LIBUSB_SUCCESS, bytes(length)
+
+    def control(self, request_type, b_request, w_value, w_index, data):
+        """
+        Handle a control transfer.
+        :param data: bytes to send for OUT transfers, number of bytes to read for IN transfers.
+        :return: (libusb error code, bytes received) tuple.
+        """
+        with self._lock:
+            self.transfers += 1
+            if request_type & usb.LIBUSB_ENDPOINT_IN:
+                return self.control_in(request_type, b_request, w_value, w_index, data)
+            return self.control_out(request_type, b_request, w_value, w_index, data), b''
+
+
+class VirtualPacDevice(VirtualDevice):
+    """
+    PAC series board. The configuration is read by sending a 0x59 request and reading 64 reports from
+    endpoint 0x84, and written as 64 packets of 4 bytes starting with a 0x50 header.
+    """
+    interfaces = 3
+    layout = None
+    report_id = 0x03
+    endpoint = 0x84
+
+    def __init__(self, serial=None):
+        super().__init__(serial)
+        # The configuration held by the board, header included.
+        self.config = bytearray([0x50, 0xdd, 0x0f, 0x00]) + bytearray(self.layout.template)
+        self.writes = 0  # Number of complete configurations written.
+        self._incoming = None
+
+    def control_out(self, request_type, b_request, w_value, w_index, data):
+        if b_request != _SET_CONFIGURATION or not data or data[0] != self.report_id:
+            return usb.LIBUSB_ERROR_PIPE
+        packet = data[1:5]
+
+        if self._incoming is not None:
+            self._incoming += packet
+            if len(self._incoming) >= len(self.config):
+                self.config[:] = self._incoming[:len(self.config)]
+                self._incoming = None
+                self.writes += 1
+        elif packet[:2] == b'\x59\xdd':
+            # Configuration request
+            for pos in range(0, len(self.config), 4):
+                self.queue_report(self.endpoint, bytes([self.report_id]) + self.config[pos:pos + 4])
+        elif packet[:2] == b'\x50\xdd':
+            self._incoming = bytearray(packet)
+        else:
+            return self.command(packet)
+        return usb.LIBUSB_SUCCESS
+
+    def command(self, packet):
+        """ Handle a single packet that isn't part of a configuration transfer """
+        return usb.LIBUSB_ERROR_PIPE
+
+
+class VirtualIpac2(VirtualPacDevice):
+    product_id = 0x0420
+    product_name = 'I-PAC 2'
+    layout = ipac2.LAYOUT
+
+
+class VirtualIpac4(VirtualPacDevice):
+    product_id = 0x0430
+    product_name = 'I-PAC 4'
+    layout = ipac4.LAYOUT
+
+
+class VirtualJpac(VirtualPacDevice):
+    product_id = 0x0450
+    product_name = 'J-PAC'
+    layout = jpac.LAYOUT
+
+
+class VirtualMiniPac(VirtualPacDevice):
+    product_id = 0x0440
+    product_name = 'Mini-PAC'
+    layout = mini_pac.LAYOUT
+
+
+class VirtualUltimateIO(VirtualPacDevice):
+    """ Ultimate IO board, also accepts the single packet LED commands. """
+    product_id = 0x0410
+    product_name = 'Ultimate I/O'
+    layout = ultimate_io.LAYOUT
+
+    def __init__(self, serial=None):
+        super().__init__(serial)
+        self.leds = bytearray(96)  # LED intensities, LED 1 is index 0.
+        self.fade_rate = 0
+        self.random_state = False
+
+    def command(self, packet):
+        action, value = packet[0], packet[1]
+        if 1 <= action <= 96:
+            self.leds[action - 1] = value
+        elif action == 0x80:
+            self.leds[:] = bytes([value]) * len(self.leds)
+        elif action == 0x89:
+            self.random_state = True
+        elif action == 0xc0:
+            self.fade_rate = value
+        else:
+            return usb.LIBUSB_ERROR_PIPE
+        return usb.LIBUSB_SUCCESS
+
+
+class VirtualUltraStik(VirtualDevice):
+    """
+    UltraStik 360 joystick. 2015 and newer boards take the 96 byte map as 4 byte packets on interface 2,
+    older boards take it as three 32 byte vendor requests on interface 0. Changing the controller id changes
+    the product id.
+    """
+    product_name = 'UltraStik 360'
+    config_size = 96
+
+    def __init__(self, controller_id=1, pre_2015=False, serial=None):
+        super().__init__(serial)
+        self.controller_id = controller_id
+        self.pre_2015 = pre_2015
+        self.interfaces = 1 if pre_2015 else 3
+        self.config = bytearray(self.config_size)
+        self.writes = 0
+        self._incoming = bytearray()
+
+    @property
+    def product_id(self):
+        return (0x0500 if self.pre_2015 else 0x0510) + self.controller_id
+
+    def _set_controller_id(self, data):
+        """ Return True if the data is a controller id change """
+        if data[0] in range(0x51, 0x55):
+            self.controller_id = data[0] - 0x50
+            return True
+        return False
+
+    def _received(self):
+        """ Apply a complete map """
+        self.config[:] = self._incoming[:self.config_size]
+        self._incoming = bytearray()
+        self.writes += 1
+
+    def control_out(self, request_type, b_request, w_value, w_index, data):
+        if self.pre_2015:
+            if b_request == 0xe9:
+                if _value(w_value) == 1:
+                    self._incoming = bytearray()
+                elif len(self._incoming) == 32 and self._set_controller_id(self._incoming):
+                    self._incoming = bytearray()
+                elif len(self._incoming) >= self.config_size:
+                    self._received()
+            elif b_request == 0xeb:
+                self._incoming += data
+            return usb.LIBUSB_SUCCESS
+
+        if b_request != _SET_CONFIGURATION:
+            return usb.LIBUSB_ERROR_PIPE
+        if not self._incoming and len(data) == 4 and self._set_controller_id(data):
+            return usb.LIBUSB_SUCCESS
+        self._incoming += data
+        if len(self._incoming) >= self.config_size:
+            self._received()
+        return usb.LIBUSB_SUCCESS
+
+
+class VirtualUSBButton(VirtualDevice):
+    """
+    USB Button. Accepts the color override, the 64 byte configuration and the configuration request, which
+    answers with 16 reports of 4 bytes on endpoint 0x81. Press state reports are sent on the same endpoint.
+    """
+    product_id = 0x1200
+    product_name = 'USB Button'
+    config_size = 64
+    endpoint = 0x81
+
+    def __init__(self, serial=None):
+        super().__init__(serial)
+        self.color = (0, 0, 0)
+        self.config = bytearray([0x50, 0xdd]) + bytearray(self.config_size - 2)
+        self.writes = 0
+        self.pressed = False
+        self._incoming = None
+
+    def press(self, pressed=True):
+        """ Press or release the button, a state report is sent on the interrupt endpoint """
+        self.pressed = pressed
+        self.queue_report(self.endpoint, bytes([0x02, int(pressed), 0x00, 0x00, 0x00]))
+
+    def control_out(self, request_type, b_request, w_value, w_index, data):
+        if b_request != _SET_CONFIGURATION:
+            return usb.LIBUSB_ERROR_PIPE
+
+        if self._incoming is not None:
+            self._incoming += data
+            if len(self._incoming) >= self.config_size:
+                self.config[:] = self._incoming[:self.config_size]
+                self._incoming = None
+                self.writes += 1
+        elif data[0] == 0x01:
+            self.color = tuple(data[1:4])
+        elif data[:2] == b'\x59\xdd':
+            for pos in range(0, self.config_size, 4):
+                self.queue_report(self.endpoint, self.config[pos:pos + 4])
+        elif data[0] in (0x50, 0x51) and data[1] == 0xdd:
+            self._incoming = bytearray(data)
+        else:
+            return usb.LIBUSB_ERROR_PIPE
+        return usb.LIBUSB_SUCCESS
+
+    def control_in(self, request_type, b_request, w_value, w_index, length):
+        if b_request != _CLEAR_FEATURE:
+            return usb.LIBUSB_ERROR_PIPE, b''
+        if w_value == 0x0102:
+            return usb.LIBUSB_SUCCESS, bytes((0x02, int(self.pressed), 0x00, 0x00))[:length]
+        return usb.LIBUSB_SUCCESS, bytes((0x01,) + self.color)[:length]
+
+
+class _Pending:
+    """ An asynchronous transfer submitted to a VirtualUSB object. """
+    __slots__ = ('transfer_p', 'device', 'deadline', 'ready_at')
+
+    def __init__(self, transfer_p, device, deadline):
+        self.transfer_p = transfer_p
+        self.device = device
+        self.deadline = deadline
+        self.ready_at = None
+
+
+class VirtualUSB:
+    """
+    Replaces the libusb entry points with an emulated bus of virtual devices while installed.
+
+    'latency' is the time a device takes to handle one transfer, transfers to the same device are handled
+    one at a time. 'round_trip' is the extra time before the host sees a completed transfer, queued
+    asynchronous transfers overlap their round trips.
+    """
+
+    def __init__(self, devices=(), latency=0.0, round_trip=0.0, bus=1):
+        """
+        :param devices: list of VirtualDevice objects to attach.
+        :param latency: seconds per transfer.
+        :param round_trip: seconds added to every transfer seen by the host.
+        :param bus: bus number of the attached devices.
+        """
+        self.latency = latency
+        self.round_trip = round_trip
+        self.bus = bus
+        self.devices = list()
+        self._originals = None
+        self._lock = threading.RLock()
+        self._next_address = 1
+        self._pointers = dict()  # address of a fake libusb device -> VirtualDevice
+        self._buffers = dict()  # address -> ctypes buffer backing a fake libusb pointer
+        self._handles = dict()  # address of a fake libusb device handle -> VirtualDevice
+        self._claimed = dict()  # (VirtualDevice, interface) -> handle address
+        self._device_lists = dict()
+        self._product_ids = dict()  # VirtualDevice -> product id when last enumerated
+
+        # Asynchronous transfers
+        self._queue = deque()  # _Pending objects waiting for a device
+        self._completed = deque()  # _Pending objects waiting for handle_events()
+        self._events = threading.Condition(self._lock)
+        self._worker = None
+        self._interrupted = False
+
+        for device in devices:
+            self.attach(device)
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.uninstall()
+
+    def install(self):
+        """ Replace the libusb entry points """
+        if self._originals is None:
+            self._originals = {name: getattr(usb, name) for name in _ENTRY_POINTS}
+            for name in _ENTRY_POINTS:
+                setattr(usb, name, getattr(self, name))
+
+    def uninstall(self):
+        """ Restore the libusb entry points """
+        if self._originals is not None:
+            for name, func in self._originals.items():
+                setattr(usb, name, func)
+            self._originals = None
+        if self._worker is not None:
+            with self._lock:
+                self._queue.append(None)
+                self._events.notify_all()
+            self._worker.join()
+            self._worker = None
+        self._queue.clear()
+        self._completed.clear()
+
+    def attach(self, device, address=None, bus=None):
+        """
+        Plug a virtual device into the bus.
+        :param device: VirtualDevice object.
+        :param address: device address, the next free address if None.
+        :param bus: bus number, the bus number given to VirtualUSB if None.
+        :return: VirtualDevice object.
+        """
+        with self._lock:
+            device.bus = bus or self.bus
+            device.address = address or self._next_address
+            device.port_numbers = (device.address,)
+            self._next_address = max(self._next_address, device.address) + 1
+            self.devices.append(device)
+            buf = ct.create_string_buffer(1)
+            self._buffers[ct.addressof(buf)] = buf
+            self._pointers[ct.addressof(buf)] = device
+        return device
+
+    def detach(self, device):
+        """ Unplug a virtual device, open handles fail with LIBUSB_ERROR_NO_DEVICE. """
+        with self._lock:
+            self.devices.remove(device)
+            for key in [k for k, d in self._pointers.items() if d is device]:
+                del self._pointers[key]
+
+    def _device(self, dev):
+        return self._pointers.get(_address(dev))
+
+    def _handle_device(self, dev_handle):
+        device = self._handles.get(_address(dev_handle))
+        return device if device in self.devices else None
+
+    # Enumeration
+
+    def has_capability(self, capability):
+        return 0
+
+    def get_device_list(self, ctx, list_ref):
+        with self._lock:
+            # A device that changed its product id re-enumerates with a new address, like the real boards do.
+            for device in self.devices:
+                if self._product_ids.setdefault(device, device.product_id) != device.product_id:
+                    self._product_ids[device] = device.product_id
+                    device.address = self._next_address
+                    device.port_numbers = (device.address,)
+                    self._next_address += 1
+            pointers = [k for k, d in self._pointers.items() if d in self.devices]
+            array = (ct.c_void_p * (len(pointers) + 1))(*pointers)
+            self._device_lists[ct.addressof(array)] = array
+            _set_pointer(list_ref, ct.addressof(array))
+        return len(pointers)
+
+    def free_device_list(self, dev_list, unref_devices):
+        self._device_lists.pop(_address(dev_list), None)
+
+    def get_bus_number(self, dev):
+        return self._device(dev).bus
+
+    def get_device_address(self, dev):
+        return self._device(dev).address
+
+    def get_port_numbers(self, dev, port_numbers, size):
+        ports = self._device(dev).port_numbers[:size]
+        for x, port in enumerate(ports):
+            port_numbers[x] = port
+        return len(ports)
+
+    def get_device_descriptor(self, dev, desc_ref):
+        device = self._device(dev)
+        if device is None:
+            return usb.LIBUSB_ERROR_NO_DEVICE
+        device.descriptor(ct.cast(desc_ref, ct.POINTER(usb.device_descriptor)).contents)
+        return usb.LIBUSB_SUCCESS
+
+    # Device handles
+
+    def open(self, dev, handle_ref):
+        with self._lock:
+            device = self._device(dev)
+            if device is None or device not in self.devices:
+                return usb.LIBUSB_ERROR_NO_DEVICE
+            buf = ct.create_string_buffer(1)
+            self._buffers[ct.addressof(buf)] = buf
+            self._handles[ct.addressof(buf)] = device
+            _set_pointer(handle_ref, ct.addressof(buf))
+        return usb.LIBUSB_SUCCESS
+
+    def close(self, dev_handle):
+        with self._lock:
+            key = _address(dev_handle)
+            for claim in [c for c, h in self._claimed.items() if h == key]:
+                del self._claimed[claim]
+            self._handles.pop(key, None)
+            self._buffers.pop(key, None)
+
+    def get_device(self, dev_handle):
+        device = self._handles.get(_address(dev_handle))
+        for key, dev in self._pointers.items():
+            if dev is device:
+                return ct.cast(key, ct.POINTER(usb.device))
+        return None
+
+    def set_auto_detach_kernel_driver(self, dev_handle, enable):
+        return usb.LIBUSB_SUCCESS
+
+    def claim_interface(self, dev_handle, interface):
+        with self._lock:
+            device = self._handle_device(dev_handle)
+            if device is None:
+                return usb.LIBUSB_ERROR_NO_DEVICE
+            if not 0 <= interface < device.interfaces:
+                return usb.LIBUSB_ERROR_NOT_FOUND
+            owner = self._claimed.setdefault((device, interface), _address(dev_handle))
+            return usb.LIBUSB_SUCCESS if owner == _address(dev_handle) else usb.LIBUSB_ERROR_BUSY
+
+    def release_interface(self, dev_handle, interface):
+        with self._lock:
+            device = self._handles.get(_address(dev_handle))
+            if self._claimed.get((device, interface)) != _address(dev_handle):
+                return usb.LIBUSB_ERROR_NOT_FOUND
+            del self._claimed[(device, interface)]
+        return usb.LIBUSB_SUCCESS
+
+    def get_string_descriptor_ascii(self, dev_handle, index, data, length):
+        device = self._handle_device(dev_handle)
+        if device is None:
+            return usb.LIBUSB_ERROR_NO_DEVICE
+        value = device.strings.get(index)
+        if value is None:
+            return usb.LIBUSB_ERROR_INVALID_PARAM
+        value = value.encode('ascii')[:length - 1] + b'\x00'
+        ct.memmove(data, value, len(value))
+        return len(value) - 1
+
+    # Synchronous transfers
+
+    def _transfer(self, device, operation):
+        """ Run a transfer operation, taking the device latency and round trip time """
+        with device._lock:
+            if self.latency:
+                time.sleep(self.latency)
+            result = operation()
+        if self.round_trip:
+            time.sleep(self.round_trip)
+        return result
+
+    def control_transfer(self, dev_handle, request_type, b_request, w_value, w_index, data, length, timeout):
+        device = self._handle_device(dev_handle)
+        if device is None:
+            return usb.LIBUSB_ERROR_NO_DEVICE
+        length = _value(length)
+        request_type = _value(request_type)
+        if request_type & usb.LIBUSB_ENDPOINT_IN:
+            ret, received = self._transfer(device, lambda: device.control(
+                request_type, _value(b_request), _value(w_value), _value(w_index), length))
+            if ret < 0:
+                return ret
+            if received:
+                ct.memmove(data, received, len(received))
+            return len(received)
+
+        payload = ct.string_at(data, length) if length else b''
+        ret, _received = self._transfer(device, lambda: device.control(
+            request_type, _value(b_request), _value(w_value), _value(w_index), payload))
+        return ret if ret < 0 else length
+
+    def interrupt_transfer(self, dev_handle, endpoint, data, length, actual_length, timeout):
+        device = self._handle_device(dev_handle)
+        if device is None:
+            return usb.LIBUSB_ERROR_NO_DEVICE
+        actual_length[0] = 0
+        if not endpoint & usb.LIBUSB_ENDPOINT_IN:
+            ret = self._transfer(device, lambda: device.interrupt_out(endpoint, ct.string_at(data, length)))
+            if ret == usb.LIBUSB_SUCCESS:
+                actual_length[0] = length
+            return ret
+
+        report = self._transfer(device, lambda: device.interrupt_in(endpoint, timeout / 1000 if timeout else None))
+        if report is None:
+            return usb.LIBUSB_ERROR_TIMEOUT
+        report = report[:length]
+        ct.memmove(data, report, len(report))
+        actual_length[0] = len(report)
+        return usb.LIBUSB_SUCCESS
+
+    # Asynchronous transfers
+
+    def submit_transfer(self, transfer_p):
+        transfer = transfer_p.contents
+        device = self._handle_device(transfer.dev_handle)
+        if device is None:
+            return usb.LIBUSB_ERROR_NO_DEVICE
+        deadline = time.monotonic() + transfer.timeout / 1000 if transfer.timeout else None
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run_worker, name='virtual-usb', daemon=True)
+                self._worker.start()
+            self._queue.append(_Pending(transfer_p, device, deadline))
+            self._events.notify_all()
+        return usb.LIBUSB_SUCCESS
+
+    def cancel_transfer(self, transfer_p):
+        with self._lock:
+            for pending in list(self._queue):
+                if pending is not None and _address(pending.transfer_p) == _address(transfer_p):
+                    self._queue.remove(pending)
+                    self._finish(pending, usb.LIBUSB_TRANSFER_CANCELLED)
+                    return usb.LIBUSB_SUCCESS
+        return usb.LIBUSB_ERROR_NOT_FOUND
+
+    def _finish(self, pending, status, actual_length=0):
+        """ Hand a handled transfer to handle_events() """
+        transfer = pending.transfer_p.contents
+        transfer.status = status
+        transfer.actual_length = actual_length
+        pending.ready_at = time.monotonic() + self.round_trip
+        with self._lock:
+            self._completed.append(pending)
+            self._events.notify_all()
+
+    def _run_worker(self):
+        """ Handle queued transfers in submission order, interrupt IN transfers wait for a report. """
+        while True:
+            with self._lock:
+                self._events.wait_for(lambda: self._queue)
+                pending = self._queue.popleft()
+                if pending is None:
+                    return
+                if pending.device not in self.devices:
+                    self._finish(pending, usb.LIBUSB_TRANSFER_NO_DEVICE)
+                    continue
+                transfer = pending.transfer_p.contents
+                if transfer.type == usb.LIBUSB_TRANSFER_TYPE_INTERRUPT and transfer.endpoint & usb.LIBUSB_ENDPOINT_IN \
+                        and not pending.device.pending_reports(transfer.endpoint):
+                    if pending.deadline is not None and time.monotonic() >= pending.deadline:
+                        self._finish(pending, usb.LIBUSB_TRANSFER_TIMED_OUT)
+                    else:
+                        # Wait for a report, without holding up transfers to other endpoints.
+                        self._queue.append(pending)
+                        if all(p is not None and p.transfer_p.contents.type == usb.LIBUSB_TRANSFER_TYPE_INTERRUPT
+                               for p in self._queue):
+                            self._events.wait(0.001)
+                    continue
+
+            with pending.device._lock:
+                if self.latency:
+                    time.sleep(self.latency)
+                self._handle(pending)
+
+    def _handle(self, pending):
+        """ Run a transfer against its device """
+        transfer = pending.transfer_p.contents
+        device = pending.device
+        buffer = ct.cast(transfer.buffer, ct.c_void_p).value
+
+        if transfer.type == usb.LIBUSB_TRANSFER_TYPE_CONTROL:
+            setup = usb.control_setup.from_address(buffer)
+            data_address = buffer + usb.LIBUSB_CONTROL_SETUP_SIZE
+            if setup.bmRequestType & usb.LIBUSB_ENDPOINT_IN:
+                ret, received = device.control(setup.bmRequestType, setup.bRequest, setup.wValue, setup.wIndex,
+                                               setup.wLength)
+                ct.memmove(data_address, received, len(received))
+            else:
+                ret, received = device.control(setup.bmRequestType, setup.bRequest, setup.wValue, setup.wIndex,
+                                               ct.string_at(data_address, setup.wLength))
+                received = b'\x00' * setup.wLength
+            if ret < 0:
+                self._finish(pending, usb.LIBUSB_TRANSFER_STALL)
+            else:
+                self._finish(pending, usb.LIBUSB_TRANSFER_COMPLETED, len(received))
+        elif transfer.endpoint & usb.LIBUSB_ENDPOINT_IN:
+            report = device.interrupt_in(transfer.endpoint)[:transfer.length]
+            ct.memmove(buffer, report, len(report))
+            self._finish(pending, usb.LIBUSB_TRANSFER_COMPLETED, len(report))
+        else:
+            ret = device.interrupt_out(transfer.endpoint, ct.string_at(buffer, transfer.length))
+            self._finish(pending, usb.LIBUSB_TRANSFER_COMPLETED if ret == usb.LIBUSB_SUCCESS
+                         else usb.LIBUSB_TRANSFER_STALL, transfer.length if ret == usb.LIBUSB_SUCCESS else 0)
+
+    def handle_events_timeout_completed(self, ctx, tv_ref, completed):
+        tv = ct.cast(tv_ref, ct.POINTER(usb.timeval)).contents
+        end = time.monotonic() + tv.tv_sec + tv.tv_usec / 1000000
+
+        ready = list()
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                ready = [p for p in self._completed if p.ready_at <= now]
+                if ready or self._interrupted or now >= end:
+                    break
+                waits = [p.ready_at for p in self._completed] + [end]
+                self._events.wait(min(waits) - now)
+            for pending in ready:
+                self._completed.remove(pending)
+            self._interrupted = False
+
+        # Call the completion callbacks outside the lock, like libusb they may submit new transfers.
+        for pending in ready:
+            pending.transfer_p.contents.callback(pending.transfer_p)
+        return usb.LIBUSB_SUCCESS
+
+    def interrupt_event_handler(self, ctx):
+        with self._lock:
+            self._interrupted = True
+            self._events.notify_all()
@@ -3,20 +3,21 @@
 # file 'LICENSE', which is part of this source code package.
 #
 import ctypes as ct
-import json
 import logging
 
 from python_easy_json import JSONObject
 from ultimarc import translate_gettext as _
-from ultimarc.devices._device import USBDeviceHandle, USBRequestCode
-from ultimarc.devices._mappings import get_ipac_series_macro_mapping_index, get_ipac_series_mapping_key, \
-    get_ipac_series_debounce_key, IPACSeriesMapping, IPACSeriesDebounce
-from ultimarc.devices._structures import PacHeaderStruct, PacStruct, PacConfigUnion, LEDConfigStruct
+from ultimarc.devices._device import USBRequestCode
+from ultimarc.devices._led_sequencer import LEDAnimation, LEDSequencer
+from ultimarc.devices._pac import PacDevice, PacLayout, fill
+from ultimarc.devices._structures import LEDConfigStruct
 
 _logger = logging.getLogger('ultimarc')
 
 ULTIMATE_IO_RESOURCE_TYPES = ['ultimate-io-pin', 'ultimate-io-led']
 
+ULTIMATE_IO_LED_COUNT = 96
+
 # Pin mapping for ultimate-io device
 # code_index: Normal action
 # alternate_code_index: Alternate action
@@ -73,125 +74,25 @@ PinMapping = {
     '2coin': (33, 83, 133)
 }
 
+LAYOUT = PacLayout('ultimate-io', 'ultimate-io-pin', 'ultimate-io-pin.schema', PinMapping, macro_start=164,
+                   macro_max_size=87,
+                   defaults={13: 0xff, 15: 0xff, 63: 0xff, 65: 0xff,
+                             **fill(100, 149, 0x01, skip=(108, 109, 113, 115, 116, 118, 120, 122, 139)), 157: 0x7f},
+                   shift_value=0x40, shift_detect=(0x41, 0x40), paclink=False)
+
 
-class UltimateIODevice(USBDeviceHandle):
+class UltimateIODevice(PacDevice):
     """ Manage an ultimate-io device """
     class_id = 'ultimate-io'
     class_descr = _('ULTIMATE IO')
-    interface = 2
-    ULTIMATEIO_INDEX = ct.c_uint16(0x02)
-
-    # Each macro starts with control character e0 - fe.  Total of 30 macros possible
-    # overall total macro characters is 56
-    MACRO_MAX_COUNT = 30
-
-    # These two values need to add up to 251
-    MACRO_MAX_SIZE = 87
-    MACRO_START_INDEX = 164
-
-    def get_device_config(self, indent=None, file=None):
-        """ Return a json string of the device configuration """
-        config = self.read_device()
-        json_obj = self.to_json_str(config)
-        if file:
-            if self.write_to_file(json_obj, file, indent):
-                return _('Wrote ultimate-io configuration to ' + file)
-            else:
-                return _('Failed to write ultimate-io configuration to file.')
-        else:
-            return json.dumps(json_obj, indent=indent) if config else None
-
-    def read_device(self):
-        """ Return the configuration of the connected ultimate-io """
-        request = PacHeaderStruct(0x59, 0xdd, 0x0f, 0)
-        ret = self.write(USBRequestCode.SET_CONFIGURATION, int(0x03), self.ULTIMATEIO_INDEX,
-                         request, ct.sizeof(request))
-        return self.read_interrupt(0x84, PacStruct()) if ret else None
-
-    def to_json_str(self, ultimate_struct):
-        """ Converts a PacStruct to a json object """
-        json_obj = {'schemaVersion': 2.0, 'resourceType': 'ultimate-io-pin', 'deviceClass': self.class_id}
-
-        # header configuration
-        header = PacConfigUnion()
-        header.asByte = ultimate_struct.header.byte_4
-
-        json_obj['debounce'] = get_ipac_series_debounce_key(header.config.debounce)
-
-        # macros
-        macros = self._create_macro_array_(ultimate_struct)
-        if len(macros):
-            json_obj['macros'] = macros
-
-        # pins
-        pins = []
-        for key in PinMapping:
-            action_index, alternate_action_index, shift_index = PinMapping[key]
-            pin = {}
-            if ultimate_struct.bytes[action_index]:
-                pin['name'] = key
-                pin['action'] = get_ipac_series_mapping_key(ultimate_struct.bytes[action_index])
-                if pin['action'] is None:
-                    mi = get_ipac_series_macro_mapping_index(ultimate_struct.bytes[action_index])
-                    if mi is not None:
-                        pin['action'] = macros[mi]['name']
-                    else:
-                        _logger.debug(_(f'{key} action ({hex(ultimate_struct.bytes[action_index])})is not a valid value'))
-                if ultimate_struct.bytes[alternate_action_index]:
-                    alt_action = get_ipac_series_mapping_key(ultimate_struct.bytes[alternate_action_index])
-                    if alt_action is None:
-                        mi = get_ipac_series_macro_mapping_index(ultimate_struct.bytes[alternate_action_index])
-                        if mi is not None:
-                            pin['alternate_action'] = macros[mi]['name']
-                    else:
-                        pin['alternate_action'] = alt_action
-                if ultimate_struct.bytes[shift_index] == 0x41:
-                    pin['shift'] = True
-                pins.append(pin)
-        json_obj['pins'] = pins
-
-        return json_obj if self.validate_config(json_obj, 'ultimate-io-pin.schema') else None
-
-    @classmethod
-    def _create_macro_array_(cls, pac_struct):
-        # macros
-        macros = []
-        macro_start = 0xe0
-        macro_index = 1
-
-        y = 0
-        for x in range(cls.MACRO_START_INDEX, len(pac_struct.bytes)):
-            if x >= y:
-                macro = {}
-                if pac_struct.bytes[x]:
-                    if pac_struct.bytes[x] == macro_start:
-                        macro['name'] = f'#{macro_index}'
-                        macro_start += 1
-                        macro_index += 1
-
-                        action = []
-                        for y in range(x + 1, len(pac_struct.bytes)):
-                            # check that the value isn't zero and not the start of the next macro
-                            if pac_struct.bytes[y] and pac_struct.bytes[y] != macro_start:
-                                action.append(get_ipac_series_mapping_key(pac_struct.bytes[y]))
-                            else:
-                                macro['action'] = action
-                                macros.append(macro)
-                                break
-                else:
-                    # No more macros defined, end the loop
-                    break
-        return macros
-
-    @classmethod
-    def write_to_file(cls, data: dict, file_path, indent=None):
-        try:
-            with open(file_path, 'w') as h:
-                json.dump(data, h, indent=indent)
-                return True
-        except FileNotFoundError as err:
-            _logger.debug(err)
-            return False
+    layout = LAYOUT
+
+    _leds_ = None  # bytearray of the LED intensities last sent, None if not known.
+
+    def _forget_state_(self):
+        """ The LED intensities last sent are no longer known """
+        super()._forget_state_()
+        self._leds_ = None
 
     def set_led_config(self, config_file):
         """ Write a new LED configuration to the current UltimateUI device """
@@ -204,157 +105,140 @@ class UltimateIODevice(USBDeviceHandle):
         if not valid_config:
             return False
 
+        messages = self._create_led_messages_(valid_config)
+        if messages is None:
+            return False
+
+        return self._send_led_messages_([(data.action, data.value) for data in messages])
+
+    def _create_led_messages_(self, valid_config: dict):
+        """
+        Create the LED messages of a configuration.
+        :param valid_config: config dict, validated against the base schema.
+        :return: list of LEDConfigStruct or None if the configuration is not valid.
+        """
         config = JSONObject(valid_config)
 
         if config.deviceClass != 'ultimate-io':
             _logger.error(_('Configuration device class is not "ultimate-io".'))
-            return False
+            return None
 
-        if config.resourceType == 'ultimate-io-led':
-            if not self.validate_config(config, 'ultimate-io-led.schema'):
-                return False
+        if not self.validate_config(valid_config, 'ultimate-io-led.schema'):
+            return None
 
+        messages = list()
         if config.allIntensities.active:
-            self.set_all_led_intensities(config.allIntensities.value)
+            messages.append(self._create_led_device_message_(0x80, config.allIntensities.value))
         else:
             for intensity in config.intensities:
-                self.set_led_intensity(intensity.led, intensity.value)
+                messages.append(self._create_led_device_message_(intensity.led, intensity.value))
 
         try:
             if config.randomState:
-                self.set_led_random_state()
+                messages.append(self._create_led_device_message_(0x89, 0))
 
             if config.fadeRate:
-                self.set_led_fade_rate(config.fadeRate)
+                messages.append(self._create_led_device_message_(0xc0, config.fadeRate))
         except AttributeError:
             None
 
-        return True
+        return messages
+
+    def _compile_config_(self, config_file):
+        """ Encode a pin configuration as PacStruct bytes, or an LED configuration as LED messages """
+        valid_config = self.validate_config_base(config_file, ULTIMATE_IO_RESOURCE_TYPES)
+        if not valid_config:
+            return None
+        if valid_config['resourceType'] != 'ultimate-io-led':
+            return super()._compile_config_(config_file)
+
+        messages = self._create_led_messages_(valid_config)
+        return ('ultimate-io-led', b''.join(bytes(data) for data in messages)) if messages is not None else None
+
+    def _send_payload_(self, kind, payload):
+        if kind != 'ultimate-io-led':
+            return super()._send_payload_(kind, payload)
+
+        size = ct.sizeof(LEDConfigStruct)
+        return self._send_led_messages_([(payload[x], payload[x + 1]) for x in range(0, len(payload), size)])
+
+    def set_led_frame(self, intensities):
+        """
+        Set the intensity of every LED, only the LEDs that changed since the last frame are sent. When most
+        LEDs change, the all intensities command sets the most common value first.
+        :param intensities: 96 intensity values between 0 and 255, bytes or a list, LED 1 first.
+        :return: True if successful otherwise False.
+        """
+        frame = bytes(intensities)
+        if len(frame) != ULTIMATE_IO_LED_COUNT:
+            raise ValueError(_('LED frame must have') + f' {ULTIMATE_IO_LED_COUNT} ' + _('intensity values'))
+
+        leds = self._leds_
+        changed = [(x + 1, value) for x, value in enumerate(frame) if leds is None or leds[x] != value]
+        value = max(set(frame), key=frame.count)
+        bulk = [(0x80, value)] + [(x + 1, v) for x, v in enumerate(frame) if v != value]
+        return self._send_led_messages_(bulk if len(bulk) < len(changed) else changed)
+
+    def play_led_animation(self, animation: LEDAnimation):
+        """
+        Start playing an LED animation on a scheduler thread, see _led_sequencer.py.
+        The device handle must not be used by other threads until the sequencer has stopped.
+        :param animation: LEDAnimation object.
+        :return: started LEDSequencer object.
+        """
+        sequencer = LEDSequencer(self, animation)
+        sequencer.start()
+        return sequencer
+
+    def _send_led_messages_(self, messages):
+        """
+        Send LED messages as one batch of queued transfers, intensities the LEDs already have are skipped.
+        :param messages: list of (action, value) tuples, see LEDConfigStruct.
+        :return: True if successful otherwise False.
+        """
+        leds = bytearray(self._leds_) if self._leds_ is not None else None
+        packets = list()
+        for action, value in messages:
+            if 1 <= action <= ULTIMATE_IO_LED_COUNT:
+                if leds is not None and leds[action - 1] == value:
+                    continue
+                if leds is not None:
+                    leds[action - 1] = value
+            elif action == 0x80:
+                if leds is not None and leds.count(value) == ULTIMATE_IO_LED_COUNT:
+                    continue
+                leds = bytearray([value]) * ULTIMATE_IO_LED_COUNT
+            elif action == 0x89:
+                leds = None
+            packets.append(bytes([action, value, 0x00, 0x00]))
+
+        self._forget_payloads_('ultimate-io-led')
+        if not packets:
+            self._leds_ = leds
+            return True
+
+        # Each 4 byte block is sent as its own report, the same packet write() sends for one LEDConfigStruct.
+        data = b''.join(packets)
+        ok = self.write_alt(USBRequestCode.SET_CONFIGURATION, int(0x03), self.PAC_INDEX,
+                            (ct.c_ubyte * len(data)).from_buffer_copy(data), len(data))
+        self._leds_ = leds if ok else None
+        return bool(ok)
 
     def set_all_led_intensities (self, value):
         """ Set all LED intensities with one value """
-        data = self._create_led_device_message_(0x80, value)
-
-        return self.write(USBRequestCode.SET_CONFIGURATION, int(0x03), self.ULTIMATEIO_INDEX,
-                          data, ct.sizeof(data))
+        return self._send_led_messages_([(0x80, value)])
 
     def set_led_intensity(self, led, value):
         """ Set the intensity for an LED """
-        data = self._create_led_device_message_(led, value)
-
-        return self.write(USBRequestCode.SET_CONFIGURATION, int(0x03), self.ULTIMATEIO_INDEX,
-                          data, ct.sizeof(data))
+        return self._send_led_messages_([(led, value)])
 
     def set_led_random_state(self):
         """ Set the LEDs to a random states """
-        data = self._create_led_device_message_(0x89, 0)
-
-        return self.write(USBRequestCode.SET_CONFIGURATION, int(0x03), self.ULTIMATEIO_INDEX,
-                          data, ct.sizeof(data))
+        return self._send_led_messages_([(0x89, 0)])
 
     def set_led_fade_rate(self, rate):
         """ Set the fade rate for the LEDs """
-        data = self._create_led_device_message_(0xc0, rate)
-
-        return self.write(USBRequestCode.SET_CONFIGURATION, int(0x03), self.ULTIMATEIO_INDEX,
-                          data, ct.sizeof(data))
-
-    def set_config(self, config_file, use_current):
-        """ Write a new pin configuration to the current UltimateIO device """
-
-        # Get the current configuration from the device
-        cur_config = self.read_device() if use_current else None
-
-        # Insert the new configuration into the PacStruct data object
-        res, data = self._create_device_message_(config_file, cur_config)
-        return self.write_alt(USBRequestCode.SET_CONFIGURATION, int(0x03), self.ULTIMATEIO_INDEX, data, ct.sizeof(data)) \
-            if res else False
-
-    def set_pin(self, pin_config):
-        """ Write a pin to the current ultimate-io device """
-        pin = pin_config[0]
-        # Get the current configuration from the device
-        cur_config = self.read_device()
-        macros = self._create_macro_array_(cur_config)
-
-        action_index, alternate_action_index, shift_index = PinMapping[pin]
-        action = pin_config[1].upper()
-        cur_config.bytes[action_index] = 0
-        if action in IPACSeriesMapping:
-            cur_config.bytes[action_index] = IPACSeriesMapping[action]
-        else:
-            macro_val = 0xe0
-            for x in macros:
-                if x['name'].upper() == action:
-                    cur_config.bytes[action_index] = macro_val
-                else:
-                    macro_val += 1
-        if cur_config.bytes[action_index] == 0:
-            _logger.info(_(f'{pin} action "{action}" is not a valid value'))
-
-        # Pin alternate action
-        alternate_action = pin_config[2].upper()
-        # Empty string means no value
-        if len(alternate_action) > 0:
-            cur_config.bytes[alternate_action_index] = 0
-            if alternate_action in IPACSeriesMapping:
-                cur_config.bytes[alternate_action_index] = IPACSeriesMapping[alternate_action]
-            else:
-                macro_val = 0xe0
-                for x in macros:
-                    if x['name'].upper() == alternate_action:
-                        cur_config.bytes[alternate_action_index] = macro_val
-                    else:
-                        macro_val += 1
-            if cur_config.bytes[alternate_action_index] == 0:
-                _logger.info(_(f'{pin} alternate action "{alternate_action}" is not a valid value'))
-        else:
-            # No Alternate Value
-            cur_config.bytes[alternate_action_index] = 0
-
-        # Pin designated as shift
-        cur_config.bytes[shift_index] = 0x41 if pin_config[3].lower() in ['true', '1', 't', 'y'] else 0x01
-
-        # Header - Setup to send back to device
-        cur_config.header.type = 0x50
-        cur_config.header.byte_2 = 0xdd
-        cur_config.header.byte_3 = 0x0f
-
-        return self.write_alt(USBRequestCode.SET_CONFIGURATION, int(0x03), self.ULTIMATEIO_INDEX,
-                              cur_config, ct.sizeof(cur_config))
-
-    def set_debounce(self, debounce):
-        """ Set debounce value to the current ultimate-io device """
-        val = debounce.lower()
-        if val in IPACSeriesDebounce:
-            # Get the current configuration from the device
-            cur_config = self.read_device()
-
-            header = PacConfigUnion()
-            header.asByte = cur_config.header.byte_4
-            header.config.debounce = IPACSeriesDebounce[val]
-
-            cur_config.header.byte_4 = header.asByte
-        else:
-            _logger.info(_(f'"{debounce}" is not a valid debounce value.'))
-            _logger.info(_(f'Valid values are: {list(IPACSeriesDebounce.keys())}'))
-            return None
-
-        # Header - Setup to send back to device
-        cur_config.header.type = 0x50
-        cur_config.header.byte_2 = 0xdd
-        cur_config.header.byte_3 = 0x0f
-
-        return self.write_alt(USBRequestCode.SET_CONFIGURATION, int(0x03), self.ULTIMATEIO_INDEX,
-                              cur_config, ct.sizeof(cur_config))
-
-    def set_config_ui(self, config_dict: dict):
-        """ Write a new configuration from UI to the current ultimate-io device """
-
-        # Insert the new configuration into the PacStruct data object
-        res, data = self._create_device_struct_(config_dict)
-        return self.write_alt(USBRequestCode.SET_CONFIGURATION, int(0x03), self.ULTIMATEIO_INDEX, data, ct.sizeof(data)) \
-            if res else False
+        return self._send_led_messages_([(0xc0, rate)])
 
     def _create_led_device_message_(self, action, value):
         """ Create led message to be sent to the device """
@@ -364,144 +248,3 @@ class UltimateIODevice(USBDeviceHandle):
         data.value = value
 
         return data
-
-    def _create_device_message_(self, config_file: str, cur_device_config=None):
-        """ Create the message to be sent to the device """
-
-        # List of possible 'resourceType' values in the config file for an ultimate-io device.
-        resource_types = ['ultimate-io-pin']
-
-        # Validate against the base schema.
-        valid_config = self.validate_config_base(config_file, resource_types)
-        if not valid_config:
-            return False, None
-
-        return self._create_device_struct_(valid_config, cur_device_config)
-
-    def _create_device_struct_(self, json_config: dict, cur_device_config=None):
-        data = cur_device_config if cur_device_config else PacStruct()
-        config = JSONObject(json_config)
-
-        if config.deviceClass != 'ultimate-io':
-            _logger.error(_('Configuration device class is not "ultimate-io".'))
-            return False, None
-
-        # Determine which config resource type we have.
-        if config.resourceType == 'ultimate-io-pin':
-            return self._create_pin_data_(config, cur_device_config, data)
-
-        return False, None
-
-    def _create_pin_data_(self, config, cur_device_config, data):
-        if not self.validate_config(config, 'ultimate-io-pin.schema'):
-            return False, None
-        # Prep the data structure
-        data.bytes[13] = 0xff
-        data.bytes[15] = 0xff
-        data.bytes[63] = 0xff
-        data.bytes[65] = 0xff
-        for x in range(100, 149):
-            data.bytes[x] = 0x01
-        # set these back to 0
-        data.bytes[108] = 0
-        data.bytes[109] = 0
-        data.bytes[113] = 0
-        data.bytes[115] = 0
-        data.bytes[116] = 0
-        data.bytes[118] = 0
-        data.bytes[120] = 0
-        data.bytes[122] = 0
-        data.bytes[139] = 0
-        data.bytes[157] = 0x7f
-        # Header
-        data.header.type = 0x50
-        data.header.byte_2 = 0xdd
-        data.header.byte_3 = 0x0f
-        # Header configuration options
-        header = PacConfigUnion()
-        val = config.debounce.lower()
-        if val in IPACSeriesDebounce:
-            header.config.debounce = IPACSeriesDebounce[val]
-        else:
-            _logger.info(_(f'"{config.debounce}" is not a valid debounce value'))
-            return False, None
-        # set data header
-        data.header.byte_4 = header.asByte
-        # bug: Current limitation, macros are not kept between configurations.  To prevent lingering macro
-        #   values in pac structure
-        # Clear current macro structure
-        if cur_device_config is not None:
-            for x in range(self.MACRO_START_INDEX, self.MACRO_MAX_COUNT):
-                data.bytes[x] = 0
-        # key: Macro name value: macro value (e0 - fe)
-        macro_dict = {}
-        try:
-            # Macros
-            # Each macro starts with control character e0 - fe.  Total of 30 macros possible
-            # overall total macro characters is 56
-            cur_size_count = 0
-            cur_macro = 0xe0
-            cur_position = self.MACRO_START_INDEX
-
-            if len(config.macros) > self.MACRO_MAX_COUNT:
-                _logger.debug(_(f'There are more than {self.MACRO_MAX_COUNT} '
-                                f'macros defined for the ultimate-io device'))
-                return False, None
-
-            for macro in config.macros:
-                if len(macro.action) > 0:
-                    # Set the start point of the new macro
-                    data.bytes[cur_position] = cur_macro
-                    macro_dict[macro.name.upper()] = cur_macro
-
-                    cur_position += 1
-                    cur_macro += 1
-                    cur_size_count += 1
-
-                    for action in macro.action:
-                        if action.upper() in IPACSeriesMapping:
-                            data.bytes[cur_position] = IPACSeriesMapping[action.upper()]
-                            cur_position += 1
-                            cur_size_count += 1
-
-                        if cur_size_count > self.MACRO_MAX_SIZE:
-                            _logger.debug(_(f'There are more than {self.MACRO_MAX_SIZE} '
-                                            f'macro values defined for the ultimate-io device'))
-                            return False, None
-        except AttributeError:
-            pass
-        # Pins
-        # Places the action value, alternate action value and if assigned as shift key
-        # 0x40 in the shift position for all pins designated as shift pins in json config
-        for pin in config.pins:
-            try:
-                action_index, alternate_action_index, shift_index = PinMapping[pin.name]
-                action = pin.action.upper()
-                if action in IPACSeriesMapping:
-                    data.bytes[action_index] = IPACSeriesMapping[action]
-                elif action in macro_dict:
-                    data.bytes[action_index] = macro_dict[action]
-                else:
-                    _logger.info(_(f'{pin.name} action "{action}" is not a valid value'))
-
-                try:
-                    alternate_action = pin.alternate_action.upper()
-                    if alternate_action in IPACSeriesMapping:
-                        data.bytes[alternate_action_index] = IPACSeriesMapping[alternate_action]
-                    elif alternate_action in macro_dict:
-                        data.bytes[alternate_action_index] = macro_dict[alternate_action]
-                    elif alternate_action:
-                        _logger.info(_(f'{pin.name} alternate action "{alternate_action}" is not a valid value'))
-                except AttributeError:
-                    pass
-
-                # Pin designated as shift
-                try:
-                    if pin.shift:
-                        data.bytes[shift_index] = 0x40
-                except AttributeError:
-                    pass
-
-            except KeyError:
-                _logger.debug(_(f'Pin {pin.name} does not exists in ultimate-io device'))
-        return True, data
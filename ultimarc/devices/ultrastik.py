@@ -11,6 +11,7 @@ from python_easy_json import JSONObject
 from ultimarc import translate_gettext as _
 from ultimarc.devices._device import USBDeviceHandle, USBRequestCode, USBRequestType, USBRequestRecipient
 from ultimarc.devices._structures import UltraStikStruct
+from ultimarc.devices._ultrastik_maps import UltraStikMapCache, default_map_cache
 
 _logger = logging.getLogger('ultimarc')
 
@@ -59,6 +60,54 @@ DIRECTION_MAP = {
 }
 
 
+def create_config_struct(config: JSONObject, flash):
+    """
+    Encode an 'ultrastik-config' configuration.
+    :param config: JSON object with configuration.
+    :param flash: flash byte value, the pre 2015 joysticks only store the configuration when it is 0x00.
+    :return: UltraStikStruct
+    """
+    data = UltraStikStruct()
+    data.keepAnalog = 0x11 if config.keepAnalog else 0x50  # Keep Analog: true on(0x11) else false off(0x50)
+    data.mapSize = 9
+    data.restrictor = 0x09 if config.restrictor else 0x10
+    data.borders = (ct.c_uint8 * 8)(*config.borders)
+    data.map = (ct.c_uint8 * 81)(*[DIRECTION_MAP[v] for v in config.map])
+    data.flash = flash
+    data.reserved = (ct.c_uint8 * 3)(*[0, 0, 0])
+    return data
+
+
+def compile_config_file(dev_h, config_file):
+    """
+    Validate an 'ultrastik-config' configuration file.
+    :param dev_h: UltraStik device class or handle, used for validation.
+    :param config_file: Absolute path to configuration json file.
+    :return: JSON object or None if the configuration is not valid.
+    """
+    config = dev_h.validate_config_base(config_file, ['ultrastik-config'])
+    if not config or not dev_h.validate_config(config, 'ultrastik-config.schema'):
+        return None
+    return JSONObject(config)
+
+
+def switch_map(dev_h, name, maps: UltraStikMapCache = None):
+    """
+    Send a compiled map to a joystick, nothing is sent if the joystick already holds the map.
+    :param dev_h: opened UltraStik device handle.
+    :param name: map name, see UltraStikMapCache.names().
+    :param maps: UltraStikMapCache object, defaults to default_map_cache().
+    :return: True if successful otherwise False.
+    """
+    payload = (maps or default_map_cache()).payload(type(dev_h), name)
+    if payload is None:
+        return False
+    if dev_h.payload_applied('ultrastik-config', payload):
+        _logger.debug(_('UltraStik map already applied') + f' ({name}).')
+        return True
+    return dev_h.apply_payload('ultrastik-config', payload)
+
+
 class UltraStikPre2015Device(USBDeviceHandle):
     """
     Manage an UltraStik 360 Joystick (Pre-2015)
@@ -99,16 +148,26 @@ class UltraStikPre2015Device(USBDeviceHandle):
         """ Set the joystick configuration """
 
         config = JSONObject(self.validate_config_base(config_file, USTIK_RESOURCE_TYPES))
-
-        data = UltraStikStruct()
-        data.keepAnalog = 0x11 if config.keepAnalog else 0x50  # Keep Analog: true on(0x11) else false off(0x50)
-        data.mapSize = 9
-        data.restrictor = 0x09 if config.restrictor else 0x10
-        data.borders = (ct.c_uint8 * 8)(*config.borders)
-        data.map = (ct.c_uint8 * 81)(*[DIRECTION_MAP[v] for v in config.map])
-        data.flash = 0x00 if config.flash else 0xFF
-        data.reserved = (ct.c_uint8 * 3)(*[0, 0, 0])
-
+        return self._write_config_struct_(create_config_struct(config, 0x00 if config.flash else 0xFF))
+
+    def switch_map(self, name, maps: UltraStikMapCache = None):
+        """ Send a compiled map, see switch_map() """
+        return switch_map(self, name, maps)
+
+    def _compile_config_(self, config_file):
+        """ Encode a configuration file as UltraStikStruct bytes """
+        config = compile_config_file(self, config_file)
+        return ('ultrastik-config', bytes(create_config_struct(config, 0x00 if config.flash else 0xFF))) \
+            if config else None
+
+    def _send_payload_(self, kind, payload):
+        if kind == 'ultrastik-config':
+            return self._write_config_struct_(UltraStikStruct.from_buffer_copy(payload))
+        return super()._send_payload_(kind, payload)
+
+    def _write_config_struct_(self, data):
+        """ Send an UltraStikStruct configuration to the joystick """
+        self._forget_payloads_()
         resp_2 = resp_3 = resp_4 = False
         payload = (ct.c_uint8 * USTIK_PRE_MESG_LENGTH)(0)
 
@@ -118,7 +177,8 @@ class UltraStikPre2015Device(USBDeviceHandle):
         # We need to write 32 bytes here.
         for x in range(3):
             ct.memmove(ct.addressof(payload), ct.byref(data, USTIK_PRE_MESG_LENGTH * x), USTIK_PRE_MESG_LENGTH)
-            _logger.debug(f"  config data block {x+1}: {' '.join('%02X' % b for b in payload)}")
+            if _logger.isEnabledFor(logging.DEBUG):
+                _logger.debug(f"  config data block {x+1}: {' '.join('%02X' % b for b in payload)}")
 
             resp_2 = self.write(USBRequestCodePre2015.ULTRASTIK_EB, 0x0, USTIK_PRE_INTERFACE,
                                 payload, USTIK_PRE_MESG_LENGTH,
@@ -168,15 +228,24 @@ class UltraStikDevice(USBDeviceHandle):
         """ Set the joystick configuration """
 
         config = JSONObject(self.validate_config_base(config_file, USTIK_RESOURCE_TYPES))
+        return self._write_config_struct_(create_config_struct(config, 0x00))
+
+    def switch_map(self, name, maps: UltraStikMapCache = None):
+        """ Send a compiled map, see switch_map() """
+        return switch_map(self, name, maps)
+
+    def _compile_config_(self, config_file):
+        """ Encode a configuration file as UltraStikStruct bytes """
+        config = compile_config_file(self, config_file)
+        return ('ultrastik-config', bytes(create_config_struct(config, 0x00))) if config else None
 
-        data = UltraStikStruct()
-        data.keepAnalog = 0x11 if config.keepAnalog else 0x50  # Keep Analog: true on(0x11) else false off(0x50)
-        data.mapSize = 9
-        data.restrictor = 0x09 if config.restrictor else 0x10
-        data.borders = (ct.c_uint8 * 8)(*config.borders)
-        data.map = (ct.c_uint8 * 81)(*[DIRECTION_MAP[v] for v in config.map])
-        data.flash = 0x00
-        data.reserved = (ct.c_uint8 * 3)(*[0, 0, 0])
+    def _send_payload_(self, kind, payload):
+        if kind == 'ultrastik-config':
+            return self._write_config_struct_(UltraStikStruct.from_buffer_copy(payload))
+        return super()._send_payload_(kind, payload)
 
+    def _write_config_struct_(self, data):
+        """ Send an UltraStikStruct configuration to the joystick """
+        self._forget_payloads_()
         return self.write_alt(USBRequestCode.SET_CONFIGURATION, 0x0, USTIK_INTERFACE, data, ct.sizeof(data))
 
@@ -9,6 +9,8 @@ from enum import IntEnum
 
 from python_easy_json import JSONObject
 from ultimarc import translate_gettext as _
+from ultimarc.devices._button_state import STATE_REPORT_ID, ButtonWatcher
+from ultimarc.devices._color_stream import DEFAULT_RATE, ColorStream
 from ultimarc.devices._device import USBDeviceHandle, USBRequestCode
 from ultimarc.devices._mappings import IPACSeriesMapping, get_ipac_series_mapping_key
 from ultimarc.devices._structures import UltimarcStruct
@@ -16,6 +18,7 @@ from ultimarc.devices._structures import UltimarcStruct
 _logger = logging.getLogger('ultimarc')
 
 USBButtonReportID = 0x0200
+USBButtonStateReportID = 0x0100 | STATE_REPORT_ID  # Input report type, state report.
 USBButtonWIndex = 0x0
 PACKETSIZE = 64
 ROWARRAY = ct.c_uint8 * 6
@@ -88,19 +91,48 @@ class USBButtonDevice(USBDeviceHandle):
     class_descr = _('USB Button')
     interface = 0  # USB interface to write and read from.
 
+    _watcher_ = None  # ButtonWatcher object, see watch_state().
+
     def get_state(self):
         """
-        Return the USB button click state.
+        Return the USB button click state, the last state reported if the button is being watched.
         :return: 1 if clicked otherwise 0, None if error.
         """
-        # TODO: Can't seem to make this work to return the button click state.  See USBButtonGetState() in PacDrive.cpp.
-        data = USBButtonColorStruct(0x02, RGBValueStruct(0x0, 0x0, 0x0))
-        ret = self.read(USBRequestCode.CLEAR_FEATURE, USBButtonReportID, USBButtonWIndex, data, ct.sizeof(data))
+        watcher = self._watcher_
+        if watcher is not None and watcher.running and watcher.pressed is not None:
+            return int(watcher.pressed)
+
+        # Request the state input report, the state is the first byte after the report id.
+        data = USBButtonColorStruct(STATE_REPORT_ID, RGBValueStruct(0x0, 0x0, 0x0))
+        ret = self.read(USBRequestCode.CLEAR_FEATURE, USBButtonStateReportID, USBButtonWIndex, data,
+                        ct.sizeof(data))
         if ret:
-            return data.red
+            return data.rgb.red & 0x01
         _logger.error(_('Failed to read usb button state.'))
         return None
 
+    def watch_state(self, callback=None, queue=None):
+        """
+        Start publishing press and release events, see _button_state.py. Watching stops when the interface is
+        released or the returned watcher is stopped.
+        :param callback: optional callable taking a ButtonEvent, called from the USB event thread.
+        :param queue: optional queue.Queue object events are put on.
+        :return: started ButtonWatcher object or None if error.
+        """
+        if self._watcher_ is not None:
+            self._watcher_.stop()
+        watcher = ButtonWatcher(self, callback, queue)
+        if not watcher.start():
+            return None
+        self._watcher_ = watcher
+        return watcher
+
+    def release_interface(self):
+        if self._watcher_ is not None:
+            self._watcher_.stop()
+            self._watcher_ = None
+        super().release_interface()
+
     def set_color(self, red, green, blue):
         """
         Set USB button color, overrides the current device configuration released color.
@@ -114,8 +146,20 @@ class USBButtonDevice(USBDeviceHandle):
                 raise ValueError(_('Color argument value is invalid'))
 
         data = USBButtonColorStruct(0x01, RGBValueStruct(red, green, blue))
+        self._forget_payloads_()
         return self.write(USBRequestCode.SET_CONFIGURATION, USBButtonReportID, USBButtonWIndex, data, ct.sizeof(data))
 
+    def color_stream(self, max_rate=DEFAULT_RATE):
+        """
+        Start a color stream, colors can then be set, faded and pulsed from any thread, see _color_stream.py.
+        The device handle must not be used by other threads until the stream has stopped.
+        :param max_rate: maximum colors sent per second.
+        :return: started ColorStream object.
+        """
+        stream = ColorStream(self, max_rate)
+        stream.start()
+        return stream
+
     def get_color(self):
         """
         Return override USB button RGB color.  Will return (0, 0, 0) if the device has not yet been written
@@ -136,37 +180,63 @@ class USBButtonDevice(USBDeviceHandle):
         :param application: Permanent or temporary application of configuration to device.
         :return: True if successful otherwise False.
         """
+        message = self._create_config_message_(config_file, application)
+        if message is None:
+            return False
+        kind, data = message
+        return self._send_payload_(kind, bytes(data))
+
+    def _create_config_message_(self, config_file, application=ConfigApplication.permanent):
+        """
+        Validate a configuration file and create the message to send to the device.
+        :param config_file: Absolute path to configuration json file.
+        :param application: Permanent or temporary application of configuration to device.
+        :return: (kind, data structure) tuple or None if the configuration is not valid.
+        """
         # List of possible 'resourceType' values in the config file for a USB button.
         resource_types = ['usb-button-color', 'usb-button-config']
 
         # Validate against the base schema.
         config = JSONObject(self.validate_config_base(config_file, resource_types))
         if not config:
-            return False
+            return None
 
         if config.deviceClass != 'usb-button':
             _logger.error(_('Configuration device class is not "usb-button".'))
-            return False
+            return None
 
         # Determine which config resource type we have.
         if config.resourceType == 'usb-button-color':
             if not self.validate_config(config.to_dict(), 'usb-button-color.schema'):
-                return False
+                return None
             _logger.debug(_('Device JSON configuration passed schema validation.'))
-            data = USBButtonColorStruct(0x01,
-                                        RGBValueStruct(config.colorRGB.red, config.colorRGB.green,
-                                                       config.colorRGB.blue))
-            return self.write(USBRequestCode.SET_CONFIGURATION, USBButtonReportID, USBButtonWIndex, data,
-                              ct.sizeof(data))
+            return 'usb-button-color', USBButtonColorStruct(0x01,
+                                                            RGBValueStruct(config.colorRGB.red, config.colorRGB.green,
+                                                                           config.colorRGB.blue))
 
         # Process usb-button-config data
         if not self.validate_config(config.to_dict(), 'usb-button-config.schema'):
-            return False
+            return None
         _logger.debug(_('Device JSON configuration passed schema validation.'))
 
-        data = self.create_message(config, application)
-        return self.write_alt(USBRequestCode.SET_CONFIGURATION, 0x00, USBButtonWIndex, data,
+        return 'usb-button-config', self.create_message(config, application)
+
+    def _compile_config_(self, config_file):
+        """ Encode a configuration file as the bytes of a color or configuration message """
+        message = self._create_config_message_(config_file)
+        return (message[0], bytes(message[1])) if message else None
+
+    def _send_payload_(self, kind, payload):
+        if kind == 'usb-button-color':
+            data = USBButtonColorStruct.from_buffer_copy(payload)
+            self._forget_payloads_()
+            return self.write(USBRequestCode.SET_CONFIGURATION, USBButtonReportID, USBButtonWIndex, data,
                               ct.sizeof(data))
+        if kind == 'usb-button-config':
+            data = USBButtonConfigStruct.from_buffer_copy(payload)
+            self._forget_payloads_()
+            return self.write_alt(USBRequestCode.SET_CONFIGURATION, 0x00, USBButtonWIndex, data, ct.sizeof(data))
+        return super()._send_payload_(kind, payload)
 
     def create_message(self, config: JSONObject, application=ConfigApplication.permanent):
         """
@@ -205,28 +275,31 @@ class USBButtonDevice(USBDeviceHandle):
 
         data = USBButtonConfigStruct(application, 0xdd, action, 0x00, released_rgb, pressed_rgb, *row_keys)
 
-        _logger.debug(_(' application') + f': {application.name}')
-        _logger.debug(_(' action') + f': {config.action}')
-        _logger.debug(
-            _(' released color') + f': R({released_rgb.red}), G({released_rgb.green}), B({released_rgb.blue})')
-        _logger.debug(_(' pressed color') + f': R({pressed_rgb.red}), G({pressed_rgb.green}), B({pressed_rgb.blue})')
-        for row in debug_data:
-            _logger.debug(_(' row') + f': {", ".join(row)}')
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug(_(' application') + f': {application.name}')
+            _logger.debug(_(' action') + f': {config.action}')
+            _logger.debug(
+                _(' released color') + f': R({released_rgb.red}), G({released_rgb.green}), B({released_rgb.blue})')
+            _logger.debug(
+                _(' pressed color') + f': R({pressed_rgb.red}), G({pressed_rgb.green}), B({pressed_rgb.blue})')
+            for row in debug_data:
+                _logger.debug(_(' row') + f': {", ".join(row)}')
 
         return data
 
     def set_config_ui(self, config: JSONObject):
         """ Write the configuration from UI to the device """
         data = self.create_message(config)
+        self._forget_payloads_()
         return self.write_alt(USBRequestCode.SET_CONFIGURATION, 0x00, USBButtonWIndex, data,
                               ct.sizeof(data))
 
     def get_device_config (self, indent=None, file=None):
         """ Return a json string of the device configuration """
-        config = self.read_device()
-        json_obj = self.create_json(config)
+        config = self.read_config()
+        json_obj = self.create_json(config) if config else None
         if file:
-            if self.write_to_file(json_obj, file, indent):
+            if json_obj is not None and self.write_to_file(json_obj, file, indent):
                 return _('Wrote USB-Button configuration to ' + file)
             else:
                 return _('Failed to write USB-Button configuration to file.')
@@ -294,11 +367,25 @@ class USBButtonDevice(USBDeviceHandle):
         return config if self.validate_config(config, 'usb-button-config.schema') else None
 
     def read_device(self):
-        """ Return the configuration of the connected USBButton """
+        """ Return the configuration of the connected USBButton, None while the button is being watched """
+        # The configuration is sent on the endpoint the watcher always has a transfer pending on.
+        if self._watcher_ is not None and self._watcher_.running:
+            _logger.error(_('Unable to read the usb button configuration while watching the button state.'))
+            return None
         request = USBButtonRequestStruct(0x59, 0xdd, 0x00, 0x00)
         ret = self.write_raw(USBRequestCode.SET_CONFIGURATION, 0x200, 0x00,
                          request, ct.sizeof(request))
-        return self.read_interrupt(0x81, USBButtonConfigStruct(), False) if ret else None
+        config = self.read_interrupt(0x81, USBButtonConfigStruct(), False) if ret else None
+        if config is not None:
+            self._cache_put_('usb-button-config', bytes(config))
+        return config
+
+    def read_config(self):
+        """ Return the configuration of the connected USBButton, only reading it if the config cache has no copy """
+        cached = self._cache_get_('usb-button-config')
+        if cached is not None and len(cached) == ct.sizeof(USBButtonConfigStruct):
+            return USBButtonConfigStruct.from_buffer_copy(cached)
+        return self.read_device()
 
     @classmethod
     def write_to_file(cls, data: dict, file_path, indent=None):
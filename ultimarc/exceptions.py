@@ -32,3 +32,12 @@ class USBDeviceInterfaceNotClaimedError(Exception):
         self.dev_key = dev_key
         self.message = message
         super().__init__(f'{dev_key}: {message}')
+
+
+class USBDeviceBusyError(Exception):
+    """ Device is locked by another program. """
+
+    def __init__(self, dev_key, message=_('Device is in use by another program.')):
+        self.dev_key = dev_key
+        self.message = message
+        super().__init__(f'{dev_key}: {message}')
@@ -0,0 +1,236 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Profiles switch the configuration of several devices at once, IE: the control layout of a game.
+#
+# A profile is a json file in $XDG_CONFIG_HOME/ultimarc/profiles naming a configuration file for each device,
+# paths are relative to the profile file:
+#
+#    {
+#      "schemaVersion": 2.0,
+#      "resourceType": "profile",
+#      "devices": [
+#        {"config": "ipac2-street-fighter.json"},
+#        {"config": "ultrastik-joy4way.json", "bus": 1, "address": 5}
+#      ]
+#    }
+#
+# Compiling a profile validates each configuration and encodes it into the bytes sent to the device, for every
+# device class of the configuration 'deviceClass'. The compiled profile is kept in $XDG_CACHE_HOME/ultimarc/profiles
+# with the sha256 hash of each payload and of the source files, it is compiled again when a source file changes.
+# Applying a profile only sends the payloads a device does not already hold, see
+# USBDeviceHandle.payload_applied().
+#
+import hashlib
+import json
+import logging
+import os
+
+import fastjsonschema
+
+from ultimarc import translate_gettext as _
+from ultimarc.devices import class_id_classes
+from ultimarc.devices._validators import get_schema_validator
+from ultimarc.system_utils import cache_dir, config_dir
+
+_logger = logging.getLogger('ultimarc')
+
+COMPILED_VERSION = 1  # Increase when the compiled profile format or a payload encoding changes.
+
+
+def default_profile_dir():
+    """ Return the profile directory, $XDG_CONFIG_HOME/ultimarc/profiles """
+    return os.path.join(config_dir(), 'profiles')
+
+
+def default_compiled_dir():
+    """ Return the compiled profile directory, $XDG_CACHE_HOME/ultimarc/profiles """
+    return os.path.join(cache_dir(), 'profiles')
+
+
+def _file_hash(path):
+    """ Return the sha256 hash of a file """
+    with open(path, 'rb') as h:
+        return hashlib.sha256(h.read()).hexdigest()
+
+
+def _class_path(cls):
+    """ Return the 'module:class' name of a device class, used to find its payload """
+    return f'{cls.__module__}:{cls.__name__}'
+
+
+class ProfileStore(object):
+    """ Compiles, stores and applies profiles. """
+
+    def __init__(self, profile_dir=None, compiled_dir=None):
+        """
+        :param profile_dir: directory holding the profile files, see default_profile_dir().
+        :param compiled_dir: directory holding the compiled profiles, see default_compiled_dir().
+        """
+        self.profile_dir = profile_dir or default_profile_dir()
+        self.compiled_dir = compiled_dir or default_compiled_dir()
+
+    def names(self):
+        """ Return a sorted list of profile names """
+        try:
+            files = os.listdir(self.profile_dir)
+        except OSError:
+            return []
+        return sorted(file[:-5] for file in files if file.endswith('.json'))
+
+    def path(self, name):
+        """ Return the profile file of a profile name """
+        return os.path.join(self.profile_dir, f'{name}.json')
+
+    def compiled_path(self, name):
+        """ Return the compiled profile file of a profile name """
+        return os.path.join(self.compiled_dir, f'{name}.json')
+
+    def _read_profile_(self, name):
+        """
+        Read and validate a profile file.
+        :param name: profile name.
+        :return: profile dict or None.
+        """
+        path = self.path(name)
+        if not os.path.exists(path):
+            _logger.error(_('Unable to find profile') + f' {name} ({path}).')
+            return None
+        try:
+            with open(path) as h:
+                profile = json.loads(h.read())
+        except ValueError:
+            _logger.error(_('Profile file is not valid JSON.') + f' ({path})')
+            return None
+
+        schema, validator = get_schema_validator('profile.schema')
+        if not schema:
+            return None
+        try:
+            validator(profile)
+        except fastjsonschema.JsonSchemaException as e:
+            _logger.error(_('Profile file did not validate against the profile schema.') + f' ({path})\n{e}')
+            return None
+        return profile
+
+    def _compile_entry_(self, config_file):
+        """
+        Compile the configuration file of a profile device entry.
+        :param config_file: Absolute path to configuration json file.
+        :return: (class id, dict of device class name -> payload dict) or None.
+        """
+        try:
+            with open(config_file) as h:
+                class_id = json.loads(h.read()).get('deviceClass')
+        except (OSError, ValueError, AttributeError):
+            _logger.error(_('Unable to read configuration file') + f' {config_file}.')
+            return None
+
+        classes = class_id_classes(class_id) if isinstance(class_id, str) else []
+        if not classes:
+            _logger.error(_('Unknown device class in configuration file') + f' {config_file}.')
+            return None
+
+        payloads = dict()
+        for cls in classes:
+            compiled = cls.compile_config(config_file)
+            if compiled is None:
+                _logger.error(_('Unable to compile configuration file') + f' {config_file}.')
+                return None
+            kind, data = compiled
+            payloads[_class_path(cls)] = {'kind': kind, 'data': data.hex(), 'hash': hashlib.sha256(data).hexdigest()}
+        return class_id, payloads
+
+    def compile(self, name):
+        """
+        Compile a profile and store the compiled profile.
+        :param name: profile name.
+        :return: compiled profile dict or None if the profile is not valid.
+        """
+        profile = self._read_profile_(name)
+        if profile is None:
+            return None
+
+        path = self.path(name)
+        sources = {path: _file_hash(path)}
+        devices = list()
+        for entry in profile['devices']:
+            config_file = os.path.join(os.path.dirname(path), os.path.expanduser(entry['config']))
+            compiled = self._compile_entry_(config_file)
+            if compiled is None:
+                return None
+            class_id, payloads = compiled
+            sources[config_file] = _file_hash(config_file)
+            devices.append({'config': config_file, 'class_id': class_id, 'bus': entry.get('bus'),
+                            'address': entry.get('address'), 'payloads': payloads})
+
+        compiled = {
+            'version': COMPILED_VERSION,
+            'name': name,
+            'hash': hashlib.sha256(json.dumps(devices, sort_keys=True).encode('utf-8')).hexdigest(),
+            'sources': sources,
+            'devices': devices
+        }
+
+        # A profile can still be applied when the compiled profile can't be stored, it is compiled every time.
+        compiled_path = self.compiled_path(name)
+        try:
+            os.makedirs(self.compiled_dir, exist_ok=True)
+            with open(compiled_path + '.tmp', 'w') as h:
+                json.dump(compiled, h)
+            os.replace(compiled_path + '.tmp', compiled_path)
+        except OSError as e:
+            _logger.warning(_('Unable to store compiled profile') + f' {compiled_path}: {e}')
+
+        _logger.debug(_('Compiled profile') + f' {name}: {compiled["hash"]}.')
+        return compiled
+
+    def load(self, name):
+        """
+        Return a compiled profile, compiling it if the profile or one of its configuration files changed.
+        :param name: profile name.
+        :return: compiled profile dict or None if the profile is not valid.
+        """
+        try:
+            with open(self.compiled_path(name)) as h:
+                compiled = json.loads(h.read())
+            if compiled.get('version') == COMPILED_VERSION and \
+                    all(_file_hash(path) == digest for path, digest in compiled['sources'].items()):
+                return compiled
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+        return self.compile(name)
+
+    def apply(self, name, devices):
+        """
+        Send the payloads of a profile the devices do not already hold.
+        :param name: profile name.
+        :param devices: USBDevices object.
+        :return: list of result dicts, 'result' is 'sent', 'unchanged', 'failed' or 'not found'.
+                 None if the profile is not valid.
+        """
+        compiled = self.load(name)
+        if compiled is None:
+            return None
+
+        results = list()
+        for entry in compiled['devices']:
+            found = False
+            for dev in devices.filter(class_id=entry['class_id'], bus=entry['bus'], address=entry['address']):
+                payload = entry['payloads'].get(_class_path(dev.__dev_class__))
+                if payload is None:
+                    continue
+                found = True
+                data = bytes.fromhex(payload['data'])
+                with dev as dev_h:
+                    if dev_h.payload_applied(payload['kind'], data):
+                        result = 'unchanged'
+                    else:
+                        result = 'sent' if dev_h.apply_payload(payload['kind'], data) else 'failed'
+                results.append({'device': dev.dev_key, 'bus': dev.bus, 'address': dev.address,
+                                'config': entry['config'], 'result': result})
+            if not found:
+                results.append({'device': None, 'bus': entry['bus'], 'address': entry['address'],
+                                'config': entry['config'], 'result': 'not found'})
+        return results
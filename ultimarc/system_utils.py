@@ -5,10 +5,17 @@
 # !!! This file is python 3.x compliant !!!
 #
 
+import errno
 import logging
 import os
 import subprocess
 import sys
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows, file locks are not supported.
+    fcntl = None
 
 try:
     import requests
@@ -159,7 +166,7 @@ class _ToolLoggingFormatter(logging.Formatter):
         return msg
 
 
-def setup_logging(logger, progname, debug=False, quiet=False, logfile=None):
+def setup_logging(logger, progname, debug=False, quiet=False, logfile=None, stream=None):
     """
   Setup Python logging
   :param logger: Handle to logger object
@@ -167,6 +174,7 @@ def setup_logging(logger, progname, debug=False, quiet=False, logfile=None):
   :param debug: True if debugging enabled
   :param quiet: True if quiet output selected.
   :param logfile: Path and filename to log file to output to
+  :param stream: Stream to output to, sys.stdout if not given
   :return: Nothing
   """
     if not logger:
@@ -183,8 +191,9 @@ def setup_logging(logger, progname, debug=False, quiet=False, logfile=None):
         formatter = _ToolLoggingFormatter("%(message)s")
 
     # Setup stream logging handler
-    handler = logging.StreamHandler(sys.stdout)
-    handler.flush = sys.stdout.flush
+    stream = stream or sys.stdout
+    handler = logging.StreamHandler(stream)
+    handler.flush = stream.flush
     handler.setFormatter(formatter)
 
     logger.addHandler(handler)
@@ -236,56 +245,171 @@ def run_external_program(args, cwd=None, env=None, shell=False, debug=False):
     return p.returncode, stdoutdata, stderrdata
 
 
+def runtime_dir():
+    """
+    Return the directory for the lock files and sockets of this user, $XDG_RUNTIME_DIR/ultimarc or
+    ~/.local/run/ultimarc.
+    """
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if base:
+        return os.path.join(base, 'ultimarc')
+    return os.path.join(os.path.expanduser('~'), '.local/run/ultimarc')
+
+
+def config_dir():
+    """
+    Return the directory for the settings and profiles of this user, $XDG_CONFIG_HOME/ultimarc or
+    ~/.config/ultimarc.
+    """
+    return os.path.join(os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser('~'), '.config'),
+                        'ultimarc')
+
+
+def cache_dir():
+    """ Return the directory for files that can be recreated, $XDG_CACHE_HOME/ultimarc or ~/.cache/ultimarc. """
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                        'ultimarc')
+
+
+class FileLock(object):
+    """
+    Exclusive advisory lock on a file, based on fcntl.flock(). The lock is dropped by the operating system
+    when the process exits, so a stale lock file never blocks anyone. Each FileLock object opens its own
+    file descriptor, two objects locking the same file exclude each other even in the same process.
+    The holder may remove the lock file, a waiter that then locks the removed file opens the path again.
+    Locking always succeeds where fcntl is not available.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path and file name of the lock file, the directory is created if needed.
+        """
+        self.path = path
+        self._fd = None
+
+    @property
+    def locked(self):
+        return self._fd is not None
+
+    def acquire(self, timeout=None, poll=0.05):
+        """
+        Lock the file.
+        :param timeout: seconds to wait for another holder to release the lock, None waits forever and
+                        zero does not wait.
+        :param poll: seconds between attempts while waiting.
+        :return: True if the lock was acquired otherwise False.
+        """
+        if self._fd is not None:
+            return True
+
+        lock_path = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(lock_path):
+            os.makedirs(lock_path, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is None:
+            self._fd = fd
+            return True
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    os.close(fd)
+                    raise
+                locked = False
+            if locked:
+                if self._is_current_(fd):
+                    self._fd = fd
+                    return True
+                # The holder we waited for removed the file, lock the file now at the path.
+                os.close(fd)
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                continue
+            if deadline is not None and time.monotonic() >= deadline:
+                os.close(fd)
+                return False
+            time.sleep(poll if deadline is None else max(min(poll, deadline - time.monotonic()), 0))
+
+    def _is_current_(self, fd):
+        """ Return True if the open file is the file at the lock path """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        fst = os.fstat(fd)
+        return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+    def release(self):
+        """ Unlock the file """
+        if self._fd is not None:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def write(self, text: str):
+        """ Replace the contents of the locked file """
+        if self._fd is not None:
+            os.ftruncate(self._fd, 0)
+            os.pwrite(self._fd, text.encode('utf-8'), 0)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
 def pid_is_running(pid: int):
     """
   Check For the existence of a unix pid.
   :param pid: integer ID of this process
   :return: True if process with this ID is running, otherwise False
   """
-    # See if there is a currently running mysqld instance
-    # pylint: disable=unused-variable
-    args = ['ps', '-eo', 'ruid,pid,ppid,args']
-    code, so, se = run_external_program(args=args)
-    if code == 0:
-        lines = so.split('\n')
-        for line in lines:
-            if str(pid) in line:
-                while '  ' in line:
-                    line = line.replace('  ', ' ')
-                if pid == int(line.strip().split(' ')[1]) and '<defunct>' not in line:
-                    return True
-    return False
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # Running as another user.
+        return True
+    return True
+
+
+_pid_locks = dict()  # pid file -> FileLock object held by this process.
+
+
+def _pid_file(progname: str, pid_file: str = None):
+    """ Return the default pid file for a program """
+    if pid_file:
+        return pid_file
+    return os.path.join(os.path.expanduser("~"), ".local/run", "{0}.pid".format(progname))
 
 
 def write_pidfile_or_die(progname: str, pid_file: str = None):
     """
-  Attempt to write our PID to the given PID file or raise an exception.
+  Lock the given PID file and write our PID to it or raise an exception if another instance holds the lock.
+  The lock is held until remove_pidfile() is called or the process exits.
   :param progname: Name of this program
   :param pid_file: an alternate path and pid file to use
   :return: pid path and filename
   """
-    if not pid_file:
-        home = os.path.expanduser("~")
-        pid_path = os.path.join(home, ".local/run")
-        pid_file = os.path.join(pid_path, "{0}.pid".format(progname))
-    else:
-        pid_path = os.path.dirname(pid_file)
-
-    if not os.path.exists(pid_path):
-        os.makedirs(pid_path)
-
-    if os.path.exists(pid_file):
-        pid = int(open(pid_file).read())
-
-        if pid_is_running(pid):
-            _logger.warning("program is already running, aborting.")
-            raise SystemExit
-
-        else:
-            os.remove(pid_file)
+    pid_file = _pid_file(progname, pid_file)
+    if pid_file in _pid_locks:
+        return pid_file
 
-    open(pid_file, "w").write(str(os.getpid()))
+    lock = FileLock(pid_file)
+    if not lock.acquire(timeout=0):
+        _logger.warning("program is already running, aborting.")
+        raise SystemExit
 
+    lock.write(str(os.getpid()))
+    _pid_locks[pid_file] = lock
     return pid_file
 
 
@@ -295,13 +419,15 @@ def remove_pidfile(progname: str, pid_file: str = None):
   :param progname: Name of this program
   :param pid_file: an alternate pid file to use
   """
-    if not pid_file:
-        home = os.path.expanduser("~")
-        pid_path = os.path.join(home, ".local/run")
-        pid_file = os.path.join(pid_path, "{0}.pid".format(progname))
+    pid_file = _pid_file(progname, pid_file)
+    lock = _pid_locks.pop(pid_file, None)
 
+    # The file is removed while still locked, an instance waiting for the lock then locks a new pid file,
+    # see FileLock.acquire().
     if os.path.exists(pid_file):
         os.remove(pid_file)
+    if lock is not None:
+        lock.release()
 
 
 def print_progress_bar(iteration, total, prefix="", suffix="", decimals=1, bar_length=90, fill="█"):
@@ -7,11 +7,11 @@ import logging
 import os.path
 import sys
 import traceback
-import platform
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from ultimarc import translate_gettext as _
-from ultimarc.devices import USBDevices
-from ultimarc.system_utils import remove_pidfile, write_pidfile_or_die, setup_logging, tc as _tc
+from ultimarc.system_utils import setup_logging, tc as _tc
 
 toolname = 'ultimarc'
 
@@ -19,11 +19,40 @@ _logger = logging.getLogger('ultimarc')
 
 _VENDOR_FILTER = ['d209']  # List of USB vendor IDs.
 
+# Result of running a job on one device, 'error' is the exception raised by the job or None.
+DeviceJobResult = namedtuple('DeviceJobResult', ['device', 'result', 'error'])
+
+
+def run_device_jobs(devices, job, jobs=1):
+    """
+    Open each device and call job(dev, dev_h) with the opened device handle. Up to 'jobs' devices are
+    processed at the same time, each device is only used by one job.
+    :param devices: list of USBDeviceInfo objects.
+    :param job: callable taking (USBDeviceInfo, USBDeviceHandle), returns False if the job failed.
+    :param jobs: maximum number of devices processed at the same time.
+    :return: list of DeviceJobResult objects in device order.
+    """
+    def run_job(dev):
+        try:
+            with dev as dev_h:
+                return DeviceJobResult(dev, job(dev, dev_h), None)
+        except Exception as e:
+            _logger.debug(traceback.format_exc())
+            _logger.error(f'{dev.dev_key} ({dev.bus},{dev.address}): {e}')
+            return DeviceJobResult(dev, False, e)
+
+    if jobs <= 1 or len(devices) <= 1:
+        return [run_job(dev) for dev in devices]
+
+    with ThreadPoolExecutor(max_workers=min(jobs, len(devices)), thread_name_prefix='ultimarc-job') as executor:
+        return list(executor.map(run_job, devices))
+
 
 class ToolEnvironmentObject(object):
     """ Tool environment configuration object """
 
     devices = None  # USBDevices object
+    jobs = 1  # Number of devices to process at the same time.
 
     def __init__(self, items):
         """
@@ -41,6 +70,36 @@ class ToolEnvironmentObject(object):
         """ Clean up or close everything we need to """
         _logger.info(_tc.reset)  # Turn off terminal colors.
 
+    def run_jobs(self, devices, job):
+        """
+        Run a job on every device, see run_device_jobs().
+        :param devices: list of USBDeviceInfo objects.
+        :param job: callable taking (USBDeviceInfo, USBDeviceHandle), returns False if the job failed.
+        :return: True if the job was successful on every device otherwise False.
+        """
+        results = run_device_jobs(devices, job, self.jobs)
+        failed = [r for r in results if r.error is not None or r.result is False]
+        if failed and len(results) > 1:
+            _logger.error(_('Failed on {} of {} devices').format(len(failed), len(results)) + ': ' +
+                          ', '.join(f'{r.device.dev_key} ({r.device.bus},{r.device.address})' for r in failed))
+        return not failed
+
+
+class _ToolArgumentParser(argparse.ArgumentParser):
+    """ Argument parser writing help and errors to the output streams of the tool """
+
+    def __init__(self, *args, stdout=None, stderr=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stdout = stdout
+        self._stderr = stderr
+
+    def _print_message(self, message, file=None):
+        if file is sys.stderr:
+            file = self._stderr or file
+        elif file is None or file is sys.stdout:
+            file = self._stdout or file
+        super()._print_message(message, file)
+
 
 class ToolContextManager(object):
     """
@@ -48,34 +107,88 @@ class ToolContextManager(object):
     """
     _tool_cmd = None
     _command = None
+    _stats = False  # Print the metrics summary at exit.
+    _trace_file = None  # Write the transfer trace to this file at exit.
+    _record_file = None  # Write the recorded session to this file at exit.
+    _replay = None  # ReplayUSB object serving a recorded session in place of libusb.
+    _previous_sink = None  # Metrics sink replaced by the sink of this tool, restored at exit.
+    _stdout = None  # Output stream of the tool, None for sys.stdout.
+    _stderr = None  # Error stream of the tool, None for sys.stderr.
     _env = None
 
     _env_config_obj = None
 
-    def __init__(self, command, args):
+    shared_devices = None  # USBDevices object kept by the daemon, used instead of searching for devices.
+
+    def __init__(self, command, args, stdout=None, stderr=None):
         """
         Initialize Tool Context Manager
         :param command: command name
         :param args: parsed argparser commandline arguments object.
+        :param stdout: output stream of the tool, sys.stdout if not given.
+        :param stderr: error stream of the tool, sys.stderr if not given.
         """
         if not command:
             _logger.error(_('command not set, aborting.'))
             exit(1)
 
+        # The device modules load libusb, import them here so 'ultimarc --help' and the command lookup don't.
+        from ultimarc.devices import USBDevices
+        from ultimarc.devices._config_cache import DEFAULT_TTL, ConfigCache
+        from ultimarc.devices._locks import DeviceLocks
+        from ultimarc.devices._metrics import InMemoryMetrics, JSONMetricsSink, PrometheusTextfileSink, \
+            set_metrics_sink
+        from ultimarc.devices._trace import enable_trace
+
         self._command = command
+        self._stdout = stdout
+        self._stderr = stderr
+        self._stats = getattr(args, 'stats', False)
+        self._trace_file = getattr(args, 'trace', None)
+        self._record_file = getattr(args, 'record', None)
+        if self._record_file:
+            from ultimarc.devices._session import start_recording
+            start_recording()
+        elif self._trace_file:
+            enable_trace()
+        replay_file = getattr(args, 'replay', None)
+        if replay_file:
+            from ultimarc.devices._session import ReplayUSB, SessionFormatError
+            try:
+                self._replay = ReplayUSB(replay_file, strict=False)
+            except (OSError, SessionFormatError) as e:
+                _logger.error(_('Failed to load session file') + f': {e}')
+                exit(1)
+            self._replay.install()
+        # Metrics are only collected when asked for, the default sink discards them. Each tool run gets its own
+        # sink, so a tool run by the daemon only reports its own transfers.
+        stats_file = getattr(args, 'stats_file', None)
+        if stats_file:
+            self._previous_sink = set_metrics_sink(JSONMetricsSink(stats_file) if stats_file.endswith('.json')
+                                                   else PrometheusTextfileSink(stats_file))
+        elif self._stats:
+            self._previous_sink = set_metrics_sink(InMemoryMetrics())
+        # Each device is locked while it is open, tools using different devices can run at the same time.
+        devices = self.shared_devices
+        if devices is None:
+            device_locks = None
+            if self._replay is None:
+                device_locks = DeviceLocks(timeout=getattr(args, 'lock_timeout', 30.0))
+            # A session must hold every transfer, so recording and replaying never use cached configurations.
+            # Without the cache, configurations are still stored for the next tool.
+            config_cache = None
+            if not (self._replay or self._record_file):
+                config_cache = ConfigCache(ttl=0 if getattr(args, 'no_cache', False) else DEFAULT_TTL)
+            devices = USBDevices(_VENDOR_FILTER, device_locks=device_locks, config_cache=config_cache)
+        else:
+            devices.rescan()
         # The Environment dict is where we can set up any information related to all tools.
         self._env = {
             'command': command,
-            'devices': USBDevices(_VENDOR_FILTER)
+            'devices': devices,
+            'jobs': max(getattr(args, 'jobs', 1) or 1, 1)
         }
 
-        if platform.system() == 'Linux':
-            write_pidfile_or_die(command)
-
-            if not self._env:
-                remove_pidfile(command)
-                exit(1)
-
     def __enter__(self):
         """ Return object with properties set to config values """
         self._env_config_obj = ToolEnvironmentObject(self._env)
@@ -83,34 +196,80 @@ class ToolContextManager(object):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """ Clean up or close everything we need to """
+        from ultimarc.devices._metrics import InMemoryMetrics, get_metrics_sink, set_metrics_sink
+        from ultimarc.devices._trace import disable_trace
+
         self._env_config_obj.cleanup()
+        if self._env['devices'] is not self.shared_devices:
+            self._env['devices'].close_all()
 
-        remove_pidfile(self._command)
+        sink = get_metrics_sink()
+        sink.flush()
+        if self._stats and isinstance(sink, InMemoryMetrics):
+            print(sink.summary(), file=self._stderr or sys.stderr)
+        if self._previous_sink is not None:
+            set_metrics_sink(self._previous_sink)
+            self._previous_sink = None
+        trace = disable_trace()
+        if trace is not None:
+            if self._trace_file:
+                trace.dump(self._trace_file)
+            if self._record_file:
+                trace.save(self._record_file)
+        if self._replay is not None:
+            self._replay.uninstall()
 
         if exc_type is not None:
-            print((traceback.format_exc()))
+            print((traceback.format_exc()), file=self._stdout or sys.stdout)
             _logger.error(_('tool encountered an unexpected error, quitting.'))
             exit(1)
 
     @staticmethod
-    def initialize_logging(tool_cmd):
+    def initialize_logging(tool_cmd, argv=None, stream=None):
+        """
+        :param tool_cmd: Tool command line id.
+        :param argv: tool arguments, sys.argv if not given.
+        :param stream: output stream of the tool, sys.stdout if not given.
+        """
+        argv = sys.argv if argv is None else argv
         setup_logging(
-            _logger, tool_cmd, '--debug' in sys.argv, '-q' in sys.argv or '--quiet' in sys.argv,
-            '{0}.log'.format(tool_cmd) if '--log-file' in sys.argv else None)
+            _logger, tool_cmd, '--debug' in argv, '-q' in argv or '--quiet' in argv,
+            '{0}.log'.format(tool_cmd) if '--log-file' in argv else None, stream)
 
     @staticmethod
-    def get_argparser(tool_cmd, tool_desc):
+    def get_argparser(tool_cmd, tool_desc, stdout=None, stderr=None):
         """
         :param tool_cmd: Tool command line id.
         :param tool_desc: Tool description.
+        :param stdout: stream for help output, sys.stdout if not given.
+        :param stderr: stream for argument errors, sys.stderr if not given.
         """
         # Setup program arguments.
-        parser = argparse.ArgumentParser(prog=tool_cmd, description=tool_desc)
+        parser = _ToolArgumentParser(prog=tool_cmd, description=tool_desc, stdout=stdout, stderr=stderr)
         parser.add_argument('--debug', help=_('enable debug output'), default=False, action='store_true')
         parser.add_argument('--log-file', help=_('write output to a log file'), default=False, action='store_true')
         parser.add_argument('-q', '--quiet', help=_('suppress normal output'), default=False, action='store_true')
         parser.add_argument('--bus', help=_('filter by usb device bus number'), type=int, default=None)
         parser.add_argument('--address', help=_('filter by usb device address number'), type=int, default=None)
+        parser.add_argument('-j', '--jobs', help=_('number of devices to process at the same time'), type=int,
+                            default=1, metavar='N')
+        parser.add_argument('--no-daemon', help=_('do not send the command to a running ultimarc daemon'),
+                            default=False, action='store_true')
+        parser.add_argument('--lock-timeout', help=_('seconds to wait for another program using a device, '
+                                                     'default 30'), type=float, default=30.0, metavar='SECONDS')
+        parser.add_argument('--no-cache', help=_('read device configurations from the devices instead of the '
+                                                 'configuration cache'), default=False, action='store_true')
+        parser.add_argument('--stats', help=_('print USB transfer statistics at exit'), default=False,
+                            action='store_true')
+        parser.add_argument('--stats-file', help=_('write metrics to a file at exit, in Prometheus text format '
+                                                   'unless the file name ends with .json'), default=None,
+                            metavar='FILE')
+        parser.add_argument('--trace', help=_('record USB transfers and write them to a pcap file at exit'),
+                            default=None, metavar='FILE')
+        parser.add_argument('--record', help=_('record the USB session and write it to a session file at exit'),
+                            default=None, metavar='FILE')
+        parser.add_argument('--replay', help=_('use the devices and transfers of a recorded session file instead '
+                                               'of USB devices'), default=None, metavar='FILE')
         return parser
 
     @staticmethod
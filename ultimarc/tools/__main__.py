@@ -5,28 +5,13 @@
 # Search for and run command line tools.
 #
 import copy
-import glob
 import importlib
 import os
-import re
 import sys
 
 from ultimarc import translate_gettext as _
 from ultimarc.tools import toolname
-
-
-def _grep_prop(filename, prop_name):
-    """
-    Look for property in file
-    :param filename: path to file and file name.
-    :param prop_name: property to search for in file.
-    :return: property value or None.
-    """
-    fdata = open(filename, "r").read()
-    obj = re.search("^{0} = ['|\"|_('|_(\"](.+)['|\"|')|\")]$".format(prop_name), fdata, re.MULTILINE)
-    if obj:
-        return obj.group(1).replace('(', '').replace("'", '').replace(')', '')
-    return None
+from ultimarc.tools._commands import COMMANDS, scan_tools
 
 
 def _run_tool():
@@ -37,7 +22,6 @@ def _run_tool():
 
     proj_path = os.path.abspath(__file__).split('/ultimarc/tools')[0]
     import_base = os.path.join(proj_path, 'ultimarc')
-    tool_path = os.path.join(import_base, 'tools')
 
     show_usage = False
     command = "no-command"
@@ -53,30 +37,31 @@ def _run_tool():
 
     os.environ['PYTHONPATH'] = import_base
 
-    command_names = list()
-
-    libs = glob.glob(os.path.join(tool_path, "*.py"))
-    for lib in libs:
-        mod_cmd = _grep_prop(lib, "tool_cmd")
-        mod_desc = _grep_prop(lib, "tool_desc")
-        if not mod_cmd:
-            continue
-
-        # TODO: Support i18n translations for tool_cmd and tool_desc.  We need to import the module
-        #       here and query the gettext strings.  Importing the modules here is really slow.
-        usage_mod_cmd = mod_cmd.replace('(', '').replace("'", '')
-        usage_mod_desc = mod_desc.replace('(', '').replace("'", '')
-
-        if mod_cmd != "template":
-            command_names.append("  {0} : {1}".format(usage_mod_cmd.ljust(14), usage_mod_desc))
-
-        if mod_cmd == command:
-            mod_name = os.path.basename(lib).split(".")[0]
-            mod = importlib.import_module("ultimarc.tools.{0}".format(mod_name))
-            exit_code = mod.run()
-            if '-q' not in sys.argv and '--quiet' not in sys.argv:
-                print(_('finished.'))
-            return exit_code
+    commands = COMMANDS
+    # A tool added since the command index was generated is found by searching the tool modules.
+    if not show_usage and command not in commands:
+        commands = scan_tools()
+
+    # Let a running daemon handle the command, it keeps the devices open between commands.
+    if command in commands and command != 'daemon':
+        from ultimarc.daemon import DaemonClient
+        if DaemonClient.available():
+            if 'ULTIMARC_NO_DAEMON' in os.environ:
+                # The daemon must close the devices it holds before this process can open them.
+                DaemonClient().release()
+            else:
+                exit_code = DaemonClient().run_tool([command] + args[1:])
+                if exit_code is not None:
+                    if '-q' not in sys.argv and '--quiet' not in sys.argv:
+                        print(_('finished.'))
+                    return exit_code
+
+    if command in commands:
+        mod = importlib.import_module("ultimarc.tools.{0}".format(commands[command][0]))
+        exit_code = mod.run()
+        if '-q' not in sys.argv and '--quiet' not in sys.argv:
+            print(_('finished.'))
+        return exit_code
 
     if not show_usage:
         print(_('Error: Invalid command argument'))
@@ -92,9 +77,9 @@ def _run_tool():
     print(f"\n{_usage}: {_tool} [{_command}] " +
           f"[{_short_help}|{_long_help}] [{_args}]\n\n{_commands}:")
 
-    command_names.sort()
-    for gn in command_names:
-        print(gn)
+    for cmd, (mod_name, desc) in sorted(commands.items()):
+        if cmd != "template":
+            print("  {0} : {1}".format(_(cmd).ljust(14), _(desc)))
     print("")
 
 
@@ -0,0 +1,84 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Index of the command line tools, so a launch only imports the tool being run.
+#
+# COMMANDS is generated from the 'tool_cmd' and 'tool_desc' values of the tool modules, regenerate it after
+# adding or renaming a tool:
+#
+#    python -m ultimarc.tools._commands
+#
+import glob
+import os
+import re
+
+TOOL_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# --- generated, do not edit ---
+# Command name -> (module name, description), descriptions are translated when shown.
+COMMANDS = {
+    'daemon': ('daemon', 'keep devices open and serve requests on a local socket'),
+    'ipac2': ('ipac2', 'Manage ipac2 devices'),
+    'ipac4': ('ipac4', 'Manage ipac4 devices'),
+    'jpac': ('jpac', 'Manage jpac devices'),
+    'list': ('list_devices', 'list all attached ultimarc devices'),
+    'mini-pac': ('mini_pac', 'Manage Mini-pac devices'),
+    'profile': ('profile', 'compile and apply device profiles'),
+    'template': ('_tool_template', 'put tool help description here'),
+    'ultimate-io': ('ultimate_io', 'Manage UltimateIO devices'),
+    'ultrastik': ('ultrastik', 'configure ultrastik 360 joysticks'),
+    'usb-button': ('usb_button', 'manage usb-button devices.'),
+}
+# --- end generated ---
+
+
+def _grep_prop(filename, prop_name):
+    """
+    Look for property in file
+    :param filename: path to file and file name.
+    :param prop_name: property to search for in file.
+    :return: property value or None.
+    """
+    with open(filename, "r") as h:
+        fdata = h.read()
+    obj = re.search("^{0} = ['|\"|_('|_(\"](.+)['|\"|')|\")]$".format(prop_name), fdata, re.MULTILINE)
+    if obj:
+        return obj.group(1).replace('(', '').replace("'", '').replace(')', '')
+    return None
+
+
+def scan_tools(tool_path=TOOL_PATH):
+    """
+    Search the tool modules for their command name and description.
+    :param tool_path: directory holding the tool modules.
+    :return: dict of command name -> (module name, description).
+    """
+    commands = dict()
+    for lib in sorted(glob.glob(os.path.join(tool_path, "*.py"))):
+        mod_cmd = _grep_prop(lib, "tool_cmd")
+        if not mod_cmd:
+            continue
+        commands[mod_cmd] = (os.path.basename(lib).split(".")[0], _grep_prop(lib, "tool_desc") or '')
+    return commands
+
+
+def write_index(commands, filename=__file__):
+    """
+    Replace the generated COMMANDS block of this file.
+    :param commands: dict of command name -> (module name, description).
+    :param filename: file to update.
+    """
+    with open(filename, "r") as h:
+        fdata = h.read()
+    lines = [f'    {cmd!r}: ({mod!r}, {desc!r}),' for cmd, (mod, desc) in sorted(commands.items())]
+    block = '# Command name -> (module name, description), descriptions are translated when shown.\n' + \
+            'COMMANDS = {\n' + '\n'.join(lines) + '\n}\n'
+    fdata = re.sub(r'(# --- generated, do not edit ---\n).*?(# --- end generated ---)',
+                   lambda m: m.group(1) + block + m.group(2), fdata, flags=re.DOTALL)
+    with open(filename, "w") as h:
+        h.write(fdata)
+
+
+if __name__ == "__main__":
+    write_index(scan_tools())
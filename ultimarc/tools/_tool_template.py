@@ -14,7 +14,8 @@ from ultimarc.tools import ToolContextManager, ToolEnvironmentObject
 _logger = logging.getLogger('ultimarc')
 
 # Tool_cmd and tool_desc name are required.
-# Remember to add/update bash completion in 'tools.bash'
+# Remember to add/update bash completion in 'tools.bash' and regenerate the command index with
+# 'python -m ultimarc.tools._commands'.
 tool_cmd = _('template')
 tool_desc = _('put tool help description here')
 
@@ -49,15 +50,16 @@ class ProgramTemplateClass(object):
         return 0
 
 
-def run():
+def run(argv=None, stdout=None, stderr=None):
+    # The daemon gives the tool arguments and output streams, otherwise sys.argv, sys.stdout and sys.stderr are used.
     # Set global debug value and setup application logging.
-    ToolContextManager.initialize_logging(tool_cmd)
-    parser = ToolContextManager.get_argparser(tool_cmd, tool_desc)
+    ToolContextManager.initialize_logging(tool_cmd, argv, stdout)
+    parser = ToolContextManager.get_argparser(tool_cmd, tool_desc, stdout, stderr)
 
     # TODO:  Setup additional program arguments here.
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
-    with ToolContextManager(tool_cmd, args) as tool_env:
+    with ToolContextManager(tool_cmd, args, stdout, stderr) as tool_env:
         process = ProgramTemplateClass(args, tool_env)
         exit_code = process.run()
         return exit_code
@@ -0,0 +1,68 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Keep devices open and serve requests on a local socket, see ultimarc/daemon.py.
+#
+import logging
+import os
+import signal
+import sys
+
+from ultimarc import translate_gettext as _
+from ultimarc.daemon import DaemonServer, default_socket_path
+from ultimarc.system_utils import remove_pidfile, runtime_dir, write_pidfile_or_die
+from ultimarc.tools import ToolContextManager, ToolEnvironmentObject
+
+_logger = logging.getLogger('ultimarc')
+
+# Tool_cmd and tool_desc name are required.
+# Remember to add/update bash completion in 'tools.bash'
+tool_cmd = _('daemon')
+tool_desc = _('keep devices open and serve requests on a local socket')
+
+
+class DaemonClass(object):
+    def __init__(self, args, tool_env: ToolEnvironmentObject):
+        """
+        :param args: command line arguments.
+        :param tool_env: tool environment information, see: gcp_initialize().
+        """
+        self.args = args
+        self.tool_env = tool_env
+
+    def run(self):
+        """
+        Main program process
+        :return: Exit code value
+        """
+        server = DaemonServer(self.tool_env.devices, self.args.socket)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: server.stop())
+        server.serve_forever()
+        return 0
+
+
+def run(argv=None, stdout=None, stderr=None):
+    # Set global debug value and setup application logging.
+    ToolContextManager.initialize_logging(tool_cmd, argv, stdout)
+    parser = ToolContextManager.get_argparser(tool_cmd, tool_desc, stdout, stderr)
+    parser.add_argument('--socket', help=_('socket path, default') + f' {default_socket_path()}',
+                        default=None, metavar='PATH')
+    args = parser.parse_args(argv)
+
+    # Only one daemon may serve the socket, check before opening any device.
+    pid_file = os.path.join(runtime_dir(), 'daemon.pid')
+    write_pidfile_or_die(tool_cmd, pid_file)
+    try:
+        with ToolContextManager(tool_cmd, args, stdout, stderr) as tool_env:
+            process = DaemonClass(args, tool_env)
+            exit_code = process.run()
+            return exit_code
+    finally:
+        remove_pidfile(tool_cmd, pid_file)
+
+
+# --- Main Program Call ---
+if __name__ == "__main__":
+    sys.exit(run())
@@ -45,55 +45,49 @@ class JPACClass(object):
             _logger.error(_('No jpac devices found, aborting'))
             return -1
 
+        return 0 if self.tool_env.run_jobs(devices, self.run_device) else -1
+
+    def run_device(self, dev, dev_h):
+        """
+        Process the command line arguments for one device.
+        :param dev: USBDeviceInfo object.
+        :param dev_h: opened device handle.
+        :return: True if successful otherwise False.
+        """
         # Get config from device
         if self.args.get_config:
-            for dev in devices:
-                with dev as dev_h:
-                    indent = int(self.args.indent) if self.args.indent else None
-                    response = dev_h.get_device_config(indent, self.args.file)
-                    _logger.info(response)
+            indent = int(self.args.indent) if self.args.indent else None
+            response = dev_h.get_device_config(indent, self.args.file)
+            _logger.info(response)
 
         # Set jpac device configuration from a configuration file
         if self.args.set_config:
-            for dev in devices:
-                with dev as dev_h:
-                    use_current = self.args.current
-                    dev_h.set_config(self.args.set_config, use_current)
-                    _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
-                                 _('configuration successfully applied to device.'))
-
-        if self.args.set_pin:
-            for dev in devices:
-                with dev as dev_h:
-                    dev_h.set_pin(self.args.set_pin)
-                    _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
-                                 _('pin successfully applied to device.'))
-
-        # Set debounce value
-        if self.args.set_debounce:
-            for dev in devices:
-                with dev as dev_h:
-                    response = dev_h.set_debounce(self.args.set_debounce)
-                    if response:
-                        _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
-                                     _('debounce successfully applied to device.'))
-
-        # Set paclink value
-        if self.args.paclink is not None:
-            for dev in devices:
-                with dev as dev_h:
-                    response = dev_h.set_paclink(self.args.paclink)
-                    if response:
-                        _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
-                                     _('paclink successfully applied to device.'))
-
-        return 0
-
-
-def run():
+            if not dev_h.set_config(self.args.set_config, self.args.current):
+                return False
+            _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
+                         _('configuration successfully applied to device.'))
+
+        # Set pins, debounce and paclink values with a single write to each device
+        if self.args.set_pin or self.args.set_debounce or self.args.paclink is not None:
+            with dev_h.transaction() as tx:
+                for pin in self.args.set_pin or []:
+                    tx.set_pin(pin[0], pin[1], pin[2], pin[3].lower() in ['true', '1', 't', 'y'])
+                if self.args.set_debounce:
+                    tx.set_debounce(self.args.set_debounce)
+                if self.args.paclink is not None:
+                    tx.set_paclink(self.args.paclink)
+            if not tx.result:
+                return False
+            _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
+                         _('changes successfully applied to device.'))
+
+        return True
+
+
+def run(argv=None, stdout=None, stderr=None):
     # Set global debug value and setup application logging.
-    ToolContextManager.initialize_logging(tool_cmd)
-    parser = ToolContextManager.get_argparser(tool_cmd, tool_desc)
+    ToolContextManager.initialize_logging(tool_cmd, argv, stdout)
+    parser = ToolContextManager.get_argparser(tool_cmd, tool_desc, stdout, stderr)
     group = parser.add_argument_group()
 
     # Setup additional program arguments here.
@@ -108,12 +102,12 @@ def run():
                        help=_('Use jpac current config when applying config from file'), default=False,
                        action='store_true')
     group.add_argument('--set-debounce', help=_('Set jpac debounce value'), type=str, metavar='STR')
-    group.add_argument('--set-pin', help=_('Set single pin'), type=str,
-                       default=None, metavar=('PIN', 'ACTION', 'ALT_ACTION', 'IS_SHIFT'), nargs=4)
+    group.add_argument('--set-pin', help=_('Set a pin, may be repeated'), type=str,
+                       default=None, metavar=('PIN', 'ACTION', 'ALT_ACTION', 'IS_SHIFT'), nargs=4, action='append')
     group.add_argument('--set-paclink', dest='paclink', help=_('Set jpac paclink value'), action='store_true')
     group.add_argument('--unset-paclink', dest='paclink', help=_('Unset jpac paclink value'), action='store_false')
     group.set_defaults(paclink=None)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if not args.get_config and args.indent:
         _logger.error(_('The --indent argument can only be used with the --get_config argument '))
@@ -132,7 +126,7 @@ def run():
             _logger.error(_('Unable to find configuration file specified in argument.'))
             return -1
 
-    with ToolContextManager(tool_cmd, args) as tool_env:
+    with ToolContextManager(tool_cmd, args, stdout, stderr) as tool_env:
         process = JPACClass(args, tool_env)
         exit_code = process.run()
         return exit_code
@@ -6,6 +6,7 @@
 #
 import logging
 import sys
+import time
 
 from ultimarc import translate_gettext as _
 from ultimarc.devices import DeviceClassID
@@ -63,10 +64,24 @@ class ListDevicesClass(object):
                             _logger.info(f'  {fld}: {desc_val:04x} (desc idx: 0x{desc_val:04x}, str: "{desc_str}")')
                         else:
                             _logger.info(f'  {fld}: {desc_val}')
+                    self.list_cached_configs(dev)
 
         except (USBDeviceNotFoundError, USBDeviceClaimInterfaceError) as e:
             _logger.error(_('An error occurred while inspecting device') + f' {e.dev_key}.')
 
+    def list_cached_configs(self, dev):
+        """
+        Show the configurations the config cache holds for a device, without reading the device.
+        :param dev: USBDeviceInfo object.
+        """
+        cache = self.env.devices.config_cache
+        if cache is None:
+            return
+        now = time.time()
+        for kind, entry in sorted(cache.entries(cache.device_id(dev)).items()):
+            _logger.info(f'  {kind}: {entry["hash"][:12]} (' + _('cached') +
+                         f' {int(now - entry["time"])}s ' + _('ago') + ')')
+
     def run(self):
         """
         Main program process
@@ -76,17 +91,17 @@ class ListDevicesClass(object):
         return 0
 
 
-def run():
+def run(argv=None, stdout=None, stderr=None):
     # Set global debug value and setup application logging.
-    ToolContextManager.initialize_logging(tool_cmd)
-    parser = ToolContextManager.get_argparser(tool_cmd, tool_desc)
+    ToolContextManager.initialize_logging(tool_cmd, argv, stdout)
+    parser = ToolContextManager.get_argparser(tool_cmd, tool_desc, stdout, stderr)
     parser.add_argument('-c', '--class-id', help=_('filter by device class id'), type=str)
     parser.add_argument('-d', '--descriptors', help=_('Show device descriptor values.'), default=False,
                         action='store_true')
 
     classes = ','.join([c.value for c in DeviceClassID])
     parser.epilog = f"class ids: {classes}"
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # Verify class id is valid by looking in the Enum by value.
     if args.class_id:
@@ -96,7 +111,7 @@ def run():
             _logger.error('Invalid class id argument value.')
             return -1
 
-    with ToolContextManager(tool_cmd, args) as tool_env:
+    with ToolContextManager(tool_cmd, args, stdout, stderr) as tool_env:
         process = ListDevicesClass(args, tool_env)
         exit_code = process.run()
         return exit_code
@@ -0,0 +1,105 @@
+#
+# This file is subject to the terms and conditions defined in the
+# file 'LICENSE', which is part of this source code package.
+#
+# Tool for compiling and applying device profiles, see ultimarc/profiles.py.
+#
+import logging
+import os
+import sys
+
+from ultimarc import translate_gettext as _
+from ultimarc.profiles import ProfileStore, default_profile_dir
+from ultimarc.tools import ToolContextManager, ToolEnvironmentObject
+
+_logger = logging.getLogger('ultimarc')
+
+# Tool_cmd and tool_desc name are required.
+# Remember to add/update bash completion in 'tools.bash'
+tool_cmd = _('profile')
+tool_desc = _('compile and apply device profiles')
+
+
+class ProfileClass(object):
+    """ Tool class for applying profiles. """
+
+    def __init__(self, args, env: ToolEnvironmentObject, store: ProfileStore):
+        """
+        :param args: command line arguments.
+        :param env: tool environment information, see: gcp_initialize().
+        :param store: ProfileStore object.
+        """
+        self.args = args
+        self.env = env
+        self.store = store
+
+    def run(self):
+        """
+        Main program process
+        :return: Exit code value
+        """
+        results = self.store.apply(self.args.name, self.env.devices)
+        if results is None:
+            _logger.error(_('Failed to compile profile') + f' {self.args.name}.')
+            return -1
+
+        exit_code = 0
+        for result in results:
+            config = os.path.basename(result['config'])
+            if result['result'] == 'not found':
+                _logger.warning(_('No device found for') + f' {config}.')
+                continue
+            prefix = f'{result["device"]} ({result["bus"]},{result["address"]}): {config} '
+            if result['result'] == 'sent':
+                _logger.info(prefix + _('applied to device.'))
+            elif result['result'] == 'unchanged':
+                _logger.info(prefix + _('already applied, nothing sent.'))
+            else:
+                _logger.error(prefix + _('failed to apply to device.'))
+                exit_code = -1
+        return exit_code
+
+
+def run(argv=None, stdout=None, stderr=None):
+    # Set global debug value and setup application logging.
+    ToolContextManager.initialize_logging(tool_cmd, argv, stdout)
+    parser = ToolContextManager.get_argparser(tool_cmd, tool_desc, stdout, stderr)
+
+    parser.add_argument('action', help=_('list profiles, compile profiles or apply a profile'),
+                        choices=['list', 'compile', 'apply'])
+    parser.add_argument('name', help=_('profile name, compile all profiles if not given'), nargs='?', default=None)
+    parser.add_argument('--profile-dir', help=_('profile directory, default') + f' {default_profile_dir()}',
+                        default=None, metavar='PATH')
+
+    args = parser.parse_args(argv)
+    store = ProfileStore(os.path.abspath(args.profile_dir) if args.profile_dir else None)
+
+    if args.action == 'list':
+        for name in store.names():
+            print(name, file=stdout or sys.stdout)
+        return 0
+
+    if args.action == 'compile':
+        exit_code = 0
+        for name in [args.name] if args.name else store.names():
+            compiled = store.compile(name)
+            if compiled is None:
+                _logger.error(_('Failed to compile profile') + f' {name}.')
+                exit_code = -1
+                continue
+            _logger.info(f'{name}: ' + _('compiled') + f' {compiled["hash"][:12]}.')
+        return exit_code
+
+    if not args.name:
+        _logger.error(_('A profile name is required to apply a profile.'))
+        return -1
+
+    with ToolContextManager(tool_cmd, args, stdout, stderr) as tool_env:
+        process = ProfileClass(args, tool_env, store)
+        exit_code = process.run()
+        return exit_code
+
+
+# --- Main Program Call ---
+if __name__ == "__main__":
+    sys.exit(run())
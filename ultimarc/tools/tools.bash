@@ -13,9 +13,9 @@ _python()
 
 
     # These are the specific tools we support
-    tools="--help list usb-button"
+    tools="--help daemon list profile ultrastik usb-button"
     # These are the standard options all tools support.
-    stdopts="--help --debug --log-file --bus --address"
+    stdopts="--help --debug --log-file --bus --address --jobs --no-daemon --no-cache --lock-timeout --stats --stats-file --trace --record --replay"
 
     #
     #  Complete the arguments to some of the basic commands.
@@ -35,15 +35,33 @@ _python()
             COMPREPLY=( $(compgen -W "${tools}" -- ${cur}) )
             return 0
             ;;
+        daemon)
+            # These are options specific to this tool.
+            local toolopts="--socket"
+            COMPREPLY=( $(compgen -W "${stdopts} ${toolopts}" -- ${cur}) )
+            return 0
+            ;;
         list)
             # These are options specific to this tool.
             local toolopts="--descriptors"
             COMPREPLY=( $(compgen -W "${stdopts} ${toolopts}" -- ${cur}) )
             return 0
             ;;
+        profile)
+            # These are options specific to this tool.
+            local toolopts="list compile apply --profile-dir"
+            COMPREPLY=( $(compgen -W "${stdopts} ${toolopts}" -- ${cur}) )
+            return 0
+            ;;
+        ultrastik)
+            # These are options specific to this tool.
+            local toolopts="--set-config --set-device-id --switch-map --list-maps --map-dir"
+            COMPREPLY=( $(compgen -W "${stdopts} ${toolopts}" -- ${cur}) )
+            return 0
+            ;;
         usb-button)
             # These are options specific to this tool.
-            local toolopts="--set-color --set-random-color --get-color --load-config --export-config"
+            local toolopts="--set-color --set-random-color --get-color --load-config --export-config --watch"
             COMPREPLY=( $(compgen -W "${stdopts} ${toolopts}" -- ${cur}) )
             return 0
             ;;
@@ -10,6 +10,7 @@ import sys
 
 from ultimarc import translate_gettext as _
 from ultimarc.devices import DeviceClassID
+from ultimarc.devices._led_sequencer import LEDAnimation
 from ultimarc.tools import ToolContextManager, ToolEnvironmentObject
 
 
@@ -22,13 +23,15 @@ tool_desc = _('Manage UltimateIO devices')
 
 
 class UltimateIOClass(object):
-    def __init__(self, args, tool_env: ToolEnvironmentObject):
+    def __init__(self, args, tool_env: ToolEnvironmentObject, animation: LEDAnimation = None):
         """
         :param args: command line arguments.
         :param tool_env: tool environment information, see: gcp_initialize().
+        :param animation: LEDAnimation object to play.
         """
         self.args = args
         self.tool_env = tool_env
+        self.animation = animation
 
     def run(self):
         """
@@ -45,112 +48,119 @@ class UltimateIOClass(object):
             _logger.error(_('No ultimate-io devices found, aborting'))
             return -1
 
+        return 0 if self.tool_env.run_jobs(devices, self.run_device) else -1
+
+    def run_device(self, dev, dev_h):
+        """
+        Process the command line arguments for one device.
+        :param dev: USBDeviceInfo object.
+        :param dev_h: opened device handle.
+        :return: True if successful otherwise False.
+        """
         # Get the pin configuration from the device
         if self.args.get_pin_config:
-            for dev in devices:
-                with dev as dev_h:
-                    indent = int(self.args.indent) if self.args.indent else None
-                    response = dev_h.get_device_config(indent, self.args.file)
-                    _logger.info(response)
+            indent = int(self.args.indent) if self.args.indent else None
+            response = dev_h.get_device_config(indent, self.args.file)
+            _logger.info(response)
 
         # Set ultimate-io device pin configuration from a configuration file
         if self.args.set_pin_config:
-            for dev in devices:
-                with dev as dev_h:
-                    use_current = self.args.current
-                    dev_h.set_config(self.args.set_pin_config, use_current)
-                    _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
-                                 _('pin configuration successfully applied to device.'))
-
-        if self.args.set_pin:
-            for dev in devices:
-                with dev as dev_h:
-                    dev_h.set_pin(self.args.set_pin)
-                    _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
-                                 _('pin successfully applied to device.'))
-
-        # Set debounce value
-        if self.args.set_debounce:
-            for dev in devices:
-                with dev as dev_h:
-                    response = dev_h.set_debounce(self.args.set_debounce)
-                    if response:
-                        _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
-                                     _('debounce successfully applied to device.'))
+            if not dev_h.set_config(self.args.set_pin_config, self.args.current):
+                return False
+            _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
+                         _('pin configuration successfully applied to device.'))
+
+        # Set pins and debounce value with a single write to each device
+        if self.args.set_pin or self.args.set_debounce:
+            with dev_h.transaction() as tx:
+                for pin in self.args.set_pin or []:
+                    tx.set_pin(pin[0], pin[1], pin[2], pin[3].lower() in ['true', '1', 't', 'y'])
+                if self.args.set_debounce:
+                    tx.set_debounce(self.args.set_debounce)
+            if not tx.result:
+                return False
+            _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
+                         _('changes successfully applied to device.'))
 
         # LED configuration options
         # Set LED values with configuration file
         if self.args.set_led_config:
-            for dev in devices:
-                with dev as dev_h:
-                    response = dev_h.set_led_config(self.args.set_led_config)
-                    if response:
-                        _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
-                                     _('LED config successfully applied to device.'))
+            response = dev_h.set_led_config(self.args.set_led_config)
+            if response:
+                _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
+                             _('LED config successfully applied to device.'))
 
         # Set one LED
         if self.args.set_led:
-            for dev in devices:
-                with dev as dev_h:
-                    led = self.args.set_led[0]
-                    value = self.args.set_led[1]
+            led = self.args.set_led[0]
+            value = self.args.set_led[1]
 
-                    if not 1 <= led <= 96:
-                        _logger.info(f'LED {led} is not between 1 to 96')
-                        return -1
+            if not 1 <= led <= 96:
+                _logger.info(f'LED {led} is not between 1 to 96')
+                return False
 
-                    if not 0 <= value <= 255:
-                        _logger.info(f'LED value {value} is not between 0 to 255')
-                        return -1
+            if not 0 <= value <= 255:
+                _logger.info(f'LED value {value} is not between 0 to 255')
+                return False
 
-                    response = dev_h.set_led_intensity(led, value)
-                    if response:
-                        _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
-                                     _('LED successfully applied to device.'))
+            response = dev_h.set_led_intensity(led, value)
+            if response:
+                _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
+                             _('LED successfully applied to device.'))
 
         # Set all LEDs to one intensity
         if self.args.set_all_leds:
-            for dev in devices:
-                with dev as dev_h:
-                    value = self.args.set_all_leds
-                    if not 0 <= value <= 255:
-                        _logger.info(f'LED value {value} is not between 0 to 255')
-                        return -1
-
-                    response = dev_h.set_all_led_intensities(value)
-                    if response:
-                        _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
-                                     _('LED intensities successfully applied to device.'))
+            value = self.args.set_all_leds
+            if not 0 <= value <= 255:
+                _logger.info(f'LED value {value} is not between 0 to 255')
+                return False
+
+            response = dev_h.set_all_led_intensities(value)
+            if response:
+                _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
+                             _('LED intensities successfully applied to device.'))
 
         # Set fade rate for all LEDs
         if self.args.set_leds_fade_rate:
-            for dev in devices:
-                with dev as dev_h:
-                    value = self.args.set_leds_fade_rate
-                    if not 0 <= value <= 255:
-                        _logger.info(f'LED fade rate {value} is not between 0 to 255')
-                        return -1
-
-                    response = dev_h.set_led_fade_rate(self.args.set_leds_fade_rate)
-                    if response:
-                        _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
-                                     _('LED fade rate successfully applied to device.'))
+            value = self.args.set_leds_fade_rate
+            if not 0 <= value <= 255:
+                _logger.info(f'LED fade rate {value} is not between 0 to 255')
+                return False
+
+            response = dev_h.set_led_fade_rate(self.args.set_leds_fade_rate)
+            if response:
+                _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
+                             _('LED fade rate successfully applied to device.'))
 
         # Set LEDs to random state
         if self.args.set_leds_random_state:
-            for dev in devices:
-                with dev as dev_h:
-                    response = dev_h.set_led_random_state()
-                    if response:
-                        _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
-                                     _('LED random state successfully applied to device.'))
-        return 0
-
-
-def run():
+            response = dev_h.set_led_random_state()
+            if response:
+                _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
+                             _('LED random state successfully applied to device.'))
+
+        # Play an LED animation until it ends, the time limit is reached or ctrl-c is pressed.
+        if self.animation:
+            sequencer = dev_h.play_led_animation(self.animation)
+            try:
+                sequencer.join(self.args.animation_time)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                sequencer.stop()
+            if not sequencer.result:
+                return False
+            _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
+                         _('LED animation played') + f', {sequencer.frames_sent} ' + _('frames sent') +
+                         f', {sequencer.frames_dropped} ' + _('frames dropped.'))
+
+        return True
+
+
+def run(argv=None, stdout=None, stderr=None):
     # Set global debug value and setup application logging.
-    ToolContextManager.initialize_logging(tool_cmd)
-    parser = ToolContextManager.get_argparser(tool_cmd, tool_desc)
+    ToolContextManager.initialize_logging(tool_cmd, argv, stdout)
+    parser = ToolContextManager.get_argparser(tool_cmd, tool_desc, stdout, stderr)
     group = parser.add_argument_group()
 
     # TODO:  Setup additional program arguments here.
@@ -165,8 +175,8 @@ def run():
     group.add_argument('--set-pin-config', help=_('Set ultimate-io device pin config from config file'), type=str, default=None,
                        metavar='CONFIG-FILE')
     group.add_argument('--set-debounce', help=_('Set debounce value'), type=str, metavar='STR')
-    group.add_argument('--set-pin', help=_('Set single pin'), type=str,
-                       default=None, metavar=('PIN', 'ACTION', 'ALT_ACTION', 'IS_SHIFT'), nargs=4)
+    group.add_argument('--set-pin', help=_('Set a pin, may be repeated'), type=str,
+                       default=None, metavar=('PIN', 'ACTION', 'ALT_ACTION', 'IS_SHIFT'), nargs=4, action='append')
     group.add_argument('--set-led-config', help=_('Set ultimate-io device LEDs from config file'), type=str,
                        default=None,
                        metavar='CONFIG-FILE')
@@ -177,7 +187,13 @@ def run():
     group.add_argument('--set-leds-fade-rate', help=_('Set fade rade for all LEDs'), type=int, default=None,
                        metavar='INT[0-255]')
     group.add_argument('--set-leds-random-state', help=_('Set all LEDs to random states'), default=False, action='store_true')
-    args = parser.parse_args()
+    group.add_argument('--play-led-animation', help=_('Play an LED animation from an animation file'), type=str,
+                       default=None, metavar='ANIMATION-FILE')
+    group.add_argument('--animation-fps', help=_('Frames per second of the LED animation'), type=float,
+                       default=None, metavar='FPS')
+    group.add_argument('--animation-time', help=_('Stop the LED animation after this many seconds'), type=float,
+                       default=None, metavar='SECONDS')
+    args = parser.parse_args(argv)
 
     if not args.get_pin_config and args.indent:
         _logger.error(_('The --indent argument can only be used with the --get_pin_config argument '))
@@ -203,8 +219,22 @@ def run():
             _logger.error(_('Unable to find configuration file specified in argument.'))
             return -1
 
-    with ToolContextManager(tool_cmd, args) as tool_env:
-        process = UltimateIOClass(args, tool_env)
+    animation = None
+    if args.play_led_animation:
+        args.play_led_animation = ToolContextManager.clean_config_path(args.play_led_animation)
+        if not os.path.exists(args.play_led_animation):
+            _logger.error(_('Unable to find configuration file specified in argument.'))
+            return -1
+        animation = LEDAnimation.load(args.play_led_animation, args.animation_fps)
+        if not animation:
+            return -1
+    elif args.animation_fps or args.animation_time:
+        _logger.error(_('The --animation-fps and --animation-time arguments can only be used with the '
+                        '--play-led-animation argument'))
+        return -1
+
+    with ToolContextManager(tool_cmd, args, stdout, stderr) as tool_env:
+        process = UltimateIOClass(args, tool_env, animation)
         exit_code = process.run()
         return exit_code
 
@@ -10,9 +10,10 @@ import logging
 import os.path
 import sys
 
-from devices.ultrastik import UltraStikPre2015Device, UltraStikDevice, USTIK_RESOURCE_TYPES
 from ultimarc import translate_gettext as _
 from ultimarc.devices import DeviceClassID
+from ultimarc.devices._ultrastik_maps import UltraStikMapCache, default_map_cache, default_map_dirs
+from ultimarc.devices.ultrastik import UltraStikPre2015Device, UltraStikDevice, USTIK_RESOURCE_TYPES
 from ultimarc.tools import ToolContextManager, ToolEnvironmentObject
 
 
@@ -25,13 +26,15 @@ tool_desc = _('configure ultrastik 360 joysticks')
 
 
 class UltraStikTool(object):
-    def __init__(self, args, tool_env: ToolEnvironmentObject):
+    def __init__(self, args, tool_env: ToolEnvironmentObject, maps: UltraStikMapCache = None):
         """
         :param args: command line arguments.
         :param tool_env: tool environment information, see: gcp_initialize().
+        :param maps: UltraStikMapCache object used by --switch-map.
         """
         self.args = args
         self.tool_env = tool_env
+        self.maps = maps
 
     def run(self):
         """
@@ -46,6 +49,18 @@ class UltraStikTool(object):
             _logger.error(_('No UltraStik 360 joysticks found, aborting'))
             return -1
 
+        # Switch every joystick to a compiled map.
+        if self.args.switch_map:
+            def apply_map(device, dev_h: [UltraStikPre2015Device, UltraStikDevice]):
+                _logger.info(_(f'Switching {device.product_name} ({device.dev_key}) to map {self.args.switch_map}'))
+                return dev_h.switch_map(self.args.switch_map, self.maps)
+
+            if not self.tool_env.run_jobs(devices, apply_map):
+                _logger.info(_(f'Failed'))
+                return -1
+            _logger.info(_(f'Success'))
+            return 0
+
         if self.args.set_device_id:
             # Setup schema data
             config = {
@@ -89,46 +104,64 @@ class UltraStikTool(object):
 
         # Apply configuration to joystick.
         else:
-            # Loop through devices and apply config
-            for device in devices:
-                dev_h: [UltraStikPre2015Device, UltraStikDevice]
-                with (device as dev_h):
-                    # Load schema and validate config
-                    if not dev_h.validate_config(config, 'ultrastik-config.schema'):
-                        return -1
+            def apply_config(device, dev_h: [UltraStikPre2015Device, UltraStikDevice]):
+                # Load schema and validate config
+                if not dev_h.validate_config(config, 'ultrastik-config.schema'):
+                    return False
+
+                _logger.info(_(f'Updating {device.product_name} ({device.dev_key})'))
+                return dev_h.set_config(self.args.set_config)
 
-                    _logger.info(_(f'Updating {device.product_name} ({device.dev_key})'))
-                    dev_h.set_config(self.args.set_config)
+            # Apply config to all devices
+            if not self.tool_env.run_jobs(devices, apply_config):
+                _logger.info(_(f'Failed'))
+                return -1
 
             _logger.info(_(f'Success'))
             return 0
 
 
-def run():
+def run(argv=None, stdout=None, stderr=None):
     # Set global debug value and setup application logging.
-    ToolContextManager.initialize_logging(tool_cmd)
-    parser = ToolContextManager.get_argparser(tool_cmd, tool_desc)
+    ToolContextManager.initialize_logging(tool_cmd, argv, stdout)
+    parser = ToolContextManager.get_argparser(tool_cmd, tool_desc, stdout, stderr)
 
     parser.add_argument('--set-config', help=_('Set joystick config from config file.'), type=str, default=None,
                         metavar='CONFIG-FILE')
     parser.add_argument('--set-device-id', help=_('set joystick controller id'), type=int, choices=[1, 2, 3, 4],
                         default=None)
+    parser.add_argument('--switch-map', help=_('switch joysticks to a compiled map, see --list-maps'), type=str,
+                        default=None, metavar='MAP-NAME')
+    parser.add_argument('--list-maps', help=_('list the maps --switch-map accepts'), default=False,
+                        action='store_true')
+    parser.add_argument('--map-dir', help=_('extra map directory, searched before the default map directories'),
+                        type=str, default=None, metavar='PATH')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # Validate arguments
-    num_args = sum([bool(args.set_device_id), bool(args.set_config)])
+    num_args = sum([bool(args.set_device_id), bool(args.set_config), bool(args.switch_map), args.list_maps])
     if num_args == 0:
         _logger.warning(_('Nothing to do.'))
         return 0
+    if num_args > 1:
+        _logger.error(_('More than one mutually exclusive argument specified.'))
+        return -1
+
+    maps = UltraStikMapCache([os.path.abspath(args.map_dir)] + default_map_dirs()) if args.map_dir \
+        else default_map_cache()
+    if args.list_maps:
+        for name in maps.names():
+            print(name, file=stdout or sys.stdout)
+        return 0
 
     if args.set_config:
         args.set_config = os.path.abspath(args.set_config)
         if not os.path.exists(args.set_config):
             _logger.error(_(f'Configuration file not found ({args.set_config})'))
 
-    with ToolContextManager(tool_cmd, args) as tool_env:
-        process = UltraStikTool(args, tool_env)
+    with ToolContextManager(tool_cmd, args, stdout, stderr) as tool_env:
+        process = UltraStikTool(args, tool_env, maps)
         exit_code = process.run()
         return exit_code
 
@@ -6,6 +6,7 @@
 #
 import logging
 import os
+import queue
 import random
 import re
 import sys
@@ -50,61 +51,81 @@ class USBButtonClass(object):
             _logger.error(_('No USB button devices found, aborting'))
             return -1
 
+        return 0 if self.env.run_jobs(devices, self.run_device) else -1
+
+    def run_device(self, dev, dev_h):
+        """
+        Process the command line arguments for one device.
+        :param dev: USBDeviceInfo object.
+        :param dev_h: opened device handle.
+        :return: True if successful otherwise False.
+        """
         # See if we are setting a color from the command line args.
         if self.args.set_color:
             match = re.match(_RGB_STRING_REGEX, self.args.set_color)
             red, green, blue = match.groups()
-            for dev in devices:
-                with dev as dev_h:
-                    dev_h.set_color(int(red), int(green), int(blue))
-                    _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
-                                 _('Color') + f': RGB({red},{green},{blue}).')
+            dev_h.set_color(int(red), int(green), int(blue))
+            _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
+                         _('Color') + f': RGB({red},{green},{blue}).')
 
         # Return the current color RGB values.
         elif self.args.get_color:
-            for dev in devices:
-                with dev as dev_h:
-                    red, green, blue = dev_h.get_color()
-                    if red is not None:
-                        _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
-                                     _('Color') + f': RGB({red},{green},{blue}).')
+            red, green, blue = dev_h.get_color()
+            if red is None:
+                return False
+            _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
+                         _('Color') + f': RGB({red},{green},{blue}).')
 
         # Set a random RGB color.
         elif self.args.set_random_color:
-            for dev in devices:
-                red = random.randrange(255)
-                green = random.randrange(255)
-                blue = random.randrange(255)
-                with dev as dev_h:
-                    dev_h.set_color(red, green, blue)
-                _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
-                             _('randomly set button color to') + f' RGB({red},{green},{blue}).')
+            red = random.randrange(255)
+            green = random.randrange(255)
+            blue = random.randrange(255)
+            dev_h.set_color(red, green, blue)
+            _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
+                         _('randomly set button color to') + f' RGB({red},{green},{blue}).')
 
         # Apply a usb button config.
         elif self.args.set_config:
-            for dev in devices:
-                with dev as dev_h:
-                    application = ConfigApplication.temporary if self.args.temporary else ConfigApplication.permanent
-                    if dev_h.set_config(self.args.set_config, application):
-                        _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
-                                     _('configuration successfully applied to device.'))
-                    else:
-                        _logger.error(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
-                                      _('failed to apply configuration to device.'))
+            application = ConfigApplication.temporary if self.args.temporary else ConfigApplication.permanent
+            if not dev_h.set_config(self.args.set_config, application):
+                _logger.error(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
+                              _('failed to apply configuration to device.'))
+                return False
+            _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
+                         _('configuration successfully applied to device.'))
 
         elif self.args.get_config:
-            for dev in devices:
-                with dev as dev_h:
-                    indent = int(self.args.indent) if self.args.indent else None
-                    response = dev_h.get_device_config(indent, self.args.file)
-                    _logger.info(response)
-        return 0
+            indent = int(self.args.indent) if self.args.indent else None
+            response = dev_h.get_device_config(indent, self.args.file)
+            _logger.info(response)
+
+        # Output press and release events until ctrl-c is pressed.
+        elif self.args.watch:
+            events = queue.Queue()
+            watcher = dev_h.watch_state(queue=events)
+            if watcher is None:
+                return False
+            try:
+                while watcher.running:
+                    try:
+                        event = events.get(timeout=1.0)
+                    except queue.Empty:
+                        continue
+                    _logger.info(f'{dev.dev_key} ({dev.bus},{dev.address}): ' +
+                                 (_('pressed') if event.pressed else _('released')) + f' {event.timestamp:.6f}')
+            except KeyboardInterrupt:
+                pass
+            finally:
+                watcher.stop()
+
+        return True
 
 
-def run():
+def run(argv=None, stdout=None, stderr=None):
     # Set global debug value and setup application logging.
-    ToolContextManager.initialize_logging(tool_cmd)
-    parser = ToolContextManager.get_argparser(tool_cmd, tool_desc)
+    ToolContextManager.initialize_logging(tool_cmd, argv, stdout)
+    parser = ToolContextManager.get_argparser(tool_cmd, tool_desc, stdout, stderr)
 
     # --set-color --get-color --load-config --export-config
     parser.add_argument('--set-color', help=_('set usb button color with RGB value'), type=str, default=None,
@@ -123,10 +144,13 @@ def run():
                        default=None, metavar='FILE-NAME')
     parser.add_argument('--temporary', help=_('apply config until device unplugged.'), default=False,
                         action='store_true')
+    parser.add_argument('--watch', help=_('output button press and release events until ctrl-c is pressed'),
+                        default=False, action='store_true')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
-    num_args = sum([bool(args.set_color), args.set_random_color, args.get_color, bool(args.set_config), args.get_config])
+    num_args = sum([bool(args.set_color), args.set_random_color, args.get_color, bool(args.set_config), args.get_config,
+                    args.watch])
     if num_args == 0:
         _logger.warning(_('Nothing to do.'))
         return 0
@@ -158,7 +182,7 @@ def run():
         _logger.error(_('The --file argument can only be used with the --get_config argument '))
         return -1
 
-    with ToolContextManager(tool_cmd, args) as tool_env:
+    with ToolContextManager(tool_cmd, args, stdout, stderr) as tool_env:
         process = USBButtonClass(args, tool_env)
         exit_code = process.run()
         return exit_code
@@ -93,7 +93,7 @@ class JpacUI(Device):
                                                    address=self.args.address)]
                 for dev in devices:
                     with dev as dev_h:
-                        self.config = dev_h.to_json_str(dev_h.read_device())
+                        self.config = dev_h.to_json_str(dev_h.read_config())
             else:
                 self.config = {'schemaVersion': 2.0, 'resourceType': 'jpac-pins',
                                'deviceClass': self.device_class_id.value, 'debounce': 'standard',
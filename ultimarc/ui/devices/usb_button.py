@@ -114,7 +114,7 @@ class UsbButtonUI(Device):
                                                    address=self.args.address)]
                 for dev in devices:
                     with dev as dev_h:
-                        self.config = dev_h.create_json(dev_h.read_device())
+                        self.config = dev_h.create_json(dev_h.read_config())
             else:
                 self.config = {'schemaVersion': 2.0, 'resourceType': 'usb-button-config',
                                'deviceClass': self.device_class_id.value,